@@ -0,0 +1,1413 @@
+#!/usr/bin/env python3
+"""
+Kopico AI Benchmarks
+Microbenchmarks for the Kopico backend hot paths and load tests against a local server
+"""
+
+import os
+import gc
+import sys
+import csv
+import json
+import time
+import argparse
+import contextlib
+import random
+import signal
+import sqlite3
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+import http.client
+import multiprocessing
+
+from kopico_bot import KopicoAI, COFFEE_PRODUCTS, build_model
+from kopico_catalog import CoffeeCatalog
+from kopico_scoring import top_matches
+from kopico_retrieval import SimilarityIndexWriter
+from kopico_segments import SegmentStore, default_segment_root
+from kopico_facets import FacetIndex, CoffeeQuery
+from kopico_fuzzy import FuzzyIndex, edit_distance, max_edits
+from kopico_cooccurrence import CoOccurrence
+from kopico_eventlog import EventLog, read_events
+from kopico_analytics import RollingStats
+from start_kopico import bind_listener, start_server_process, wait_until_ready, stop_server
+
+ORIGINS = ["Ethiopia", "Colombia", "Brazil", "Guatemala", "Kenya", "Sumatra",
+           "Costa Rica", "Honduras", "Peru", "Rwanda", "Panama", "Yemen"]
+FLAVORS = ["floral", "citrus", "bright", "chocolate", "nuts", "caramel", "smoky",
+           "spicy", "berry", "honey", "earthy", "balanced", "smooth", "bold"]
+METHODS = ["espresso", "pour-over", "french-press", "aeropress", "cold-brew", "drip"]
+
+SAMPLE_MESSAGES = [
+    "Hello there!",
+    "Can you recommend a coffee for me?",
+    "How do I brew pour over coffee?",
+    "Tell me about Ethiopian Yirgacheffe",
+    "I like strong, nutty flavors",
+    "What does shipping cost?",
+    "Is the french press better than cold brew for this one?",
+    "Thanks, bye!",
+]
+
+
+def synthetic_products(count, seed=42):
+    """Generate a synthetic coffee catalog of the given size"""
+    rng = random.Random(seed)
+    products = []
+    for i in range(count):
+        origin = rng.choice(ORIGINS)
+        products.append({
+            "name": f"{origin} Lot {i:06d}",
+            "price": rng.randint(15, 45),
+            "description": f"Single origin from {origin} with {rng.choice(FLAVORS)} notes",
+            "origin": f"{origin} Estate {i:06d}",
+            "strength": rng.randint(1, 5),
+            "acidity": rng.randint(1, 5),
+            "flavor_profile": rng.sample(FLAVORS, 4),
+            "brewing_methods": rng.sample(METHODS, 3)
+        })
+    return products
+
+
+def build_bot(product_count=None):
+    """Create a KopicoAI instance, optionally with a synthetic catalog"""
+    bot = KopicoAI()
+    if product_count is not None:
+        bot.load_catalog(synthetic_products(product_count))
+    return bot
+
+
+def time_per_call(func, args_list, repeat=200):
+    """Return the mean time per call in microseconds"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for args in args_list:
+            func(*args)
+    elapsed = time.perf_counter() - start
+    return elapsed / (repeat * len(args_list)) * 1e6
+
+
+def legacy_detect_intent(bot, message):
+    """The original nested substring scan, kept as a reference point"""
+    message_lower = message.lower()
+
+    for intent, patterns in bot.intent_patterns.items():
+        for pattern in patterns:
+            if pattern in message_lower:
+                return intent
+
+    for coffee in bot.catalog:
+        if coffee.name.lower() in message_lower or coffee.origin.lower() in message_lower:
+            return "product"
+
+    for method in bot.brewing_methods.keys():
+        if method.replace('-', ' ') in message_lower or method.replace('-', '') in message_lower:
+            return "brewing"
+
+    return "default"
+
+
+def bench_intent(sizes=(None, 10000)):
+    """Compare per-message intent detection latency across catalog sizes"""
+    print("\n🧪 Intent detection (µs per message):")
+    args_list = [(message,) for message in SAMPLE_MESSAGES]
+
+    for size in sizes:
+        bot = build_bot(size)
+        label = f"{len(bot.catalog)} products"
+        repeat = 200 if size is None else 20
+
+        compiled = time_per_call(bot.detect_intent, args_list, repeat)
+        legacy = time_per_call(lambda message: legacy_detect_intent(bot, message), args_list, repeat)
+
+        print(f"   {label:>16}: matcher {compiled:8.1f}µs | substring scan {legacy:8.1f}µs "
+              f"| {bot.intent_matcher.size} phrases")
+
+
+def nltk_pipeline():
+    """
+    The NLTK preprocessing Kopico used to have: punkt word_tokenize, a stop
+    word filter and PorterStemmer. Returns (preprocess function, tokenizer
+    label); without the punkt data only the Treebank word tokenizer runs,
+    which is the part of word_tokenize that does most of the work.
+    """
+    from nltk.stem.porter import PorterStemmer
+    from nltk.tokenize import TreebankWordTokenizer, word_tokenize
+    from kopico_text import ENGLISH_STOP_WORDS
+
+    stemmer = PorterStemmer()
+    tokenize, label = word_tokenize, "punkt"
+    try:
+        word_tokenize("Is punkt installed?")
+    except LookupError:
+        tokenize, label = TreebankWordTokenizer().tokenize, "Treebank only, punkt data missing"
+
+    def preprocess(text):
+        return [stemmer.stem(token) for token in tokenize(text.lower())
+                if token not in ENGLISH_STOP_WORDS and token.isalpha()]
+    return preprocess, label
+
+
+def bench_text(count=2000):
+    """Compare the regex tokenizer and memoized stemmer with the NLTK pipeline"""
+    from kopico_text import clear_stem_cache, stem_cache_size, index_terms, index_terms_many
+
+    print("\n🧪 Text preprocessing (µs per message):")
+    messages = SAMPLE_MESSAGES + bulk_messages(count)
+    args_list = [(message,) for message in messages]
+
+    start = time.perf_counter()
+    nltk_preprocess, label = nltk_pipeline()
+    import_ms = (time.perf_counter() - start) * 1e3
+    nltk_us = time_per_call(nltk_preprocess, args_list, repeat=1)
+
+    # The first pass meets every word for the first time; later ones hit the stem memo
+    clear_stem_cache()
+    cold_us = time_per_call(index_terms, args_list, repeat=1)
+    warm_us = time_per_call(index_terms, args_list, repeat=5)
+    # A batch with repeats, as evaluation jobs send: each distinct message is processed once
+    batch = messages * 4
+    batch_us = time_per_call(index_terms_many, [(batch,)], repeat=5) / len(batch)
+
+    print(f"   NLTK ({label}): {nltk_us:8.1f}µs, plus {import_ms:.0f}ms to import")
+    print(f"   kopico_text: {cold_us:8.1f}µs cold memo | {warm_us:6.1f}µs warm | {batch_us:6.1f}µs batched "
+          f"| {stem_cache_size()} stems memoized")
+    return {"text.nltk_us": nltk_us, "text.cold_us": cold_us, "text.warm_us": warm_us, "text.batch_us": batch_us}
+
+
+def measure_allocated(build):
+    """Return (result, bytes allocated) for a zero-argument builder"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+def bench_catalog(sizes=(10000, 50000)):
+    """Compare memory per product and lookup latency: dict list vs CoffeeCatalog"""
+    print("\n🧪 Catalog memory and lookups:")
+
+    for size in sizes:
+        source = synthetic_products(size)
+        # Copy the dicts and their lists so both sides pay for their own containers
+        products, dict_bytes = measure_allocated(lambda: [
+            dict(product, flavor_profile=list(product["flavor_profile"]),
+                 brewing_methods=list(product["brewing_methods"]))
+            for product in source
+        ])
+        catalog, catalog_bytes = measure_allocated(lambda: CoffeeCatalog(source))
+        records, record_bytes = measure_allocated(lambda: CoffeeCatalog(source).records)
+
+        print(f"   {size} products:")
+        print(f"      memory/product: dicts {dict_bytes / size:6.0f}B | records {record_bytes / size:6.0f}B "
+              f"| records+indexes {catalog_bytes / size:6.0f}B")
+
+        lookups = [
+            ("method → products",
+             lambda: [p for p in products if "aeropress" in p["brewing_methods"]][:2],
+             lambda: catalog.ids_with_method("aeropress", limit=2)),
+            ("flavor → products",
+             lambda: [p for p in products if any(f in p["flavor_profile"] for f in ["floral", "citrus"])][:2],
+             lambda: catalog.ids_with_any_flavor(["floral", "citrus"], limit=2)),
+            ("strength >= 4",
+             lambda: [p for p in products if p["strength"] >= 4][:2],
+             lambda: catalog.ids_in_range("strength", low=4, limit=2)),
+            ("all for method",
+             lambda: [p for p in products if "aeropress" in p["brewing_methods"]],
+             lambda: catalog.ids_with_method("aeropress")),
+        ]
+        for label, scan, indexed in lookups:
+            scan_us = time_per_call(scan, [()], repeat=5)
+            index_us = time_per_call(indexed, [()], repeat=50)
+            print(f"      {label:>18}: linear scan {scan_us:10.1f}µs | index {index_us:8.1f}µs")
+
+
+def legacy_recommendations(catalog, preferences):
+    """The original per-product scoring loop with a full sort"""
+    recommendations = []
+    for coffee in catalog:
+        score = 0
+        if abs(coffee.strength - preferences['strength']) <= 1:
+            score += 2
+        if abs(coffee.acidity - preferences['acidity']) <= 1:
+            score += 2
+        recommendations.append({'coffee': coffee, 'score': score})
+    recommendations.sort(key=lambda x: x['score'], reverse=True)
+    return [rec['coffee'] for rec in recommendations[:3]]
+
+
+def bench_scoring(size=20000, profile_count=1000):
+    """Compare the scoring loop with vectorized single and batch scoring"""
+    print(f"\n🧪 Preference scoring ({size} products):")
+    rng = random.Random(7)
+    catalog = CoffeeCatalog(synthetic_products(size))
+    profiles = [{'strength': rng.randint(1, 5), 'acidity': rng.randint(1, 5)}
+                for _ in range(profile_count)]
+
+    sample = [(profile,) for profile in profiles[:20]]
+    loop_us = time_per_call(lambda profile: legacy_recommendations(catalog, profile), sample, repeat=1)
+    single_us = time_per_call(lambda profile: top_matches(catalog, [profile]), sample, repeat=5)
+    batch_us = time_per_call(lambda: top_matches(catalog, profiles), [()], repeat=1) / profile_count
+
+    print(f"   per profile: python loop {loop_us:10.1f}µs | vectorized {single_us:8.1f}µs "
+          f"| batch of {profile_count} {batch_us:8.1f}µs")
+
+
+def product_text(product):
+    """The text KopicoAI indexes for a product"""
+    return (f"{product['name']} {product['description']} {product['origin']} "
+            f"{' '.join(product['flavor_profile'])}").lower()
+
+
+def build_index(products):
+    """Build a published SimilarityIndex over a list of product dicts"""
+    writer = SimilarityIndexWriter()
+    for product_id, product in enumerate(products):
+        writer.upsert(product_id, product_text(product))
+    writer.compact()
+    return writer.publish()
+
+
+def bench_retrieval(sizes=(1000, 10000, 100000)):
+    """Compare a full-scan cosine similarity with the inverted index"""
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.metrics.pairwise import cosine_similarity
+    import numpy as np
+
+    print("\n🧪 Similarity retrieval (µs per query, top 3):")
+    queries = ["smoky and spicy", "bright citrus floral", "kenya honey", "something earthy",
+               "chocolate caramel nuts", "yemen berry"]
+
+    for size in sizes:
+        products = synthetic_products(size)
+        vectorizer = TfidfVectorizer(stop_words='english')
+        vectors = vectorizer.fit_transform([product_text(p) for p in products])
+        index = build_index(products)
+
+        def full_scan(query):
+            similarities = cosine_similarity(vectorizer.transform([query]), vectors)[0]
+            top = np.argsort(similarities)[-3:][::-1]
+            return [i for i in top if similarities[i] > 0.1]
+
+        args_list = [(query,) for query in queries]
+        scan_us = time_per_call(full_scan, args_list, repeat=3)
+        index_us = time_per_call(index.search, args_list, repeat=20)
+        print(f"   {size:>7} products: full scan {scan_us:10.1f}µs | inverted index {index_us:8.1f}µs")
+
+
+def legacy_filter(catalog, query):
+    """Filter and sort by scanning every record, as a reference point for the facet index"""
+    matches = []
+    for coffee in catalog:
+        values = {"origin": (coffee.origin,), "brewing_method": coffee.brewing_methods,
+                  "flavor": coffee.flavor_profile}
+        if any(not {value.lower() for value in values[facet]} & set(keys) for facet, keys in query.values.items()):
+            continue
+        if any((low is not None and getattr(coffee, field) < low) or (high is not None and getattr(coffee, field) > high)
+               for field, (low, high) in query.ranges.items()):
+            continue
+        matches.append(coffee)
+    if query.sort:
+        field = query.sort.lstrip("-")
+        matches.sort(key=lambda coffee: getattr(coffee, field), reverse=query.sort.startswith("-"))
+    return matches[:query.limit]
+
+
+def bench_facets(sizes=(10000, 100000)):
+    """Storefront filter queries: bitmap intersection with facet counts against a scan of the catalog"""
+    print("\n🧪 Faceted search (/coffees, µs per query incl. facet counts and a page of 20):")
+    queries = {
+        "no filter": CoffeeQuery(),
+        "origin + price, by price": CoffeeQuery({"origin": ["Kenya", "Ethiopia"]}, {"price": (20, 30)}, "price"),
+        "flavor + method + strength": CoffeeQuery({"flavor": ["honey"], "brewing_method": ["espresso"]},
+                                                  {"strength": (3, None)}, "-strength"),
+        "origin, by name": CoffeeQuery({"origin": ["Peru"]}, {}, "name"),
+    }
+    metrics = {}
+    for size in sizes:
+        products = synthetic_products(size)
+        for product in products:
+            # Storefronts facet on the country, not on one estate per product
+            product["origin"] = product["origin"].split(" Estate")[0]
+        catalog = CoffeeCatalog(products)
+        start = time.perf_counter()
+        facets = FacetIndex(catalog)
+        build_ms = (time.perf_counter() - start) * 1e3
+        print(f"   {size:>7} products: index built in {build_ms:.1f}ms")
+        for label, query in queries.items():
+            facets.search(query)
+            bitmap_us = best_time_per_call(facets.search, [(query,)])
+            scan_us = time_per_call(legacy_filter, [(catalog, query)], repeat=3)
+            print(f"   {label:>28}: bitmaps {bitmap_us:8.1f}µs | scan {scan_us:10.1f}µs (no facet counts)")
+            metrics[f"facets.{size}.{label.replace(' ', '_').replace(',', '')}_us"] = bitmap_us
+    return metrics
+
+
+def misspell(text, rng):
+    """text with one typo: a letter dropped, doubled, replaced, or swapped with the next"""
+    i = rng.choice([i for i in range(len(text) - 1) if text[i].isalpha() and text[i + 1].isalpha()])
+    typo = rng.choice(("drop", "double", "replace", "swap"))
+    if typo == "drop":
+        return text[:i] + text[i + 1:]
+    if typo == "double":
+        return text[:i] + text[i] + text[i:]
+    if typo == "replace":
+        return text[:i] + rng.choice([c for c in "aeioulnrst" if c != text[i]]) + text[i + 1:]
+    return text[:i] + text[i + 1] + text[i] + text[i + 2:]
+
+
+def legacy_closest(index, span):
+    """The key closest to a span by edit distance to every key, as a reference point for the trigram index"""
+    limit = max_edits(len(span))
+    best = None
+    for key in index.keys:
+        distance = edit_distance(span, key, limit)
+        if distance <= limit and (best is None or distance < best[0]):
+            best = (distance, key)
+    return best
+
+
+def bench_fuzzy(sizes=(10000, 100000), count=50):
+    """Typo-tolerant product lookup: trigram candidates checked by edit distance, against a scan of every key"""
+    print("\n🧪 Fuzzy product lookup (µs per message; found = the product meant):")
+    metrics = {}
+    for size in sizes:
+        products = synthetic_products(size)
+        for product in products:
+            # Lots are asked for by their country as well
+            product["aliases"] = [product["name"].split(" Lot")[0]]
+        catalog = CoffeeCatalog(products)
+        start = time.perf_counter()
+        index = FuzzyIndex(catalog)
+        build_ms = (time.perf_counter() - start) * 1e3
+        print(f"   {size:>7} products: {len(index)} keys indexed in {build_ms:.0f}ms")
+        
+        # Each message with a test of whether the product found is the one
+        # meant; None when no product should be found
+        rng = random.Random(21)
+        coffees = catalog.sample(count, rng)
+        countries = [coffee.name.split(" Lot")[0] for coffee in coffees]
+        cases = {
+            "misspelt name": [(f"tell me about the {misspell(coffee.name.lower(), rng)}",
+                               lambda found, coffee=coffee: found == coffee.id)
+                              for coffee in coffees],
+            "misspelt country": [(f"anything from {misspell(country.lower(), rng)}?",
+                                  lambda found, country=country: catalog[found].name.startswith(country))
+                                 for country in countries if len(country) >= 5],
+            "no product named": [(message, None) for message in (
+                "what are your opening hours on weekends", "my parcel arrived damaged, who do I contact")],
+        }
+        for label, messages in cases.items():
+            results = [index.lookup(message) for message, _ in messages]
+            right = sum(result is None if meant is None else result is not None and meant(result[0])
+                        for result, (_, meant) in zip(results, messages))
+            lookup_us = best_time_per_call(index.lookup, [(message,) for message, _ in messages], rounds=3)
+            print(f"   {label:>18}: {lookup_us:7.1f}µs | right {right}/{len(messages)}")
+            metrics[f"fuzzy.{size}.{label.replace(' ', '_')}_us"] = lookup_us
+        
+        span = misspell(coffees[0].name.lower(), rng)
+        scan_us = time_per_call(legacy_closest, [(index, span)], repeat=1)
+        print(f"   {'scan of every key':>18}: {scan_us:7.0f}µs for one name")
+    return metrics
+
+
+def purchase_events(products, count, seed=22):
+    """
+    Cart and order events over product keys whose popularity follows a
+    power law, as shops see: (kind, products, product added or None)
+    """
+    rng = random.Random(seed)
+    keys = [f"lot {i}" for i in range(products)]
+    weights = [1 / (rank + 1) ** 0.8 for rank in range(products)]
+    picks = iter(rng.choices(keys, weights, k=count * 4))
+    events = []
+    for _ in range(count):
+        if rng.random() < 0.7:
+            events.append(("cart", [next(picks) for _ in range(rng.randint(0, 3))], next(picks)))
+        else:
+            events.append(("order", [next(picks) for _ in range(rng.randint(2, 5))], None))
+    return keys, events
+
+
+def bench_also_bought(products=100000, count=1000000, reads=2000):
+    """Co-occurrence counts fed one event at a time, and neighbour reads as the events pile up"""
+    print(f"\n🧪 Also bought ({count} events over {products} products):")
+    keys, events = purchase_events(products, count)
+    matrix = CoOccurrence(refresh_interval=3600)
+    rng = random.Random(3)
+    popular, rare = keys[:100], keys[-1000:]
+
+    ingest_seconds = 0.0
+    # A tenth of the events, then the rest: reads should cost the same after both
+    for batch in (events[:count // 10], events[count // 10:]):
+        start = time.perf_counter()
+        for kind, basket, added in batch:
+            matrix.record(kind, basket, added)
+        ingest_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        refreshed = matrix.refresh()
+        refresh_ms = (time.perf_counter() - start) * 1e3
+        read_us = best_time_per_call(matrix.neighbors, [(rng.choice(popular),) for _ in range(reads)], rounds=3)
+        stats = matrix.stats()
+        print(f"   after {stats['events']:>8} events: {refreshed:>6} lists re-ranked in {refresh_ms:6.0f}ms | "
+              f"read {read_us:.2f}µs | {stats['pairs']} pairs")
+    print(f"   ingest: {count / ingest_seconds:,.0f} events/s ({ingest_seconds / count * 1e6:.1f}µs each)")
+
+    # Reads while another thread records events, as the server does
+    stop = threading.Event()
+    def feed():
+        while not stop.is_set():
+            for kind, basket, added in events[:10000]:
+                matrix.record(kind, basket, added)
+    writer = threading.Thread(target=feed, daemon=True)
+    writer.start()
+    try:
+        busy_us = best_time_per_call(matrix.neighbors, [(rng.choice(popular + rare),) for _ in range(reads)],
+                                     rounds=3)
+    finally:
+        stop.set()
+        writer.join()
+    print(f"   read while recording: {busy_us:.2f}µs")
+    return {
+        "also_bought.ingest_us": ingest_seconds / count * 1e6,
+        "also_bought.read_us": read_us,
+        "also_bought.busy_read_us": busy_us
+    }
+
+
+def bench_event_log(capacity=65536):
+    """Cost of logging a request event on the request path, against writing it there, and drops when the disk stalls"""
+    print(f"\n🧪 Event log ({capacity} event buffer):")
+    event = (time.time(), "/chat", 200, 4.21, "0f" * 16, ["Colombian Supremo", "Brazilian Santos"],
+             {"intent": "recommend"})
+    with tempfile.TemporaryDirectory(prefix="kopico-bench-") as directory:
+        log = EventLog(directory, capacity=capacity)
+        # Held so the writer cannot drain meanwhile: the first capacity
+        # events fill the buffer, the next as many are dropped
+        with log._write_lock:
+            start = time.perf_counter()
+            for _ in range(capacity):
+                log.emit(event)
+            emit_us = (time.perf_counter() - start) / capacity * 1e6
+            start = time.perf_counter()
+            for _ in range(capacity):
+                log.emit(event)
+            full_us = (time.perf_counter() - start) / capacity * 1e6
+        start = time.perf_counter()
+        log.close()
+        drain_seconds = time.perf_counter() - start
+        written = sum(1 for _ in read_events(directory))
+        print(f"   emit: {emit_us:.2f}µs per event | buffer full: {full_us:.2f}µs, "
+              f"{log.dropped} of {capacity} dropped")
+        print(f"   writer: {written / drain_seconds:,.0f} events/s | {written} read back | "
+              f"{log.bytes_written / max(1, log.written):.0f} bytes each")
+
+        # The naive way: serialize and append on the request path
+        path = os.path.join(directory, "inline.jsonl")
+        with open(path, "a", encoding="utf-8") as f:
+            inline_us = time_per_call(lambda: (f.write(EventLog._encode(event)), f.flush()), [()], repeat=20000)
+        print(f"   write inline: {inline_us:.2f}µs per event, and stalls whenever the disk does")
+    return {"event_log.emit_us": emit_us, "event_log.inline_us": inline_us}
+
+
+def bench_analytics(requests=1000000, minutes=60):
+    """Cost of counting a request and of polling the rolling-window aggregates, and their memory as traffic grows"""
+    print(f"\n🧪 Analytics ({requests} requests over {minutes} minutes):")
+    rng = random.Random(17)
+    names = [product["name"] for product in COFFEE_PRODUCTS]
+    endpoints = ["/chat", "/chat", "/chat", "/coffee-recommendations", "/brewing-guide/<method>"]
+    intents = ["recommend", "brewing", "product", "greeting", "default"]
+    traffic = [(rng.choice(endpoints), 500 if rng.random() < 0.01 else 200, rng.lognormvariate(1.5, 0.8),
+                rng.choice(intents), rng.sample(names, 3)) for _ in range(10000)]
+
+    now = [0.0]
+    step = minutes * 60 / requests
+    stats = RollingStats(minutes, clock=lambda: now[0])
+    start = time.perf_counter()
+    for i in range(requests):
+        endpoint, status, ms, intent, products = traffic[i % len(traffic)]
+        stats.record(endpoint, status, ms, intent, products)
+        now[0] += step
+    record_us = (time.perf_counter() - start) / requests * 1e6
+
+    # Memory once the window is full, and after as much traffic again
+    tracemalloc.start()
+    now[0] = 0.0
+    stats = RollingStats(minutes, clock=lambda: now[0])
+    memory = []
+    for _ in range(2):
+        for i in range(requests):
+            endpoint, status, ms, intent, products = traffic[i % len(traffic)]
+            stats.record(endpoint, status, ms, intent, products)
+            now[0] += step
+        memory.append(tracemalloc.get_traced_memory()[0])
+    tracemalloc.stop()
+
+    # Uncached: every poll summarizes the window
+    stats.max_age = 0
+    summary_us = time_per_call(stats.snapshot, [()], repeat=200)
+    stats.max_age = float("inf")
+    poll_us = time_per_call(stats.snapshot, [()], repeat=100000)
+    print(f"   record: {record_us:.2f}µs per request | summarize the window: {summary_us:.0f}µs | "
+          f"poll: {poll_us:.2f}µs")
+    print(f"   memory: {memory[0] / 1e3:.0f} KB after {requests:,} requests, "
+          f"{memory[1] / 1e3:.0f} KB after {2 * requests:,}")
+
+    # The naive way: keep every latency of the window and sort them per poll
+    latencies = [ms for _, _, ms, _, _ in traffic] * (requests // len(traffic))
+    start = time.perf_counter()
+    sorted(latencies)
+    naive_ms = (time.perf_counter() - start) * 1e3
+    print(f"   sorting the window's {len(latencies):,} latencies instead: {naive_ms:.0f}ms per poll, "
+          f"and memory growing with traffic")
+    return {"analytics.record_us": record_us, "analytics.poll_us": poll_us}
+
+
+def bench_updates(size=20000, changes=200):
+    """Time incremental catalog changes against rebuilding everything"""
+    print(f"\n🧪 Catalog updates ({size} products):")
+    bot = build_bot(size)
+    products = [coffee.to_dict() for coffee in bot.catalog]
+    names = [product["name"] for product in products]
+    rng = random.Random(11)
+    new_products = synthetic_products(size + changes, seed=5)[size:]
+
+    start = time.perf_counter()
+    bot.load_catalog(products)
+    rebuild_ms = (time.perf_counter() - start) * 1e3
+
+    operations = {
+        "price change": lambda i: bot.update_product(rng.choice(names), {"price": rng.randint(15, 45)}),
+        "text change": lambda i: bot.update_product(rng.choice(names), {"description": f"Smoky honey lot {i}"}),
+        "add": lambda i: bot.add_product(dict(new_products[i], name=f"New Lot {i}")),
+        "remove": lambda i: bot.remove_product(names.pop(rng.randrange(len(names)))),
+    }
+    print(f"   full rebuild: {rebuild_ms:10.1f}ms")
+    for label, operation in operations.items():
+        start = time.perf_counter()
+        for i in range(changes):
+            operation(i)
+        per_change_ms = (time.perf_counter() - start) * 1e3 / changes
+        print(f"   {label:>12}: {per_change_ms:10.2f}ms per change (published as a new version)")
+
+
+def write_feed(products, path):
+    """Write products as a JSONL, CSV, SQLite or (whole-file) JSON feed, by extension"""
+    if path.endswith(".json"):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(products, f)
+    elif path.endswith(".jsonl"):
+        with open(path, "w", encoding="utf-8") as f:
+            for product in products:
+                f.write(json.dumps(product) + "\n")
+    elif path.endswith(".csv"):
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(products[0]))
+            writer.writeheader()
+            for product in products:
+                writer.writerow(dict(product, flavor_profile="|".join(product["flavor_profile"]),
+                                     brewing_methods="|".join(product["brewing_methods"])))
+    else:
+        fields = list(products[0])
+        connection = sqlite3.connect(path)
+        connection.execute(f"CREATE TABLE products ({', '.join(fields)})")
+        connection.executemany(
+            f"INSERT INTO products VALUES ({', '.join('?' * len(fields))})",
+            ([json.dumps(value) if isinstance(value, list) else value for value in product.values()]
+             for product in products))
+        connection.commit()
+        connection.close()
+
+
+# Run in a fresh interpreter: load a feed into a KopicoAI, streamed from the
+# file or read whole with json.load, and report the time and peak memory
+INGEST_SCRIPT = """
+import sys, json, time, resource
+import kopico_bot
+from kopico_sources import CatalogSource
+start = time.perf_counter()
+if sys.argv[1].endswith('.json'):
+    with open(sys.argv[1], encoding='utf-8') as f:
+        bot = kopico_bot.KopicoAI(json.load(f))
+else:
+    bot = kopico_bot.KopicoAI(source=CatalogSource(sys.argv[1]))
+seconds = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({
+    'products': len(bot.catalog),
+    'seconds': seconds,
+    'rss_mb': rss / (1 << 20) if sys.platform == 'darwin' else rss / 1024
+}))
+"""
+
+# Run in a fresh interpreter: answer chat messages while the feed is reloaded
+# in the background, and report their latency with and without the reload
+RELOAD_SCRIPT = """
+import os, sys, json, time
+import kopico_bot
+from kopico_sources import CatalogSource
+bot = kopico_bot.KopicoAI(source=CatalogSource(sys.argv[1]))
+messages = json.loads(sys.argv[2])
+
+def serve(until):
+    latencies = []
+    i = 0
+    while not until():
+        start = time.perf_counter()
+        # Numbered so that every message misses the response cache
+        bot.process_message(f"{messages[i % len(messages)]} {i}")
+        latencies.append(time.perf_counter() - start)
+        i += 1
+    return sorted(latencies)
+
+deadline = time.perf_counter() + 5
+idle = serve(lambda: time.perf_counter() > deadline)
+os.utime(sys.argv[1])
+start = time.perf_counter()
+bot.reload_catalog()
+during = serve(lambda: not bot.reloading)
+reload_seconds = time.perf_counter() - start
+pick = lambda values, q: values[min(len(values) - 1, int(len(values) * q))] * 1e3
+print(json.dumps({
+    'version': bot.snapshot.version,
+    'reload_seconds': reload_seconds,
+    'idle': [pick(idle, 0.5), pick(idle, 0.99), idle[-1] * 1e3],
+    'reloading': [pick(during, 0.5), pick(during, 0.99), during[-1] * 1e3, len(during)]
+}))
+"""
+
+
+def run_script(script, *args):
+    """Run one of the scripts above in a new interpreter and return its JSON result"""
+    output = subprocess.run([sys.executable, "-c", script, *args], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def bench_ingest(size=300000):
+    """Load a supplier feed streamed from JSONL, CSV and SQLite against json.load, then reload it under traffic"""
+    print(f"\n🧪 Catalog ingestion ({size} products, fresh process: read, index, serve):")
+    products = synthetic_products(size)
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ("feed.json", "feed.jsonl", "feed.csv", "feed.db"):
+            path = os.path.join(directory, name)
+            write_feed(products, path)
+            label = "json.load + list" if name.endswith(".json") else f"streamed {name.split('.')[1]}"
+            result = run_script(INGEST_SCRIPT, path)
+            print(f"   {label:>16}: {result['seconds']:6.1f}s | peak RSS {result['rss_mb']:7.1f}MB "
+                  f"| {result['products']} products")
+        
+        del products
+        result = run_script(RELOAD_SCRIPT, os.path.join(directory, "feed.jsonl"), json.dumps(SAMPLE_MESSAGES))
+        print(f"   background reload took {result['reload_seconds']:.1f}s, now serving version {result['version']}")
+        for label, key in (("idle", "idle"), ("during reload", "reloading")):
+            p50, p99, worst = result[key][:3]
+            print(f"   chat latency {label:>13}: p50 {p50:6.2f}ms | p99 {p99:7.2f}ms | max {worst:7.2f}ms")
+
+
+def bulk_messages(count, seed=9):
+    """Distinct chat messages in roughly the mix an evaluation job sends"""
+    rng = random.Random(seed)
+    templates = ["Can you recommend something {0} and {1}?", "What coffee is good for {0} lovers",
+                 "How do I brew {2}?", "Tell me about {3}", "Hello, any {0} {1} coffee from {3}?"]
+    return [rng.choice(templates).format(rng.choice(FLAVORS), rng.choice(FLAVORS),
+                                         rng.choice(METHODS), rng.choice(ORIGINS)) + f" #{i}"
+            for i in range(count)]
+
+
+def bench_batch(sizes=(None, 10000), count=1000):
+    """Throughput of /chat one message at a time against /chat/batch"""
+    import kopico_bot
+
+    print(f"\n🧪 Bulk chat ({count} distinct messages, empty response cache):")
+    client = kopico_bot.app.test_client()
+    messages = bulk_messages(count)
+    for size in sizes:
+        label = "default catalog" if size is None else f"{size} products"
+        kopico_bot.kopico = bot = build_bot(size)
+
+        bot.response_cache.invalidate()
+        start = time.perf_counter()
+        for message in messages:
+            client.post('/chat', json={'message': message})
+        single = count / (time.perf_counter() - start)
+
+        bot.response_cache.invalidate()
+        start = time.perf_counter()
+        client.post('/chat/batch', json={'messages': [{'message': message} for message in messages]})
+        batch = count / (time.perf_counter() - start)
+        print(f"   {label:>16}: /chat {single:9.0f} msg/s | /chat/batch {batch:9.0f} msg/s "
+              f"({batch / single:.1f}x)")
+
+
+# Run in a fresh interpreter: import the server, boot it, answer one chat message
+STARTUP_SCRIPT = """
+import sys, json, time, resource
+start = time.perf_counter()
+import kopico_bot
+imported = time.perf_counter()
+products = None
+if len(sys.argv) > 2:
+    from bench_kopico import synthetic_products
+    products = synthetic_products(int(sys.argv[2]))
+ready = time.perf_counter()
+kopico_bot.kopico = kopico_bot.KopicoAI(products, model_path=sys.argv[1] or None)
+response = kopico_bot.app.test_client().post('/chat', json={'message': 'Recommend something earthy'})
+done = time.perf_counter()
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({
+    'status': response.status_code,
+    'import_ms': (imported - start) * 1e3,
+    'first_response_ms': (imported - start + done - ready) * 1e3,
+    'rss_mb': rss / (1 << 20) if sys.platform == 'darwin' else rss / 1024
+}))
+"""
+
+
+def measure_startup(model_path, product_count=None):
+    """Start a new interpreter and return its startup measurements"""
+    args = [sys.executable, "-c", STARTUP_SCRIPT, model_path or ""]
+    if product_count is not None:
+        args.append(str(product_count))
+    output = subprocess.run(args, capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def bench_startup(sizes=(None, 20000)):
+    """Cold start with a prebuilt model against fitting the index at boot"""
+    print("\n🧪 Startup (fresh process: import, boot, first /chat response):")
+    for size in sizes:
+        label = "default catalog" if size is None else f"{size} products"
+        with tempfile.TemporaryDirectory() as directory:
+            model_path = os.path.join(directory, "kopico_model")
+            build_model(COFFEE_PRODUCTS if size is None else synthetic_products(size), model_path)
+            for mode, path in (("fit at boot", None), ("prebuilt", model_path)):
+                result = measure_startup(path, size)
+                print(f"   {label:>16} {mode:>11}: import {result['import_ms']:7.1f}ms | "
+                      f"first response {result['first_response_ms']:8.1f}ms | RSS {result['rss_mb']:6.1f}MB")
+
+
+# Run in a fresh interpreter: load the model, warm up if told to, then time
+# the first request to each path. The messages differ from the warmup's, so
+# what is measured is warm code paths, not only cached replies
+FIRST_REQUESTS_SCRIPT = """
+import sys, json, time
+import kopico_bot
+kopico_bot.get_kopico()
+warmup = kopico_bot.warm_up() if sys.argv[1] == 'warm' else None
+client = kopico_bot.app.test_client()
+timings = {}
+for label, method, path, body in json.loads(sys.argv[2]):
+    start = time.perf_counter()
+    client.open(path, method=method, json=body).get_data()
+    timings[label] = (time.perf_counter() - start) * 1e3
+print(json.dumps({'warmup': warmup, 'timings': timings}))
+"""
+
+FIRST_REQUESTS = [
+    ("chat recommend", "POST", "/chat", {"message": "Which coffee would you suggest for a fruity morning cup?"}),
+    ("chat brewing", "POST", "/chat", {"message": "What grind should I use for a french press?"}),
+    ("chat product", "POST", "/chat", {"message": "What is the price of Brazilian Santos?"}),
+    ("chat stream", "POST", "/chat/stream", {"message": "Suggest something with low acidity"}),
+    ("recommendations", "POST", "/coffee-recommendations", {"preferences": {"strength": 2, "acidity": 4}}),
+    ("coffees", "GET", "/coffees?origin=Brazil&sort=-price", None),
+    ("lookup", "GET", "/coffees/lookup?q=yirgachefe", None),
+    ("brewing guide", "GET", "/brewing-guide/aeropress", None),
+]
+
+
+def _restart_under_load(port, rolling, threads=4, settle=2.0):
+    """
+    Errors and worst latency of /chat traffic across one server restart.
+    rolling starts the new server before stopping the old one, on the
+    shared socket; otherwise the old one is stopped and its port closed
+    first, the way a server that binds its own port restarts.
+    """
+    listener = bind_listener('127.0.0.1', port)
+    url = f"http://127.0.0.1:{port}"
+    quiet = {"stdout": subprocess.DEVNULL, "stderr": subprocess.DEVNULL}
+    server = start_server_process(listener, **quiet)
+    if not wait_until_ready(url, server):
+        raise RuntimeError(f"Kopico server did not start on port {port}")
+    stop = threading.Event()
+    latencies, errors = [], []
+
+    def run(seed):
+        rng = random.Random(seed)
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                connection.request('POST', '/chat', json.dumps({"message": rng.choice(SAMPLE_MESSAGES)}),
+                                   {'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                response.read()
+                connection.close()
+                if response.status != 200:
+                    errors.append(response.status)
+            except (OSError, http.client.HTTPException) as e:
+                errors.append(type(e).__name__)
+                time.sleep(0.01)
+            latencies.append(time.perf_counter() - start)
+
+    clients = [threading.Thread(target=run, args=(seed,)) for seed in range(threads)]
+    for client in clients:
+        client.start()
+    time.sleep(settle)
+    start = time.perf_counter()
+    if rolling:
+        new = start_server_process(listener, **quiet)
+        ready = wait_until_ready(url, new, pid=new.pid)
+        stop_server(server)
+    else:
+        stop_server(server)
+        listener.close()
+        listener = bind_listener('127.0.0.1', port)
+        new = start_server_process(listener, **quiet)
+        ready = wait_until_ready(url, new)
+    restart_s = time.perf_counter() - start
+    time.sleep(settle)
+    stop.set()
+    for client in clients:
+        client.join()
+    stop_server(new)
+    listener.close()
+    if not ready:
+        raise RuntimeError("The new Kopico server did not become ready")
+    return {"requests": len(latencies), "errors": len(errors), "max_ms": max(latencies) * 1e3,
+            "restart_s": restart_s}
+
+
+def bench_restart(port=5097):
+    """First requests after a start with and without warmup, and requests lost to a restart"""
+    print("\n🧪 Restart (fresh process: first request to each path, cold and after warmup):")
+    results = {}
+    for mode in ("cold", "warm"):
+        output = subprocess.run([sys.executable, "-c", FIRST_REQUESTS_SCRIPT, mode, json.dumps(FIRST_REQUESTS)],
+                                capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        results[mode] = json.loads(output.strip().splitlines()[-1])
+    for label, _, _, _ in FIRST_REQUESTS:
+        print(f"   {label:>16}: cold {results['cold']['timings'][label]:7.2f}ms | "
+              f"warmed {results['warm']['timings'][label]:7.2f}ms")
+    cold_ms = sum(results['cold']['timings'].values())
+    warm_ms = sum(results['warm']['timings'].values())
+    warmup = results['warm']['warmup']
+    print(f"   {'all':>16}: cold {cold_ms:7.2f}ms | warmed {warm_ms:7.2f}ms "
+          f"(warmup: {warmup['requests']} requests in {warmup['seconds'] * 1e3:.0f}ms)")
+
+    print("   restart under /chat load (4 clients):")
+    for label, rolling in (("stop, then start", False), ("rolling", True)):
+        stats = _restart_under_load(port, rolling)
+        print(f"   {label:>16}: {stats['errors']} of {stats['requests']} requests failed | "
+              f"slowest {stats['max_ms']:.0f}ms | restart took {stats['restart_s']:.2f}s")
+    return {"restart.first_requests_cold_ms": cold_ms, "restart.first_requests_warm_ms": warm_ms}
+
+
+# Mixed traffic for load tests as (endpoint, method, path, JSON body); chat dominates
+LOAD_REQUESTS = [("/chat", "POST", "/chat", {"message": message}) for message in SAMPLE_MESSAGES] + [
+    ("/chat/batch", "POST", "/chat/batch", {"messages": [{"message": message} for message in SAMPLE_MESSAGES]}),
+    ("/coffee-recommendations", "POST", "/coffee-recommendations",
+     {"preferences": {"strength": "strong", "acidity": "low"}}),
+    ("/brewing-guide", "GET", "/brewing-guide/pour-over", None),
+    ("/health", "GET", "/health", None),
+]
+
+
+def _client_process(host, port, threads, duration, requests):
+    """One load generator process: threads cycling through requests over keep-alive connections"""
+    latencies = {endpoint: [] for endpoint, _, _, _ in requests}
+    errors = {endpoint: 0 for endpoint, _, _, _ in requests}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def run(offset):
+        connection = http.client.HTTPConnection(host, port, timeout=30)
+        timings = []
+        failures = []
+        i = offset
+        while time.perf_counter() < deadline:
+            endpoint, method, path, body = requests[i % len(requests)]
+            i += 1
+            start = time.perf_counter()
+            try:
+                if body is None:
+                    connection.request(method, path)
+                else:
+                    connection.request(method, path, json.dumps(body), {'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    failures.append(endpoint)
+                    continue
+            except (OSError, http.client.HTTPException):
+                failures.append(endpoint)
+                connection.close()
+                connection = http.client.HTTPConnection(host, port, timeout=30)
+                continue
+            timings.append((endpoint, time.perf_counter() - start))
+        connection.close()
+
+        with lock:
+            for endpoint, latency in timings:
+                latencies[endpoint].append(latency)
+            for endpoint in failures:
+                errors[endpoint] += 1
+
+    workers = [threading.Thread(target=run, args=(offset * 7,)) for offset in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return latencies, errors
+
+
+def load_test(host, port, duration=10, processes=4, threads=8, requests=LOAD_REQUESTS):
+    """
+    Drive a running server from several client processes.
+
+    Returns {endpoint: {requests, rps, p50_ms, p95_ms, p99_ms, errors}}.
+    """
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.starmap(_client_process, [(host, port, threads, duration, requests)] * processes)
+
+    report = {}
+    for endpoint in dict.fromkeys(endpoint for endpoint, _, _, _ in requests):
+        latencies = sorted(latency for process_latencies, _ in results for latency in process_latencies[endpoint])
+        errors = sum(process_errors[endpoint] for _, process_errors in results)
+
+        def percentile(fraction):
+            if not latencies:
+                return float('nan')
+            return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1e3
+
+        report[endpoint] = {
+            'requests': len(latencies),
+            'rps': len(latencies) / duration,
+            'p50_ms': percentile(0.50),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'errors': errors
+        }
+    return report
+
+
+def wait_until_healthy(port, timeout=60):
+    """Poll /health/ready until the server is warmed up and ready, or the timeout passes"""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            connection.request('GET', '/health/ready')
+            if connection.getresponse().status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+@contextlib.contextmanager
+def running_server(port, workers=1, threads=4, admission=False, env=None):
+    """
+    Start the production launcher on a local port for the duration of a block.
+
+    Admission control is off unless asked for, so throughput tests measure
+    the server rather than its limits.
+    """
+    launcher = os.path.join(os.path.dirname(os.path.abspath(__file__)), "start_kopico.py")
+    server_env = dict(os.environ, KOPICO_ADMISSION='1' if admission else '0', **(env or {}))
+    server = subprocess.Popen(
+        [sys.executable, launcher, "--production", "--skip-setup", "--host", "127.0.0.1",
+         "--port", str(port), "--workers", str(workers), "--threads", str(threads)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=server_env
+    )
+    try:
+        if not wait_until_healthy(port):
+            raise RuntimeError(f"Kopico server did not start on port {port}")
+        yield
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=60)
+
+
+def bench_serving(workers=(1, 4, 16), threads=4, duration=10, port=5099):
+    """Requests/s and latency of the production launcher at several worker counts"""
+    print(f"\n🧪 Production serving (POST /chat, {duration}s per run, {os.cpu_count()} CPUs):")
+    chat_requests = [request for request in LOAD_REQUESTS if request[0] == "/chat"]
+    for count in workers:
+        with running_server(port, count, threads):
+            stats = load_test('127.0.0.1', port, duration, requests=chat_requests)["/chat"]
+        print(f"   {count:>3} workers x {threads} threads: {stats['rps']:8.0f} req/s | "
+              f"p50 {stats['p50_ms']:7.2f}ms | p99 {stats['p99_ms']:7.2f}ms | errors {stats['errors']}")
+
+
+def bench_load(duration=5, workers=2, threads=4, port=5098):
+    """Mixed traffic against a local server: throughput and latency percentiles per endpoint"""
+    print(f"\n🧪 Load test ({workers} workers x {threads} threads, {duration}s of mixed traffic):")
+    with running_server(port, workers, threads):
+        report = load_test('127.0.0.1', port, duration)
+
+    metrics = {}
+    for endpoint, stats in report.items():
+        print(f"   {endpoint:>24}: {stats['rps']:8.0f} req/s | p50 {stats['p50_ms']:7.2f}ms | "
+              f"p95 {stats['p95_ms']:7.2f}ms | p99 {stats['p99_ms']:7.2f}ms | errors {stats['errors']}")
+        for stat in ('rps', 'p50_ms', 'p95_ms', 'p99_ms', 'errors'):
+            metrics[f"load.{endpoint}.{stat}"] = stats[stat]
+    return metrics
+
+
+def _open_loop_process(host, port, rate, duration, connections, requests, seed):
+    """
+    One open-loop load generator: requests are sent on a Poisson schedule
+    whatever the server's pace, and latency counts from the scheduled time,
+    so time spent waiting for a free connection shows up as latency rather
+    than as a lower request rate.
+    """
+    rng = random.Random(seed)
+    start = time.perf_counter() + 0.2
+    schedule = []
+    moment = start
+    while moment < start + duration:
+        moment += rng.expovariate(rate)
+        schedule.append(moment)
+    schedule = iter(schedule)
+    lock = threading.Lock()
+    results = []
+
+    def run():
+        connection = http.client.HTTPConnection(host, port, timeout=30)
+        done = []
+        while True:
+            with lock:
+                scheduled = next(schedule, None)
+            if scheduled is None:
+                break
+            endpoint, method, path, body = requests[rng.randrange(len(requests))]
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                if body is None:
+                    connection.request(method, path)
+                else:
+                    connection.request(method, path, json.dumps(body), {'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                status = 0
+                connection.close()
+                connection = http.client.HTTPConnection(host, port, timeout=30)
+            done.append((endpoint, status, time.perf_counter() - scheduled))
+        connection.close()
+        with lock:
+            results.extend(done)
+
+    workers = [threading.Thread(target=run) for _ in range(connections)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
+
+
+def open_loop_test(host, port, rate, duration=5, processes=4, connections=32, requests=LOAD_REQUESTS):
+    """
+    Offer rate requests/s for duration seconds, whatever the server's pace.
+
+    Returns {endpoint: {served, shed, errors, p50_ms, p99_ms}}, with the
+    percentiles over served (200) requests.
+    """
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.starmap(_open_loop_process, [(host, port, rate / processes, duration, connections,
+                                                     requests, seed) for seed in range(processes)])
+
+    report = {}
+    for endpoint in dict.fromkeys(endpoint for endpoint, _, _, _ in requests):
+        outcomes = [(status, latency) for process_results in results
+                    for name, status, latency in process_results if name == endpoint]
+        latencies = sorted(latency for status, latency in outcomes if status == 200)
+
+        def percentile(fraction):
+            if not latencies:
+                return float('nan')
+            return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1e3
+
+        report[endpoint] = {
+            'served': len(latencies),
+            'shed': sum(1 for status, _ in outcomes if status in (429, 503)),
+            'errors': sum(1 for status, _ in outcomes if status not in (200, 429, 503)),
+            'p50_ms': percentile(0.50),
+            'p99_ms': percentile(0.99)
+        }
+    return report
+
+
+def bench_overload(duration=5, workers=1, threads=4, port=5097, users=100, batch_size=100):
+    """
+    Latency under twice the load the server can take, with and without admission control.
+
+    Capacity is measured first with a closed-loop test. Then requests are
+    offered at half and at twice that rate: without admission control the
+    excess queues and every request waits behind it; with it the excess is
+    refused at once and served requests keep close to their normal latency.
+    Requests are batches of distinct messages with the response cache off,
+    so the server rather than the load generator is what runs out of CPU.
+    Health checks ride along to show they stay fast either way.
+    """
+    print(f"\n🧪 Overload ({workers} workers x {threads} threads, {duration}s per run, {os.cpu_count()} CPUs):")
+    messages = bulk_messages(users * batch_size)
+    batches = [("/chat/batch", "POST", "/chat/batch", {
+        "user_id": f"user-{i}",
+        "messages": [{"message": message} for message in messages[i * batch_size:(i + 1) * batch_size]]
+    }) for i in range(users)]
+    mixed = batches + [("/health", "GET", "/health", None)] * max(1, users // 20)
+    # Every request comes from this host, so only per-user limits and the in-flight cap apply
+    env = {'KOPICO_RESPONSE_CACHE_SIZE': '0', 'KOPICO_ADDRESS_RATE': '0'}
+
+    with running_server(port, workers, threads, env=env):
+        capacity = load_test('127.0.0.1', port, duration, processes=2, threads=4, requests=batches)["/chat/batch"]['rps']
+    print(f"   capacity: {capacity:8.0f} batches/s (closed loop, {batch_size} messages each)")
+
+    metrics = {'overload.capacity_rps': capacity}
+    for label, load, admission in (("0.5x", 0.5, True), ("2x, no admission", 2, False), ("2x, admission", 2, True)):
+        with running_server(port, workers, threads, admission=admission, env=env):
+            report = open_loop_test('127.0.0.1', port, capacity * load, duration, processes=2, connections=16,
+                                    requests=mixed)
+        stats, health = report["/chat/batch"], report["/health"]
+        offered = stats['served'] + stats['shed'] + stats['errors']
+        print(f"   {label:>17}: batch p50 {stats['p50_ms']:8.2f}ms | p99 {stats['p99_ms']:8.2f}ms | "
+              f"shed {stats['shed'] / max(1, offered):4.0%} | errors {stats['errors']} | "
+              f"health p99 {health['p99_ms']:8.2f}ms")
+        key = label.replace(", ", "_").replace(" ", "_")
+        metrics[f"overload.{key}.p99_ms"] = stats['p99_ms']
+        metrics[f"overload.{key}.health_p99_ms"] = health['p99_ms']
+    return metrics
+
+
+def process_memory(pid):
+    """RSS, PSS and private memory of a process in MB, from /proc/<pid>/smaps_rollup"""
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup", encoding="ascii") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[1].isdigit():
+                fields[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    return {"rss": fields["Rss"], "pss": fields["Pss"],
+            "private": fields["Private_Clean"] + fields["Private_Dirty"]}
+
+
+def bench_memory(size=50000, workers=3, messages=300):
+    """
+    Memory of forked workers after a catalog change, with and without shared segments.
+
+    Workers are forked from a loaded bot the way the production launcher
+    forks them, serve some chat traffic and then see a change to a fifth
+    of the catalog. Without segments each worker applies the change itself
+    and ends up with a private copy of the rebuilt index; with them one
+    worker applies it and the others map the version it published.
+    Private memory is what a worker does not share with any other process.
+    """
+    if not os.path.exists("/proc/self/smaps_rollup") or not hasattr(os, "fork"):
+        print("\n⚠️  The memory benchmark needs Linux (fork and /proc/<pid>/smaps_rollup)")
+        return {}
+    print(f"\n🧪 Worker memory ({size} products, {workers} workers, change to {size // 5} products):")
+    products = synthetic_products(size)
+    upserts = [(product["name"], {"description": product["description"] + " and honey"})
+               for product in products[:size // 5]]
+    traffic = bulk_messages(messages)
+
+    metrics = {}
+    for shared in (False, True):
+        store = SegmentStore(default_segment_root(f"kopico-bench-{os.getpid()}")) if shared else None
+        bot = KopicoAI(products=products, segments=store)
+        gc.collect()
+        gc.freeze()
+        children = []
+        try:
+            for i in range(workers):
+                ready, done = os.pipe()
+                pid = os.fork()
+                if pid == 0:
+                    os.close(ready)
+                    if shared and i > 0:
+                        bot.sync_segments(force=True)
+                    else:
+                        bot.apply_catalog_changes(upserts=upserts)
+                    bot.process_messages(traffic)
+                    gc.collect()
+                    os.write(done, b"1")
+                    time.sleep(600)
+                    os._exit(0)
+                os.close(done)
+                os.read(ready, 1)
+                os.close(ready)
+                children.append(pid)
+            usage = [process_memory(pid) for pid in children]
+        finally:
+            for pid in children:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            gc.unfreeze()
+            if store is not None:
+                store.remove()
+
+        label = "shared segments" if shared else "private copies"
+        key = "shared" if shared else "private"
+        others = sum(entry["private"] for entry in usage[1:]) / (workers - 1)
+        print(f"   {label:>15}: {usage[0]['private']:7.1f}MB private in the worker that made the change | "
+              f"{others:7.1f}MB in each other worker | {sum(entry['pss'] for entry in usage):7.1f}MB PSS in all")
+        metrics[f"memory.{key}.changed_private_mb"] = usage[0]["private"]
+        metrics[f"memory.{key}.other_private_mb"] = others
+    return metrics
+
+
+def best_time_per_call(func, args_list, min_time=0.1, rounds=5):
+    """Microseconds per call, the best of several rounds of at least min_time each"""
+    repeat = 1
+    while True:
+        elapsed = time_per_call(func, args_list, repeat) * repeat * len(args_list) / 1e6
+        if elapsed >= min_time:
+            break
+        repeat *= 2
+    return min([time_per_call(func, args_list, repeat) for _ in range(rounds)])
+
+
+def bench_micro(sizes=(None, 1000, 10000)):
+    """Per-call cost of the chat building blocks at several catalog sizes"""
+    print("\n🧪 Microbenchmarks (µs per call, best of 5):")
+    metrics = {}
+    for size in sizes:
+        bot = build_bot(size)
+        label = "default" if size is None else str(size)
+        names = [coffee.name for coffee in list(bot.catalog)[:3]]
+        cases = {
+            "detect_intent": (bot.detect_intent, SAMPLE_MESSAGES),
+            "find_similar_coffee": (bot.find_similar_coffee,
+                                    ["smoky and spicy", "bright citrus floral", "kenya honey", "something earthy"]),
+            "recommend_coffee": (bot.recommend_coffee,
+                                 ["recommend something strong", "a mild one please", "fruity coffee",
+                                  "recommend something with honey and berry notes"]),
+            "provide_brewing_tips": (bot.provide_brewing_tips,
+                                     ["how to brew espresso", "pour over guide", "french press tips", "how do i brew?"]),
+            "get_product_info": (bot.get_product_info,
+                                 [f"tell me about {name.lower()}" for name in names] + ["what is the price"]),
+        }
+        results = {name: best_time_per_call(func, [(message,) for message in messages])
+                   for name, (func, messages) in cases.items()}
+        print(f"   {label:>8} catalog: " + " | ".join(f"{name} {us:.1f}" for name, us in results.items()))
+        for name, us in results.items():
+            metrics[f"micro.{name}.{label}_us"] = us
+    return metrics
+
+
+def compare_to_baseline(metrics, baseline, tolerance):
+    """
+    Return descriptions of metrics that got worse than the baseline by more than tolerance.
+
+    Throughput (rps) must not drop, error counts must not grow, and every
+    other metric is a time that must not rise.
+    """
+    regressions = []
+    for key, value in sorted(metrics.items()):
+        old = baseline.get(key)
+        if old is None or value != value:
+            continue
+        if key.endswith(".rps"):
+            worse = value < old * (1 - tolerance)
+        elif key.endswith(".errors"):
+            worse = value > old
+        else:
+            worse = value > old * (1 + tolerance)
+        if worse:
+            regressions.append(f"{key}: {old:.2f} -> {value:.2f}")
+    return regressions
+
+
+BENCHMARKS = {
+    "intent": bench_intent,
+    "text": bench_text,
+    "catalog": bench_catalog,
+    "scoring": bench_scoring,
+    "retrieval": bench_retrieval,
+    "facets": bench_facets,
+    "fuzzy": bench_fuzzy,
+    "also_bought": bench_also_bought,
+    "event_log": bench_event_log,
+    "analytics": bench_analytics,
+    "updates": bench_updates,
+    "ingest": bench_ingest,
+    "startup": bench_startup,
+    "restart": bench_restart,
+    "batch": bench_batch,
+    "serving": bench_serving,
+    "micro": bench_micro,
+    "load": bench_load,
+    "overload": bench_overload,
+    "memory": bench_memory,
+}
+
+
+def parse_args(argv=None):
+    """Command line options for the benchmark runner"""
+    parser = argparse.ArgumentParser(description="Run Kopico benchmarks")
+    parser.add_argument('benchmarks', nargs='*', help=f"benchmarks to run (default: all of {', '.join(BENCHMARKS)})")
+    parser.add_argument('--sizes', default="default,1000,10000",
+                        help="catalog sizes for the micro benchmark; 'default' is the built-in catalog")
+    parser.add_argument('--duration', type=float, default=5, help="seconds of traffic for the load benchmark")
+    parser.add_argument('--workers', type=int, default=2, help="server workers for the load benchmark")
+    parser.add_argument('--json', help="write the collected metrics to this file")
+    parser.add_argument('--baseline', help="fail if a metric is worse than in this results file")
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help="allowed relative slowdown against the baseline (default: 0.5)")
+    return parser.parse_args(argv)
+
+
+def main():
+    """Run the selected benchmarks (all of them by default)"""
+    args = parse_args()
+    print("🤖 Kopico AI Benchmarks")
+    print("=" * 40)
+
+    sizes = tuple(None if size == "default" else int(size) for size in args.sizes.split(","))
+    options = {
+        "micro": {"sizes": sizes},
+        "load": {"duration": args.duration, "workers": args.workers},
+        "overload": {"duration": args.duration},
+    }
+
+    metrics = {}
+    for name in args.benchmarks or list(BENCHMARKS):
+        if name not in BENCHMARKS:
+            print(f"❌ Unknown benchmark: {name} (available: {', '.join(BENCHMARKS)})")
+            continue
+        metrics.update(BENCHMARKS[name](**options.get(name, {})) or {})
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"metrics": {key: round(value, 3) for key, value in metrics.items()},
+                       "cpus": os.cpu_count(), "python": sys.version.split()[0]},
+                      f, indent=2, sort_keys=True)
+        print(f"\n📝 Results written to {args.json}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["metrics"]
+        regressions = compare_to_baseline(metrics, baseline, args.tolerance)
+        if regressions:
+            print(f"\n❌ {len(regressions)} regression(s) against {args.baseline} "
+                  f"(tolerance {args.tolerance:.0%}):")
+            for regression in regressions:
+                print(f"   {regression}")
+            sys.exit(1)
+        print(f"\n✅ No regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
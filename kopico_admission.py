@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Kopico - Admission Control
+Per-user and per-address token buckets and an in-flight cap that refuse excess requests at once
+"""
+
+import math
+import time
+import threading
+from collections import OrderedDict
+
+from kopico_sessions import RespClient
+
+# Buckets are spread over this many independently locked shards
+SHARDS = 16
+
+# Period of the CL.THROTTLE rate; rates are sent as whole requests per period
+THROTTLE_PERIOD = 60
+
+
+class TokenBuckets:
+    """
+    A token bucket per key, refilled lazily when the key is next seen.
+
+    A bucket is two numbers (tokens, time of the last refill) in one of
+    SHARDS ordered dicts, each behind its own lock, so threads limiting
+    different users rarely wait for each other. Each shard drops its least
+    recently seen buckets past its share of max_keys; a bucket idle that long
+    has refilled anyway, so dropping it changes nothing.
+    """
+
+    def __init__(self, rate, burst, max_keys=100000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self._shard_size = max(1, max_keys // SHARDS)
+        self._shards = [(threading.Lock(), OrderedDict()) for _ in range(SHARDS)]
+
+    def __len__(self):
+        return sum(len(buckets) for _, buckets in self._shards)
+
+    def take(self, key, cost=1, rate=None, burst=None):
+        """
+        Take cost tokens from the bucket of key.
+
+        Returns (allowed, tokens left, seconds until cost tokens will be
+        there). A refused take leaves the bucket as it was.
+        """
+        rate = self.rate if rate is None else rate
+        burst = self.burst if burst is None else burst
+        lock, buckets = self._shards[hash(key) % SHARDS]
+        with lock:
+            now = self.clock()
+            bucket = buckets.get(key)
+            if bucket is None:
+                tokens = burst
+                bucket = buckets[key] = [burst, now]
+                if len(buckets) > self._shard_size:
+                    buckets.popitem(last=False)
+            else:
+                tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                buckets.move_to_end(key)
+            bucket[1] = now
+            if tokens >= cost:
+                bucket[0] = tokens - cost
+                return True, tokens - cost, 0.0
+            bucket[0] = tokens
+        return False, tokens, (cost - tokens) / rate if rate > 0 else math.inf
+
+    def stats(self):
+        return {
+            'backend': 'local',
+            'buckets': len(self)
+        }
+
+
+class SharedTokenBuckets:
+    """
+    Token buckets kept in a server shared by every worker process.
+
+    Uses CL.THROTTLE, the command of the redis-cell module, so a Redis with
+    that module works as well as the stand-in started with
+    `python kopico_sessions.py`. While the server is unavailable this
+    process's own buckets are used, so limits loosen to per-worker ones
+    rather than failing requests.
+    """
+
+    def __init__(self, url, rate, burst, max_keys=100000, prefix="kopico:limit:"):
+        self.client = RespClient(url, name="rate limit server")
+        self.fallback = TokenBuckets(rate, burst, max_keys)
+        self.rate = rate
+        self.burst = burst
+        self.prefix = prefix
+
+    def take(self, key, cost=1):
+        reply = self.client.command("CL.THROTTLE", self.prefix + key, max(0, math.ceil(self.burst) - 1),
+                                    max(1, round(self.rate * THROTTLE_PERIOD)), THROTTLE_PERIOD, cost)
+        if not isinstance(reply, list) or len(reply) < 4:
+            return self.fallback.take(key, cost)
+        limited, _, remaining, retry_after = reply[:4]
+        return not limited, remaining, max(0, retry_after)
+
+    def stats(self):
+        return {
+            'backend': 'remote',
+            'address': f"{self.client.address[0]}:{self.client.address[1]}",
+            'errors': self.client.errors,
+            'fallback_buckets': len(self.fallback)
+        }
+
+
+def open_token_buckets(rate, burst, url=None, max_keys=100000):
+    """SharedTokenBuckets for a redis:// or kopico:// URL, TokenBuckets otherwise, None when rate is 0"""
+    if rate <= 0:
+        return None
+    if url:
+        return SharedTokenBuckets(url, rate, burst, max_keys)
+    return TokenBuckets(rate, burst, max_keys)
+
+
+class InFlightLimit:
+    """
+    A count of requests being served that refuses, rather than queues, past its limit.
+
+    When every slot is taken, up to limit more requests may wait at most
+    wait seconds for one, which absorbs short bursts. Anything beyond that
+    is refused at once, so threads stay free to turn away the excess of a
+    sustained overload.
+    """
+
+    def __init__(self, limit, wait=0.0):
+        self.limit = limit
+        self.wait = wait
+        self.current = 0
+        self.waiting = 0
+        self._freed = threading.Condition(threading.Lock())
+
+    def enter(self):
+        with self._freed:
+            if self.current >= self.limit:
+                if self.wait <= 0 or self.waiting >= self.limit:
+                    return False
+                self.waiting += 1
+                try:
+                    if not self._freed.wait_for(lambda: self.current < self.limit, self.wait):
+                        return False
+                finally:
+                    self.waiting -= 1
+            self.current += 1
+            return True
+
+    def leave(self):
+        with self._freed:
+            self.current -= 1
+            self._freed.notify()
+
+
+class AdmissionController:
+    """
+    Decides, before any work is done, whether a request is served.
+
+    Checks run cheapest first: the in-flight cap (waiting at most wait
+    seconds for a slot), then the bucket of the client address, then the
+    bucket of the user. admit() returns None for an admitted request, which
+    must later be passed to release(), or a (status, retry_after seconds,
+    reason) refusal: 503 when the server is full, 429 when the caller is
+    over its rate.
+    """
+
+    def __init__(self, max_in_flight=0, addresses=None, users=None, wait=0.0):
+        self.in_flight = InFlightLimit(max_in_flight, wait) if max_in_flight > 0 else None
+        self.addresses = addresses
+        self.users = users
+
+    def admit(self, address=None, user_id=None):
+        if self.in_flight is not None and not self.in_flight.enter():
+            return 503, 1, 'in_flight'
+
+        refusal = None
+        if self.addresses is not None and address:
+            allowed, _, wait = self.addresses.take(address)
+            if not allowed:
+                refusal = 429, wait, 'address_rate'
+        if refusal is None and self.users is not None and user_id:
+            allowed, _, wait = self.users.take(user_id)
+            if not allowed:
+                refusal = 429, wait, 'user_rate'
+
+        if refusal is not None and self.in_flight is not None:
+            self.in_flight.leave()
+        return refusal
+
+    def release(self):
+        if self.in_flight is not None:
+            self.in_flight.leave()
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight.current if self.in_flight is not None else None,
+            'max_in_flight': self.in_flight.limit if self.in_flight is not None else None,
+            'addresses': self.addresses.stats() if self.addresses is not None else None,
+            'users': self.users.stats() if self.users is not None else None
+        }
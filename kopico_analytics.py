@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Kopico - Analytics
+Rolling-window request aggregates (request rate, intent mix, top recommended products and latency percentiles) in a ring of per-minute slots
+"""
+
+import math
+import time
+import heapq
+import threading
+from operator import itemgetter
+
+# Minutes of traffic the aggregates cover
+WINDOW_MINUTES = 60
+
+# Relative error of a reported latency percentile: a p95 of 40ms is within
+# 2% of the true one, and a p95 of 4s likewise
+SKETCH_ACCURACY = 0.02
+
+# Latencies are clamped to this range, so a sketch never has more than
+# about 400 buckets
+MIN_LATENCY_MS = 0.01
+MAX_LATENCY_MS = 60000.0
+
+# Distinct products counted per minute; products first seen in a minute
+# after that are counted together as other products
+MAX_MINUTE_PRODUCTS = 512
+
+# Products listed in a snapshot
+TOP_PRODUCTS = 10
+
+# Percentiles reported for each endpoint
+PERCENTILES = (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99))
+
+# Seconds a snapshot is served before it is recomputed
+SNAPSHOT_MAX_AGE = 1.0
+
+_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+
+
+def bucket_index(ms):
+    """The sketch bucket of a latency: bucket i holds (gamma^(i-1), gamma^i]"""
+    return math.ceil(math.log(min(max(ms, MIN_LATENCY_MS), MAX_LATENCY_MS)) / _LOG_GAMMA)
+
+
+def bucket_value(index):
+    """The latency reported for a bucket, within SKETCH_ACCURACY of all it holds"""
+    return 2 * _GAMMA ** index / (_GAMMA + 1)
+
+
+class LatencySketch:
+    """
+    Mergeable quantile sketch of latencies with a fixed relative error.
+
+    Latencies are counted in logarithmic buckets (see bucket_index), held
+    sparsely as {bucket: count}. Two sketches merge by adding their counts
+    and one leaves another by subtracting them, exactly, which is what lets
+    a window total drop a minute that has left it.
+    """
+
+    __slots__ = ("buckets", "count")
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+
+    def add(self, index, count=1):
+        """Count latencies in a bucket (see bucket_index)"""
+        self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+
+    def merge(self, other, sign=1):
+        """Add another sketch's latencies to this one, or remove them with sign -1"""
+        for index, count in other.buckets.items():
+            total = self.buckets.get(index, 0) + sign * count
+            if total:
+                self.buckets[index] = total
+            else:
+                del self.buckets[index]
+        self.count += sign * other.count
+
+    def quantiles(self, fractions):
+        """The latency (ms) below which each fraction of those counted lie; None when empty"""
+        if not self.count:
+            return [None] * len(fractions)
+        ranks = sorted((fraction * (self.count - 1), position) for position, fraction in enumerate(fractions))
+        values = [None] * len(fractions)
+        seen = 0
+        pending = iter(ranks)
+        rank, position = next(pending)
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            while seen > rank:
+                values[position] = round(bucket_value(index), 2)
+                rank, position = next(pending, (math.inf, None))
+            if position is None:
+                break
+        return values
+
+
+class _Counts:
+    """What the requests of one minute, or of the whole window, add up to"""
+
+    __slots__ = ("minute", "requests", "errors", "intents", "products", "latency")
+
+    def __init__(self, minute=None):
+        self.reset(minute)
+
+    def reset(self, minute):
+        self.minute = minute
+        self.requests = 0
+        self.errors = 0
+        self.intents = {}
+        self.products = {}
+        # {endpoint: LatencySketch}, and every endpoint together under None
+        self.latency = {}
+
+    def add(self, endpoint, error, index, intent, products):
+        self.requests += 1
+        self.errors += error
+        if intent is not None:
+            self.intents[intent] = self.intents.get(intent, 0) + 1
+        for product in products:
+            self.products[product] = self.products.get(product, 0) + 1
+        for key in (None, endpoint):
+            sketch = self.latency.get(key)
+            if sketch is None:
+                sketch = self.latency[key] = LatencySketch()
+            sketch.add(index)
+
+    def remove(self, other):
+        """Take away the counts of a minute these totals include"""
+        self.requests -= other.requests
+        self.errors -= other.errors
+        for table, removed in ((self.intents, other.intents), (self.products, other.products)):
+            for key, count in removed.items():
+                total = table[key] - count
+                if total:
+                    table[key] = total
+                else:
+                    del table[key]
+        for key, sketch in other.latency.items():
+            total = self.latency[key]
+            total.merge(sketch, -1)
+            if not total.count:
+                del self.latency[key]
+
+
+class RollingStats:
+    """
+    Request aggregates over the last `minutes` minutes, kept up to date one
+    request at a time.
+
+    Each minute's counts live in one slot of a fixed ring; the slot of the
+    oldest minute is emptied and reused as time moves on. Totals for the
+    whole window are kept alongside: a request is added to its slot and to
+    them, and a minute leaving the window is subtracted from them, so they
+    never need re-adding. Recording costs a few dict updates and memory is
+    bounded by the ring, however much traffic arrives.
+
+    snapshot() summarizes the totals at most once per max_age seconds and
+    hands every caller in between the same dict, so polls cost O(1); a
+    summary itself costs O(minutes + products + buckets), all bounded.
+    """
+
+    def __init__(self, minutes=WINDOW_MINUTES, max_products=MAX_MINUTE_PRODUCTS,
+                 max_age=SNAPSHOT_MAX_AGE, clock=time.time):
+        self.minutes = minutes
+        self.max_products = max_products
+        self.max_age = max_age
+        self.clock = clock
+        self._slots = [_Counts() for _ in range(minutes)]
+        self._totals = _Counts()
+        self._current = None
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._snapshot_time = None
+        self.recorded = 0
+
+    def _advance(self, minute):
+        """Move the current minute forward, expiring the minutes that leave the window"""
+        if self._current is not None and minute <= self._current:
+            return
+        start = minute - self.minutes + 1
+        if self._current is not None:
+            start = max(start, self._current + 1)
+        for expired in range(start, minute + 1):
+            slot = self._slots[expired % self.minutes]
+            if slot.requests:
+                self._totals.remove(slot)
+            slot.reset(expired)
+        self._current = minute
+
+    def record(self, endpoint, status, ms, intent=None, products=()):
+        """Count one request: its endpoint, status, latency in ms, intent and the products it recommended"""
+        index = bucket_index(ms)
+        error = status >= 500
+        minute = int(self.clock() // 60)
+        with self._lock:
+            self._advance(minute)
+            # A clock stepped back counts in the current minute
+            slot = self._slots[self._current % self.minutes]
+            products = [product if product in slot.products or len(slot.products) < self.max_products
+                        else None for product in products or ()]
+            slot.add(endpoint, error, index, intent, products)
+            self._totals.add(endpoint, error, index, intent, products)
+            self.recorded += 1
+
+    def snapshot(self):
+        """The window's aggregates as a dict, recomputed at most every max_age seconds"""
+        now = self.clock()
+        snapshot = self._snapshot
+        if snapshot is not None and 0 <= now - self._snapshot_time < self.max_age:
+            return snapshot
+        with self._lock:
+            self._advance(int(now // 60))
+            snapshot = self._summarize(now)
+            self._snapshot, self._snapshot_time = snapshot, now
+        return snapshot
+
+    def _summarize(self, now):
+        totals = self._totals
+        per_minute = []
+        for minute in range(self._current - self.minutes + 1, self._current + 1):
+            slot = self._slots[minute % self.minutes]
+            counted = slot.minute == minute
+            per_minute.append({
+                'minute': minute * 60,
+                'requests': slot.requests if counted else 0,
+                'errors': slot.errors if counted else 0
+            })
+
+        fractions = [fraction for _, fraction in PERCENTILES]
+        latency = {}
+        for endpoint, sketch in totals.latency.items():
+            summary = {'requests': sketch.count}
+            summary.update(zip((name for name, _ in PERCENTILES), sketch.quantiles(fractions)))
+            latency['all' if endpoint is None else endpoint] = summary
+
+        # Products past a full minute are counted under None, which is never listed
+        products = heapq.nlargest(TOP_PRODUCTS + 1, totals.products.items(), key=itemgetter(1))
+        products = [{'name': name, 'count': count} for name, count in products if name is not None]
+        return {
+            'window_minutes': self.minutes,
+            'requests': totals.requests,
+            'errors': totals.errors,
+            'requests_per_minute': per_minute,
+            'intents': dict(totals.intents),
+            'top_products': products[:TOP_PRODUCTS],
+            'other_products': totals.products.get(None, 0),
+            'latency': latency,
+            'generated_at': round(now, 3)
+        }
+
+    def stats(self):
+        return {
+            'recorded': self.recorded,
+            'window_requests': self._totals.requests,
+            'window_minutes': self.minutes
+        }
+
+
+def open_rolling_stats(enabled=True, minutes=WINDOW_MINUTES):
+    """A RollingStats over the last minutes, or None when analytics are turned off"""
+    return RollingStats(minutes) if enabled else None
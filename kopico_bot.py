@@ -4,107 +4,403 @@ Kopico - AI Coffee Assistant
 A Python-based chatbot for coffee recommendations and brewing assistance
 """
 
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, g, request, jsonify, render_template, stream_with_context
 from flask_cors import CORS
+from werkzeug.serving import make_server
+from werkzeug.wsgi import ClosingIterator
 import random
 import re
+import os
+import gc
+import hmac
 import json
+import math
+import sys
+import time
+import signal
+import socket
+import uuid
+import hashlib
+import threading
 from datetime import datetime
-import nltk
-from nltk.tokenize import word_tokenize
-from nltk.corpus import stopwords
-from nltk.stem import PorterStemmer
-import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-
-# Download required NLTK data
-try:
-    nltk.data.find('tokenizers/punkt')
-except LookupError:
-    nltk.download('punkt')
-
-try:
-    nltk.data.find('corpora/stopwords')
-except LookupError:
-    nltk.download('stopwords')
+from kopico_matcher import PhraseMatcher
+from kopico_catalog import CoffeeCatalog, CoffeeRecord
+from kopico_scoring import top_matches
+from kopico_retrieval import SimilarityIndexWriter
+from kopico_cache import ResponseCache, normalize_message
+from kopico_text import index_terms, stem_text, stem_texts
+from kopico_metrics import MetricsRegistry, resident_memory_bytes
+from kopico_fragments import ReplyFragments
+from kopico_responses import PreparedResponse
+from kopico_sessions import Session, MAX_REMEMBERED_PRODUCTS, open_session_store
+from kopico_admission import AdmissionController, open_token_buckets
+from kopico_segments import open_segment_store
+from kopico_facets import FacetIndex, CoffeeQuery
+from kopico_sources import open_catalog_source
+from kopico_fuzzy import FuzzyIndex, normalize_key, origin_forms, product_keys
+from kopico_cooccurrence import CoOccurrence, EVENT_WEIGHTS, MAX_EVENT_PRODUCTS
+from kopico_eventlog import open_event_log
+from kopico_analytics import open_rolling_stats
 
 app = Flask(__name__)
-CORS(app)
+# The website reads Retry-After to tell users when to try again
+CORS(app, expose_headers=['Retry-After'])
+
+# Served at /metrics; every worker process keeps its own
+metrics = MetricsRegistry()
+REQUESTS = metrics.counter('kopico_requests_total', 'HTTP requests by endpoint, method and status',
+                           ('endpoint', 'method', 'status'))
+REQUEST_SECONDS = metrics.histogram('kopico_request_seconds', 'Time to build a response, by endpoint',
+                                    ('endpoint',))
+STAGE_SECONDS = metrics.histogram('kopico_stage_seconds', 'Time spent in each stage of a chat request; '
+                                  'format includes retrieval when a reply needs it', ('stage',))
+INTENTS = metrics.counter('kopico_intents_total', 'Chat messages by detected intent', ('intent',))
+SHED = metrics.counter('kopico_shed_requests_total', 'Requests refused by admission control, by reason',
+                       ('reason',))
+
+# Caller supplied request IDs are kept only if they look like an ID
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+
+# Request size limits for the recommendation endpoint
+MAX_RECOMMENDATIONS = 50
+MAX_BATCH_PROFILES = 10000
+
+# Page sizes for /coffees
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Longest text /coffees/lookup searches
+MAX_LOOKUP_LENGTH = 200
+
+# Responses for these intents depend only on the message and the catalog
+CACHEABLE_INTENTS = ("recommend", "brewing", "product")
+RESPONSE_CACHE_SIZE = int(os.environ.get('KOPICO_RESPONSE_CACHE_SIZE', 4096))
+RESPONSE_CACHE_TTL = float(os.environ.get('KOPICO_RESPONSE_CACHE_TTL', 600))
+
+# Read-only GET responses are serialized and compressed once per catalog
+# version; Cache-Control lets a CDN keep them and revalidate with the ETag
+PREPARED_RESPONSE_CACHE_SIZE = 1024
+GET_CACHE_CONTROL = os.environ.get('KOPICO_GET_CACHE_CONTROL', 'public, max-age=60')
+
+# Per-user conversation state; set KOPICO_SESSION_URL (redis://host:port) to
+# share it between worker processes instead of keeping it in each one
+SESSION_URL = os.environ.get('KOPICO_SESSION_URL')
+SESSION_MAX_ENTRIES = int(os.environ.get('KOPICO_SESSION_MAX_ENTRIES', 100000))
+SESSION_MAX_BYTES = int(os.environ.get('KOPICO_SESSION_MAX_BYTES', 32 << 20))
+SESSION_TTL = float(os.environ.get('KOPICO_SESSION_TTL', 1800))
+MAX_USER_ID_LENGTH = 128
+
+# With KOPICO_SEGMENT_DIR set (production mode sets it to a directory in
+# /dev/shm), the similarity index and numeric catalog columns are published
+# there as shared segments that every worker maps instead of holding its own
+# copy. Catalog changes made through one worker reach the others within
+# SEGMENT_CHECK_INTERVAL seconds
+SEGMENT_DIR = os.environ.get('KOPICO_SEGMENT_DIR')
+SEGMENT_CHECK_INTERVAL = 0.5
+
+# With KOPICO_CATALOG_PATH set, products are read from that JSONL, CSV or
+# SQLite file instead of COFFEE_PRODUCTS (brewing guides from
+# KOPICO_GUIDES_PATH or the file's brewing_guides table), and read again in
+# the background when a thread polling it every SOURCE_CHECK_INTERVAL
+# seconds sees it change. A changed file is only read once it has
+# been left alone for SOURCE_SETTLE_SECONDS, so a feed being written is not
+# read half-way through
+CATALOG_PATH = os.environ.get('KOPICO_CATALOG_PATH')
+GUIDES_PATH = os.environ.get('KOPICO_GUIDES_PATH')
+SOURCE_CHECK_INTERVAL = float(os.environ.get('KOPICO_SOURCE_CHECK_INTERVAL', 5))
+SOURCE_SETTLE_SECONDS = 2.0
+
+# Young garbage collections between full ones while a reload builds (the
+# default is 10): in effect, no full collection until the new catalog is in
+RELOAD_FULL_GC_THRESHOLD = 1 << 30
+
+# Words that make a country in a message a place rather than a coffee, as
+# in "I want to visit Brazil"; names and aliases are never demoted
+PLACE_CUES = ("visit", "travel", "trip", "holiday", "vacation", "flight", "fly to", "live in",
+              "move to", "moving to", "weather", "capital", "language")
+
+# Follow-ups such as "tell me more about the second one" point at a product
+# from the previous reply; they are answered from the session, never cached
+FOLLOW_UP_INTENTS = ("product", "brewing", "default")
+REFERENCE_PATTERN = re.compile(r"\b(first|second|third|fourth|1st|2nd|3rd|4th|last|that|this)\s+(?:one|coffee|blend)\b")
+REFERENCE_POSITIONS = {
+    "first": 0, "1st": 0, "that": 0, "this": 0,
+    "second": 1, "2nd": 1, "third": 2, "3rd": 2, "fourth": 3, "4th": 3,
+    "last": -1
+}
+
+# Admission control: requests past these limits are refused at once with a
+# 429 (caller over its rate) or 503 (server full) and a Retry-After, instead
+# of queueing behind work the server cannot keep up with. Rates are requests
+# per second per worker process, or shared by every worker when
+# KOPICO_RATE_LIMIT_URL (redis://host:port) is set; 0 turns a limit off
+ADMISSION_ENABLED = os.environ.get('KOPICO_ADMISSION', '1') != '0'
+MAX_IN_FLIGHT = int(os.environ.get('KOPICO_MAX_IN_FLIGHT', 32))
+# Longest a request waits for an in-flight slot, to ride out short bursts
+ADMISSION_WAIT = float(os.environ.get('KOPICO_ADMISSION_WAIT', 0.05))
+USER_RATE = float(os.environ.get('KOPICO_USER_RATE', 10))
+USER_BURST = float(os.environ.get('KOPICO_USER_BURST', 20))
+ADDRESS_RATE = float(os.environ.get('KOPICO_ADDRESS_RATE', 100))
+ADDRESS_BURST = float(os.environ.get('KOPICO_ADDRESS_BURST', 200))
+RATE_LIMIT_URL = os.environ.get('KOPICO_RATE_LIMIT_URL')
+# Cheap endpoints that are always served, so probes and scrapes see an
+# overloaded server as it is. An analytics stream would hold its in-flight
+# slot for as long as it is open; MAX_ANALYTICS_STREAMS bounds them instead
+ADMISSION_EXEMPT = ('/health', '/health/live', '/health/ready', '/metrics', '/analytics', '/analytics/stream')
+# Addresses of the reverse proxies in front of the server, comma separated. A
+# request from one of them is limited by the client address the proxies
+# forwarded in X-Forwarded-For; with none set, a proxy's requests all count
+# against the proxy's own address
+TRUSTED_PROXIES = frozenset(address.strip() for address in os.environ.get('KOPICO_TRUSTED_PROXIES', '').split(',')
+                            if address.strip())
+
+# Largest number of messages accepted by one /chat/batch request
+MAX_BATCH_MESSAGES = 1000
+
+# Cart and order events posted to /events build the also-bought neighbours
+# of each product. With shared segments every worker journals its events
+# next to them and counts every worker's; otherwise each keeps only the
+# events it receives. KOPICO_ALSO_BOUGHT_BLEND (0 to 1) is how much they weigh
+# against the content match when recommending; 0 leaves recommendations
+# to the content match alone
+MAX_BATCH_EVENTS = 1000
+MAX_ALSO_BOUGHT = 10
+ALSO_BOUGHT_BLEND = float(os.environ.get('KOPICO_ALSO_BOUGHT_BLEND', 0))
+ALSO_BOUGHT_REFRESH_INTERVAL = float(os.environ.get('KOPICO_ALSO_BOUGHT_REFRESH_INTERVAL', 5))
+
+# With KOPICO_EVENT_LOG_DIR set, each call to LOGGED_ENDPOINTS is logged
+# there (its time, status, latency, intent and the products it named) by a
+# background writer; see kopico_eventlog.py for the format and a reader. A
+# worker buffers up to EVENT_LOG_BUFFER events and drops the excess rather
+# than make requests wait for the disk
+EVENT_LOG_DIR = os.environ.get('KOPICO_EVENT_LOG_DIR')
+EVENT_LOG_BUFFER = int(os.environ.get('KOPICO_EVENT_LOG_BUFFER', 65536))
+EVENT_LOG_SEGMENT_BYTES = int(os.environ.get('KOPICO_EVENT_LOG_SEGMENT_BYTES', 64 << 20))
+EVENT_LOG_SEGMENTS = int(os.environ.get('KOPICO_EVENT_LOG_SEGMENTS', 16))
+LOGGED_ENDPOINTS = ('/chat', '/coffee-recommendations', '/brewing-guide/<method>')
+
+# /analytics serves request rate, intent mix, top recommended products and
+# latency percentiles over the last ANALYTICS_WINDOW_MINUTES, as counted by
+# the worker process that answers; /analytics/stream pushes them every
+# ANALYTICS_STREAM_INTERVAL seconds. A stream ends after
+# ANALYTICS_STREAM_SECONDS (browsers reconnect by themselves), and each
+# worker serves at most MAX_ANALYTICS_STREAMS at once, each holding a thread
+ANALYTICS_ENABLED = os.environ.get('KOPICO_ANALYTICS', '1') != '0'
+ANALYTICS_WINDOW_MINUTES = int(os.environ.get('KOPICO_ANALYTICS_WINDOW_MINUTES', 60))
+ANALYTICS_STREAM_INTERVAL = float(os.environ.get('KOPICO_ANALYTICS_STREAM_INTERVAL', 2))
+ANALYTICS_STREAM_SECONDS = float(os.environ.get('KOPICO_ANALYTICS_STREAM_SECONDS', 300))
+MAX_ANALYTICS_STREAMS = int(os.environ.get('KOPICO_MAX_ANALYTICS_STREAMS', 2))
+# Probes, scrapes and the dashboard itself are not counted
+UNTRACKED_ENDPOINTS = ('/health', '/health/live', '/health/ready', '/metrics', '/analytics', '/analytics/stream',
+                       'unmatched')
+
+# /health/live answers as soon as the process serves; /health/ready only
+# once the model is loaded and warmed up, by running WARMUP_MESSAGES and a
+# request to every other read path through the app, so the first real
+# requests find warm caches and code paths. KOPICO_WARMUP=0 skips the
+# warmup. A server started by serve() reports not ready on SIGTERM, stops
+# accepting, and waits up to DRAIN_TIMEOUT seconds for requests in flight
+WARMUP_ENABLED = os.environ.get('KOPICO_WARMUP', '1') != '0'
+DRAIN_TIMEOUT = float(os.environ.get('KOPICO_DRAIN_TIMEOUT', 30))
+# One message per intent, a follow-up, a description and a misspelt name
+WARMUP_MESSAGES = (
+    "Hello!",
+    "Can you recommend a smooth coffee with chocolate notes?",
+    "Tell me more about the second one",
+    "How do I brew pour-over coffee?",
+    "Tell me about Ethiopian coffee",
+    "How long does shipping take for my order?",
+    "Thanks, goodbye!",
+    "I like strong, nutty flavors",
+    "Is the columbian supremo any good?"
+)
+# Follow-ups need a session; this one is only ever used by the warmup
+WARMUP_USER_ID = 'kopico-warmup'
+
+# Catalog admin endpoints accept this token; without it only local clients may call them
+ADMIN_TOKEN = os.environ.get('KOPICO_ADMIN_TOKEN')
+
+# Prebuilt similarity index loaded at boot instead of refitting
+MODEL_PATH = os.environ.get('KOPICO_MODEL_PATH',
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kopico_model'))
+
+# Coffee database; python kopico_bot.py --build-model prebuilds its search index
+COFFEE_PRODUCTS = [
+    {
+        "name": "Ethiopian Yirgacheffe",
+        "price": 28,
+        "description": "Bright, floral notes with citrus undertones",
+        "origin": "Ethiopia",
+        "strength": 2,
+        "acidity": 5,
+        "flavor_profile": ["floral", "citrus", "bright", "tea-like"],
+        "brewing_methods": ["pour-over", "aeropress", "chemex"],
+        "aliases": ["Yirgacheffe"]
+    },
+    {
+        "name": "Colombian Supremo",
+        "price": 25,
+        "description": "Rich, full-bodied with chocolate notes",
+        "origin": "Colombia",
+        "strength": 4,
+        "acidity": 3,
+        "flavor_profile": ["chocolate", "nuts", "caramel", "balanced"],
+        "brewing_methods": ["drip", "french-press", "espresso"]
+    },
+    {
+        "name": "Brazilian Santos",
+        "price": 22,
+        "description": "Smooth, nutty flavor with low acidity",
+        "origin": "Brazil",
+        "strength": 3,
+        "acidity": 2,
+        "flavor_profile": ["nutty", "smooth", "mild", "chocolate"],
+        "brewing_methods": ["french-press", "cold-brew", "drip"]
+    },
+    {
+        "name": "Guatemalan Antigua",
+        "price": 30,
+        "description": "Complex, smoky with spice undertones",
+        "origin": "Guatemala",
+        "strength": 4,
+        "acidity": 4,
+        "flavor_profile": ["smoky", "spicy", "complex", "wine-like"],
+        "brewing_methods": ["espresso", "pour-over", "french-press"]
+    },
+    {
+        "name": "Italian Espresso Blend",
+        "price": 26,
+        "description": "Bold, intense flavor perfect for espresso",
+        "origin": "Italy",
+        "strength": 5,
+        "acidity": 2,
+        "flavor_profile": ["bold", "intense", "dark", "roasted"],
+        "brewing_methods": ["espresso", "moka-pot", "drip"]
+    },
+    {
+        "name": "House Special Blend",
+        "price": 24,
+        "description": "Balanced blend of our finest beans",
+        "origin": "House Blend",
+        "strength": 3,
+        "acidity": 3,
+        "flavor_profile": ["balanced", "smooth", "versatile", "classic"],
+        "brewing_methods": ["drip", "french-press", "pour-over"]
+    }
+]
+
+def catalog_fingerprint(products):
+    """
+    Hash of a product list or catalog, used to tell whether a prebuilt model matches it.
+    
+    Hashed one product at a time, to the same value as the JSON of the whole list.
+    """
+    digest = hashlib.sha256(b'[')
+    for position, product in enumerate(products):
+        if position:
+            digest.update(b',')
+        if isinstance(product, CoffeeRecord):
+            product = product.to_dict()
+        digest.update(json.dumps(product, sort_keys=True, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+    digest.update(b']')
+    return digest.hexdigest()
+
+def product_phrases(record):
+    """The lowercase phrases that name a product in a message: name, origin (see origin_forms) and aliases"""
+    return (record.name.lower(),) + origin_forms(record.origin) + tuple(alias.lower() for alias in record.aliases)
+
+class KopicoSnapshot:
+    """
+    Everything derived from one catalog version, published as a single object
+    so a request that holds it never mixes two versions
+    """
+    
+    __slots__ = ("catalog", "similarity_index", "intent_matcher", "product_matcher", "fragments",
+                 "brewing_methods", "fuzzy_index", "pending_fuzzy", "_facets", "_facets_lock")
+    
+    def __init__(self, catalog, similarity_index, intent_matcher, product_matcher=None, fragments=None,
+                 brewing_methods=None, fuzzy_index=None, pending_fuzzy=None):
+        self.catalog = catalog
+        self.similarity_index = similarity_index
+        self.intent_matcher = intent_matcher
+        self.product_matcher = product_matcher
+        self.fragments = fragments
+        self.brewing_methods = brewing_methods
+        self.fuzzy_index = fuzzy_index
+        self.pending_fuzzy = pending_fuzzy
+        self._facets = None
+        self._facets_lock = threading.Lock()
+    
+    @property
+    def version(self):
+        return self.catalog.version
+    
+    @property
+    def facets(self):
+        """The FacetIndex of the catalog, built by the first /coffees query of this version"""
+        if self._facets is None:
+            with self._facets_lock:
+                if self._facets is None:
+                    self._facets = FacetIndex(self.catalog)
+        return self._facets
+    
+    def matches(self, message):
+        """All live phrase matches in a message, in priority order"""
+        return self.matches_stemmed(stem_text(message))
+    
+    def matches_stemmed(self, stemmed):
+        """matches() for a message already passed through stem_text"""
+        matches = self.intent_matcher.matches(stemmed)
+        if self.product_matcher is not None:
+            matches = sorted(matches + self.product_matcher.matches(stemmed),
+                             key=lambda match: (match[2], match[0]))
+        
+        for match in matches:
+            payload = match[3]
+            if payload[0] == "product":
+                # Phrases of removed or renamed products stay in the base
+                # matcher until it is rebuilt; skip them here
+                record = self.catalog.get(payload[1])
+                if record is None or payload[2] not in product_phrases(record):
+                    continue
+            yield payload
+    
+    def closest_product(self, message, origins=True):
+        """
+        (record, confidence) of the product a message most likely names,
+        allowing for typos, or None. Confidence is 1 for an exact name,
+        origin or alias and falls with each edit. origins=False leaves out
+        products the message names only by their origin.
+        """
+        accept = self._has_key if origins else self._has_name_key
+        best = None
+        for index in (self.fuzzy_index, self.pending_fuzzy):
+            if index is None:
+                continue
+            found = index.lookup(message, accept)
+            if found is not None and (best is None or found[1] > best[1]):
+                best = found
+        if best is None:
+            return None
+        return self.catalog[best[0]], best[1]
+    
+    def _has_key(self, product_id, key):
+        # Like phrases, keys of removed or renamed products stay in the
+        # base index until it is rebuilt
+        record = self.catalog.get(product_id)
+        return record is not None and key in product_keys(record)
+    
+    def _has_name_key(self, product_id, key):
+        record = self.catalog.get(product_id)
+        return record is not None and key in product_keys(record) and key not in origin_forms(record.origin)
 
 class KopicoAI:
     """
     Kopico AI Coffee Assistant - Advanced chatbot for coffee recommendations
     """
     
-    def __init__(self):
+    def __init__(self, products=None, model_path=None, sessions=None, segments=None, source=None):
         self.name = "Kopico"
-        self.stemmer = PorterStemmer()
-        self.stop_words = set(stopwords.words('english'))
-        
-        # Coffee database
-        self.coffee_products = [
-            {
-                "name": "Ethiopian Yirgacheffe",
-                "price": 28,
-                "description": "Bright, floral notes with citrus undertones",
-                "origin": "Ethiopia",
-                "strength": 2,
-                "acidity": 5,
-                "flavor_profile": ["floral", "citrus", "bright", "tea-like"],
-                "brewing_methods": ["pour-over", "aeropress", "chemex"]
-            },
-            {
-                "name": "Colombian Supremo",
-                "price": 25,
-                "description": "Rich, full-bodied with chocolate notes",
-                "origin": "Colombia",
-                "strength": 4,
-                "acidity": 3,
-                "flavor_profile": ["chocolate", "nuts", "caramel", "balanced"],
-                "brewing_methods": ["drip", "french-press", "espresso"]
-            },
-            {
-                "name": "Brazilian Santos",
-                "price": 22,
-                "description": "Smooth, nutty flavor with low acidity",
-                "origin": "Brazil",
-                "strength": 3,
-                "acidity": 2,
-                "flavor_profile": ["nutty", "smooth", "mild", "chocolate"],
-                "brewing_methods": ["french-press", "cold-brew", "drip"]
-            },
-            {
-                "name": "Guatemalan Antigua",
-                "price": 30,
-                "description": "Complex, smoky with spice undertones",
-                "origin": "Guatemala",
-                "strength": 4,
-                "acidity": 4,
-                "flavor_profile": ["smoky", "spicy", "complex", "wine-like"],
-                "brewing_methods": ["espresso", "pour-over", "french-press"]
-            },
-            {
-                "name": "Italian Espresso Blend",
-                "price": 26,
-                "description": "Bold, intense flavor perfect for espresso",
-                "origin": "Italy",
-                "strength": 5,
-                "acidity": 2,
-                "flavor_profile": ["bold", "intense", "dark", "roasted"],
-                "brewing_methods": ["espresso", "moka-pot", "drip"]
-            },
-            {
-                "name": "House Special Blend",
-                "price": 24,
-                "description": "Balanced blend of our finest beans",
-                "origin": "House Blend",
-                "strength": 3,
-                "acidity": 3,
-                "flavor_profile": ["balanced", "smooth", "versatile", "classic"],
-                "brewing_methods": ["drip", "french-press", "pour-over"]
-            }
-        ]
         
         # Brewing methods database
         self.brewing_methods = {
@@ -148,7 +444,8 @@ class KopicoAI:
         # Intent patterns
         self.intent_patterns = {
             "greeting": ["hello", "hi", "hey", "good morning", "good afternoon", "good evening", "what's up"],
-            "recommend": ["recommend", "suggest", "best coffee", "what coffee", "help me choose", "perfect coffee", "good for"],
+            "recommend": ["recommend", "suggest", "best coffee", "what coffee", "help me choose", "perfect coffee", "good for",
+                          "something between", "in between", "goes well with", "beginner", "new to coffee"],
             "brewing": ["brew", "brewing", "how to make", "preparation", "temperature", "grind", "ratio", "method"],
             "product": ["price", "cost", "buy", "purchase", "tell me about", "what is", "describe"],
             "order": ["order", "cart", "checkout", "shipping", "delivery", "buy now"],
@@ -174,191 +471,1122 @@ class KopicoAI:
             ]
         }
         
-        # Initialize TF-IDF vectorizer for similarity matching
-        self.vectorizer = TfidfVectorizer(stop_words='english', max_features=1000)
-        self._prepare_coffee_corpus()
+        # Catalog changes are serialized; readers never take this lock
+        self._write_lock = threading.RLock()
+        self.snapshot = None
+        self.response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+        self.prepared_responses = ResponseCache(PREPARED_RESPONSE_CACHE_SIZE, float('inf'))
+        if sessions is None:
+            sessions = open_session_store(SESSION_URL, SESSION_MAX_ENTRIES, SESSION_TTL, SESSION_MAX_BYTES)
+        self.sessions = sessions
+        if segments is None:
+            segments = open_segment_store(SEGMENT_DIR)
+        self.segments = segments
+        self.segment_version = 0
+        self._segment_checked = 0.0
+        
+        # A CatalogSource to load products from and reload when it changes
+        self.source = source
+        self.model_path = model_path
+        self.source_report = None
+        self.reload_error = None
+        self._source_signature = None
+        self._source_checked = time.monotonic()
+        self._reload_lock = threading.Lock()
+        self._reloader = None
+        self._source_watcher_pid = None
+        self._watch_lock = threading.Lock()
+        
+        # Products bought together, from cart and order events
+        self.also_bought = CoOccurrence(
+            MAX_ALSO_BOUGHT, ALSO_BOUGHT_REFRESH_INTERVAL,
+            journal=os.path.join(segments.root, 'also-bought') if segments is not None else None
+        )
+        self.also_bought_blend = ALSO_BOUGHT_BLEND
+        if source is not None and products is None:
+            self.load_source(model_path)
+            self.watch_source()
+        else:
+            self.load_catalog(COFFEE_PRODUCTS if products is None else products, model_path)
+    
+    @property
+    def catalog(self):
+        return self.snapshot.catalog
     
-    def _prepare_coffee_corpus(self):
-        """Prepare coffee product corpus for similarity matching"""
-        corpus = []
-        for coffee in self.coffee_products:
-            text = f"{coffee['name']} {coffee['description']} {coffee['origin']} {' '.join(coffee['flavor_profile'])}"
-            corpus.append(text.lower())
+    @property
+    def similarity_index(self):
+        return self.snapshot.similarity_index
+    
+    @property
+    def intent_matcher(self):
+        return self.snapshot.intent_matcher
+    
+    def load_catalog(self, products, model_path=None):
+        """
+        Index a list of product dicts and rebuild everything derived from it.
         
-        self.coffee_vectors = self.vectorizer.fit_transform(corpus)
+        When model_path holds a model built from the same products, its
+        similarity index is memory-mapped instead of being fitted again.
+        With shared segments that another process has already loaded these
+        products into, their latest version is used and nothing is indexed.
+        """
+        self._load(CoffeeCatalog(products), model_path=model_path)
     
-    def preprocess_text(self, text):
-        """Preprocess text for better understanding"""
-        # Convert to lowercase
-        text = text.lower()
+    def load_source(self, model_path=None):
+        """Read the catalog source and serve what it holds; returns the read report"""
+        # Taken before reading: a file that changes meanwhile is read again
+        self._source_signature = self.source.signature()
+        started = time.perf_counter()
+        catalog, guides, report = self.source.read()
+        if len(catalog) == 0:
+            raise ValueError(f"No valid products in {self.source.path}")
+        self._load(catalog, guides, model_path, self.source.path)
+        self.source_report = dict(report, catalog_version=self.snapshot.version,
+                                  seconds=round(time.perf_counter() - started, 3),
+                                  loaded_at=datetime.now().isoformat())
+        return self.source_report
+    
+    def _load(self, catalog, brewing_methods=None, model_path=None, source=None):
+        """
+        Serve a newly read catalog, and brewing guides when given, in place of the current ones.
+        
+        The intent matcher, and the similarity index unless workers share
+        segments, are built before any lock is taken, so requests and admin
+        changes carry on meanwhile; changes made in the meantime are replaced
+        along with the rest of the old catalog. With shared segments the
+        index is built under the segment lock, so that other workers loading
+        the same catalog map it rather than fitting their own. source, the
+        path the catalog was read from, is journaled so those workers know
+        where to read it.
+        """
+        if brewing_methods is None:
+            brewing_methods = self.brewing_methods
+        fingerprint = catalog_fingerprint(catalog)
+        base_matcher = self._build_intent_matcher(catalog, brewing_methods)
+        base_fuzzy = FuzzyIndex(catalog)
+        index_writer = self._open_index(catalog, fingerprint, model_path) if self.segments is None else None
         
-        # Tokenize
-        tokens = word_tokenize(text)
+        with self._write_lock:
+            catalog.version = 1 if self.snapshot is None else self.snapshot.version + 1
+            self._base_matcher = base_matcher
+            self._base_fuzzy = base_fuzzy
+            self._pending_phrases = {}
+            self.brewing_methods = brewing_methods
+            
+            if self.segments is None:
+                self.index_writer = index_writer or self._open_index(catalog, fingerprint, model_path)
+            else:
+                with self.segments.lock():
+                    joined = self._join_segments(catalog, fingerprint)
+                    if joined is None:
+                        self.index_writer = self._open_index(catalog, fingerprint, model_path)
+                        record = {'load': fingerprint}
+                        if source is not None:
+                            record['source'] = source
+                        self._share(catalog, record)
+                    else:
+                        catalog = joined
+            self._publish(catalog)
+    
+    def reload_catalog(self, wait=False):
+        """
+        Read the catalog source again in a background thread and serve it once fully built.
         
-        # Remove stopwords and stem
-        tokens = [self.stemmer.stem(token) for token in tokens if token not in self.stop_words and token.isalpha()]
+        Requests are answered from the current catalog until then. Returns
+        False when a reload was already running; with wait, waits for
+        whichever reload runs. A failed reload keeps the current catalog and
+        leaves its error in reload_error.
+        """
+        with self._reload_lock:
+            started = self._reloader is None or not self._reloader.is_alive()
+            if started:
+                self._reloader = threading.Thread(target=self._reload, name="kopico-reload", daemon=True)
+                self._reloader.start()
+            reloader = self._reloader
+        if wait:
+            reloader.join()
+        return started
+    
+    def _reload(self):
+        # The build allocates millions of objects, which set off full
+        # garbage collections over the whole heap that stall every request
+        # thread for seconds. Only those are held off until the swap: young
+        # collections go on, so cycles request threads leave meanwhile are
+        # still collected
+        thresholds = gc.get_threshold()
+        gc.set_threshold(thresholds[0], thresholds[1], RELOAD_FULL_GC_THRESHOLD)
+        try:
+            self.load_source(self.model_path)
+            self.reload_error = None
+        except Exception as e:
+            self.reload_error = f"{type(e).__name__}: {e}"
+            print(f"⚠️  Reloading the catalog from {self.source.path} failed, "
+                  f"still serving version {self.snapshot.version}: {e}", file=sys.stderr)
+        finally:
+            gc.set_threshold(*thresholds)
+    
+    @property
+    def reloading(self):
+        return self._reloader is not None and self._reloader.is_alive()
+    
+    def check_source(self):
+        """
+        Start a reload when the catalog source changed since it was last read.
         
-        return tokens
+        Checks at most every SOURCE_CHECK_INTERVAL seconds, and waits until
+        the files have been left alone for SOURCE_SETTLE_SECONDS.
+        """
+        if self.source is None:
+            return
+        now = time.monotonic()
+        if now - self._source_checked < SOURCE_CHECK_INTERVAL:
+            return
+        self._source_checked = now
+        if self.source.signature() != self._source_signature and self.source.age() >= SOURCE_SETTLE_SECONDS:
+            self.reload_catalog()
     
-    def detect_intent(self, message):
-        """Detect user intent from message"""
-        message_lower = message.lower()
+    def watch_source(self):
+        """Poll the catalog source for changes in a background thread of this process"""
+        if self.source is None or self._source_watcher_pid == os.getpid():
+            return
+        with self._watch_lock:
+            if self._source_watcher_pid == os.getpid():
+                return
+            # A forked worker inherits the parent's watcher but not its thread
+            self._source_watcher_pid = os.getpid()
+            threading.Thread(target=self._watch_source, name="kopico-source-watch", daemon=True).start()
+    
+    def _watch_source(self):
+        while True:
+            time.sleep(SOURCE_CHECK_INTERVAL)
+            try:
+                self.check_source()
+            except Exception as e:
+                print(f"⚠️  Checking the catalog source failed: {e}", file=sys.stderr)
+    
+    def source_stats(self):
+        """The catalog source, its last load and whether a reload is running, for /health"""
+        if self.source is None:
+            return None
+        return {
+            'path': self.source.path,
+            'guides_path': self.source.guides_path,
+            'reloading': self.reloading,
+            'last_error': self.reload_error,
+            'last_load': self.source_report
+        }
+    
+    def _open_index(self, catalog, fingerprint, model_path=None):
+        """The prebuilt index in model_path if it was built from this catalog, a freshly fitted one otherwise"""
+        if model_path is not None:
+            meta = SimilarityIndexWriter.read_metadata(model_path)
+            if meta is not None and meta.get('fingerprint') == fingerprint:
+                return SimilarityIndexWriter.load(model_path)
+            print(f"⚠️  No prebuilt model for this catalog in {model_path}, fitting the index")
+        return self.fit_index(catalog)
+    
+    @staticmethod
+    def fit_index(catalog):
+        """Build a compacted similarity index for every product in a catalog"""
+        return SimilarityIndexWriter.fit((coffee.id, coffee.text) for coffee in catalog)
+    
+    def apply_catalog_changes(self, upserts=(), removals=()):
+        """
+        Apply product changes without refitting anything and publish the result.
+        
+        upserts is a sequence of (name, fields) pairs and removals a sequence of
+        names, as in CoffeeCatalog.updated. Only products whose text changed are
+        re-indexed, so price updates never touch the similarity index. With
+        shared segments the change is journaled and the index republished, so
+        every other worker picks it up.
+        """
+        if self.segments is not None:
+            # Catch up first: another worker may have loaded a new catalog
+            # from the source, which is then read here in the background
+            self.sync_segments(force=True)
+        if self._reloader is not None:
+            # Changes apply to the reloaded catalog, not the one it replaces
+            self._reloader.join()
+        
+        with self._write_lock:
+            if self.segments is None:
+                catalog, changed, removed = self._change_catalog(self.snapshot.catalog, upserts, removals)
+            else:
+                with self.segments.lock():
+                    # Changes apply on top of whatever another worker published last
+                    self.sync_segments(force=True)
+                    if self.segments is not None and self.segment_version != self.segments.current_version():
+                        raise RuntimeError("The catalog is being reloaded from its source; try again shortly")
+                    catalog, changed, removed = self._change_catalog(self.snapshot.catalog, upserts, removals)
+                    if self.segments is not None:
+                        self._share(catalog, {
+                            'upserts': [[name, fields] for name, fields in upserts],
+                            'removals': list(removals)
+                        })
+            self._publish(catalog, [record.id for record in changed] + [record.id for record in removed])
+            return changed, removed
+    
+    def _change_catalog(self, previous, upserts, removals, reindex=True):
+        """
+        The catalog after a change, with its changed and removed records.
+        
+        Product phrases are queued for the matcher and, when reindex is set,
+        the similarity index is updated; nothing is published.
+        """
+        catalog, changed, removed = previous.updated(upserts, removals)
+        
+        for record in removed:
+            if reindex:
+                self.index_writer.remove(record.id)
+            self._pending_phrases.pop(record.id, None)
+        
+        for record in changed:
+            old = previous.get(record.id)
+            if reindex and (old is None or old.text != record.text):
+                self.index_writer.upsert(record.id, record.text)
+            if old is None or product_phrases(old) != product_phrases(record):
+                self._pending_phrases[record.id] = record
+            elif record.id in self._pending_phrases:
+                self._pending_phrases[record.id] = record
+        return catalog, changed, removed
+    
+    def _share(self, catalog, record):
+        """Publish the index and numeric columns as a new segment version, then use the shared copy"""
+        arrays, meta = self.index_writer.to_arrays()
+        arrays.update({f"catalog_{field}": column for field, column in catalog.columns.items()})
+        arrays['catalog_alive'] = catalog.alive
+        version = self.segments.publish(arrays, {'index': meta, 'catalog_version': catalog.version}, record,
+                                        base='load' in record)
+        self._use_segment(catalog, version, *self.segments.attach(version))
+    
+    def _join_segments(self, catalog, fingerprint):
+        """
+        Bring a just loaded catalog up to the current segment version, or return None.
         
-        for intent, patterns in self.intent_patterns.items():
-            for pattern in patterns:
-                if pattern in message_lower:
-                    return intent
+        Only possible when the latest catalog loaded into the segments has
+        the same fingerprint: the changes journaled since are replayed and the
+        current index is mapped.
+        """
+        start = None
+        for version, entry in self.segments.records_since(0):
+            if 'load' in entry:
+                start = version if entry['load'] == fingerprint else None
+        if start is None:
+            return None
+        
+        version = self.segments.current_version()
+        arrays, meta = self.segments.attach(version)
+        catalog, _ = self._replay(catalog, start, version)
+        self._use_segment(catalog, version, arrays, meta)
+        return catalog
+    
+    def _replay(self, catalog, start, version):
+        """
+        Apply the changes journaled after version start, up to version, to a catalog.
+        
+        Returns the new catalog and the ids of the products changed, or
+        (None, None) when a catalog was loaded in between.
+        """
+        entries = [entry for _, entry in self.segments.records_since(start, version)]
+        if any('upserts' not in entry for entry in entries):
+            return None, None
+        changed_ids = set()
+        for entry in entries:
+            catalog, changed, removed = self._change_catalog(
+                catalog, [(name, fields) for name, fields in entry['upserts']], entry['removals'], reindex=False)
+            changed_ids.update(record.id for record in changed + removed)
+        return catalog, changed_ids
+    
+    def _use_segment(self, catalog, version, arrays, meta):
+        """Serve the index and numeric columns of a catalog from a mapped segment version"""
+        self.index_writer = SimilarityIndexWriter.from_arrays(arrays, meta['index'])
+        catalog.use_columns({field: arrays[f"catalog_{field}"] for field in catalog.RANGE_FIELDS},
+                            arrays['catalog_alive'])
+        self.segment_version = version
+    
+    def sync_segments(self, force=False):
+        """
+        Catch up with catalog versions other workers published to the shared segments.
+        
+        Their journaled changes are replayed on this worker's catalog, which
+        is cheap, while the index is mapped from the segment rather than
+        rebuilt. Checks at most every SEGMENT_CHECK_INTERVAL seconds unless forced.
+        """
+        if self.segments is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._segment_checked < SEGMENT_CHECK_INTERVAL:
+            return
+        self._segment_checked = now
+        version = self.segments.current_version()
+        if version == self.segment_version:
+            return
+        
+        # Requests never wait for a catalog change or reload in progress; a
+        # later one catches up
+        if not self._write_lock.acquire(blocking=force):
+            return
+        try:
+            if version <= self.segment_version:
+                return
+            # Map the target version first; it stays readable even if it is pruned meanwhile
+            arrays, meta = self.segments.attach(version)
+            catalog, changed_ids = self._replay(self.snapshot.catalog, self.segment_version, version)
+            if catalog is None:
+                loads = [entry for _, entry in self.segments.records_since(self.segment_version, version)
+                         if 'load' in entry]
+                if self.source is not None and loads[-1].get('source') == self.source.path:
+                    # Another worker reloaded the source; read it too, and map its index
+                    self.reload_catalog()
+                    return
+                print(f"⚠️  The catalog in {self.segments.root} was replaced by another process; "
+                      f"this worker keeps its own", file=sys.stderr)
+                self.segments = None
+                return
+            self._use_segment(catalog, version, arrays, meta)
+            self._publish(catalog, sorted(changed_ids))
+        finally:
+            self._write_lock.release()
+    
+    def add_product(self, product):
+        """Add a new product to the catalog"""
+        with self._write_lock:
+            if self.catalog.find_by_name(product.get('name', '')) is not None:
+                raise ValueError(f"A product named '{product['name']}' already exists")
+            return self.apply_catalog_changes(upserts=[(product.get('name', ''), product)])[0][0]
+    
+    def update_product(self, name, changes):
+        """Change fields of an existing product"""
+        with self._write_lock:
+            if self.catalog.find_by_name(name) is None:
+                raise KeyError(name)
+            return self.apply_catalog_changes(upserts=[(name, changes)])[0][0]
+    
+    def remove_product(self, name):
+        """Remove a product from the catalog"""
+        return self.apply_catalog_changes(removals=[name])[1][0]
+    
+    def _publish(self, catalog, changed_ids=None):
+        """
+        Swap in a new snapshot for the catalog; a single assignment readers see atomically.
         
-        # Check for product names
-        for coffee in self.coffee_products:
-            if coffee['name'].lower() in message_lower or coffee['origin'].lower() in message_lower:
-                return "product"
+        changed_ids lists the products added, changed or removed since the
+        current snapshot, whose reply fragments must be rendered again;
+        None renders them all.
+        """
+        limit = max(SimilarityIndexWriter.MIN_DELTA, int(len(catalog) * SimilarityIndexWriter.DELTA_FRACTION))
+        if len(self._pending_phrases) > limit:
+            self._base_matcher = self._build_intent_matcher(catalog)
+            self._base_fuzzy = FuzzyIndex(catalog)
+            self._pending_phrases = {}
         
-        # Check for brewing methods
-        for method in self.brewing_methods.keys():
-            if method.replace('-', ' ') in message_lower or method.replace('-', '') in message_lower:
-                return "brewing"
+        product_matcher = pending_fuzzy = None
+        if self._pending_phrases:
+            product_matcher = PhraseMatcher()
+            self._add_product_phrases(product_matcher, self._pending_phrases.values())
+            product_matcher.build()
+            pending_fuzzy = FuzzyIndex(self._pending_phrases.values())
+        
+        previous = self.snapshot.fragments if self.snapshot is not None else None
+        fragments = ReplyFragments(catalog, self.brewing_methods, previous, changed_ids)
+        self.snapshot = KopicoSnapshot(catalog, self.index_writer.publish(), self._base_matcher,
+                                       product_matcher, fragments, self.brewing_methods,
+                                       self._base_fuzzy, pending_fuzzy)
+        self.response_cache.invalidate()
+        self.prepared_responses.invalidate()
+    
+    def _build_intent_matcher(self, catalog, brewing_methods=None):
+        """
+        Compile intent phrases, product names, brewing methods and place cues into one matcher.
+        
+        Phrases are stored stemmed and messages are stemmed before a scan,
+        so "brews", "brewed" and "brewing" all match "brew".
+        """
+        matcher = PhraseMatcher()
+        
+        # Rank by tier first so the priority order of detect_intent is kept:
+        # intent phrases, then product names/origins, then brewing methods
+        for tier, (intent, patterns) in enumerate(self.intent_patterns.items()):
+            for pattern in {stem_text(pattern) for pattern in patterns}:
+                matcher.add(pattern, (tier, 0), ("intent", intent))
+        
+        self._add_product_phrases(matcher, catalog)
+        
+        method_tier = len(self.intent_patterns) + 1
+        if brewing_methods is None:
+            brewing_methods = self.brewing_methods
+        for idx, method in enumerate(brewing_methods.keys()):
+            for alias in {stem_text(method), stem_text(method.replace('-', ''))}:
+                matcher.add(alias, (method_tier, idx), ("brewing", method))
+        
+        for cue in {stem_text(cue) for cue in PLACE_CUES}:
+            matcher.add(cue, (method_tier + 1, 0), ("place",))
+        
+        return matcher.build()
+    
+    def _add_product_phrases(self, matcher, records):
+        """Register the name, origin and aliases of each product with a matcher"""
+        product_tier = len(self.intent_patterns)
+        for coffee in records:
+            origins = origin_forms(coffee.origin)
+            for phrase in product_phrases(coffee):
+                kind = "origin" if phrase in origins else "name"
+                matcher.add(stem_text(phrase), (product_tier, coffee.id), ("product", coffee.id, phrase, kind))
+    
+    def _first_match(self, snapshot, message_lower, kind):
+        """Return the value of the highest priority match of a given kind"""
+        for payload in snapshot.matches(message_lower):
+            if payload[0] == kind:
+                return payload[1]
+        return None
+    
+    def preprocess_text(self, text):
+        """Preprocess text for better understanding: the stems retrieval indexes"""
+        return index_terms(text)
+    
+    def detect_intent(self, message):
+        """Detect user intent from message"""
+        return self._detect(self.snapshot, stem_text(message), message)
+    
+    def detect_intents(self, messages):
+        """Detect the intent of many messages, stemming and scanning each distinct message once"""
+        snapshot = self.snapshot
+        stemmed = stem_texts(messages)
+        intents = {}
+        for text, message in zip(stemmed, messages):
+            if text not in intents:
+                intents[text] = self._detect(snapshot, text, message)
+        return [intents[text] for text in stemmed]
+    
+    def _detect(self, snapshot, stemmed, message):
+        """
+        The intent of a message, given its stem_text as well. A message
+        that matches nothing but names a product with a typo ("columbian")
+        asks about that product. So does one naming a product's origin,
+        unless a PLACE_CUES word says the country is meant as a place.
+        """
+        matches = list(snapshot.matches_stemmed(stemmed))
+        place = any(payload[0] == "place" for payload in matches)
+        intent = self._intent_of(matches, place)
+        if intent == "default" and snapshot.closest_product(message, origins=not place) is not None:
+            return "product"
+        return intent
+    
+    @staticmethod
+    def _intent_of(matches, place=False):
+        """The intent named by the highest priority match; with place, origins name no product"""
+        for payload in matches:
+            if payload[0] == "intent":
+                return payload[1]
+            if payload[0] == "place" or (place and payload[0] == "product" and payload[3] == "origin"):
+                continue
+            return payload[0]
         
         return "default"
     
     def find_similar_coffee(self, query):
         """Find coffee similar to user query using TF-IDF"""
-        query_vector = self.vectorizer.transform([query.lower()])
-        similarities = cosine_similarity(query_vector, self.coffee_vectors)[0]
+        snapshot = self.snapshot
         
-        # Get top 3 most similar coffees
-        top_indices = np.argsort(similarities)[-3:][::-1]
+        # Top 3 most similar coffees above the relevance threshold
+        with STAGE_SECONDS.time('retrieval'):
+            ids = snapshot.similarity_index.search(query, k=3, threshold=0.1)
         
-        recommendations = []
-        for idx in top_indices:
-            if similarities[idx] > 0.1:  # Threshold for relevance
-                recommendations.append(self.coffee_products[idx])
+        return snapshot.catalog.get_many(ids)
+    
+    def recommend_coffee(self, message, similar=None, mentioned=None):
+        """
+        Provide coffee recommendations based on user preferences.
         
-        return recommendations
+        similar optionally holds the find_similar_coffee result for the
+        message, computed ahead of time for a batch of messages. The ids of
+        the recommended coffees are appended to the mentioned list if given.
+        """
+        return "".join(self.recommendation_sections(message, similar, mentioned))
     
-    def recommend_coffee(self, message):
-        """Provide coffee recommendations based on user preferences"""
+    def recommendation_sections(self, message, similar=None, mentioned=None):
+        """Yield a recommendation reply piece by piece: header, each coffee, closing line"""
         message_lower = message.lower()
+        snapshot = self.snapshot
+        catalog = snapshot.catalog
         
         # Strength preferences
         if any(word in message_lower for word in ["strong", "bold", "intense", "dark"]):
-            recommendations = [coffee for coffee in self.coffee_products if coffee['strength'] >= 4]
-            response = "For strong coffee lovers, I recommend:\n\n"
+            yield "For strong coffee lovers, I recommend:\n\n"
+            recommendations = catalog.get_many(catalog.ids_in_range('strength', low=4, limit=2))
         elif any(word in message_lower for word in ["mild", "light", "smooth", "gentle"]):
-            recommendations = [coffee for coffee in self.coffee_products if coffee['strength'] <= 3]
-            response = "For those who prefer milder coffees:\n\n"
+            yield "For those who prefer milder coffees:\n\n"
+            recommendations = catalog.get_many(catalog.ids_in_range('strength', high=3, limit=2))
         elif any(word in message_lower for word in ["fruity", "floral", "bright", "citrus"]):
-            recommendations = [coffee for coffee in self.coffee_products if 
-                             any(flavor in coffee['flavor_profile'] for flavor in ["floral", "citrus", "bright"])]
-            response = "For fruity and floral coffee enthusiasts:\n\n"
+            yield "For fruity and floral coffee enthusiasts:\n\n"
+            recommendations = catalog.get_many(
+                catalog.ids_with_any_flavor(["floral", "citrus", "bright"], limit=2))
         elif any(word in message_lower for word in ["chocolate", "nutty", "caramel", "sweet"]):
-            recommendations = [coffee for coffee in self.coffee_products if 
-                             any(flavor in coffee['flavor_profile'] for flavor in ["chocolate", "nuts", "caramel"])]
-            response = "For chocolate and nutty flavor lovers:\n\n"
+            yield "For chocolate and nutty flavor lovers:\n\n"
+            recommendations = catalog.get_many(
+                catalog.ids_with_any_flavor(["chocolate", "nuts", "caramel"], limit=2))
+        elif any(word in message_lower for word in ["milk", "latte", "cappuccino", "flat white"]):
+            yield "For lattes, cappuccinos and other milk drinks, bold coffees that stand up to milk:\n\n"
+            recommendations = catalog.get_many(catalog.ids_in_range('strength', low=4, limit=2))
+        elif any(word in message_lower for word in ["between", "medium", "middle"]):
+            yield "For a medium strength, between mild and bold:\n\n"
+            recommendations = catalog.get_many(catalog.ids_in_range('strength', low=3, high=3, limit=2))
+        elif any(word in message_lower for word in ["beginner", "new to coffee", "just starting"]):
+            yield "To start your coffee journey, smooth and mild coffees that are easy to enjoy:\n\n"
+            recommendations = catalog.get_many(catalog.ids_in_range('strength', high=3, limit=2))
         else:
+            yield "Based on your preferences, I recommend:\n\n"
             # Use similarity matching
-            recommendations = self.find_similar_coffee(message)
+            recommendations = self.find_similar_coffee(message) if similar is None else similar
             if not recommendations:
-                recommendations = random.sample(self.coffee_products, 2)
-            response = "Based on your preferences, I recommend:\n\n"
+                recommendations = catalog.sample(2)
+        
+        if self.also_bought_blend > 0:
+            recommendations = self.blend_also_bought(catalog, recommendations)
         
-        # Format recommendations
+        # Entries are pre-rendered; only the position is added here
         for i, coffee in enumerate(recommendations[:2], 1):
-            response += f"{i}. **{coffee['name']}** (${coffee['price']})\n"
-            response += f"   {coffee['description']}\n"
-            response += f"   Origin: {coffee['origin']}\n"
-            response += f"   Best for: {', '.join(coffee['brewing_methods'][:2])}\n\n"
+            if mentioned is not None:
+                mentioned.append(coffee.id)
+            yield f"{i}. {snapshot.fragments.pick(coffee)}"
         
-        response += "Would you like to know more about any of these coffees or need brewing tips? ☕"
+        yield "Would you like to know more about any of these coffees or need brewing tips? ☕"
+    
+    def blend_also_bought(self, catalog, recommendations, count=2):
+        """
+        Rerank content-based picks with the coffees bought alongside them.
         
-        return response
+        The pick at rank r scores (1 - blend) / r and adds blend * score / r
+        to each of its also-bought neighbours, so a coffee often bought with
+        the top pick can take a place from a weaker content match. Ties keep
+        the content order.
+        """
+        blend = self.also_bought_blend
+        scores = {}
+        for rank, coffee in enumerate(recommendations, 1):
+            scores[coffee.id] = scores.get(coffee.id, 0.0) + (1 - blend) / rank
+            for key, score in self.also_bought.neighbors(coffee.name.lower()):
+                neighbor = catalog.find_by_name(key)
+                if neighbor is not None:
+                    scores[neighbor.id] = scores.get(neighbor.id, 0.0) + blend * score / rank
+        return catalog.get_many(sorted(scores, key=lambda product_id: -scores[product_id])[:count])
     
-    def provide_brewing_tips(self, message):
+    def also_bought_with(self, coffee, limit=None):
+        """(record, score) of the coffees most often bought with one, best first; O(limit)"""
+        catalog = self.snapshot.catalog
+        found = []
+        for key, score in self.also_bought.neighbors(coffee.name.lower(), limit):
+            neighbor = catalog.find_by_name(key)
+            # Removed products stay in the lists until their partners are bought again
+            if neighbor is not None:
+                found.append((neighbor, score))
+        return found
+    
+    def record_events(self, events):
+        """
+        Count a batch of cart and order events; returns (events, pairs, unknown product names).
+        
+        A cart event is {"type": "cart", "product": name, "cart": [names
+        already in the cart]}, an order {"type": "order", "products":
+        [names]}. The whole batch is checked before any of it is counted,
+        and a malformed event raises ValueError. Names of products not in
+        the catalog, such as ones removed since they went into a cart, are
+        skipped and counted.
+        """
+        catalog = self.snapshot.catalog
+        unknown = 0
+        
+        def keys(names, field, index):
+            nonlocal unknown
+            if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+                raise ValueError(f"event {index}: {field} must be a list of product names")
+            if len(names) > MAX_EVENT_PRODUCTS:
+                raise ValueError(f"event {index}: {field} may name at most {MAX_EVENT_PRODUCTS} products")
+            found = []
+            for name in names:
+                record = catalog.find_by_name(name)
+                if record is None:
+                    unknown += 1
+                else:
+                    found.append(record.name.lower())
+            return found
+        
+        parsed = []
+        for index, event in enumerate(events):
+            kind = event.get('type') if isinstance(event, dict) else None
+            if kind not in EVENT_WEIGHTS:
+                raise ValueError(f"event {index}: type must be one of {', '.join(EVENT_WEIGHTS)}")
+            if kind == 'cart':
+                if not isinstance(event.get('product'), str):
+                    raise ValueError(f"event {index}: product must name the product added to the cart")
+                added = keys([event['product']], 'product', index)
+                parsed.append((kind, keys(event.get('cart', []), 'cart', index), added[0] if added else None))
+            else:
+                parsed.append((kind, keys(event.get('products'), 'products', index), None))
+        
+        pairs = sum(self.also_bought.record(kind, products, added) for kind, products, added in parsed
+                    if added is not None or kind == 'order')
+        return len(parsed), pairs, unknown
+    
+    def reply_key(self, snapshot, message):
+        """Response cache key of a message: recommendations blended with also-bought change as the lists do"""
+        if self.also_bought_blend > 0:
+            return (snapshot.version, self.also_bought.generation, message)
+        return (snapshot.version, message)
+    
+    def provide_brewing_tips(self, message, mentioned=None):
         """Provide brewing tips based on method"""
+        return "".join(self.brewing_sections(message, mentioned))
+    
+    def brewing_sections(self, message, mentioned=None):
+        """Yield a brewing reply piece by piece: the guide, then suitable coffees"""
         message_lower = message.lower()
         
         # Find brewing method in message
-        method = None
-        for brewing_method in self.brewing_methods.keys():
-            if brewing_method.replace('-', ' ') in message_lower or brewing_method.replace('-', '') in message_lower:
-                method = brewing_method
-                break
+        snapshot = self.snapshot
+        method = self._first_match(snapshot, message_lower, "brewing")
         
         if method:
-            info = self.brewing_methods[method]
-            response = f"**{method.replace('-', ' ').title()} Brewing Guide:**\n\n"
-            response += f"☕ **Grind Size:** {info['grind']}\n"
-            response += f"⚖️ **Ratio:** {info['ratio']} (coffee:water)\n"
-            response += f"⏱️ **Brew Time:** {info['time']}\n"
-            response += f"🌡️ **Temperature:** {info['temperature']}\n"
-            response += f"💡 **Pro Tips:** {info['tips']}\n\n"
+            yield snapshot.fragments.guides[method]
             
             # Recommend suitable coffees
-            suitable_coffees = [coffee for coffee in self.coffee_products if method in coffee['brewing_methods']]
-            if suitable_coffees:
-                response += f"**Perfect coffees for {method.replace('-', ' ')}:**\n"
-                for coffee in suitable_coffees[:2]:
-                    response += f"• {coffee['name']} - {coffee['description']}\n"
+            suitable = snapshot.fragments.suitable.get(method)
+            if suitable is not None:
+                ids, section = suitable
+                if mentioned is not None:
+                    mentioned.extend(ids)
+                yield section
         else:
             response = "I can help with brewing methods like:\n"
             response += "☕ Espresso • 🌊 Pour-over • 🫖 French Press\n"
             response += "💨 AeroPress • 🧊 Cold Brew\n\n"
             response += "Which brewing method interests you?"
-        
-        return response
+            yield response
     
-    def get_product_info(self, message):
+    def get_product_info(self, message, mentioned=None):
         """Get specific product information"""
         message_lower = message.lower()
         
         # Find mentioned coffee
-        for coffee in self.coffee_products:
-            if coffee['name'].lower() in message_lower or coffee['origin'].lower() in message_lower:
-                response = f"**{coffee['name']}** 🌟\n\n"
-                response += f"💰 **Price:** ${coffee['price']}\n"
-                response += f"🌍 **Origin:** {coffee['origin']}\n"
-                response += f"📝 **Description:** {coffee['description']}\n"
-                response += f"💪 **Strength:** {coffee['strength']}/5\n"
-                response += f"🍋 **Acidity:** {coffee['acidity']}/5\n"
-                response += f"🎯 **Flavor Profile:** {', '.join(coffee['flavor_profile'])}\n"
-                response += f"☕ **Best Brewing Methods:** {', '.join(coffee['brewing_methods'])}\n\n"
-                response += "Would you like to add this to your cart or learn about brewing tips?"
-                
-                return response
+        snapshot = self.snapshot
+        idx = self._first_match(snapshot, message_lower, "product")
+        if idx is not None:
+            if mentioned is not None:
+                mentioned.append(idx)
+            return snapshot.fragments.card(snapshot.catalog[idx])
         
+        # No exact name: try the closest one, checking back when it is a guess
+        closest = snapshot.closest_product(message_lower)
+        if closest is not None:
+            coffee, confidence = closest
+            if mentioned is not None:
+                mentioned.append(coffee.id)
+            card = snapshot.fragments.card(coffee)
+            if confidence < 1:
+                return f"Did you mean **{coffee.name}**? 🤔\n\n{card}"
+            return card
+
         return "I'd be happy to tell you about our coffee products! We have Ethiopian Yirgacheffe, Colombian Supremo, Brazilian Santos, Guatemalan Antigua, Italian Espresso Blend, and House Special Blend. Which one interests you?"
     
-    def process_message(self, message, user_id=None):
-        """Main message processing function"""
-        intent = self.detect_intent(message)
+    def process_message(self, message, user_id=None, details=None):
+        """
+        Main message processing function. details, when given, gets the
+        intent and the ids of the products the reply mentions.
+        """
+        message = normalize_message(message)
+        with STAGE_SECONDS.time('intent'):
+            intent = self.detect_intent(message)
+        INTENTS.inc(intent)
+        
+        session = self.load_session(user_id)
+        referenced = self.resolve_reference(session, intent, message)
+        if referenced is not None:
+            reply, products = self.follow_up(intent, message, referenced)
+        elif intent in CACHEABLE_INTENTS:
+            key = self.reply_key(self.snapshot, message)
+            reply, products = self.response_cache.get_or_compute(key, lambda: self.format_reply(intent, message))
+        else:
+            reply, products = self.format_reply(intent, message)
+        
+        if session is not None:
+            self.remember(user_id, session, intent, products, referenced)
+        if details is not None:
+            details.update(intent=intent, products=products)
+        return reply
+    
+    def process_messages(self, messages):
+        """
+        Process a batch of messages and return their replies in order.
+        
+        Intents are detected once per distinct message, and every
+        recommendation that needs a similarity search is searched for in a
+        single batched pass. A message that fails gets its exception in
+        place of a reply, so one bad item never fails the whole batch.
+        Batches are stateless: sessions are neither read nor updated.
+        """
+        snapshot = self.snapshot
+        messages = [normalize_message(message) for message in messages]
+        intents = self.detect_intents(messages)
+        for intent in intents:
+            INTENTS.inc(intent)
+        
+        # Only recommendations not cached yet are searched for
+        keys = {}
+        for message, intent in zip(messages, intents):
+            if intent in CACHEABLE_INTENTS and message not in keys:
+                keys[message] = (self.reply_key(snapshot, message), intent)
+        queries = [message for message, (key, intent) in keys.items()
+                   if intent == "recommend" and key not in self.response_cache]
+        similar = dict(zip(queries, (snapshot.catalog.get_many(ids) for ids in
+                                     snapshot.similarity_index.search_many(queries, k=3, threshold=0.1))))
+        
+        replies = {}
+        for message, (key, intent) in keys.items():
+            try:
+                replies[message] = self.response_cache.get_or_compute(
+                    key, lambda: self.format_reply(intent, message, similar.get(message)))
+            except Exception as e:
+                replies[message] = e
+        
+        results = []
+        for message, intent in zip(messages, intents):
+            try:
+                reply = replies[message] if intent in CACHEABLE_INTENTS else self.format_reply(intent, message)
+            except Exception as e:
+                reply = e
+            results.append(reply if isinstance(reply, Exception) else reply[0])
+        return results
+    
+    def stream_message(self, message, user_id=None):
+        """Like process_message, but yield the reply in sections as soon as each is formatted"""
+        message = normalize_message(message)
+        with STAGE_SECONDS.time('intent'):
+            intent = self.detect_intent(message)
+        INTENTS.inc(intent)
+        
+        session = self.load_session(user_id)
+        referenced = self.resolve_reference(session, intent, message)
+        key = self.reply_key(self.snapshot, message)
+        cached = flight = None
+        if referenced is None and intent in CACHEABLE_INTENTS:
+            # Identical messages streamed at once wait for this one's reply
+            cached, flight = self.response_cache.begin(key)
+        
+        if referenced is not None:
+            reply, products = self.follow_up(intent, message, referenced)
+            yield reply
+        elif cached is not None:
+            reply, products = cached
+            yield reply
+        else:
+            sections = []
+            mentioned = []
+            try:
+                for section in self.respond_sections(intent, message, mentioned):
+                    sections.append(section)
+                    yield section
+            except BaseException as e:
+                if flight is not None:
+                    # A client that went away leaves the reply to the next one waiting
+                    self.response_cache.finish(key, flight, error=None if isinstance(e, GeneratorExit) else e)
+                raise
+            products = tuple(mentioned)
+            if flight is not None:
+                self.response_cache.finish(key, flight, ("".join(sections), products))
+        
+        if session is not None:
+            self.remember(user_id, session, intent, products, referenced)
+    
+    def respond_sections(self, intent, message, mentioned=None):
+        """Yield the reply for a message whose intent is already known, in sections"""
+        if intent == "recommend":
+            return self.recommendation_sections(message, mentioned=mentioned)
+        elif intent == "brewing":
+            return self.brewing_sections(message, mentioned)
+        return iter([self.respond(intent, message, mentioned=mentioned)])
+    
+    def format_reply(self, intent, message, similar=None):
+        """respond(), timed as the format stage; returns (reply, ids of the products it mentions)"""
+        mentioned = []
+        with STAGE_SECONDS.time('format'):
+            reply = self.respond(intent, message, similar, mentioned)
+        return reply, tuple(mentioned)
+    
+    def load_session(self, user_id):
+        """The session of a user (new if they have none), or None for anonymous users"""
+        if not isinstance(user_id, str) or user_id in ('', 'anonymous') or len(user_id) > MAX_USER_ID_LENGTH:
+            return None
+        with STAGE_SECONDS.time('session'):
+            return self.sessions.load(user_id) or Session()
+    
+    def resolve_reference(self, session, intent, message):
+        """The product a follow-up like "the second one" points at, or None"""
+        if session is None or not session.last_products or intent not in FOLLOW_UP_INTENTS:
+            return None
+        match = REFERENCE_PATTERN.search(message)
+        if match is None:
+            return None
+        position = REFERENCE_POSITIONS[match.group(1)]
+        if position >= len(session.last_products):
+            return None
+        return self.catalog.get(session.last_products[position])
+    
+    def follow_up(self, intent, message, coffee):
+        """Answer a follow-up about a product from the previous reply"""
+        snapshot = self.snapshot
+        if intent == "brewing":
+            method = self._first_match(snapshot, message, "brewing")
+            if method is None:
+                method = next((method for method in coffee.brewing_methods
+                               if method in snapshot.brewing_methods), None)
+            if method is not None:
+                return f"For **{coffee.name}**:\n\n{snapshot.fragments.guides[method]}", (coffee.id,)
+        return snapshot.fragments.card(coffee), (coffee.id,)
+    
+    def remember(self, user_id, session, intent, products, referenced=None):
+        """Store what a reply was about so the next message can refer to it"""
+        session.last_intent = intent
+        if products:
+            session.last_products = products[:MAX_REMEMBERED_PRODUCTS]
+        
+        # Asking about a product, by name or as a follow-up, shows interest in it
+        interest = referenced
+        if interest is None and intent == "product" and products:
+            interest = self.catalog.get(products[0])
+        if interest is not None:
+            session.observe(interest.strength, interest.acidity)
         
+        with STAGE_SECONDS.time('session'):
+            self.sessions.save(user_id, session)
+    
+    def respond(self, intent, message, similar=None, mentioned=None):
+        """Build the reply for a message whose intent is already known"""
         if intent == "greeting":
             return random.choice(self.responses["greeting"])
         elif intent == "goodbye":
             return random.choice(self.responses["goodbye"])
         elif intent == "recommend":
-            return self.recommend_coffee(message)
+            return self.recommend_coffee(message, similar, mentioned)
         elif intent == "brewing":
-            return self.provide_brewing_tips(message)
+            return self.provide_brewing_tips(message, mentioned)
         elif intent == "product":
-            return self.get_product_info(message)
+            return self.get_product_info(message, mentioned)
         elif intent == "order":
             return "I can help guide you through our products! Check out our coffee selection and use the 'Add to Cart' buttons on the website. Need help choosing the right coffee for you? 🛒"
         else:
             return random.choice(self.responses["default"])
 
-# Initialize Kopico AI
-kopico = KopicoAI()
+# Kopico AI is created at server start (or on first use), not at import
+kopico = None
+_kopico_lock = threading.Lock()
+
+def get_kopico():
+    """Return the shared KopicoAI instance, loading it on the first call"""
+    global kopico
+    if kopico is None:
+        with _kopico_lock:
+            if kopico is None:
+                kopico = KopicoAI(model_path=MODEL_PATH, source=open_catalog_source(CATALOG_PATH, GUIDES_PATH))
+    return kopico
+
+def build_model(products=COFFEE_PRODUCTS, path=MODEL_PATH):
+    """Fit the similarity index for a product list or catalog and save it for fast startup"""
+    catalog = products if isinstance(products, CoffeeCatalog) else CoffeeCatalog(products)
+    writer = KopicoAI.fit_index(catalog)
+    writer.save(path, {
+        'fingerprint': catalog_fingerprint(catalog),
+        'products': len(catalog),
+        'built_at': datetime.now().isoformat()
+    })
+    return writer
+
+event_log = open_event_log(EVENT_LOG_DIR, EVENT_LOG_BUFFER, EVENT_LOG_SEGMENT_BYTES, EVENT_LOG_SEGMENTS)
+analytics = open_rolling_stats(ANALYTICS_ENABLED, ANALYTICS_WINDOW_MINUTES)
+analytics_streams = threading.BoundedSemaphore(MAX_ANALYTICS_STREAMS)
+
+# What warm_up() did, once it has; set on SIGTERM by serve()
+warmup_report = None
+_warmup_lock = threading.Lock()
+draining = threading.Event()
+
+admission = AdmissionController(
+    MAX_IN_FLIGHT,
+    open_token_buckets(ADDRESS_RATE, ADDRESS_BURST, RATE_LIMIT_URL),
+    open_token_buckets(USER_RATE, USER_BURST, RATE_LIMIT_URL),
+    ADMISSION_WAIT
+) if ADMISSION_ENABLED else None
+
+def collect_process_metrics():
+    """Metrics read at scrape time: memory, in-flight requests, catalog version, cache and session counters"""
+    rss = resident_memory_bytes()
+    if rss is not None:
+        yield ('kopico_process_resident_memory_bytes', 'gauge',
+               'Resident memory of this worker process', [({}, rss)])
+    if event_log is not None:
+        stats = event_log.stats()
+        for name in ('accepted', 'written', 'dropped', 'lost'):
+            yield (f'kopico_event_log_{name}_total', 'counter', f'Request events {name} by the event log',
+                   [({}, stats[name])])
+    if admission is not None and admission.in_flight is not None:
+        yield ('kopico_in_flight_requests', 'gauge', 'Admitted requests being served by this process',
+               [({}, admission.in_flight.current)])
+    if kopico is None:
+        return
+    
+    yield ('kopico_catalog_version', 'gauge', 'Catalog version being served', [({}, kopico.snapshot.version)])
+    stats = kopico.response_cache.stats()
+    yield ('kopico_response_cache_entries', 'gauge', 'Replies held in the response cache', [({}, stats['size'])])
+    for name in ('hits', 'misses', 'coalesced', 'evictions', 'expirations', 'invalidations'):
+        yield (f'kopico_response_cache_{name}_total', 'counter',
+               f'Response cache {name}', [({}, stats[name])])
+    
+    stats = kopico.also_bought.stats()
+    yield ('kopico_also_bought_events_total', 'counter', 'Cart and order events counted by this process',
+           [({}, stats['events'])])
+    yield ('kopico_also_bought_products', 'gauge', 'Products with an also-bought row in this process',
+           [({}, stats['products'])])
+    
+    stats = kopico.sessions.stats()
+    if 'size' in stats:
+        yield ('kopico_sessions', 'gauge', 'Sessions held in this process', [({}, stats['size'])])
+        yield ('kopico_session_bytes', 'gauge', 'Memory charged to sessions in this process', [({}, stats['bytes'])])
+    for name in ('evictions', 'expirations', 'errors'):
+        if name in stats:
+            yield (f'kopico_session_{name}_total', 'counter', f'Session store {name}', [({}, stats[name])])
+
+metrics.add_collector(collect_process_metrics)
+
+@app.before_request
+def start_request():
+    """Keep the caller's X-Request-ID (or assign one) and start the request clock"""
+    request_id = request.headers.get('X-Request-ID', '')
+    g.request_id = request_id if REQUEST_ID_PATTERN.match(request_id) else uuid.uuid4().hex
+    g.request_start = time.perf_counter()
+
+def request_user_id():
+    """The user_id a request names in its JSON body or query string, if it names one"""
+    if request.is_json:
+        data = request.get_json(silent=True)
+        user_id = data.get('user_id') if isinstance(data, dict) else None
+    else:
+        user_id = request.args.get('user_id')
+    if not isinstance(user_id, str) or user_id in ('', 'anonymous') or len(user_id) > MAX_USER_ID_LENGTH:
+        return None
+    return user_id
+
+def client_address():
+    """The address a request came from, read back through X-Forwarded-For past trusted proxies"""
+    address = request.remote_addr
+    if address in TRUSTED_PROXIES:
+        # Each proxy appends the address it was reached from; the nearest one no proxy of ours
+        # added is the client, since anything further left the client could have written itself
+        hops = [hop.strip() for hop in request.headers.get('X-Forwarded-For', '').split(',') if hop.strip()]
+        for hop in reversed(hops):
+            address = hop
+            if hop not in TRUSTED_PROXIES:
+                break
+    return address
+
+@app.before_request
+def admit_request():
+    """Refuse requests over the in-flight cap or their caller's rate before any work is done"""
+    if admission is None or request.path in ADMISSION_EXEMPT or request.method == 'OPTIONS':
+        return None
+    with STAGE_SECONDS.time('admission'):
+        # The parsed body is cached on the request, so routes do not parse it again
+        refusal = admission.admit(client_address(), request_user_id() if admission.users is not None else None)
+    if refusal is None:
+        g.admitted = True
+        return None
+    
+    status, retry_after, reason = refusal
+    SHED.inc(reason)
+    retry_after = max(1, math.ceil(retry_after))
+    response = jsonify({
+        'error': 'Too many requests' if status == 429 else 'Server is busy',
+        'retry_after': retry_after
+    })
+    response.status_code = status
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+@app.before_request
+def sync_catalog():
+    """Pick up catalog changes other worker processes published, and make sure the catalog file is watched"""
+    if kopico is not None:
+        if kopico.segments is not None:
+            kopico.sync_segments()
+        # Normally started after the fork; this covers servers that fork without telling us
+        kopico.watch_source()
+
+@app.teardown_request
+def release_request(exc):
+    """Give back the in-flight slot of an admitted request, however it ended"""
+    if g.pop('admitted', False):
+        admission.release()
+
+@app.after_request
+def finish_request(response):
+    """Count and time the request and echo its ID back to the caller"""
+    response.headers['X-Request-ID'] = g.request_id
+    if request.environ.get('kopico.warmup'):
+        # Warmup requests are left out of metrics, analytics and the event log
+        return response
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    elapsed = time.perf_counter() - g.request_start
+    REQUEST_SECONDS.observe(elapsed, endpoint)
+    REQUESTS.inc(endpoint, request.method, str(response.status_code))
+    if event_log is not None and endpoint in LOGGED_ENDPOINTS and request.method != 'OPTIONS':
+        # A tuple into a ring buffer; serializing and writing happen on the log's own thread
+        event_log.emit((round(time.time(), 3), endpoint, response.status_code, round(elapsed * 1e3, 2),
+                        g.request_id, g.get('logged_products'), g.get('logged_fields')))
+    if analytics is not None and endpoint not in UNTRACKED_ENDPOINTS and request.method != 'OPTIONS':
+        fields = g.get('logged_fields') or {}
+        intent = fields.get('intent')
+        recommended = endpoint == '/coffee-recommendations' or intent == 'recommend'
+        analytics.record(endpoint, response.status_code, elapsed * 1e3, intent,
+                         g.get('logged_products') if recommended else None)
+    return response
+
+def log_details(products=None, **fields):
+    """Add the names of the products a response is about, and other fields, to its event log entry and analytics"""
+    if event_log is not None or analytics is not None:
+        if products is not None:
+            catalog = get_kopico().catalog
+            g.logged_products = [catalog[product_id].name for product_id in products
+                                 if catalog.get(product_id) is not None]
+        g.logged_fields = fields
+
+def serve_prepared(key, prepare):
+    """
+    Serve a read-only GET response that changes only with the catalog.
+    
+    prepare(snapshot) returns a PreparedResponse. It runs once per catalog
+    version and key; later requests get the stored bytes, or a 304 when
+    their If-None-Match still matches.
+    """
+    kopico = get_kopico()
+    snapshot = kopico.snapshot
+    prepared = kopico.prepared_responses.get_or_compute((snapshot.version,) + key, lambda: prepare(snapshot))
+    return prepared.to_response()
+
+def prepared_json(payload, status=200):
+    """A PreparedResponse with the same body jsonify would send"""
+    return PreparedResponse(app.json.response(payload).get_data(), status=status, cache_control=GET_CACHE_CONTROL)
 
 @app.route('/')
 def index():
-    return "Kopico AI Coffee Assistant API is running! 🤖☕"
+    return serve_prepared(('index',), lambda snapshot: PreparedResponse(
+        "Kopico AI Coffee Assistant API is running! 🤖☕", 'text/html; charset=utf-8',
+        cache_control=GET_CACHE_CONTROL))
 
 @app.route('/chat', methods=['POST'])
 def chat():
     """Main chat endpoint"""
     try:
-        data = request.get_json()
+        kopico = get_kopico()
+        with STAGE_SECONDS.time('parse'):
+            data = request.get_json()
         message = data.get('message', '').strip()
         user_id = data.get('user_id', 'anonymous')
         
@@ -368,17 +1596,92 @@ def chat():
             }), 400
         
         # Process message with Kopico AI
-        response = kopico.process_message(message, user_id)
+        details = {}
+        response = kopico.process_message(message, user_id, details)
+        log_details(details['products'], intent=details['intent'])
+        
+        with STAGE_SECONDS.time('serialize'):
+            return jsonify({
+                'response': response,
+                'timestamp': datetime.now().isoformat(),
+                'bot_name': 'Kopico'
+            })
+    
+    except Exception as e:
+        return jsonify({
+            'error': f'Error processing message: {str(e)}'
+        }), 500
+
+def sse_event(event, data):
+    """Format one Server-Sent Event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/chat/stream', methods=['GET', 'POST'])
+def chat_stream():
+    """Chat endpoint that sends the reply as Server-Sent Events, one section at a time"""
+    data = request.get_json(silent=True) if request.method == 'POST' else request.args
+    message = (data or {}).get('message', '')
+    user_id = (data or {}).get('user_id', 'anonymous')
+    if not isinstance(message, str) or not message.strip():
+        return jsonify({
+            'error': 'No message provided'
+        }), 400
+    
+    kopico = get_kopico()
+    
+    def generate():
+        try:
+            for section in kopico.stream_message(message.strip(), user_id):
+                yield sse_event('chunk', {'text': section})
+            yield sse_event('done', {
+                'timestamp': datetime.now().isoformat(),
+                'bot_name': 'Kopico'
+            })
+        except Exception as e:
+            yield sse_event('error', {'error': f'Error processing message: {str(e)}'})
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Keep reverse proxies from buffering the stream
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/chat/batch', methods=['POST'])
+def chat_batch():
+    """Answer a list of {message, user_id} items in one request, in order"""
+    try:
+        data = request.get_json()
+        items = data.get('messages') if isinstance(data, dict) else None
+        if not isinstance(items, list) or len(items) > MAX_BATCH_MESSAGES:
+            return jsonify({
+                'error': f'messages must be a list of at most {MAX_BATCH_MESSAGES} items'
+            }), 400
+        
+        results = [None] * len(items)
+        valid = []
+        for position, item in enumerate(items):
+            message = item.get('message') if isinstance(item, dict) else None
+            if not isinstance(message, str) or not message.strip():
+                results[position] = {'error': 'No message provided'}
+            else:
+                valid.append((position, message.strip()))
+        
+        replies = get_kopico().process_messages([message for _, message in valid])
+        for (position, _), reply in zip(valid, replies):
+            if isinstance(reply, Exception):
+                results[position] = {'error': f'Error processing message: {str(reply)}'}
+            else:
+                results[position] = {'response': reply}
         
         return jsonify({
-            'response': response,
+            'results': results,
             'timestamp': datetime.now().isoformat(),
             'bot_name': 'Kopico'
         })
     
     except Exception as e:
         return jsonify({
-            'error': f'Error processing message: {str(e)}'
+            'error': f'Error processing messages: {str(e)}'
         }), 500
 
 @app.route('/coffee-recommendations', methods=['POST'])
@@ -386,78 +1689,655 @@ def get_recommendations():
     """Get personalized coffee recommendations"""
     try:
         data = request.get_json()
-        preferences = data.get('preferences', {})
-        
-        # Simple recommendation based on preferences
-        strength = preferences.get('strength', 3)
-        acidity = preferences.get('acidity', 3)
-        
-        recommendations = []
-        for coffee in kopico.coffee_products:
-            score = 0
-            if abs(coffee['strength'] - strength) <= 1:
-                score += 2
-            if abs(coffee['acidity'] - acidity) <= 1:
-                score += 2
+        limit = data.get('limit', 3)
+        kopico = get_kopico()
+        catalog = kopico.catalog
+        
+        if type(limit) is not int or not 1 <= limit <= MAX_RECOMMENDATIONS:
+            return jsonify({
+                'error': f'limit must be an integer between 1 and {MAX_RECOMMENDATIONS}'
+            }), 400
+        
+        # Batch mode: score every profile in one matrix operation
+        if 'profiles' in data:
+            profiles = data['profiles']
+            if not isinstance(profiles, list) or len(profiles) > MAX_BATCH_PROFILES:
+                return jsonify({
+                    'error': f'profiles must be a list of at most {MAX_BATCH_PROFILES} preference objects'
+                }), 400
             
-            recommendations.append({
-                'coffee': coffee,
-                'score': score
+            matches = top_matches(catalog, profiles, limit)
+            log_details(profiles=len(profiles))
+            return jsonify({
+                'results': [
+                    [catalog[product_id].to_dict() for product_id in ids]
+                    for ids in matches
+                ],
+                'message': 'Here are my personalized recommendations for you!'
             })
         
-        # Sort by score and return top 3
-        recommendations.sort(key=lambda x: x['score'], reverse=True)
-        top_recommendations = [rec['coffee'] for rec in recommendations[:3]]
+        preferences = data.get('preferences')
+        if preferences is None:
+            # Fall back to what the user's chat has shown interest in
+            session = kopico.load_session(data.get('user_id'))
+            preferences = session.preferences() if session is not None else {}
+        ids = top_matches(catalog, [preferences], limit)[0]
+        log_details(ids)
         
         return jsonify({
-            'recommendations': top_recommendations,
+            'recommendations': [catalog[product_id].to_dict() for product_id in ids],
             'message': 'Here are my personalized recommendations for you!'
         })
     
+    except ValueError as e:
+        return jsonify({
+            'error': f'Invalid preferences: {str(e)}'
+        }), 400
+    
     except Exception as e:
         return jsonify({
             'error': f'Error getting recommendations: {str(e)}'
         }), 500
 
+def parse_coffee_query(args):
+    """
+    A CoffeeQuery from /coffees query parameters.
+    
+    origin, method and flavor may be repeated or comma-separated and match
+    any of their values; strength, acidity and price take _min and _max
+    bounds. Raises ValueError for anything malformed.
+    """
+    def listed(name):
+        return [value.strip() for given in args.getlist(name) for value in given.split(',') if value.strip()]
+    
+    def number(name):
+        value = args.get(name)
+        if value is None or value == '':
+            return None
+        try:
+            number = float(value)
+        except ValueError:
+            raise ValueError(f"{name} must be a number") from None
+        if not math.isfinite(number):
+            raise ValueError(f"{name} must be a finite number")
+        return number
+    
+    limit = args.get('limit', str(DEFAULT_PAGE_SIZE))
+    if not limit.isdigit() or not 1 <= int(limit) <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be an integer between 1 and {MAX_PAGE_SIZE}")
+    
+    return CoffeeQuery(
+        values={
+            'origin': listed('origin'),
+            'brewing_method': [method.lower().replace(' ', '-') for method in listed('method')],
+            'flavor': listed('flavor')
+        },
+        ranges={field: (number(f'{field}_min'), number(f'{field}_max'))
+                for field in ('strength', 'acidity', 'price')},
+        sort=args.get('sort', ''),
+        limit=int(limit),
+        cursor=args.get('cursor')
+    )
+
+@app.route('/coffees', methods=['GET'])
+def search_coffees():
+    """Filter, sort and page through the catalog, with a count for every facet value"""
+    try:
+        query = parse_coffee_query(request.args)
+    except ValueError as e:
+        return jsonify({
+            'error': f'Invalid query: {str(e)}'
+        }), 400
+    
+    try:
+        def prepare(snapshot):
+            result = snapshot.facets.search(query)
+            return prepared_json({
+                'coffees': [coffee.to_dict() for coffee in result['records']],
+                'total': result['total'],
+                'next_cursor': result['next_cursor'],
+                'facets': result['facets'],
+                'price_range': result['price_range'],
+                'catalog_version': snapshot.version
+            })
+        
+        return serve_prepared(('coffees',) + query.key(), prepare)
+    
+    except ValueError as e:
+        return jsonify({
+            'error': f'Invalid query: {str(e)}'
+        }), 400
+    
+    except Exception as e:
+        return jsonify({
+            'error': f'Error searching coffees: {str(e)}'
+        }), 500
+
+@app.route('/coffees/lookup', methods=['GET'])
+def lookup_coffee():
+    """The coffee a name, origin or alias means even when misspelt, with how confident the match is"""
+    query = request.args.get('q', '')
+    if not normalize_key(query) or len(query) > MAX_LOOKUP_LENGTH:
+        return jsonify({
+            'error': f'q must hold a name of up to {MAX_LOOKUP_LENGTH} characters'
+        }), 400
+    
+    try:
+        def prepare(snapshot):
+            closest = snapshot.closest_product(query)
+            if closest is None:
+                return prepared_json({
+                    'error': 'No coffee matches that name'
+                }, 404)
+            coffee, confidence = closest
+            return prepared_json({
+                'coffee': coffee.to_dict(),
+                'confidence': confidence,
+                'catalog_version': snapshot.version
+            })
+        
+        # Spellings that normalize alike get the same answer, so they share one entry
+        return serve_prepared(('coffee-lookup', normalize_key(query)), prepare)
+    
+    except Exception as e:
+        return jsonify({
+            'error': f'Error looking up coffee: {str(e)}'
+        }), 500
+
+@app.route('/events', methods=['POST'])
+def record_events():
+    """
+    Count cart and order events for the also-bought neighbours: one event
+    object, or {"events": [...]} for a batch
+    """
+    try:
+        kopico = get_kopico()
+        data = request.get_json(silent=True)
+        events = data.get('events', [data]) if isinstance(data, dict) else None
+        if not isinstance(events, list) or not 1 <= len(events) <= MAX_BATCH_EVENTS:
+            return jsonify({
+                'error': f'Send an event object or events, a list of 1 to {MAX_BATCH_EVENTS} events'
+            }), 400
+        
+        accepted, pairs, unknown = kopico.record_events(events)
+        return jsonify({
+            'accepted': accepted,
+            'pairs': pairs,
+            'unknown_products': unknown
+        }), 202
+    
+    except ValueError as e:
+        return jsonify({
+            'error': f'Invalid event: {str(e)}'
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'error': f'Error recording events: {str(e)}'
+        }), 500
+
+@app.route('/also-bought/<product>', methods=['GET'])
+def also_bought(product):
+    """The coffees most often bought with a product, best first, as of the last neighbour refresh"""
+    limit = request.args.get('limit', str(MAX_ALSO_BOUGHT))
+    if not limit.isdigit() or not 1 <= int(limit) <= MAX_ALSO_BOUGHT:
+        return jsonify({
+            'error': f'limit must be an integer between 1 and {MAX_ALSO_BOUGHT}'
+        }), 400
+    
+    try:
+        kopico = get_kopico()
+        coffee = kopico.catalog.find_by_name(product)
+        if coffee is None:
+            return jsonify({
+                'error': f'Product not found: {product}'
+            }), 404
+        
+        def prepare(snapshot):
+            return prepared_json({
+                'product': coffee.name,
+                'also_bought': [dict(neighbor.to_dict(), score=score)
+                                for neighbor, score in kopico.also_bought_with(coffee, int(limit))],
+                'catalog_version': snapshot.version
+            })
+        
+        # The lists change with each refresh, so a refresh starts new entries
+        return serve_prepared(('also-bought', kopico.also_bought.generation, coffee.id, int(limit)), prepare)
+    
+    except Exception as e:
+        return jsonify({
+            'error': f'Error getting also-bought coffees: {str(e)}'
+        }), 500
+
 @app.route('/brewing-guide/<method>', methods=['GET'])
 def get_brewing_guide(method):
     """Get brewing guide for specific method"""
     try:
         method = method.lower().replace(' ', '-')
+        kopico = get_kopico()
         
-        if method in kopico.brewing_methods:
-            guide = kopico.brewing_methods[method]
-            return jsonify({
-                'method': method,
-                'guide': guide,
-                'suitable_coffees': [
-                    coffee for coffee in kopico.coffee_products 
-                    if method in coffee['brewing_methods']
-                ]
-            })
-        else:
-            return jsonify({
+        def prepare(snapshot):
+            catalog = snapshot.catalog
+            if method in snapshot.brewing_methods:
+                return prepared_json({
+                    'method': method,
+                    'guide': snapshot.brewing_methods[method],
+                    'suitable_coffees': [
+                        coffee.to_dict() for coffee in
+                        catalog.get_many(catalog.ids_with_method(method))
+                    ]
+                })
+            return prepared_json({
                 'error': 'Brewing method not found',
-                'available_methods': list(kopico.brewing_methods.keys())
-            }), 404
+                'available_methods': list(snapshot.brewing_methods.keys())
+            }, 404)
+        
+        # Every unknown method gets the same 404 body, so they share one entry
+        known = method if method in kopico.snapshot.brewing_methods else None
+        log_details(method=method)
+        return serve_prepared(('brewing-guide', known), prepare)
     
     except Exception as e:
         return jsonify({
             'error': f'Error getting brewing guide: {str(e)}'
         }), 500
 
+def admin_allowed():
+    """Check the admin token, or allow only local clients when none is configured"""
+    if ADMIN_TOKEN:
+        return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN)
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+def admin_forbidden():
+    return jsonify({
+        'error': 'Admin access required'
+    }), 403
+
+@app.route('/admin/products', methods=['POST'])
+def add_product():
+    """Add a single product to the live catalog"""
+    if not admin_allowed():
+        return admin_forbidden()
+    try:
+        kopico = get_kopico()
+        data = request.get_json()
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Product must be a JSON object'}), 400
+        
+        record = kopico.add_product(data)
+        return jsonify({
+            'product': record.to_dict(),
+            'catalog_version': kopico.snapshot.version
+        }), 201
+    
+    except ValueError as e:
+        return jsonify({
+            'error': f'Invalid product: {str(e)}'
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'error': f'Error adding product: {str(e)}'
+        }), 500
+
+@app.route('/admin/products', methods=['PATCH'])
+def change_products():
+    """Apply a batch of upserts (matched by name) and removals in one catalog version"""
+    if not admin_allowed():
+        return admin_forbidden()
+    try:
+        kopico = get_kopico()
+        data = request.get_json()
+        upserts = data.get('upserts', [])
+        removals = data.get('removals', [])
+        if not all(isinstance(product, dict) for product in upserts):
+            return jsonify({'error': 'upserts must be a list of product objects'}), 400
+        
+        changed, removed = kopico.apply_catalog_changes(
+            upserts=[(product.get('name', ''), product) for product in upserts],
+            removals=removals
+        )
+        return jsonify({
+            'changed': [record.name for record in changed],
+            'removed': [record.name for record in removed],
+            'catalog_version': kopico.snapshot.version
+        })
+    
+    except KeyError as e:
+        return jsonify({
+            'error': f'Product not found: {e.args[0]}'
+        }), 404
+    except ValueError as e:
+        return jsonify({
+            'error': f'Invalid product: {str(e)}'
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'error': f'Error updating catalog: {str(e)}'
+        }), 500
+
+@app.route('/admin/products/<name>', methods=['PUT', 'DELETE'])
+def change_product(name):
+    """Update fields of one product, or remove it"""
+    if not admin_allowed():
+        return admin_forbidden()
+    try:
+        kopico = get_kopico()
+        if request.method == 'DELETE':
+            record = kopico.remove_product(name)
+            return jsonify({
+                'removed': record.name,
+                'catalog_version': kopico.snapshot.version
+            })
+        
+        changes = request.get_json()
+        if not isinstance(changes, dict):
+            return jsonify({'error': 'Changes must be a JSON object'}), 400
+        
+        record = kopico.update_product(name, changes)
+        return jsonify({
+            'product': record.to_dict(),
+            'catalog_version': kopico.snapshot.version
+        })
+    
+    except KeyError:
+        return jsonify({
+            'error': f'Product not found: {name}'
+        }), 404
+    except ValueError as e:
+        return jsonify({
+            'error': f'Invalid product: {str(e)}'
+        }), 400
+    except Exception as e:
+        return jsonify({
+            'error': f'Error updating product: {str(e)}'
+        }), 500
+
+@app.route('/admin/reload', methods=['POST'])
+def reload_catalog():
+    """
+    Read the catalog source again in the background; {"wait": true} waits
+    for the new catalog to be served
+    """
+    if not admin_allowed():
+        return admin_forbidden()
+    kopico = get_kopico()
+    if kopico.source is None:
+        return jsonify({'error': 'No catalog source configured (set KOPICO_CATALOG_PATH)'}), 409
+    
+    data = request.get_json(silent=True)
+    wait = isinstance(data, dict) and data.get('wait') is True
+    started = kopico.reload_catalog(wait=wait)
+    if not wait:
+        return jsonify({
+            'status': 'reloading' if started else 'already_reloading',
+            'catalog_version': kopico.snapshot.version
+        }), 202
+    if kopico.reload_error is not None:
+        return jsonify({
+            'error': f'Error reloading catalog: {kopico.reload_error}',
+            'catalog_version': kopico.snapshot.version
+        }), 500
+    return jsonify({
+        'status': 'reloaded',
+        'catalog_version': kopico.snapshot.version,
+        'source': kopico.source_report
+    })
+
+@app.route('/analytics', methods=['GET'])
+def analytics_endpoint():
+    """Rolling-window request aggregates of the worker process that answers"""
+    if analytics is None:
+        return jsonify({
+            'error': 'Analytics are turned off'
+        }), 404
+    response = jsonify(analytics.snapshot())
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/analytics/stream', methods=['GET'])
+def analytics_stream():
+    """The /analytics aggregates pushed as Server-Sent Events every ANALYTICS_STREAM_INTERVAL seconds"""
+    if analytics is None:
+        return jsonify({
+            'error': 'Analytics are turned off'
+        }), 404
+    if not analytics_streams.acquire(blocking=False):
+        response = jsonify({
+            'error': 'Too many analytics streams',
+            'retry_after': int(ANALYTICS_STREAM_SECONDS)
+        })
+        response.status_code = 503
+        response.headers['Retry-After'] = str(int(ANALYTICS_STREAM_SECONDS))
+        return response
+    
+    def generate():
+        deadline = time.monotonic() + ANALYTICS_STREAM_SECONDS
+        # How long the browser waits before reconnecting once a stream ends
+        yield f"retry: {int(ANALYTICS_STREAM_INTERVAL * 1000)}\n\n"
+        while True:
+            yield sse_event('analytics', analytics.snapshot())
+            if time.monotonic() + ANALYTICS_STREAM_INTERVAL > deadline:
+                return
+            # A draining server ends its streams at once; browsers reconnect to the next one
+            if draining.wait(ANALYTICS_STREAM_INTERVAL):
+                return
+    
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # Called however the stream ends, even when it never started
+    response.call_on_close(analytics_streams.release)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics of the worker process that answers"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/health/live', methods=['GET'])
+def liveness_check():
+    """Liveness probe: the process is up and answering, whether or not it is ready"""
+    return jsonify({
+        'status': 'alive',
+        'pid': os.getpid()
+    })
+
+def readiness():
+    """'ready', 'warming' while the model loads and warms up, or 'draining' once the server is stopping"""
+    if draining.is_set():
+        return 'draining'
+    if kopico is None or (WARMUP_ENABLED and warmup_report is None):
+        return 'warming'
+    return 'ready'
+
+@app.route('/health/ready', methods=['GET'])
+def readiness_check():
+    """Readiness probe: 200 once the model is loaded and warmed up, 503 while warming up or draining"""
+    status = readiness()
+    if status == 'warming':
+        # Servers that never called warm_up (another WSGI server, say) start it here
+        warm_up_in_background()
+    response = jsonify({
+        'status': status,
+        'pid': os.getpid(),
+        'catalog_version': kopico.snapshot.version if kopico is not None else None,
+        'warmup': warmup_report
+    })
+    response.status_code = 200 if status == 'ready' else 503
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
+    kopico = get_kopico()
     return jsonify({
         'status': 'healthy',
+        'ready': readiness() == 'ready',
         'bot_name': 'Kopico',
         'version': '1.0.0',
+        'catalog_version': kopico.snapshot.version,
+        'response_cache': kopico.response_cache.stats(),
+        'sessions': kopico.sessions.stats(),
+        'segment_version': kopico.segment_version if kopico.segments is not None else None,
+        'catalog_source': kopico.source_stats(),
+        'admission': admission.stats() if admission is not None else None,
+        'also_bought': kopico.also_bought.stats(),
+        'event_log': event_log.stats() if event_log is not None else None,
+        'analytics': analytics.stats() if analytics is not None else None,
         'timestamp': datetime.now().isoformat()
     })
 
+def warmup_requests(snapshot):
+    """(method, path, options for the test client) of the requests warm_up() sends"""
+    calls = [('POST', '/chat', {'json': {'message': message, 'user_id': WARMUP_USER_ID}})
+             for message in WARMUP_MESSAGES]
+    calls += [
+        ('POST', '/chat/stream', {'json': {'message': WARMUP_MESSAGES[1]}}),
+        ('POST', '/chat/batch', {'json': {'messages': [{'message': message} for message in WARMUP_MESSAGES]}}),
+        ('POST', '/coffee-recommendations', {'json': {'preferences': {'strength': 4, 'acidity': 2}}}),
+        ('POST', '/coffee-recommendations', {'json': {'profiles': [{'strength': 2}, {'acidity': 4}]}}),
+        ('GET', '/coffees', {'query_string': {'sort': 'price', 'limit': 20}}),
+        ('GET', '/coffees/lookup', {'query_string': {'q': 'columbian'}}),
+        ('GET', '/', {})
+    ]
+    coffee = next(iter(snapshot.catalog), None)
+    if coffee is not None:
+        calls += [
+            ('GET', '/coffees', {'query_string': {'origin': coffee.origin, 'strength_min': 2}}),
+            ('GET', f'/also-bought/{coffee.name}', {})
+        ]
+    calls += [('GET', f'/brewing-guide/{method}', {}) for method in snapshot.brewing_methods]
+    return calls
+
+def warm_up():
+    """
+    Load the model and send representative requests through the app: every
+    intent, the similarity search, fuzzy lookup, a follow-up, streaming,
+    batches, recommendations, catalog search and each brewing guide. Their
+    replies fill the response and prepared-response caches. Runs once per
+    process (workers forked after it inherit the result) and returns what
+    it did, which /health/ready reports.
+    
+    The requests are marked so that metrics, analytics and the event log
+    leave them out, and they write nothing but a session of their own.
+    """
+    global warmup_report
+    with _warmup_lock:
+        if warmup_report is not None:
+            return warmup_report
+        start = time.perf_counter()
+        snapshot = get_kopico().snapshot
+        client = app.test_client()
+        failed = []
+        calls = warmup_requests(snapshot) if WARMUP_ENABLED else []
+        for method, path, options in calls:
+            try:
+                response = client.open(path, method=method, environ_base={'kopico.warmup': True}, **options)
+                response.get_data()
+                if response.status_code >= 500:
+                    failed.append(f"{method} {path}: {response.status_code}")
+            except Exception as e:
+                failed.append(f"{method} {path}: {e}")
+        if failed:
+            print(f"⚠️  {len(failed)} warmup requests failed: {'; '.join(failed[:3])}", file=sys.stderr)
+        warmup_report = {
+            'requests': len(calls),
+            'failed': len(failed),
+            'seconds': round(time.perf_counter() - start, 3),
+            'catalog_version': snapshot.version
+        }
+        return warmup_report
+
+def warm_up_in_background():
+    """Start warm_up() in a thread unless it is running or done"""
+    if warmup_report is None and not _warmup_lock.locked():
+        threading.Thread(target=warm_up, name="kopico-warmup", daemon=True).start()
+
+class RequestsInFlight:
+    """WSGI middleware counting the requests being answered, until their whole body is sent"""
+    
+    def __init__(self, app):
+        self.app = app
+        self.count = 0
+        self._idle = threading.Condition()
+    
+    def __call__(self, environ, start_response):
+        with self._idle:
+            self.count += 1
+        try:
+            return ClosingIterator(self.app(environ, start_response), self._done)
+        except BaseException:
+            self._done()
+            raise
+    
+    def _done(self):
+        with self._idle:
+            self.count -= 1
+            if not self.count:
+                self._idle.notify_all()
+    
+    def wait_idle(self, timeout):
+        """Wait until no request is being answered; False if timeout passed first"""
+        with self._idle:
+            return self._idle.wait_for(lambda: not self.count, timeout)
+
+def serve(host='0.0.0.0', port=5000, fd=None):
+    """
+    Serve with the threaded server until SIGTERM or SIGINT, then drain.
+    
+    fd is a listening socket inherited from the launcher, which a
+    replacement process shares: connections queue on it whichever process
+    accepts them, so this one warms up before it accepts any. A server
+    binding its own port serves at once, probes included, and reports
+    ready once warm. When stopped it reports draining, stops accepting,
+    ends analytics streams and waits up to DRAIN_TIMEOUT seconds for the
+    requests in flight.
+    """
+    if fd is not None:
+        # The inherited socket decides the address, whatever host and port say
+        with socket.socket(fileno=os.dup(fd)) as listener:
+            host, port = listener.getsockname()[:2]
+        warm_up()
+    in_flight = RequestsInFlight(app)
+    server = make_server(host, port, in_flight, threaded=True, fd=fd)
+    if fd is None:
+        warm_up_in_background()
+    
+    def stop(signum, frame):
+        draining.set()
+        # shutdown() waits for serve_forever() to return, so it cannot run on this thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+    
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"📡 Serving on http://{host}:{port} (pid {os.getpid()})")
+    # Returns once stop() shut it down, with the socket closed
+    server.serve_forever()
+    
+    print(f"🚰 Draining {in_flight.count} requests (pid {os.getpid()})...")
+    # Request threads are daemons, so the process would not wait for them
+    if not in_flight.wait_idle(DRAIN_TIMEOUT):
+        print(f"⚠️  {in_flight.count} requests still running after {DRAIN_TIMEOUT:.0f}s", file=sys.stderr)
+    if event_log is not None:
+        event_log.close()
+
 if __name__ == '__main__':
+    if '--build-model' in sys.argv:
+        print(f"🔧 Building Kopico model in {MODEL_PATH}...")
+        source = open_catalog_source(CATALOG_PATH, GUIDES_PATH)
+        build_model(COFFEE_PRODUCTS if source is None else source.read()[0])
+        print("✅ Model built! The server will load it at startup.")
+        sys.exit(0)
+    
     print("🤖 Starting Kopico AI Coffee Assistant...")
+    if '--fd' in sys.argv:
+        # Started by start_kopico.py on a socket it holds, so it can be restarted without dropping requests
+        serve(fd=int(sys.argv[sys.argv.index('--fd') + 1]))
+        sys.exit(0)
+    
+    get_kopico()
+    warm_up()
     print("📡 API will be available at http://localhost:5000")
     print("☕ Ready to help with coffee recommendations and brewing tips!")
     
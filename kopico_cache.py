@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Kopico - Response Cache
+Bounded LRU + TTL cache that collapses concurrent misses for the same key
+"""
+
+import re
+import time
+import threading
+from collections import OrderedDict
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_message(message):
+    """Lowercase a message and collapse its whitespace"""
+    return WHITESPACE.sub(" ", message.lower()).strip()
+
+
+class _Flight:
+    """A computation in progress that other callers can wait on"""
+
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU cache with a time-to-live per entry.
+
+    When several threads miss on the same key at once, only the first one
+    computes the value; the others wait for it and share the result.
+    get_or_compute() does this for a value computed in one call; begin()
+    and finish() for one a caller computes piece by piece, such as a reply
+    streamed as it is formatted.
+    """
+
+    def __init__(self, max_entries=2048, ttl=600.0, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        """Whether key holds a live entry; counts neither a hit nor a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[1] > self.clock()
+
+    def _live(self, key):
+        """The live value for key, counted as a hit, or None; call it holding the lock"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires <= self.clock():
+            del self._entries[key]
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def get(self, key):
+        """Return the cached value for key, or None when it is missing or expired"""
+        with self._lock:
+            value = self._live(key)
+            if value is None:
+                self.misses += 1
+            return value
+
+    def begin(self, key):
+        """
+        Look up key for a caller that computes the value itself on a miss.
+
+        Returns (value, None) on a hit, or once another caller computing
+        the value has finished it. Otherwise returns (None, flight): the
+        caller computes the value and must then call finish() with that
+        flight, whether it succeeds or not.
+        """
+        while True:
+            with self._lock:
+                value = self._live(key)
+                if value is not None:
+                    return value, None
+                flight = self._flights.get(key)
+                if flight is None:
+                    flight = self._flights[key] = _Flight()
+                    self.misses += 1
+                    return None, flight
+                self.coalesced += 1
+
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            if flight.value is not None:
+                return flight.value, None
+            # The caller computing it gave up; compute it here instead
+
+    def finish(self, key, flight, value=None, error=None):
+        """
+        End a computation started by begin(): store value and hand it to
+        the callers waiting for it, or hand them error. With neither, the
+        computation was abandoned and the first waiting caller takes it over.
+        """
+        flight.value = value
+        flight.error = error
+        with self._lock:
+            if value is not None and error is None:
+                self._store(key, value)
+            self._flights.pop(key, None)
+        flight.done.set()
+
+    def get_or_compute(self, key, compute):
+        """Return the cached value for key, computing and storing it on a miss"""
+        value, flight = self.begin(key)
+        if flight is None:
+            return value
+        try:
+            value = compute()
+        except BaseException as e:
+            self.finish(key, flight, error=e)
+            raise
+        self.finish(key, flight, value)
+        return value
+
+    def put(self, key, value):
+        """Store a value computed outside get_or_compute"""
+        with self._lock:
+            self._store(key, value)
+
+    def _store(self, key, value):
+        """Insert a value and evict least recently used entries over the limit"""
+        self._entries[key] = (value, self.clock() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self):
+        """Drop every entry, e.g. after the catalog changed"""
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        """Counters for monitoring"""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations
+            }
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""
+Kopico - Coffee Catalog
+Compact product storage with secondary indexes built at load time
+"""
+
+import sys
+import heapq
+import random
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+
+REQUIRED_FIELDS = ("name", "price", "description", "origin", "strength", "acidity",
+                   "flavor_profile", "brewing_methods")
+
+
+class CoffeeRecord:
+    """A single coffee product stored in a slotted record"""
+
+    __slots__ = ("id", "name", "price", "description", "origin",
+                 "strength", "acidity", "flavor_profile", "brewing_methods", "aliases")
+
+    def __init__(self, id, name, price, description, origin, strength, acidity,
+                 flavor_profile, brewing_methods, aliases=()):
+        self.id = id
+        self.name = name
+        self.price = price
+        self.description = description
+        self.origin = sys.intern(origin)
+        self.strength = strength
+        self.acidity = acidity
+        self.flavor_profile = tuple(sys.intern(flavor) for flavor in flavor_profile)
+        self.brewing_methods = tuple(sys.intern(method) for method in brewing_methods)
+        # Other names customers use for the product; optional
+        self.aliases = tuple(aliases)
+
+    @classmethod
+    def from_dict(cls, id, data):
+        """Build a record from a product dict as used in the API, validating it"""
+        missing = [field for field in REQUIRED_FIELDS if field not in data]
+        if missing:
+            raise ValueError(f"Product is missing fields: {', '.join(missing)}")
+
+        for field in ("name", "description", "origin"):
+            if not isinstance(data[field], str) or not data[field].strip():
+                raise ValueError(f"Product field '{field}' must be a non-empty string")
+        for field in ("price", "strength", "acidity"):
+            if isinstance(data[field], bool) or not isinstance(data[field], (int, float)):
+                raise ValueError(f"Product field '{field}' must be a number")
+        for field in ("flavor_profile", "brewing_methods"):
+            if not isinstance(data[field], (list, tuple)) or not all(isinstance(v, str) for v in data[field]):
+                raise ValueError(f"Product field '{field}' must be a list of strings")
+        aliases = data.get("aliases")
+        if aliases is None:
+            aliases = ()
+        if not isinstance(aliases, (list, tuple)) or not all(isinstance(v, str) and v.strip() for v in aliases):
+            raise ValueError("Product field 'aliases' must be a list of non-empty strings")
+
+        return cls(
+            id=id,
+            name=data["name"].strip(),
+            price=data["price"],
+            description=data["description"],
+            origin=data["origin"].strip(),
+            strength=data["strength"],
+            acidity=data["acidity"],
+            flavor_profile=data["flavor_profile"],
+            brewing_methods=data["brewing_methods"],
+            aliases=[alias.strip() for alias in aliases]
+        )
+
+    @property
+    def text(self):
+        """The text used for similarity matching"""
+        return f"{self.name} {self.description} {self.origin} {' '.join(self.flavor_profile)}"
+
+    def to_dict(self):
+        """Return the product in the JSON shape the API has always used, plus aliases when it has any"""
+        product = {
+            "name": self.name,
+            "price": self.price,
+            "description": self.description,
+            "origin": self.origin,
+            "strength": self.strength,
+            "acidity": self.acidity,
+            "flavor_profile": list(self.flavor_profile),
+            "brewing_methods": list(self.brewing_methods)
+        }
+        if self.aliases:
+            product["aliases"] = list(self.aliases)
+        return product
+
+    def __repr__(self):
+        return f"CoffeeRecord({self.id}, {self.name!r})"
+
+
+def _merge_ids(runs, limit=None):
+    """Merge ascending id runs into one ascending, de-duplicated id list"""
+    merged = []
+    last = None
+    for product_id in heapq.merge(*runs):
+        if product_id != last:
+            merged.append(product_id)
+            last = product_id
+            if limit is not None and len(merged) >= limit:
+                break
+    return merged
+
+
+class CoffeeCatalog:
+    """
+    Coffee products plus the lookup structures every handler needs.
+
+    Product ids are positions in `records` and are never reused: a removed
+    product leaves a None behind. Every index returns ids in catalog order
+    so results match the order of a plain linear scan.
+
+    A catalog is treated as read-only once built. `updated()` returns a new
+    catalog with a higher version, so readers holding the old one keep a
+    consistent view while the new one is published.
+    """
+
+    RANGE_FIELDS = ("strength", "acidity", "price")
+
+    def __init__(self, products=(), version=1):
+        self.records = [CoffeeRecord.from_dict(idx, product) for idx, product in enumerate(products)]
+        self.version = version
+        self._build_indexes()
+
+    @classmethod
+    def from_records(cls, records, version=1):
+        """
+        A catalog over a list of records already built, whose ids must be
+        their positions in it. The list is used as is, not copied.
+        """
+        catalog = cls.__new__(cls)
+        catalog.records = records
+        catalog.version = version
+        catalog._build_indexes()
+        return catalog
+
+    def _build_indexes(self):
+        """Build the secondary indexes over the current records"""
+        by_method = {}
+        by_flavor = {}
+        by_origin = {}
+        by_name = {}
+
+        for record in self:
+            if record.name.lower() in by_name:
+                raise ValueError(f"A product named '{record.name}' already exists")
+            by_name[record.name.lower()] = record.id
+            by_origin.setdefault(record.origin.lower(), []).append(record.id)
+            for method in record.brewing_methods:
+                by_method.setdefault(method, []).append(record.id)
+            for flavor in record.flavor_profile:
+                by_flavor.setdefault(flavor, []).append(record.id)
+
+        self._by_method = {key: tuple(ids) for key, ids in by_method.items()}
+        self._by_flavor = {key: tuple(ids) for key, ids in by_flavor.items()}
+        self._by_origin = {key: tuple(ids) for key, ids in by_origin.items()}
+        self._by_name = by_name
+        self._live_count = len(by_name)
+
+        # For each numeric field keep ids sorted by (value, id) together with
+        # the sorted values, so a range is a contiguous slice found by bisect.
+        # The same fields are also kept as NumPy columns for vectorized scoring
+        self._sorted = {}
+        self.columns = {}
+        self.alive = np.array([record is not None for record in self.records], dtype=bool)
+        for field in self.RANGE_FIELDS:
+            self.columns[field] = np.array(
+                [np.nan if record is None else getattr(record, field) for record in self.records],
+                dtype=np.float64
+            )
+            order = sorted(self, key=lambda record: (getattr(record, field), record.id))
+            self._sorted[field] = (
+                [getattr(record, field) for record in order],
+                [record.id for record in order]
+            )
+
+    def __len__(self):
+        return self._live_count
+
+    def __iter__(self):
+        return (record for record in self.records if record is not None)
+
+    def __getitem__(self, product_id):
+        return self.records[product_id]
+
+    def get(self, product_id):
+        """Return the live record for an id, or None if it is unknown or removed"""
+        if 0 <= product_id < len(self.records):
+            return self.records[product_id]
+        return None
+
+    def get_many(self, ids):
+        """Return the records for a sequence of ids"""
+        records = self.records
+        return [records[product_id] for product_id in ids]
+
+    def sample(self, count, rng=random):
+        """Pick up to count distinct live records at random"""
+        ids = list(self._by_name.values())
+        return self.get_many(rng.sample(ids, min(count, len(ids))))
+
+    def find_by_name(self, name):
+        """Return the record with this exact (case-insensitive) name, or None"""
+        product_id = self._by_name.get(name.strip().lower())
+        return None if product_id is None else self.records[product_id]
+
+    def ids_with_method(self, method, limit=None):
+        """Ids of products that list a brewing method"""
+        ids = self._by_method.get(method, ())
+        return list(ids[:limit]) if limit is not None else list(ids)
+
+    def ids_with_any_flavor(self, flavors, limit=None):
+        """Ids of products having at least one of the given flavor tags"""
+        runs = [self._by_flavor[flavor] for flavor in flavors if flavor in self._by_flavor]
+        return _merge_ids(runs, limit)
+
+    def ids_from_origin(self, origin):
+        """Ids of products from an origin (case-insensitive)"""
+        return list(self._by_origin.get(origin.lower(), ()))
+
+    def ids_in_range(self, field, low=None, high=None, limit=None):
+        """Ids of products whose numeric field lies within [low, high]"""
+        values, ids = self._sorted[field]
+        start = 0 if low is None else bisect_left(values, low)
+        end = len(values) if high is None else bisect_right(values, high)
+
+        # Ids are ascending within each distinct value, so split the slice
+        # into per-value runs and merge them back into catalog order
+        runs = []
+        run_start = start
+        while run_start < end:
+            run_end = bisect_right(values, values[run_start], run_start, end)
+            runs.append(ids[i] for i in range(run_start, run_end))
+            run_start = run_end
+        return _merge_ids(runs, limit)
+
+    def ids_by_value(self, field):
+        """Ascending id tuples keyed by each value of origin (lowercased), brewing_methods or flavor_profile"""
+        return {"origin": self._by_origin, "brewing_methods": self._by_method,
+                "flavor_profile": self._by_flavor}[field]
+
+    @property
+    def methods(self):
+        """All brewing methods that at least one product lists"""
+        return list(self._by_method.keys())
+
+    @property
+    def origins(self):
+        """All product origins in catalog order"""
+        return [self.records[ids[0]].origin for ids in self._by_origin.values()]
+
+    def use_columns(self, columns, alive):
+        """
+        Swap the NumPy columns for equal ones kept elsewhere, such as in shared
+        memory. They are only ever read; changed catalogs get their own copies.
+        """
+        self.columns = dict(columns)
+        self.alive = alive
+
+    def updated(self, upserts=(), removals=()):
+        """
+        Return (new catalog, changed records, removed records) after applying changes.
+
+        `upserts` is a sequence of (name, fields) pairs. When a product with
+        that name exists its fields are merged in (including a new name);
+        otherwise fields must describe a complete new product. `removals`
+        is a sequence of product names. Unknown removals raise KeyError and
+        invalid products raise ValueError; the current catalog is never
+        modified either way.
+        """
+        catalog = self._copy()
+        changed = {}
+        removed = {}
+
+        for name in removals:
+            record = catalog.find_by_name(name)
+            if record is None:
+                raise KeyError(name)
+            catalog._unindex(record)
+            catalog.records[record.id] = None
+            removed[record.id] = record
+            changed.pop(record.id, None)
+
+        for name, fields in upserts:
+            existing = catalog.find_by_name(name)
+            if existing is None:
+                record = CoffeeRecord.from_dict(len(catalog.records), fields)
+                catalog.records.append(None)
+            else:
+                record = CoffeeRecord.from_dict(existing.id, dict(existing.to_dict(), **fields))
+                catalog._unindex(existing)
+
+            clash = catalog.find_by_name(record.name)
+            if clash is not None:
+                raise ValueError(f"A product named '{record.name}' already exists")
+
+            catalog.records[record.id] = record
+            catalog._index(record)
+            changed[record.id] = record
+
+        catalog._refresh_columns(list(changed.values()), list(removed))
+        catalog.version = self.version + 1
+        return catalog, list(changed.values()), list(removed.values())
+
+    def _copy(self):
+        """Shallow copy whose containers can be changed without touching self"""
+        catalog = CoffeeCatalog.__new__(CoffeeCatalog)
+        catalog.records = list(self.records)
+        catalog.version = self.version
+        catalog._by_method = dict(self._by_method)
+        catalog._by_flavor = dict(self._by_flavor)
+        catalog._by_origin = dict(self._by_origin)
+        catalog._by_name = dict(self._by_name)
+        catalog._live_count = self._live_count
+        catalog._sorted = {field: (list(values), list(ids)) for field, (values, ids) in self._sorted.items()}
+        catalog.columns = self.columns
+        catalog.alive = self.alive
+        return catalog
+
+    def _index(self, record):
+        """Add a record to every index of a copied catalog"""
+        self._by_name[record.name.lower()] = record.id
+        self._live_count += 1
+        _insert_id(self._by_origin, record.origin.lower(), record.id)
+        for method in record.brewing_methods:
+            _insert_id(self._by_method, method, record.id)
+        for flavor in record.flavor_profile:
+            _insert_id(self._by_flavor, flavor, record.id)
+        for field, (values, ids) in self._sorted.items():
+            value = getattr(record, field)
+            low = bisect_left(values, value)
+            high = bisect_right(values, value, low)
+            position = bisect_left(ids, record.id, low, high)
+            values.insert(position, value)
+            ids.insert(position, record.id)
+
+    def _unindex(self, record):
+        """Remove a record from every index of a copied catalog"""
+        del self._by_name[record.name.lower()]
+        self._live_count -= 1
+        _remove_id(self._by_origin, record.origin.lower(), record.id)
+        for method in record.brewing_methods:
+            _remove_id(self._by_method, method, record.id)
+        for flavor in record.flavor_profile:
+            _remove_id(self._by_flavor, flavor, record.id)
+        for field, (values, ids) in self._sorted.items():
+            value = getattr(record, field)
+            low = bisect_left(values, value)
+            high = bisect_right(values, value, low)
+            position = bisect_left(ids, record.id, low, high)
+            del values[position]
+            del ids[position]
+
+    def _refresh_columns(self, changed, removed_ids):
+        """Give a copied catalog its own NumPy columns with the changes applied"""
+        size = len(self.records)
+        self.alive = _resized(self.alive, size, False)
+        self.columns = {field: _resized(column, size, np.nan) for field, column in self.columns.items()}
+
+        self.alive[removed_ids] = False
+        for field in self.RANGE_FIELDS:
+            self.columns[field][removed_ids] = np.nan
+        for record in changed:
+            self.alive[record.id] = True
+            for field in self.RANGE_FIELDS:
+                self.columns[field][record.id] = getattr(record, field)
+
+
+def _resized(column, size, fill):
+    """Copy of a column grown to size, new slots set to fill"""
+    grown = np.full(size, fill, dtype=column.dtype)
+    grown[:len(column)] = column
+    return grown
+
+
+def _insert_id(index, key, product_id):
+    """Insert an id into a key's ascending id tuple, replacing the tuple"""
+    ids = index.get(key, ())
+    position = bisect_left(ids, product_id)
+    index[key] = ids[:position] + (product_id,) + ids[position:]
+
+
+def _remove_id(index, key, product_id):
+    """Remove an id from a key's id tuple, dropping the key when it empties"""
+    ids = index[key]
+    position = bisect_left(ids, product_id)
+    ids = ids[:position] + ids[position + 1:]
+    if ids:
+        index[key] = ids
+    else:
+        del index[key]
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Kopico - Also Bought
+Item-to-item co-occurrence counts kept up to date from cart and order events, with a top-k neighbour list per product
+"""
+
+import os
+import sys
+import glob
+import json
+import math
+import time
+import heapq
+import threading
+import contextlib
+from operator import itemgetter
+
+try:
+    import fcntl
+except ImportError:
+    # No flock on Windows; the journal is then only locked within a process
+    fcntl = None
+
+# Rows are spread over this many independently locked shards
+SHARDS = 16
+
+# How much one event says its products go together: adding a coffee to a
+# cart that holds another counts once, buying them in one order three times
+EVENT_WEIGHTS = {"cart": 1, "order": 3}
+
+# Products of one event that are counted; an order of n adds n * (n - 1) pairs
+MAX_EVENT_PRODUCTS = 50
+
+# Partners counted per product. A row that outgrows this drops its weaker
+# half, so memory stays bounded however many one-off pairs arrive
+MAX_ROW_SIZE = 256
+
+# Neighbours ranked per product
+TOP_K = 10
+
+# Seconds between refreshes of the neighbour lists of changed products. Each
+# worker process refreshes on its own clock, so with a shared journal two
+# workers may answer from counts up to this far apart; without one, each
+# worker only ever counts the events it received itself
+REFRESH_INTERVAL = 5.0
+
+# Bytes a shared journal may reach before a refresh folds it into a snapshot
+# of the counts and starts it afresh from there
+JOURNAL_BYTES = 16 << 20
+
+
+class CoOccurrence:
+    """
+    Sparse item-item co-occurrence matrix, updated one event at a time.
+
+    Products are keys (lowercase names, which survive a catalog reload
+    that renumbers ids). Each has a row {partner: weighted count} and a
+    weighted event total in one of SHARDS dicts, each behind its own lock,
+    so recording an event touches only the rows of its products and marks
+    them dirty. A background thread re-ranks the dirty rows every
+    refresh_interval seconds into each product's top_k neighbours, scored
+    by cosine similarity, count / sqrt(total * partner total), so best
+    sellers do not top every list. Reads only look up that finished list
+    and cost O(k) however many events arrive.
+
+    A list is re-ranked when its own row changes; partner totals moving
+    meanwhile shift its scores a little until then.
+
+    Worker processes each hold their own matrix. Given a journal directory
+    they share one: record() appends the event to a journal there, and
+    every process counts every journaled event, its own included, in order
+    at its next refresh, so all of them hold the same counts. A journal
+    past journal_bytes is folded into a snapshot that its next lines add to.
+    """
+
+    def __init__(self, top_k=TOP_K, refresh_interval=REFRESH_INTERVAL, max_row_size=MAX_ROW_SIZE,
+                 journal=None, journal_bytes=JOURNAL_BYTES):
+        self.top_k = top_k
+        self.refresh_interval = refresh_interval
+        self.max_row_size = max_row_size
+        self.journal = journal
+        self.journal_bytes = journal_bytes
+        # (inode, first line, byte offset) of the journal read so far
+        self._journal_position = None
+        self._refresh_lock = threading.Lock()
+        if journal is not None:
+            os.makedirs(journal, exist_ok=True)
+            with self._journal_lock(exclusive=True):
+                if not os.path.exists(self._journal_path):
+                    self._start_journal(None)
+        # (lock, rows, totals, dirty keys) per shard
+        self._shards = [(threading.Lock(), {}, {}, set()) for _ in range(SHARDS)]
+        self._neighbors = {}
+        self._stats_lock = threading.Lock()
+        self.events = 0
+        self.pairs = 0
+        # Bumped by every refresh that changed a list, so anything derived
+        # from the lists can tell when it is stale
+        self.generation = 0
+        self._refresher = None
+        self._refresher_pid = None
+        self._start_lock = threading.Lock()
+
+    def _shard(self, key):
+        return self._shards[hash(key) % SHARDS]
+
+    def record(self, kind, products, added=None):
+        """
+        Count one event and return the pairs it added.
+
+        kind is "cart" or "order". An order pairs all of its products; a
+        cart event names the product just added and pairs it only with the
+        rest of the cart, whose own pairs were counted when they were added.
+        """
+        weight = EVENT_WEIGHTS[kind]
+        products = [key for key in dict.fromkeys(products) if key != added][:MAX_EVENT_PRODUCTS]
+        if self.journal is not None:
+            self._append([kind, products, added])
+            pairs = len(products) * (len(products) - 1 if added is None else 2)
+        else:
+            pairs = self._count(weight, products, added)
+
+        with self._stats_lock:
+            self.events += 1
+            self.pairs += pairs
+        if self._refresher_pid != os.getpid():
+            # Started by the first event, so a forked worker starts its own
+            self.start()
+        return pairs
+
+    def _count(self, weight, products, added):
+        """Add one event's pairs to the rows of its products; returns how many"""
+        if added is None:
+            updates = {key: [partner for partner in products if partner != key] for key in products}
+        else:
+            updates = {key: (added,) for key in products}
+            updates[added] = products
+
+        pairs = 0
+        for key, partners in updates.items():
+            lock, rows, totals, dirty = self._shard(key)
+            with lock:
+                totals[key] = totals.get(key, 0) + weight
+                row = rows.get(key)
+                if row is None:
+                    row = rows[key] = {}
+                for partner in partners:
+                    row[partner] = row.get(partner, 0) + weight
+                if len(row) > self.max_row_size:
+                    self._prune(row)
+                if partners:
+                    dirty.add(key)
+            pairs += len(partners)
+        return pairs
+
+    def _prune(self, row):
+        """Keep the stronger half of a row; a pair dropped early enough was seen too rarely to rank"""
+        kept = heapq.nlargest(self.max_row_size // 2, row.items(), key=itemgetter(1))
+        row.clear()
+        row.update(kept)
+
+    def _total(self, key):
+        # Read without the shard lock: a single dict lookup is atomic
+        return self._shard(key)[2].get(key, 0)
+
+    @property
+    def _journal_path(self):
+        return os.path.join(self.journal, "events.jsonl")
+
+    @contextlib.contextmanager
+    def _journal_lock(self, exclusive=False):
+        """Hold the journal's lock: shared to append to it, exclusive to start it afresh"""
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.journal, "lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _append(self, event):
+        line = (json.dumps(event, separators=(",", ":")) + "\n").encode("utf-8")
+        with self._journal_lock():
+            # One O_APPEND write, so lines from concurrent processes never interleave
+            fd = os.open(self._journal_path, os.O_WRONLY | os.O_APPEND)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+    def _start_journal(self, snapshot):
+        """Replace the journal with one continuing from a snapshot file (None: from nothing)"""
+        header = (json.dumps({"snapshot": snapshot, "started": f"{time.time_ns()}-{os.getpid()}"}) + "\n").encode("utf-8")
+        staging = f"{self._journal_path}.tmp-{os.getpid()}"
+        with open(staging, "wb") as f:
+            f.write(header)
+        # Processes holding the old journal open finish reading it
+        os.replace(staging, self._journal_path)
+        return os.stat(self._journal_path).st_ino, header
+
+    def _catch_up(self):
+        """
+        Count the events journaled since this process last read, by any
+        process; returns the journal's size. A journal started afresh
+        replaces the counts with the snapshot it continues from first.
+        """
+        with open(self._journal_path, "rb") as f:
+            inode = os.fstat(f.fileno()).st_ino
+            header = f.readline()
+            position = self._journal_position
+            # A new first line tells a fresh journal apart should the inode have been reused
+            if position is not None and position[:2] == (inode, header):
+                f.seek(position[2])
+            else:
+                self._load(json.loads(header)["snapshot"])
+            offset = f.tell()
+            for line in iter(f.readline, b""):
+                if not line.endswith(b"\n"):
+                    # Still being written
+                    break
+                kind, products, added = json.loads(line)
+                self._count(EVENT_WEIGHTS[kind], products, added)
+                offset += len(line)
+            self._journal_position = (inode, header, offset)
+        return offset
+
+    def _load(self, snapshot):
+        """Replace every row and total with those of a snapshot file, or clear them"""
+        state = {"rows": {}, "totals": {}}
+        if snapshot is not None:
+            with open(os.path.join(self.journal, snapshot), encoding="utf-8") as f:
+                state = json.load(f)
+        for lock, rows, totals, dirty in self._shards:
+            with lock:
+                rows.clear()
+                totals.clear()
+                dirty.clear()
+        for key, total in state["totals"].items():
+            lock, rows, totals, dirty = self._shard(key)
+            with lock:
+                totals[key] = total
+                rows[key] = state["rows"].get(key, {})
+                dirty.add(key)
+        self._neighbors = {key: ranked for key, ranked in self._neighbors.items() if key in state["totals"]}
+
+    def _compact(self):
+        """Fold the journal into a snapshot of the counts and start it afresh from there"""
+        with self._journal_lock(exclusive=True):
+            # Nothing is appended meanwhile, so once caught up the counts hold every journaled event
+            if self._catch_up() <= self.journal_bytes:
+                # Another process started it afresh first
+                return
+            state = {"rows": {}, "totals": {}}
+            for lock, rows, totals, _ in self._shards:
+                with lock:
+                    state["rows"].update(rows)
+                    state["totals"].update(totals)
+            snapshot = f"snapshot-{time.time_ns()}-{os.getpid()}.json"
+            staging = os.path.join(self.journal, f"{snapshot}.tmp")
+            with open(staging, "w", encoding="utf-8") as f:
+                json.dump(state, f, separators=(",", ":"))
+            os.replace(staging, os.path.join(self.journal, snapshot))
+            inode, header = self._start_journal(snapshot)
+            self._journal_position = (inode, header, len(header))
+            # The previous snapshot stays for processes still reading the journal that named it
+            for stale in sorted(glob.glob(os.path.join(self.journal, "snapshot-*.json")))[:-2]:
+                os.remove(stale)
+
+    def refresh(self):
+        """Re-rank the neighbours of every product whose row changed; returns how many were"""
+        with self._refresh_lock:
+            if self.journal is not None and self._catch_up() > self.journal_bytes:
+                self._compact()
+            return self._rerank()
+
+    def _rerank(self):
+        refreshed = 0
+        for lock, rows, totals, dirty in self._shards:
+            with lock:
+                changed = [(key, totals[key], list(rows[key].items())) for key in dirty]
+                dirty.clear()
+            # Ranked outside the lock, so events for this shard carry on meanwhile
+            for key, total, row in changed:
+                scored = ((count / math.sqrt(total * max(self._total(partner), count)), partner)
+                          for partner, count in row)
+                best = heapq.nlargest(self.top_k, scored, key=itemgetter(0))
+                self._neighbors[key] = tuple((partner, round(score, 4)) for score, partner in best)
+            refreshed += len(changed)
+        if refreshed:
+            self.generation += 1
+        return refreshed
+
+    def neighbors(self, key, limit=None):
+        """(partner key, score) of the products most often bought with a product, best first, as last refreshed"""
+        if self.journal is not None and self._refresher_pid != os.getpid():
+            # A process answering from the journal keeps up with it whether or not it records events
+            self.start()
+        return self._neighbors.get(key, ())[:self.top_k if limit is None else limit]
+
+    def start(self):
+        """Refresh neighbour lists in a background thread every refresh_interval seconds"""
+        with self._start_lock:
+            if self._refresher_pid == os.getpid():
+                return
+            # A forked worker inherits the parent's refresher but not its thread
+            self._refresher = threading.Thread(target=self._run, name="kopico-also-bought", daemon=True)
+            self._refresher_pid = os.getpid()
+            self._refresher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"⚠️  Refreshing also-bought neighbours failed: {e}", file=sys.stderr)
+
+    def stats(self):
+        return {
+            'events': self.events,
+            'pairs': self.pairs,
+            'products': sum(len(rows) for _, rows, _, _ in self._shards),
+            'ranked': len(self._neighbors),
+            'pending': sum(len(dirty) for _, _, _, dirty in self._shards),
+            'generation': self.generation,
+            'shared': self.journal is not None
+        }
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+Kopico - Event Log
+In-memory ring buffer of request events drained by a background thread into size-rotated JSONL segments, and a reader for them
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import atexit
+import argparse
+import threading
+from collections import Counter
+
+# Events buffered in memory; past this, new events are dropped and counted
+DEFAULT_CAPACITY = 65536
+
+# A segment is closed and a new one started once it holds this many bytes
+DEFAULT_SEGMENT_BYTES = 64 << 20
+
+# Closed segments kept; older ones are deleted
+DEFAULT_MAX_SEGMENTS = 16
+
+# Seconds the writer waits between drains, unless the buffer fills to half first
+FLUSH_INTERVAL = 0.5
+
+# Events serialized and written with one write() call
+BATCH_SIZE = 4096
+
+# Segment files are events-<ms since the epoch>-<pid>.jsonl; the one being
+# written ends in .open until it is closed
+SEGMENT_PREFIX = "events-"
+SEGMENT_SUFFIX = ".jsonl"
+OPEN_SUFFIX = ".open"
+
+# Field names of the event tuples emit() takes; None values are left out
+FIELDS = ("ts", "endpoint", "status", "ms", "request_id", "products")
+
+
+class RingBuffer:
+    """
+    Fixed-size FIFO of events in a preallocated list.
+
+    put() never waits for room: when the buffer is full the event is
+    dropped and counted, so a writer that falls behind costs events, not
+    request latency.
+    """
+
+    def __init__(self, capacity):
+        self._slots = [None] * capacity
+        self._head = 0
+        self._size = 0
+        self._lock = threading.Lock()
+        self.accepted = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def capacity(self):
+        return len(self._slots)
+
+    def put(self, item):
+        """Append an item; False when the buffer is full and it was dropped"""
+        with self._lock:
+            if self._size == len(self._slots):
+                self.dropped += 1
+                return False
+            self._slots[(self._head + self._size) % len(self._slots)] = item
+            self._size += 1
+            self.accepted += 1
+            return True
+
+    def take(self, limit):
+        """Remove and return up to limit of the oldest items"""
+        with self._lock:
+            count = min(limit, self._size)
+            end = self._head + count
+            if end <= len(self._slots):
+                items = self._slots[self._head:end]
+                self._slots[self._head:end] = [None] * count
+            else:
+                end -= len(self._slots)
+                items = self._slots[self._head:] + self._slots[:end]
+                self._slots[self._head:] = [None] * (len(self._slots) - self._head)
+                self._slots[:end] = [None] * end
+            self._head = end % len(self._slots)
+            self._size -= count
+            return items
+
+
+def _pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def segment_paths(directory):
+    """Segment files in a directory, closed and open, oldest first"""
+    paths = glob.glob(os.path.join(directory, f"{SEGMENT_PREFIX}*{SEGMENT_SUFFIX}"))
+    paths += glob.glob(os.path.join(directory, f"{SEGMENT_PREFIX}*{SEGMENT_SUFFIX}{OPEN_SUFFIX}"))
+    return sorted(paths, key=os.path.basename)
+
+
+class EventLog:
+    """
+    Append-only log of request events, written off the request path.
+
+    emit() stores an event tuple (see FIELDS, plus a dict of extra fields
+    or None) in a RingBuffer and returns. A writer thread, started by the
+    first event so every forked worker runs its own, drains the buffer
+    every FLUSH_INTERVAL seconds, or sooner once it is half full, and
+    appends each batch to the open segment as JSON lines with one write.
+    Segments are rotated at segment_bytes and the oldest closed ones
+    deleted past max_segments, so the log takes bounded disk. Each process
+    writes its own segments, so workers never interleave lines.
+    """
+
+    def __init__(self, directory, capacity=DEFAULT_CAPACITY, segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 max_segments=DEFAULT_MAX_SEGMENTS, flush_interval=FLUSH_INTERVAL):
+        self.directory = str(directory)
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.flush_interval = flush_interval
+        self.buffer = RingBuffer(capacity)
+        self.written = 0
+        self.bytes_written = 0
+        self.lost = 0
+        self.errors = 0
+        self.last_error = None
+        self._file = None
+        self._path = None
+        self._file_bytes = 0
+        self._wake = threading.Event()
+        self._write_lock = threading.Lock()
+        self._writer = None
+        self._writer_pid = None
+        self._start_lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def emit(self, event):
+        """Queue an event for writing; never blocks on disk, and drops it when the buffer is full"""
+        if self._writer_pid != os.getpid():
+            self.start()
+        if not self.buffer.put(event):
+            return False
+        if len(self.buffer) * 2 >= self.buffer.capacity:
+            self._wake.set()
+        return True
+
+    @property
+    def dropped(self):
+        return self.buffer.dropped
+
+    def start(self):
+        """Start the writer thread of this process"""
+        with self._start_lock:
+            if self._writer_pid == os.getpid():
+                return
+            # A forked worker inherits the parent's handle but not its thread
+            self._file = self._path = None
+            self._writer = threading.Thread(target=self._run, name="kopico-event-log", daemon=True)
+            self._writer_pid = os.getpid()
+            self._writer.start()
+            atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Write out everything buffered so far"""
+        with self._write_lock:
+            while True:
+                events = self.buffer.take(BATCH_SIZE)
+                if not events:
+                    return
+                self._write(events)
+
+    def _write(self, events):
+        data = "".join(self._encode(event) for event in events).encode("utf-8")
+        try:
+            if self._file is not None and self._file_bytes + len(data) > self.segment_bytes:
+                self._close_segment()
+            if self._file is None:
+                self._open_segment()
+            self._file.write(data)
+            self._file.flush()
+        except OSError as e:
+            # A full or missing disk loses these events but never stops requests
+            self.errors += 1
+            self.lost += len(events)
+            if self.last_error is None:
+                print(f"⚠️  Writing the event log to {self.directory} failed: {e}", file=sys.stderr)
+            self.last_error = str(e)
+            self._file = None
+            return
+        self._file_bytes += len(data)
+        self.written += len(events)
+        self.bytes_written += len(data)
+
+    @staticmethod
+    def _encode(event):
+        record = {field: value for field, value in zip(FIELDS, event) if value is not None}
+        if event[len(FIELDS)]:
+            record.update(event[len(FIELDS)])
+        return json.dumps(record, separators=(",", ":"), ensure_ascii=False) + "\n"
+
+    def _open_segment(self):
+        name = f"{SEGMENT_PREFIX}{int(time.time() * 1000):013d}-{os.getpid()}{SEGMENT_SUFFIX}"
+        self._path = os.path.join(self.directory, name)
+        self._file = open(self._path + OPEN_SUFFIX, "ab")
+        self._file_bytes = 0
+        self._prune()
+
+    def _close_segment(self):
+        self._file.close()
+        os.replace(self._path + OPEN_SUFFIX, self._path)
+        self._file = self._path = None
+
+    def _prune(self):
+        """Delete the oldest segments past max_segments; open ones only when their process is gone"""
+        closed = []
+        for path in segment_paths(self.directory):
+            if path.endswith(OPEN_SUFFIX):
+                pid = int(os.path.basename(path).split("-")[2].split(".")[0])
+                if pid == os.getpid() or _pid_running(pid):
+                    continue
+            closed.append(path)
+        for path in closed[:max(0, len(closed) - self.max_segments)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def close(self):
+        """Write out what is buffered and close the open segment"""
+        if self._writer_pid != os.getpid():
+            return
+        self.flush()
+        with self._write_lock:
+            if self._file is not None:
+                try:
+                    self._close_segment()
+                except OSError:
+                    self._file = None
+
+    def stats(self):
+        return {
+            'directory': self.directory,
+            'accepted': self.buffer.accepted,
+            'written': self.written,
+            'dropped': self.dropped,
+            'lost': self.lost,
+            'buffered': len(self.buffer),
+            'capacity': self.buffer.capacity,
+            'bytes_written': self.bytes_written,
+            'errors': self.errors,
+            'last_error': self.last_error
+        }
+
+
+def open_event_log(directory=None, capacity=DEFAULT_CAPACITY, segment_bytes=DEFAULT_SEGMENT_BYTES,
+                   max_segments=DEFAULT_MAX_SEGMENTS):
+    """An EventLog writing to directory, or None when no directory is configured"""
+    return EventLog(directory, capacity, segment_bytes, max_segments) if directory else None
+
+
+def read_events(directory, since=None):
+    """
+    Yield every event logged in a directory as a dict, segment by segment.
+
+    A line still being written at the end of an open segment is skipped.
+    since, a Unix time, skips events logged before it.
+    """
+    for path in segment_paths(directory):
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            # Closed (renamed) or pruned since it was listed
+            continue
+        with f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if since is None or event.get("ts", 0) >= since:
+                    yield event
+
+
+def percentile(values, fraction):
+    """The value below which a fraction of sorted values lie"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(events):
+    """Request counts, latency percentiles, intents and products mentioned, per endpoint"""
+    latencies = {}
+    statuses = Counter()
+    intents = Counter()
+    products = Counter()
+    for event in events:
+        endpoint = event.get("endpoint")
+        latencies.setdefault(endpoint, []).append(event.get("ms", 0))
+        statuses[(endpoint, event.get("status"))] += 1
+        if "intent" in event:
+            intents[event["intent"]] += 1
+        products.update(event.get("products") or ())
+
+    endpoints = {}
+    for endpoint, values in latencies.items():
+        values.sort()
+        endpoints[endpoint] = {
+            'requests': len(values),
+            'statuses': {str(status): count for (name, status), count in statuses.items() if name == endpoint},
+            'p50_ms': percentile(values, 0.5),
+            'p95_ms': percentile(values, 0.95),
+            'p99_ms': percentile(values, 0.99)
+        }
+    return {
+        'endpoints': endpoints,
+        'intents': dict(intents.most_common()),
+        'top_products': dict(products.most_common(10))
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Read the Kopico event log")
+    parser.add_argument('command', choices=('cat', 'summary'),
+                        help="cat prints events as JSON lines; summary aggregates them")
+    parser.add_argument('directory', help="the KOPICO_EVENT_LOG_DIR the server wrote to")
+    parser.add_argument('--since', type=float, default=None, help="only events of the last N seconds")
+    parser.add_argument('--endpoint', default=None, help="only events of this endpoint, e.g. /chat")
+    args = parser.parse_args(argv)
+
+    since = time.time() - args.since if args.since is not None else None
+    events = (event for event in read_events(args.directory, since)
+              if args.endpoint is None or event.get("endpoint") == args.endpoint)
+    try:
+        if args.command == 'cat':
+            for event in events:
+                sys.stdout.write(json.dumps(event, ensure_ascii=False) + "\n")
+        else:
+            print(json.dumps(summarize(events), indent=2, ensure_ascii=False))
+    except BrokenPipeError:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+"""
+Kopico - Faceted Search
+Bitmaps per facet value that answer catalog filters by intersection, with facet counts and cursors
+"""
+
+import json
+import math
+import base64
+import itertools
+import threading
+
+import numpy as np
+
+# Facets and the catalog field each is read from
+FACETS = {
+    "origin": "origin",
+    "brewing_method": "brewing_methods",
+    "flavor": "flavor_profile",
+    "strength": "strength",
+    "acidity": "acidity",
+}
+
+# Facets answered from the catalog's numeric columns; ranges of them are
+# unions of their value bitmaps
+RANGE_FACETS = ("strength", "acidity")
+
+# Sort orders besides catalog order; a leading "-" sorts descending
+SORT_FIELDS = ("price", "strength", "acidity", "name")
+
+# Values listed per facet in a result, most frequent first
+MAX_FACET_VALUES = 100
+
+# A value gets a bitmap when at least this fraction of products have it,
+# which is where a bitmap becomes smaller than a list of 32-bit ids
+DENSE_FRACTION = 1 / 32
+
+if hasattr(np, "bitwise_count"):
+    def popcount(words):
+        """Set bits per row of a uint64 array"""
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.uint32)
+else:
+    # NumPy before 2.0 has no popcount; look bits up 16 at a time
+    _POPCOUNT16 = np.array([bin(i).count("1") for i in range(1 << 16)], dtype=np.uint8)
+
+    def popcount(words):
+        """Set bits per row of a uint64 array"""
+        halves = words.view(np.uint16).reshape(words.shape[:-1] + (-1,))
+        return _POPCOUNT16[halves].sum(axis=-1, dtype=np.uint32)
+
+
+def _key(value):
+    """Facet values match case-insensitively; numbers match as numbers"""
+    return value.lower() if isinstance(value, str) else value
+
+
+def pack(mask, words):
+    """A boolean array as a bitmap of words uint64 words, bit i of the bitmap being mask[i]"""
+    packed = np.zeros(words * 8, dtype=np.uint8)
+    bits = np.packbits(mask, bitorder="little")
+    packed[:len(bits)] = bits
+    return packed.view(np.uint64)
+
+
+def unpack(bitmap, size):
+    """The boolean array of the first size bits of a bitmap"""
+    return np.unpackbits(bitmap.view(np.uint8), count=size, bitorder="little").view(bool)
+
+
+class FacetGroup:
+    """
+    The values of one facet and the products having each.
+
+    Values most products share get a bitmap row, counted against a filter
+    with popcount. The long tail of rare values (an origin per estate, say)
+    is kept as sorted id lists back to back, with ptr marking where each
+    starts, and counted by looking its ids up in the unpacked filter. Keys
+    are the dense values then the sparse ones, each part in sorted order.
+    """
+
+    __slots__ = ("keys", "labels", "rows", "counts", "bitmaps", "ptr", "ids")
+
+    def __init__(self, values, size, words):
+        """values maps each key to (label, ascending ids)"""
+        threshold = max(1, int(size * DENSE_FRACTION))
+        dense = sorted((key for key, (_, ids) in values.items() if len(ids) >= threshold), key=str)
+        sparse = sorted((key for key, (_, ids) in values.items() if len(ids) < threshold), key=str)
+        self.keys = dense + sparse
+        self.labels = [values[key][0] for key in self.keys]
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+        self.counts = np.array([len(values[key][1]) for key in self.keys], dtype=np.int64)
+
+        self.bitmaps = np.zeros((len(dense), words), dtype=np.uint64)
+        mask = np.zeros(size, dtype=bool)
+        for row, key in enumerate(dense):
+            ids = np.asarray(values[key][1], dtype=np.int64)
+            mask[ids] = True
+            self.bitmaps[row] = pack(mask, words)
+            mask[ids] = False
+
+        self.ptr = np.zeros(len(sparse) + 1, dtype=np.int64)
+        self.ptr[1:] = np.cumsum([len(values[key][1]) for key in sparse])
+        self.ids = np.fromiter(itertools.chain.from_iterable(values[key][1] for key in sparse),
+                               dtype=np.int64, count=int(self.ptr[-1]))
+
+    def union(self, keys, size, words):
+        """Bitmap of the products having any of the given values"""
+        dense = len(self.bitmaps)
+        rows = [self.rows[key] for key in keys if key in self.rows]
+        bitmap = np.zeros(words, dtype=np.uint64)
+        if any(row < dense for row in rows):
+            bitmap |= np.bitwise_or.reduce(self.bitmaps[[row for row in rows if row < dense]], axis=0)
+        sparse = [self.ids[self.ptr[row - dense]:self.ptr[row - dense + 1]] for row in rows if row >= dense]
+        if sparse:
+            mask = np.zeros(size, dtype=bool)
+            mask[np.concatenate(sparse)] = True
+            bitmap |= pack(mask, words)
+        return bitmap
+
+    def count(self, bitmap, mask=None):
+        """Products in a bitmap having each value; mask, the same set unpacked, is needed for sparse values"""
+        counts = np.empty(len(self.keys), dtype=np.int64)
+        dense = len(self.bitmaps)
+        counts[:dense] = popcount(self.bitmaps & bitmap)
+        if len(self.ids):
+            hits = np.zeros(len(self.ids) + 1, dtype=np.int64)
+            np.cumsum(mask[self.ids], out=hits[1:])
+            counts[dense:] = hits[self.ptr[1:]] - hits[self.ptr[:-1]]
+        return counts
+
+    def top(self, counts, limit):
+        """Rows of the values with the highest non-zero counts, highest first, then in key order"""
+        present = np.flatnonzero(counts)
+        if len(present) > limit:
+            threshold = np.partition(counts[present], -limit)[-limit]
+            above = present[counts[present] > threshold]
+            present = np.concatenate([above, present[counts[present] == threshold][:limit - len(above)]])
+        return present[np.lexsort((present, -counts[present]))]
+
+
+class CoffeeQuery:
+    """
+    A validated /coffees query.
+
+    values maps a facet to the values it must match (any of them), ranges
+    a numeric field to (low, high) with either end None.
+    """
+
+    __slots__ = ("values", "ranges", "sort", "limit", "cursor")
+
+    def __init__(self, values=None, ranges=None, sort="", limit=20, cursor=None):
+        self.values = {facet: tuple(sorted({_key(value) for value in given}, key=str))
+                       for facet, given in (values or {}).items() if given}
+        self.ranges = {field: bounds for field, bounds in (ranges or {}).items()
+                       if bounds != (None, None)}
+        for facet in self.values:
+            if facet not in FACETS:
+                raise ValueError(f"Unknown facet '{facet}'")
+        for field, (low, high) in self.ranges.items():
+            if field not in RANGE_FACETS + ("price",):
+                raise ValueError(f"No range filter on '{field}'")
+            if low is not None and high is not None and low > high:
+                raise ValueError(f"{field} range is empty: {low} > {high}")
+        if sort.lstrip("-") not in SORT_FIELDS + ("",) or sort == "-":
+            raise ValueError(f"sort must be one of: {', '.join(SORT_FIELDS)} (prefix - to reverse)")
+        self.sort = sort
+        self.limit = limit
+        self.cursor = decode_cursor(cursor, sort) if cursor else None
+
+    def key(self):
+        """A hashable form of the query, for caching its result"""
+        return (tuple(sorted(self.values.items())), tuple(sorted(self.ranges.items())),
+                self.sort, self.limit, self.cursor)
+
+
+def encode_cursor(sort, value, product_id):
+    """An opaque cursor for the position after a product in a sort order"""
+    raw = json.dumps([sort, value, product_id], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, sort):
+    """(sort value, product id) of a cursor from encode_cursor, for the same sort order"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, value, product_id = json.loads(raw)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor") from None
+    if cursor_sort != sort:
+        raise ValueError("The cursor belongs to another sort order")
+    # A cursor comes back from the client, so what it holds is checked like any other input
+    field = sort.lstrip("-")
+    if not sort:
+        valid = value is None
+    elif field == "name":
+        valid = isinstance(value, str)
+    else:
+        valid = type(value) in (int, float) and math.isfinite(value)
+    if not valid or type(product_id) is not int or product_id < 0:
+        raise ValueError("Invalid cursor")
+    return value, product_id
+
+
+class FacetIndex:
+    """
+    A bitmap per facet value over one catalog version.
+
+    Bit i of a bitmap is set when product i has the value. A filter is the
+    intersection, word by word, of the union of the bitmaps of the values
+    asked for in each facet; at 100,000 products a bitmap is 1,563 words, so
+    a query costs a few dozen vectorized passes over 12 KB arrays whatever
+    the number of matches. Counts for a facet are taken with every filter
+    but its own, so a storefront can show how many products each other
+    value would give.
+
+    Values few products share are kept as id lists instead (see
+    FacetGroup), so a facet with a value per product stays as small as the
+    catalog. The index is built from the catalog's own secondary indexes,
+    and sort orders on first use.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.size = len(catalog.records)
+        self.words = max(1, (self.size + 63) // 64)
+        self.alive = pack(catalog.alive, self.words)
+        self._orders = {}
+        self._orders_lock = threading.Lock()
+        self.groups = {facet: FacetGroup(self._values(field), self.size, self.words)
+                       for facet, field in FACETS.items()}
+
+    def _values(self, field):
+        """(label, ascending ids) per key of a facet, from the catalog's own indexes"""
+        catalog = self.catalog
+        values = {}
+        if field in RANGE_FACETS:
+            column = catalog.columns[field]
+            for value in np.unique(column[catalog.alive]).tolist():
+                value = int(value) if value.is_integer() else value
+                values[value] = (value, np.flatnonzero(column == value))
+            return values
+
+        for value, ids in catalog.ids_by_value(field).items():
+            label = catalog.records[ids[0]].origin if field == "origin" else value
+            key = _key(value)
+            if key in values:
+                # Values differing only in case are one facet value
+                ids = sorted(set(values[key][1]) | set(ids))
+            values[key] = (values.get(key, (label,))[0], ids)
+        return values
+
+    def _filters(self, query):
+        """Bitmap of each filtered facet or range of a query"""
+        filters = {}
+        for facet, keys in query.values.items():
+            filters[facet] = self.groups[facet].union(keys, self.size, self.words)
+
+        for field, (low, high) in query.ranges.items():
+            if field in RANGE_FACETS:
+                group = self.groups[field]
+                keys = [key for key in group.keys
+                        if (low is None or key >= low) and (high is None or key <= high)]
+                bitmap = group.union(keys, self.size, self.words)
+            else:
+                column = self.catalog.columns[field]
+                mask = self.catalog.alive.copy()
+                if low is not None:
+                    mask &= column >= low
+                if high is not None:
+                    mask &= column <= high
+                bitmap = pack(mask, self.words)
+            filters[field] = bitmap & filters[field] if field in filters else bitmap
+        return filters
+
+    def _order(self, sort):
+        """Live product ids in a sort order, with the sort value of each"""
+        order = self._orders.get(sort)
+        if order is not None:
+            return order
+
+        field = sort.lstrip("-")
+        ids = np.flatnonzero(self.catalog.alive)
+        if field == "name":
+            names = [self.catalog.records[product_id].name.lower() for product_id in ids.tolist()]
+            ranks = np.empty(len(names), dtype=np.int64)
+            ranks[sorted(range(len(names)), key=names.__getitem__)] = np.arange(len(names))
+            values = ranks
+        else:
+            values = self.catalog.columns[field][ids]
+        keys = -values if sort.startswith("-") else values
+        # Ties are broken by id so every product has one place in the order
+        by_key = np.lexsort((ids, keys))
+        order = (ids[by_key], keys[by_key])
+        with self._orders_lock:
+            self._orders[sort] = order
+        return order
+
+    def _sort_key(self, sort, product_id):
+        """The value a cursor stores for a product: what it is sorted by"""
+        record = self.catalog.records[product_id]
+        field = sort.lstrip("-")
+        return record.name.lower() if field == "name" else getattr(record, field)
+
+    @staticmethod
+    def _scan(mask, count, start=0, order=None):
+        """
+        Up to count ids set in mask, in the given order (catalog order by
+        default) from position start. The order is read in growing chunks,
+        so a dense result fills a page after reading a few hundred ids.
+        """
+        end = len(mask) if order is None else len(order)
+        found = []
+        chunk = max(count * 4, 256)
+        while start < end and len(found) < count:
+            if order is None:
+                ids = np.flatnonzero(mask[start:start + chunk]) + start
+            else:
+                ids = order[start:start + chunk]
+                ids = ids[mask[ids]]
+            found.extend(ids[:count - len(found)].tolist())
+            start += chunk
+            chunk *= 4
+        return found
+
+    def _page(self, query, mask):
+        """Ids of one page of matches after the query's cursor, and whether more follow"""
+        if query.cursor and query.cursor[1] >= self.size:
+            raise ValueError("Invalid cursor")
+        if not query.sort:
+            start = query.cursor[1] + 1 if query.cursor else 0
+            page = self._scan(mask, query.limit + 1, start)
+        else:
+            order, keys = self._order(query.sort)
+            first, stop = self._bounds(query, query.sort, keys)
+            start = max(first, self._resume(query, order, keys)) if query.cursor else first
+            page = self._scan(mask, query.limit + 1, start, order[:stop])
+        return page[:query.limit], len(page) > query.limit
+
+    @staticmethod
+    def _bounds(query, sort, keys):
+        """Positions in a sort order between which its field is within the query's range of it"""
+        low, high = query.ranges.get(sort.lstrip("-"), (None, None))
+        if sort.startswith("-"):
+            low, high = (None if high is None else -high), (None if low is None else -low)
+        first = 0 if low is None else int(np.searchsorted(keys, low, side="left"))
+        stop = len(keys) if high is None else int(np.searchsorted(keys, high, side="right"))
+        return first, stop
+
+    def _resume(self, query, order, keys):
+        """Position in a sort order just after the product a cursor points at"""
+        value, last_id = query.cursor
+        field = query.sort.lstrip("-")
+        if field == "name":
+            # Names are ranked, not compared, and unique: find the first one past the cursor's
+            records = self.catalog.records
+            descending = query.sort.startswith("-")
+            low, high = 0, len(order)
+            while low < high:
+                middle = (low + high) // 2
+                name = records[int(order[middle])].name.lower()
+                if (name >= value) if descending else (name <= value):
+                    low = middle + 1
+                else:
+                    high = middle
+            return low
+        key = -value if query.sort.startswith("-") else value
+        low = int(np.searchsorted(keys, key, side="left"))
+        high = int(np.searchsorted(keys, key, side="right"))
+        return low + int(np.searchsorted(order[low:high], last_id, side="right"))
+
+    def search(self, query):
+        """
+        Products matching a query, one page at a time, with facet counts.
+
+        Returns a dict with the page of records, the total number of
+        matches, the cursor of the next page (None on the last one), the
+        count of every facet value and the price range of the matches.
+        """
+        filters = self._filters(query)
+        result = self.alive.copy()
+        for bitmap in filters.values():
+            result &= bitmap
+        mask = unpack(result, self.size)
+        ids, more = self._page(query, mask)
+
+        facets = {}
+        for facet, group in self.groups.items():
+            # Leave a facet's own filter out of its counts
+            others = [bitmap for other, bitmap in filters.items() if other != facet]
+            if not others:
+                counts = group.counts
+            elif facet not in filters:
+                counts = group.count(result, mask)
+            else:
+                base = self.alive.copy()
+                for bitmap in others:
+                    base &= bitmap
+                counts = group.count(base, unpack(base, self.size) if len(group.ids) else None)
+            rows = group.top(counts, len(group.keys) if facet in RANGE_FACETS else MAX_FACET_VALUES)
+            if facet in RANGE_FACETS:
+                rows = sorted(rows.tolist(), key=group.keys.__getitem__)
+            facets[facet] = [{"value": group.labels[row], "count": int(counts[row])} for row in rows]
+
+        prices, keys = self._order("price")
+        first, stop = self._bounds(query, "price", keys)
+        cheapest = self._scan(mask, 1, 0, prices[first:stop])
+        dearest = self._scan(mask, 1, 0, prices[first:stop][::-1])
+        last = ids[-1] if ids else None
+        return {
+            "records": self.catalog.get_many(ids),
+            "total": int(popcount(result[np.newaxis])[0]),
+            "next_cursor": (encode_cursor(query.sort, self._sort_key(query.sort, last) if query.sort else None, last)
+                            if more else None),
+            "facets": facets,
+            "price_range": {
+                "min": self.catalog.records[cheapest[0]].price,
+                "max": self.catalog.records[dearest[0]].price
+            } if cheapest else None
+        }
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Kopico - Reply Fragments
+Product and brewing-guide text rendered once per catalog version
+"""
+
+# Products listed under a brewing guide and in a recommendation
+SUITABLE_LIMIT = 2
+
+
+def render_card(coffee):
+    """The full product card, the answer to "tell me about <coffee>" """
+    return "".join((
+        f"**{coffee.name}** 🌟\n\n",
+        f"💰 **Price:** ${coffee.price}\n",
+        f"🌍 **Origin:** {coffee.origin}\n",
+        f"📝 **Description:** {coffee.description}\n",
+        f"💪 **Strength:** {coffee.strength}/5\n",
+        f"🍋 **Acidity:** {coffee.acidity}/5\n",
+        f"🎯 **Flavor Profile:** {', '.join(coffee.flavor_profile)}\n",
+        f"☕ **Best Brewing Methods:** {', '.join(coffee.brewing_methods)}\n\n",
+        "Would you like to add this to your cart or learn about brewing tips?"
+    ))
+
+
+def render_pick(coffee):
+    """A recommendation entry, without its "1. " position prefix"""
+    return (f"**{coffee.name}** (${coffee.price})\n"
+            f"   {coffee.description}\n"
+            f"   Origin: {coffee.origin}\n"
+            f"   Best for: {', '.join(coffee.brewing_methods[:2])}\n\n")
+
+
+def render_bullet(coffee):
+    """A one-line mention under a brewing guide"""
+    return f"• {coffee.name} - {coffee.description}\n"
+
+
+def render_guide(method, info):
+    """The brewing guide for one method"""
+    return "".join((
+        f"**{method.replace('-', ' ').title()} Brewing Guide:**\n\n",
+        f"☕ **Grind Size:** {info['grind']}\n",
+        f"⚖️ **Ratio:** {info['ratio']} (coffee:water)\n",
+        f"⏱️ **Brew Time:** {info['time']}\n",
+        f"🌡️ **Temperature:** {info['temperature']}\n",
+        f"💡 **Pro Tips:** {info['tips']}\n\n"
+    ))
+
+
+class ReplyFragments:
+    """
+    Every piece of reply text that depends only on the catalog.
+
+    Product fragments are kept in lists indexed by product id, like the
+    catalog's records. Cards are stored UTF-8 encoded: their emoji would
+    make Python keep them at 4 bytes per character, and decoding one costs
+    far less than rendering it. A new catalog version reuses the fragments of
+    products that did not change and renders only the rest, so a price
+    update costs a few string formats rather than a full re-render.
+    Brewing sections are rebuilt every version since which coffees suit a
+    method can change with any product.
+    """
+
+    __slots__ = ("records", "cards", "picks", "bullets", "guides", "suitable")
+
+    def __init__(self, catalog, brewing_methods, previous=None, changed_ids=None):
+        self.records = catalog.records
+        size = len(catalog.records)
+        if previous is None or changed_ids is None:
+            self.cards = [None] * size
+            self.picks = [None] * size
+            self.bullets = [None] * size
+            self.guides = {method: render_guide(method, info) for method, info in brewing_methods.items()}
+            stale = range(size)
+        else:
+            grow = [None] * (size - len(previous.cards))
+            self.cards = previous.cards + grow
+            self.picks = previous.picks + grow
+            self.bullets = previous.bullets + grow
+            self.guides = previous.guides
+            stale = changed_ids
+
+        for product_id in stale:
+            coffee = catalog.records[product_id]
+            if coffee is None:
+                self.cards[product_id] = self.picks[product_id] = self.bullets[product_id] = None
+            else:
+                self.cards[product_id] = render_card(coffee).encode("utf-8")
+                self.picks[product_id] = render_pick(coffee)
+                self.bullets[product_id] = render_bullet(coffee)
+
+        self.suitable = {}
+        for method in brewing_methods:
+            ids = catalog.ids_with_method(method, limit=SUITABLE_LIMIT)
+            if ids:
+                self.suitable[method] = (ids, f"**Perfect coffees for {method.replace('-', ' ')}:**\n"
+                                              + "".join(self.bullets[product_id] for product_id in ids))
+
+    def _current(self, coffee):
+        """Whether the stored fragments were rendered from this very record"""
+        return coffee.id < len(self.records) and self.records[coffee.id] is coffee
+
+    def card(self, coffee):
+        """The product card of a record, rendered now if it is not from this version"""
+        return self.cards[coffee.id].decode("utf-8") if self._current(coffee) else render_card(coffee)
+
+    def pick(self, coffee):
+        """The recommendation entry of a record, rendered now if it is not from this version"""
+        return self.picks[coffee.id] if self._current(coffee) else render_pick(coffee)
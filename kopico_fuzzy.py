@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+Kopico - Fuzzy Lookup
+Trigram index over product names, origins and aliases that finds the product a misspelt message names
+"""
+
+import re
+
+import numpy as np
+
+from kopico_text import ENGLISH_STOP_WORDS
+
+WORD_PATTERN = re.compile(r"[^\W_]+")
+
+# Longest run of message words compared against a key
+MAX_SPAN_WORDS = 4
+
+# Shorter spans are one edit away from too many unrelated words
+MIN_SPAN_LENGTH = 4
+
+# Lowest confidence (1 - edits / length of the longer string) reported as a match
+MIN_CONFIDENCE = 0.75
+
+# Most edits tried between a span and a key however long they are; typing
+# a name people rarely make more, and every edit allowed widens the search
+MAX_EDITS = 2
+
+# Candidates per span, most shared trigrams first, whose edit distance is computed
+MAX_VERIFIED = 8
+
+# A span whose rarest trigrams are still had by more keys than this names
+# nothing in particular and is skipped
+MAX_PROBED = 50000
+
+# Trigrams of a string one edit can change: a swap of neighbours, which
+# counts as one edit, changes four
+GRAMS_PER_EDIT = 4
+
+# Keys whose trigrams are extracted at once while building; bounds the
+# temporary arrays, which take about 100 bytes a key
+BUILD_BATCH = 1 << 16
+
+# Each character of a trigram takes 21 bits (enough for any code point), so
+# a trigram packs into one int64
+_CHAR_BITS = 21
+
+
+def normalize_key(text):
+    """Lowercase words separated by single spaces"""
+    return " ".join(WORD_PATTERN.findall(text.lower()))
+
+
+def origin_forms(origin):
+    """
+    An origin and, for a one-word origin, the adjective made from it the
+    regular way: "ethiopia" and "ethiopian", "brazil" and "brazilian".
+    Irregular ones ("italy", "italian") are left to aliases.
+    """
+    origin = normalize_key(origin)
+    if not origin or " " in origin or not origin.isalpha():
+        return (origin,)
+    return (origin, origin + ("n" if origin.endswith("a") else "ian"))
+
+
+def product_keys(record):
+    """
+    The normalized strings a product can be looked up by: its name, origin
+    (see origin_forms) and aliases. Single name words are not keys, since
+    most ("house", "special", "blend") are everyday words; a product known
+    by part of its name lists that part as an alias.
+    """
+    keys = {normalize_key(record.name)}
+    keys.update(origin_forms(record.origin))
+    keys.update(normalize_key(alias) for alias in record.aliases)
+    keys.discard("")
+    return keys
+
+
+def max_edits(length):
+    """Edits a span of this length may be from a key and still reach MIN_CONFIDENCE"""
+    return min(MAX_EDITS, max(1, int(length * (1 - MIN_CONFIDENCE))))
+
+
+def trigrams(text):
+    """The distinct trigrams of a normalized string, padded so its ends count, as packed ints"""
+    padded = f"  {text} "
+    return {(ord(padded[i]) << 2 * _CHAR_BITS) | (ord(padded[i + 1]) << _CHAR_BITS) | ord(padded[i + 2])
+            for i in range(len(padded) - 2)}
+
+
+def distinct(values):
+    """The sorted distinct values of an int array; sorting is much faster than np.unique's hashing here"""
+    values = np.sort(values)
+    keep = np.ones(len(values), dtype=bool)
+    keep[1:] = values[1:] != values[:-1]
+    return values[keep]
+
+
+def edit_distance(a, b, limit):
+    """
+    Optimal string alignment distance: insertions, deletions, substitutions
+    and swaps of neighbouring characters each count as one edit; limit + 1
+    once it must exceed limit.
+
+    Computed a column at a time with Hyyrö's bit-parallel algorithm, bit i
+    of each int standing for row i of the dynamic programming table, so a
+    character of b costs a few int operations however long a is.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    if not a:
+        return len(b)
+    matches = {}
+    for i, char in enumerate(a):
+        matches[char] = matches.get(char, 0) | (1 << i)
+    full = (1 << len(a)) - 1
+    last = 1 << (len(a) - 1)
+    positive, negative, score = full, 0, len(a)
+    diagonal = previous = 0
+    for position, char in enumerate(b, 1):
+        match = matches.get(char, 0)
+        swap = (((~diagonal) & match) << 1) & previous
+        diagonal = ((((match & positive) + positive) & full) ^ positive) | match | negative | swap
+        up = negative | (~(diagonal | positive) & full)
+        down = positive & diagonal
+        if up & last:
+            score += 1
+        elif down & last:
+            score -= 1
+        # The score falls by at most one per character left
+        if score - (len(b) - position) > limit:
+            return limit + 1
+        up = ((up << 1) | 1) & full
+        down = (down << 1) & full
+        positive = down | (~(diagonal | up) & full)
+        negative = up & diagonal
+        previous = match
+    return min(score, limit + 1)
+
+
+def spans(message):
+    """
+    Runs of up to MAX_SPAN_WORDS message words that could name a product:
+    neither end is a stop word and they are at least MIN_SPAN_LENGTH long
+    """
+    words = WORD_PATTERN.findall(message.lower())
+    found = set()
+    for start, word in enumerate(words):
+        if word in ENGLISH_STOP_WORDS:
+            continue
+        for end in range(start + 1, min(start + MAX_SPAN_WORDS, len(words)) + 1):
+            if words[end - 1] in ENGLISH_STOP_WORDS:
+                continue
+            span = " ".join(words[start:end])
+            if len(span) >= MIN_SPAN_LENGTH:
+                found.add(span)
+    return found
+
+
+class FuzzyIndex:
+    """
+    Typo-tolerant lookup of products by name, origin or alias.
+
+    Each distinct key lists the products it belongs to. Keys are numbered
+    shortest first, and grams holds the sorted distinct trigrams of all of
+    them. entries holds (trigram row << 32 | key number) for each trigram
+    of each key, sorted, so the keys having a trigram are one run of it and
+    the keys of the lengths a span can reach one slice of that run; a batch
+    of such slices, or of (trigram, key) pairs to test, is a single
+    searchsorted. A span within d edits of a key shares all but at most 4d
+    of its trigrams with it, so only keys having one of its 4d + 1 rarest
+    trigrams are candidates; those sharing enough trigrams are then checked
+    by edit distance.
+    """
+
+    def __init__(self, records):
+        products = {}
+        for record in records:
+            for key in product_keys(record):
+                products.setdefault(key, []).append(record.id)
+
+        self.keys = sorted(products, key=lambda key: (len(key), key))
+        self.key_numbers = {key: number for number, key in enumerate(self.keys)}
+        self.products = [tuple(products[key]) for key in self.keys]
+        self.lengths = np.array([len(key) for key in self.keys], dtype=np.int64)
+        self._build_entries()
+
+    def _trigram_codes(self, start, stop):
+        """(trigram, key number) of every trigram position of keys start to stop"""
+        stop = min(stop, len(self.keys))
+        # The keys padded and back to back as code points; a trigram starts
+        # at each position but the last two of each key
+        padded = [f"  {key} " for key in self.keys[start:stop]]
+        chars = np.frombuffer("".join(padded).encode("utf-32-le"), dtype=np.uint32)
+        sizes = np.array([len(text) for text in padded], dtype=np.int64)
+        codes = chars[:-2].astype(np.int64)
+        codes <<= _CHAR_BITS
+        codes |= chars[1:-1]
+        codes <<= _CHAR_BITS
+        codes |= chars[2:]
+        inside = np.ones(len(codes), dtype=bool)
+        ends = np.cumsum(sizes)[:-1]
+        inside[ends - 2] = inside[ends - 1] = False
+        owner = np.repeat(np.arange(start, stop, dtype=np.int64), sizes)[:-2]
+        return codes[inside], owner[inside]
+
+    def _build_entries(self):
+        batches = range(0, len(self.keys), BUILD_BATCH)
+        grams = [distinct(self._trigram_codes(start, start + BUILD_BATCH)[0]) for start in batches]
+        self.grams = distinct(np.concatenate(grams)) if grams else np.zeros(0, dtype=np.int64)
+
+        parts = []
+        for start in batches:
+            codes, owner = self._trigram_codes(start, start + BUILD_BATCH)
+            entries = np.searchsorted(self.grams, codes) << 32
+            entries |= owner
+            parts.append(distinct(entries))
+        self.entries = np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+        self.entries.sort()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _candidates(self, span, edits):
+        """Key numbers that may be within edits of a span, most shared trigrams first"""
+        codes = np.fromiter(trigrams(span), dtype=np.int64)
+        rows = np.searchsorted(self.grams, codes)
+        known = rows < len(self.grams)
+        known[known] = self.grams[rows[known]] == codes[known]
+        rows = rows[known].astype(np.int64) << 32
+        needed = len(codes) - GRAMS_PER_EDIT * edits
+        # Trigrams no key has are shared with nothing; the rest are probed rarest first
+        probe = len(codes) - max(needed, 1) + 1 - (len(codes) - len(rows))
+        if probe <= 0:
+            return []
+
+        # The run of each known trigram, cut to keys of a length within reach
+        low, high = np.searchsorted(self.lengths, (len(span) - edits, len(span) + edits + 1))
+        bounds = np.searchsorted(self.entries, np.concatenate((rows | low, rows | high)))
+        begins, ends = bounds[:len(rows)], bounds[len(rows):]
+        rarest = np.argsort(ends - begins, kind="stable")[:probe]
+        if (ends - begins)[rarest].sum() > MAX_PROBED:
+            return []
+        hits = np.concatenate([self.entries[begins[i]:ends[i]] for i in rarest]) & 0xFFFFFFFF
+        if not len(hits):
+            return []
+
+        # Keep the keys most probes hit. A key hit c times appears c times
+        # in hits, which gives how many keys have each count and so the
+        # lowest count the best need; keys above it are kept, then ties at it
+        wanted = 4 * MAX_VERIFIED
+        counts = np.bincount(hits - low)[hits - low]
+        levels = np.bincount(counts) // np.maximum(np.arange(counts.max() + 1), 1)
+        bar = len(levels) - 1
+        while bar > 1 and levels[bar:].sum() < wanted:
+            bar -= 1
+        above = distinct(hits[counts > bar])
+        ties = distinct(hits[counts == bar][:wanted * bar])[:max(wanted - len(above), 0)]
+        candidates = np.concatenate((above, ties))
+
+        # Then the trigrams each shares in all, testing every (trigram, key) pair at once
+        pairs = (rows[:, None] | candidates[None, :]).ravel()
+        found = np.minimum(np.searchsorted(self.entries, pairs), len(self.entries) - 1)
+        shared = (self.entries[found] == pairs).reshape(len(rows), -1).sum(axis=0)
+        keep = shared >= needed
+        candidates, shared = candidates[keep], shared[keep]
+        return candidates[np.argsort(-shared, kind="stable")[:MAX_VERIFIED]].tolist()
+
+    def _close_keys(self, span):
+        """(confidence, key number) of each key close enough to a span"""
+        number = self.key_numbers.get(span)
+        if number is not None:
+            return [(1.0, number)]
+        # One edit first: most typos are one, and fewer edits allowed means
+        # fewer trigrams to probe. Keys further away cannot rank above one found
+        close = []
+        for edits in range(1, max_edits(len(span)) + 1):
+            limit = edits
+            for number in self._candidates(span, edits):
+                key = self.keys[number]
+                distance = edit_distance(span, key, limit)
+                if distance <= limit:
+                    confidence = 1 - distance / max(len(span), len(key))
+                    if confidence >= MIN_CONFIDENCE:
+                        close.append((confidence, number))
+                        limit = distance
+            if close:
+                break
+        return close
+
+    def lookup(self, message, accept=None):
+        """
+        (product id, confidence, key) of the product a message most likely
+        names, or None. accept(product_id, key), when given, rejects keys a
+        product no longer has.
+
+        The best match covers the most of the message (span length times
+        confidence, so a close full name beats one exact word of it), then
+        has the key belonging to fewest products. Spans are searched longest
+        first, and stop once shorter ones could not score higher.
+        """
+        best = rank = None
+        for span in sorted(spans(message), key=lambda span: (-len(span), span)):
+            if rank is not None and len(span) < -rank[0]:
+                break
+            for confidence, number in self._close_keys(span):
+                candidate = (-confidence * len(span), len(self.products[number]), number)
+                if rank is not None and candidate >= rank:
+                    continue
+                key = self.keys[number]
+                for product_id in self.products[number]:
+                    if accept is None or accept(product_id, key):
+                        best, rank = (product_id, round(confidence, 3), key), candidate
+                        break
+        return best
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Kopico - Phrase Matcher
+Aho-Corasick automaton used to find every known phrase in a message in one pass
+"""
+
+from collections import deque
+
+
+def _is_word_char(char):
+    """Return True if char belongs to a word (letters, digits, underscore)"""
+    return char.isalnum() or char == '_'
+
+
+class PhraseMatcher:
+    """
+    Multi-pattern matcher built once from a set of phrases.
+
+    Every phrase is registered with a rank and a payload. Scanning a message
+    walks the automaton a single time regardless of how many phrases are
+    registered, and only reports matches that sit on word boundaries.
+    """
+
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._outputs = [[]]
+        self._built = False
+        self.size = 0
+
+    def add(self, phrase, rank, payload):
+        """Register a phrase; lower ranks win when several phrases match"""
+        phrase = phrase.lower().strip()
+        if not phrase:
+            return
+
+        state = 0
+        for char in phrase:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._outputs.append([])
+                self._goto[state][char] = next_state
+            state = next_state
+
+        self._outputs[state].append((len(phrase), rank, payload))
+        self._built = False
+        self.size += 1
+
+    def build(self):
+        """Compute failure links so the automaton can be scanned"""
+        queue = deque()
+        for state in self._goto[0].values():
+            self._fail[state] = 0
+            queue.append(state)
+
+        while queue:
+            current = queue.popleft()
+            for char, state in self._goto[current].items():
+                queue.append(state)
+                fallback = self._fail[current]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[state] = target if target != state else 0
+                # Fold the outputs of the failure target in so a scan never
+                # has to walk the failure chain to report suffix matches
+                self._outputs[state] = self._outputs[state] + self._outputs[self._fail[state]]
+
+        self._built = True
+        return self
+
+    def scan(self, text):
+        """Yield (start, end, rank, payload) for every word-bounded match in text"""
+        if not self._built:
+            self.build()
+
+        goto = self._goto
+        fail = self._fail
+        outputs = self._outputs
+        length = len(text)
+        state = 0
+
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+
+            if not outputs[state]:
+                continue
+
+            end = index + 1
+            if end < length and _is_word_char(text[end]):
+                continue
+            for phrase_length, rank, payload in outputs[state]:
+                start = end - phrase_length
+                if start > 0 and _is_word_char(text[start - 1]):
+                    continue
+                yield start, end, rank, payload
+
+    def matches(self, text):
+        """Return all matches in text ordered by rank, then by position"""
+        return sorted(self.scan(text), key=lambda match: (match[2], match[0]))
+
+    def best(self, text):
+        """Return (rank, payload) of the highest priority match, or None"""
+        best_match = None
+        for start, end, rank, payload in self.scan(text):
+            if best_match is None or rank < best_match[0]:
+                best_match = (rank, payload)
+        return best_match
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Kopico - Prepared Responses
+Read-only response bodies serialized, compressed and tagged once, served as stored bytes
+"""
+
+import gzip
+import hashlib
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this are not worth compressing
+MIN_COMPRESS_BYTES = 256
+
+# Preferred first when the client accepts several equally
+ENCODINGS = ("br", "gzip")
+
+
+class PreparedResponse:
+    """
+    One response body in every encoding it will be sent in.
+
+    Each encoding gets its own strong ETag, derived from the hash of the
+    uncompressed body, since the bytes on the wire differ between them.
+    """
+
+    __slots__ = ("status", "content_type", "cache_control", "tag", "bodies")
+
+    def __init__(self, body, content_type="application/json", status=200, cache_control="public, max-age=60"):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.status = status
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.tag = hashlib.sha256(body).hexdigest()[:32]
+        self.bodies = {"identity": body}
+
+        if len(body) >= MIN_COMPRESS_BYTES:
+            compressed = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(compressed) < len(body):
+                self.bodies["gzip"] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(body, quality=11)
+                if len(compressed) < len(body):
+                    self.bodies["br"] = compressed
+
+    def etag(self, encoding):
+        return self.tag if encoding == "identity" else f"{self.tag}-{encoding}"
+
+    def choose_encoding(self, accept_encodings):
+        """The best stored encoding the client accepts, by its q-values"""
+        best, best_quality = "identity", 0
+        for encoding in ENCODINGS:
+            quality = accept_encodings[encoding]
+            if encoding in self.bodies and quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def to_response(self):
+        """A Flask response for the current request: 304 on a matching If-None-Match, else the stored bytes"""
+        encoding = self.choose_encoding(request.accept_encodings)
+        headers = {
+            "ETag": f'"{self.etag(encoding)}"',
+            "Cache-Control": self.cache_control,
+            "Vary": "Accept-Encoding"
+        }
+
+        if_none_match = request.if_none_match
+        if if_none_match and any(if_none_match.contains_weak(self.etag(stored)) for stored in self.bodies):
+            return Response(status=304, headers=headers)
+
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(self.bodies[encoding], status=self.status, content_type=self.content_type, headers=headers)
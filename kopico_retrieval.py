@@ -0,0 +1,660 @@
+#!/usr/bin/env python3
+"""
+Kopico - Similarity Retrieval
+Incrementally maintained TF-IDF index with top-k early termination
+"""
+
+import zlib
+import itertools
+
+import numpy as np
+
+from kopico_text import index_terms, index_terms_many
+from kopico_segments import save_arrays, read_meta, load_arrays
+
+# Terms are hashed into a fixed feature space, so there is no vocabulary to
+# refit when products arrive with words the index has never seen
+N_FEATURES = 1 << 20
+
+# On-disk layout written by SimilarityIndexWriter.save: one .npy file per array.
+# Version 2 hashes stems rather than raw tokens, so version 1 models are refit
+FORMAT_VERSION = 2
+SEGMENT_ARRAYS = ("terms", "postings_ptr", "column_ids", "column_weights", "postings_ids", "postings_weights")
+STORED_ARRAYS = ("document_ids", "document_ptr", "document_terms", "document_counts", "base_ids", "pending_ids")
+
+
+def term_ids(text):
+    """Return (sorted hashed term ids, term counts) for a piece of text"""
+    tokens = index_terms(text)
+    if not tokens:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    hashed = np.fromiter((zlib.crc32(token.encode('utf-8')) for token in tokens),
+                         dtype=np.int64, count=len(tokens)) & (N_FEATURES - 1)
+    ids, counts = np.unique(hashed, return_counts=True)
+    return ids, counts.astype(np.float64)
+
+
+def term_ids_many(texts):
+    """
+    term_ids for a batch of texts, flattened into (rows, term ids, counts)
+    sorted by row and then term id. Each distinct token is hashed once.
+    """
+    hashes = {}
+    rows = []
+    hashed = []
+    for row, tokens in enumerate(index_terms_many(texts)):
+        for token in tokens:
+            term = hashes.get(token)
+            if term is None:
+                term = hashes[token] = zlib.crc32(token.encode('utf-8')) & (N_FEATURES - 1)
+            rows.append(row)
+            hashed.append(term)
+
+    keys = np.array(rows, dtype=np.int64) * N_FEATURES + np.array(hashed, dtype=np.int64)
+    keys, counts = np.unique(keys, return_counts=True)
+    return keys // N_FEATURES, keys % N_FEATURES, counts.astype(np.float64)
+
+
+class TermStatistics:
+    """Document frequencies at one point in time, used to compute IDF weights"""
+
+    def __init__(self, document_count, document_frequency):
+        self.document_count = document_count
+        self.document_frequency = document_frequency
+
+    def idf(self, ids):
+        """Smoothed IDF, matching TfidfVectorizer(smooth_idf=True)"""
+        n = self.document_count
+        return np.log((1.0 + n) / (1.0 + self.document_frequency[ids])) + 1.0
+
+    def weigh(self, ids, counts):
+        """L2-normalized TF-IDF weights for one document or query"""
+        weights = counts * self.idf(ids)
+        norm = np.sqrt(np.dot(weights, weights))
+        return weights / norm if norm else weights
+
+    def weigh_many(self, rows, ids, counts):
+        """weigh() for a batch of documents flattened like term_ids_many output"""
+        weights = counts * self.idf(ids)
+        norms = np.sqrt(np.bincount(rows, weights=weights * weights))[rows]
+        return np.divide(weights, norms, out=weights.copy(), where=norms > 0)
+
+
+class IndexSegment:
+    """
+    Immutable postings for a group of products.
+
+    Each term keeps its postings twice: ordered by product id for random
+    access, and ordered by weight (heaviest first) so a query can read only
+    the head of each list and stop as soon as no unread product can still
+    make the top k (the threshold algorithm).
+    """
+
+    INITIAL_DEPTH = 32
+
+    # Past this share of the query's postings, reading everything in one
+    # vectorized pass is cheaper than another round of sorted access
+    EXHAUSTIVE_FRACTION = 0.02
+
+    # Batch searches score queries x products blocks of at most this many
+    # cells, and fall back to one search per query when fewer than
+    # MIN_BATCH_ROWS queries would fit in a block
+    BATCH_ELEMENTS = 1 << 20
+    MIN_BATCH_ROWS = 64
+
+    def __init__(self, product_ids, rows):
+        """Build from product ids and their already weighted, normalized rows"""
+        if len(product_ids) == 0:
+            self._index_columns(0, None, None, None)
+            return
+        self._index_columns(
+            len(product_ids),
+            np.repeat(np.asarray(product_ids, dtype=np.int64), [len(ids) for ids, _ in rows]),
+            np.concatenate([ids for ids, _ in rows]),
+            np.concatenate([weights for _, weights in rows])
+        )
+
+    @classmethod
+    def from_columns(cls, size, id_column, term_column, weight_column):
+        """Build from flat (product id, term id, weight) columns covering size products"""
+        segment = cls.__new__(cls)
+        segment._index_columns(size, id_column, term_column, weight_column)
+        return segment
+
+    def _index_columns(self, size, id_column, term_column, weight_column):
+        self.size = size
+        if size == 0:
+            self.id_limit = 0
+            self.terms = np.zeros(0, dtype=np.int64)
+            self.postings_ptr = np.zeros(1, dtype=np.int64)
+            self.column_ids = self.postings_ids = np.zeros(0, dtype=np.int64)
+            self.column_weights = self.postings_weights = np.zeros(0)
+            return
+
+        self.id_limit = int(id_column.max()) + 1 if len(id_column) else 0
+        self.terms, local_terms = np.unique(term_column, return_inverse=True)
+
+        # Column-major postings (a CSC matrix without the scipy dependency):
+        # grouped by term, ordered by product id within each term
+        by_id = np.lexsort((id_column, local_terms))
+        self.postings_ptr = np.concatenate([[0], np.cumsum(np.bincount(local_terms, minlength=len(self.terms)))])
+        self.column_ids = id_column[by_id]
+        self.column_weights = weight_column[by_id]
+
+        by_weight = np.lexsort((id_column, -weight_column, local_terms))
+        self.postings_ids = id_column[by_weight]
+        self.postings_weights = weight_column[by_weight]
+
+    @classmethod
+    def from_arrays(cls, size, id_limit, arrays):
+        """Rebuild a segment from arrays written by SimilarityIndexWriter.to_arrays"""
+        segment = cls.__new__(cls)
+        segment.size = size
+        segment.id_limit = id_limit
+        for name in SEGMENT_ARRAYS:
+            setattr(segment, name, arrays[name])
+        return segment
+
+    def search(self, ids, weights, k, threshold, dead=None):
+        """Return (product ids, scores) of the top k products above threshold"""
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0))
+        if self.size == 0 or len(ids) == 0:
+            return empty
+
+        # Keep only query terms that occur in this segment
+        local = np.searchsorted(self.terms, ids)
+        local[local == len(self.terms)] = 0
+        present = self.terms[local] == ids
+        if not present.any():
+            return empty
+        local = local[present]
+        weights = weights[present]
+
+        starts = self.postings_ptr[local]
+        lengths = self.postings_ptr[local + 1] - starts
+        exhaustive_depth = lengths.sum() * self.EXHAUSTIVE_FRACTION / len(lengths)
+
+        depth = self.INITIAL_DEPTH
+        while True:
+            if depth >= exhaustive_depth:
+                return self._search_all(weights, starts, lengths, k, threshold, dead)
+
+            # Sorted access: the first `depth` postings of every query term
+            candidates = np.unique(np.concatenate([
+                self.postings_ids[start:start + min(depth, length)]
+                for start, length in zip(starts, lengths)
+            ]))
+            scores = self._score(candidates, weights, starts, lengths)
+            if dead is not None and len(dead):
+                scores[np.isin(candidates, dead, assume_unique=True)] = -1.0
+
+            passing = scores > threshold
+            candidates = candidates[passing]
+            scores = scores[passing]
+            if len(candidates) > k:
+                keep = np.argpartition(-scores, k - 1)[:k]
+                candidates = candidates[keep]
+                scores = scores[keep]
+
+            # Best score any unread product could still reach
+            exhausted = lengths <= depth
+            if exhausted.all():
+                break
+            next_weights = np.where(
+                exhausted, 0.0,
+                self.postings_weights[np.minimum(starts + depth, len(self.postings_weights) - 1)]
+            )
+            bound = float(np.dot(weights, next_weights))
+            if bound <= threshold or (len(candidates) == k and scores.min() >= bound):
+                break
+            depth *= 4
+
+        return candidates, scores
+
+    def search_many(self, rows, ids, weights, query_count, k, threshold, dead=None):
+        """
+        search() for a batch of queries given as flattened (row, term id, weight) entries.
+
+        Scores are accumulated term at a time into a queries x products
+        block, so each posting list is read once per block no matter how
+        many of the queries share the term.
+        """
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0))
+        results = [empty] * query_count
+        if self.size == 0 or len(ids) == 0:
+            return results
+
+        local = np.searchsorted(self.terms, ids)
+        local[local == len(self.terms)] = 0
+        present = self.terms[local] == ids
+        rows = rows[present]
+        ids = ids[present]
+        local = local[present]
+        weights = weights[present]
+        if len(rows) == 0:
+            return results
+
+        rows_per_block = min(query_count, self.BATCH_ELEMENTS // self.id_limit)
+        if rows_per_block < self.MIN_BATCH_ROWS:
+            bounds = np.flatnonzero(np.diff(rows)) + 1
+            for start, end in zip([0] + bounds.tolist(), bounds.tolist() + [len(rows)]):
+                results[rows[start]] = self.search(ids[start:end], weights[start:end], k, threshold, dead)
+            return results
+
+        # Group entries by block and then by term
+        blocks = rows // rows_per_block
+        order = np.lexsort((rows, local, blocks))
+        rows, local, weights, blocks = rows[order], local[order], weights[order], blocks[order]
+        bounds = np.flatnonzero((np.diff(local) != 0) | (np.diff(blocks) != 0)) + 1
+
+        scores = None
+        current = -1
+        for start, end in zip([0] + bounds.tolist(), bounds.tolist() + [len(rows)]):
+            block = int(blocks[start])
+            if block != current:
+                if scores is not None:
+                    self._collect(scores, current * rows_per_block, results, k, threshold, dead)
+                current = block
+                scores = np.zeros((min(rows_per_block, query_count - block * rows_per_block), self.id_limit))
+
+            term = local[start]
+            first, last = self.postings_ptr[term], self.postings_ptr[term + 1]
+            block_rows = rows[start:end] - block * rows_per_block
+            scores[np.ix_(block_rows, self.column_ids[first:last])] += np.outer(
+                weights[start:end], self.column_weights[first:last])
+
+        self._collect(scores, current * rows_per_block, results, k, threshold, dead)
+        return results
+
+    def _collect(self, scores, first_row, results, k, threshold, dead):
+        """Store the top k above threshold of each row of a score block in results"""
+        if dead is not None and len(dead):
+            scores[:, dead[dead < self.id_limit]] = 0.0
+        if k < self.id_limit:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(self.id_limit), scores.shape)
+        top_scores = np.take_along_axis(scores, top, axis=1)
+
+        passing = top_scores > threshold
+        for offset in np.flatnonzero(passing.any(axis=1)).tolist():
+            keep = passing[offset]
+            results[first_row + offset] = (top[offset][keep], top_scores[offset][keep])
+
+    def _search_all(self, weights, starts, lengths, k, threshold, dead):
+        """Top k by accumulating every posting of the query terms (term at a time)"""
+        scores = np.zeros(self.id_limit)
+        for weight, start, length in zip(weights, starts, lengths):
+            scores[self.column_ids[start:start + length]] += weight * self.column_weights[start:start + length]
+        if dead is not None and len(dead):
+            scores[dead[dead < self.id_limit]] = 0.0
+
+        candidates = np.flatnonzero(scores > threshold)
+        scores = scores[candidates]
+        if len(candidates) > k:
+            keep = np.argpartition(-scores, k - 1)[:k]
+            candidates = candidates[keep]
+            scores = scores[keep]
+        return candidates, scores
+
+    def _score(self, candidates, weights, starts, lengths):
+        """Exact similarity of sorted candidate ids via random access into the postings"""
+        scores = np.zeros(len(candidates))
+        for weight, start, length in zip(weights, starts, lengths):
+            if not length:
+                continue
+            ids = self.column_ids[start:start + length]
+            positions = np.searchsorted(ids, candidates)
+            positions[positions == length] = length - 1
+            found = ids[positions] == candidates
+            scores[found] += weight * self.column_weights[start + positions[found]]
+        return scores
+
+
+class SimilarityIndex:
+    """
+    One published, read-only version of the product similarity index.
+
+    A version is a large base segment plus a small delta segment holding
+    products added or changed since the base was built. Products removed
+    or changed since then are listed in `dead` and skipped in the base.
+    """
+
+    def __init__(self, statistics, base, delta, dead, version):
+        self.statistics = statistics
+        self.base = base
+        self.delta = delta
+        self.dead = dead
+        self.version = version
+
+    def __len__(self):
+        return self.base.size - len(self.dead) + self.delta.size
+
+    def search(self, query, k=3, threshold=0.1):
+        """Return ids of up to k products with similarity above threshold, best first"""
+        ids, counts = term_ids(query)
+
+        # Like a fitted vectorizer, ignore terms no indexed product contains
+        known = self.statistics.document_frequency[ids] > 0
+        ids = ids[known]
+        counts = counts[known]
+        if len(ids) == 0 or len(self) == 0:
+            return []
+        weights = self.statistics.weigh(ids, counts)
+
+        base_ids, base_scores = self.base.search(ids, weights, k, threshold, self.dead)
+        delta_ids, delta_scores = self.delta.search(ids, weights, k, threshold)
+
+        candidates = np.concatenate([base_ids, delta_ids])
+        scores = np.concatenate([base_scores, delta_scores])
+        order = np.lexsort((candidates, -scores))[:k]
+        return candidates[order].tolist()
+
+    def search_many(self, queries, k=3, threshold=0.1):
+        """search() for a list of queries, tokenized, weighed and scored together"""
+        results = [[] for _ in queries]
+        rows, ids, counts = term_ids_many(queries)
+        known = self.statistics.document_frequency[ids] > 0
+        rows, ids, counts = rows[known], ids[known], counts[known]
+        if len(ids) == 0 or len(self) == 0:
+            return results
+        weights = self.statistics.weigh_many(rows, ids, counts)
+
+        base = self.base.search_many(rows, ids, weights, len(queries), k, threshold, self.dead)
+        delta = self.delta.search_many(rows, ids, weights, len(queries), k, threshold)
+        for row, ((base_ids, base_scores), (delta_ids, delta_scores)) in enumerate(zip(base, delta)):
+            if len(base_ids) + len(delta_ids) == 0:
+                continue
+            candidates = np.concatenate([base_ids, delta_ids])
+            scores = np.concatenate([base_scores, delta_scores])
+            order = np.lexsort((candidates, -scores))[:k]
+            results[row] = candidates[order].tolist()
+        return results
+
+
+class SimilarityIndexWriter:
+    """
+    Keeps term counts and document frequencies up to date as products change.
+
+    Changes never refit anything: adding, updating or removing a product
+    adjusts the running document frequencies and moves the product into the
+    delta segment. `publish()` returns a new SimilarityIndex that readers
+    can swap in with a single assignment. Once the delta grows past a
+    fraction of the catalog it is merged into a fresh base, which re-weighs
+    every product with the current IDF.
+    """
+
+    MIN_DELTA = 256
+    DELTA_FRACTION = 0.1
+    DRIFT_FRACTION = 0.05
+
+    # Products tokenized at once by fit()
+    FIT_BATCH = 4096
+
+    def __init__(self):
+        self._documents = {}
+        self._stored = None
+        self.document_frequency = np.zeros(N_FEATURES, dtype=np.int32)
+        self.base = IndexSegment([], [])
+        self.base_ids = set()
+        self.base_count = 0
+        self.pending = set()
+        self.dead = set()
+        self.version = 0
+        self.published = None
+
+    @property
+    def documents(self):
+        """Term ids and counts per product id"""
+        if self._documents is None:
+            self._restore()
+        return self._documents
+
+    @classmethod
+    def fit(cls, documents, batch_size=None):
+        """
+        A compacted index over (product id, text) pairs given in ascending id order.
+
+        The pairs are consumed a batch at a time and only their term counts
+        are kept, in flat arrays, so a generator over a large catalog never
+        has to be held in memory. Gives the same index as upserting every
+        product and compacting, in a fraction of the time.
+        """
+        batch_size = batch_size or cls.FIT_BATCH
+        documents = iter(documents)
+        id_parts, length_parts, term_parts, count_parts = [], [], [], []
+        while True:
+            batch = list(itertools.islice(documents, batch_size))
+            if not batch:
+                break
+            rows, terms, counts = term_ids_many([text for _, text in batch])
+            id_parts.append(np.array([product_id for product_id, _ in batch], dtype=np.int64))
+            length_parts.append(np.bincount(rows, minlength=len(batch)))
+            term_parts.append(terms)
+            count_parts.append(counts)
+
+        document_ids = np.concatenate(id_parts or [np.zeros(0, dtype=np.int64)])
+        if np.any(np.diff(document_ids) <= 0):
+            raise ValueError("fit() needs product ids in ascending order")
+        lengths = np.concatenate(length_parts or [np.zeros(0, dtype=np.int64)])
+        terms = np.concatenate(term_parts or [np.zeros(0, dtype=np.int64)])
+        counts = np.concatenate(count_parts or [np.zeros(0)])
+        del term_parts, count_parts
+
+        document_frequency = np.bincount(terms, minlength=N_FEATURES).astype(np.int32)
+        statistics = TermStatistics(len(document_ids), document_frequency)
+        id_column = np.repeat(document_ids, lengths)
+        weights = statistics.weigh_many(np.repeat(np.arange(len(document_ids)), lengths), terms, counts)
+        base = IndexSegment.from_columns(len(document_ids), id_column, terms, weights)
+
+        arrays = {name: getattr(base, name) for name in SEGMENT_ARRAYS}
+        arrays.update({
+            "document_frequency": document_frequency,
+            "document_ids": document_ids,
+            "document_ptr": np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+            "document_terms": terms,
+            "document_counts": counts,
+            "base_ids": document_ids,
+            "pending_ids": np.zeros(0, dtype=np.int64)
+        })
+        return cls.from_arrays(arrays, {
+            "document_count": len(document_ids),
+            "segment_size": base.size,
+            "id_limit": base.id_limit,
+            "base_count": len(document_ids),
+            "index_version": 1
+        })
+
+    def upsert(self, product_id, text):
+        """Index a new product or re-index a changed one"""
+        self.remove(product_id)
+        ids, counts = term_ids(text)
+        self.documents[product_id] = (ids, counts)
+        self.document_frequency[ids] += 1
+        self.pending.add(product_id)
+        self.published = None
+
+    def remove(self, product_id):
+        """Drop a product from the index if present"""
+        document = self.documents.pop(product_id, None)
+        if document is None:
+            return
+        self.document_frequency[document[0]] -= 1
+        self.pending.discard(product_id)
+        if product_id in self.base_ids:
+            self.dead.add(product_id)
+        self.published = None
+
+    def needs_compaction(self):
+        """True when the delta is large enough to be merged into the base"""
+        limit = max(self.MIN_DELTA, int(len(self.documents) * self.DELTA_FRACTION))
+        if len(self.pending) + len(self.dead) > limit:
+            return True
+        # Base weights use the IDF from when it was built; rebuild once the
+        # collection has grown or shrunk enough for that to drift noticeably
+        drift = abs(len(self.documents) - self.base_count)
+        return drift > max(self.MIN_DELTA, self.base_count * self.DRIFT_FRACTION)
+
+    def compact(self):
+        """Merge every live product into a new base segment"""
+        statistics = self._statistics()
+        product_ids = sorted(self.documents)
+        self.base = self._segment(product_ids, statistics)
+        self.base_ids = set(product_ids)
+        self.base_count = len(product_ids)
+        self.pending = set()
+        self.dead = set()
+        self.published = None
+
+    def publish(self):
+        """Return an immutable SimilarityIndex reflecting every change so far"""
+        if self.published is not None:
+            return self.published
+        if self.needs_compaction():
+            self.compact()
+
+        statistics = self._statistics()
+        delta = self._segment(sorted(self.pending), statistics)
+        self.version += 1
+        self.published = SimilarityIndex(
+            statistics, self.base, delta,
+            np.array(sorted(self.dead), dtype=np.int64), self.version
+        )
+        return self.published
+
+    def _statistics(self):
+        """Snapshot of the running document frequencies"""
+        return TermStatistics(len(self.documents), self.document_frequency.copy())
+
+    def _segment(self, product_ids, statistics):
+        """Build a segment for products with weights from the given statistics"""
+        rows = []
+        for product_id in product_ids:
+            ids, counts = self.documents[product_id]
+            rows.append((ids, statistics.weigh(ids, counts)))
+        return IndexSegment(product_ids, rows)
+
+    def to_arrays(self):
+        """
+        The published index as (arrays, metadata), the form save() and shared segments store.
+
+        Holds the base and delta segments and dead ids exactly as published,
+        plus every product's term counts so that an index rebuilt from the
+        arrays by from_arrays() can keep changing.
+        """
+        index = self.publish()
+        arrays = {name: getattr(index.base, name) for name in SEGMENT_ARRAYS}
+        arrays.update({f"delta_{name}": getattr(index.delta, name) for name in SEGMENT_ARRAYS})
+        arrays["dead"] = index.dead
+        arrays["document_frequency"] = index.statistics.document_frequency
+
+        if self._documents is None:
+            # Nothing changed since loading: pass the stored arrays through
+            arrays.update(self._stored)
+        else:
+            product_ids = np.array(sorted(self._documents), dtype=np.int64)
+            documents = [self._documents[product_id] for product_id in product_ids.tolist()]
+            arrays["document_ids"] = product_ids
+            arrays["document_ptr"] = np.concatenate([[0], np.cumsum([len(ids) for ids, _ in documents])]).astype(np.int64)
+            arrays["document_terms"] = np.concatenate([ids for ids, _ in documents] or [np.zeros(0, dtype=np.int64)])
+            arrays["document_counts"] = np.concatenate([counts for _, counts in documents] or [np.zeros(0)])
+            arrays["base_ids"] = np.array(sorted(self.base_ids), dtype=np.int64)
+            arrays["pending_ids"] = np.array(sorted(self.pending), dtype=np.int64)
+
+        meta = {
+            "format": FORMAT_VERSION,
+            "n_features": N_FEATURES,
+            "document_count": index.statistics.document_count,
+            "segment_size": index.base.size,
+            "id_limit": index.base.id_limit,
+            "delta_size": index.delta.size,
+            "delta_id_limit": index.delta.id_limit,
+            "base_count": self.base_count,
+            "index_version": index.version
+        }
+        return arrays, meta
+
+    @classmethod
+    def from_arrays(cls, arrays, meta):
+        """
+        An index over arrays from to_arrays(), used in place without copying.
+
+        Searching reads the arrays directly, so memory-mapped ones stay
+        shared. Per-product term counts are only unpacked once the index is
+        changed.
+        """
+        writer = cls()
+        writer._documents = None
+        writer._stored = {name: arrays[name] for name in STORED_ARRAYS if name in arrays}
+        writer.document_frequency = arrays["document_frequency"]
+        writer.base = IndexSegment.from_arrays(meta["segment_size"], meta["id_limit"],
+                                               {name: arrays[name] for name in SEGMENT_ARRAYS})
+        if "delta_terms" in arrays:
+            delta = IndexSegment.from_arrays(meta["delta_size"], meta["delta_id_limit"],
+                                             {name: arrays[f"delta_{name}"] for name in SEGMENT_ARRAYS})
+        else:
+            delta = IndexSegment([], [])
+        dead = arrays["dead"] if "dead" in arrays else np.zeros(0, dtype=np.int64)
+        writer.base_count = meta.get("base_count", meta["document_count"])
+        writer.version = meta.get("index_version", 1)
+        writer.published = SimilarityIndex(
+            TermStatistics(meta["document_count"], writer.document_frequency), writer.base,
+            delta, dead, writer.version
+        )
+        return writer
+
+    def save(self, directory, metadata=None):
+        """
+        Write the index to a directory of .npy files that load() can memory-map.
+
+        Pending changes are compacted first so the files hold a single base
+        segment. The directory is replaced as a whole, so a server starting
+        at the same time sees either the old files or the new ones.
+        """
+        if self.pending or self.dead:
+            self.compact()
+        arrays, meta = self.to_arrays()
+        save_arrays(directory, arrays, dict(metadata or {}, **meta))
+
+    @staticmethod
+    def read_metadata(directory):
+        """Return the metadata of a saved index, or None if there is no usable one"""
+        meta = read_meta(directory)
+        if meta is None or meta.get("format") != FORMAT_VERSION or meta.get("n_features") != N_FEATURES:
+            return None
+        return meta
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        """
+        Open an index written by save() without refitting anything.
+
+        The arrays are memory-mapped, so loading costs the same at any catalog
+        size and pages are read (and shared between processes) on first use.
+        """
+        meta = cls.read_metadata(directory)
+        if meta is None:
+            raise ValueError(f"No compatible similarity index in {directory}")
+        return cls.from_arrays(load_arrays(directory, mmap_mode), meta)
+
+    def _restore(self):
+        """Unpack the per-product term counts of a loaded index before its first change"""
+        stored = self._stored
+        ptr = stored["document_ptr"].tolist()
+        terms = np.array(stored["document_terms"])
+        counts = np.array(stored["document_counts"])
+        self._documents = {
+            product_id: (terms[ptr[i]:ptr[i + 1]], counts[ptr[i]:ptr[i + 1]])
+            for i, product_id in enumerate(stored["document_ids"].tolist())
+        }
+        if "base_ids" in stored:
+            self.base_ids = set(stored["base_ids"].tolist())
+            self.pending = set(stored["pending_ids"].tolist())
+        else:
+            # Saved by an older version, always compacted first
+            self.base_ids = set(self._documents)
+        self.dead = set(self.published.dead.tolist()) if self.published is not None else set()
+        # The published statistics keep the read-only mapping; writes go to a copy
+        self.document_frequency = np.array(self.document_frequency)
+        self._stored = None
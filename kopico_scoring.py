@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Kopico - Preference Scoring
+Vectorized scoring of one or many preference profiles against the catalog
+"""
+
+import math
+
+import numpy as np
+
+DEFAULT_LEVEL = 3
+
+# Words customers (and the website) use instead of numbers on the 1-5 scales
+LEVEL_WORDS = {
+    "very low": 1, "very mild": 1,
+    "low": 2, "mild": 2, "light": 2, "gentle": 2,
+    "medium": 3, "balanced": 3, "moderate": 3,
+    "high": 4, "strong": 4, "bold": 4, "bright": 4,
+    "very high": 5, "very strong": 5, "intense": 5
+}
+
+# Upper bound on the size of one profiles x products score block; small
+# blocks keep the temporaries in cache, which matters more than call overhead
+CHUNK_ELEMENTS = 1 << 16
+
+
+def _level(value):
+    """Convert a preference value (number or word) to a point on a 1-5 scale"""
+    level = None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        level = float(value)
+    elif isinstance(value, str):
+        key = value.strip().lower()
+        if key in LEVEL_WORDS:
+            return float(LEVEL_WORDS[key])
+        try:
+            level = float(key)
+        except ValueError:
+            pass
+    # NaN would match no product and say nothing about why
+    if level is None or not math.isfinite(level):
+        raise ValueError(f"Unsupported preference value: {value!r}")
+    return level
+
+
+def _max_price(value):
+    """Convert a max_price (number or numeric string) to a finite, non-negative price"""
+    price = None
+    if not isinstance(value, bool):
+        try:
+            price = float(value)
+        except (TypeError, ValueError):
+            pass
+    if price is None or not math.isfinite(price) or price < 0:
+        raise ValueError(f"max_price must be a non-negative number, not {value!r}")
+    return price
+
+
+def parse_profile(preferences):
+    """Turn a preferences dict into a (strength, acidity, max_price) row"""
+    if not isinstance(preferences, dict):
+        raise ValueError("Preferences must be an object")
+
+    max_price = preferences.get('max_price')
+    return (
+        _level(preferences.get('strength', DEFAULT_LEVEL)),
+        _level(preferences.get('acidity', DEFAULT_LEVEL)),
+        np.inf if max_price is None else _max_price(max_price)
+    )
+
+
+def top_matches(catalog, profiles, k=3):
+    """
+    Score every profile against every product and return the top k ids per profile.
+
+    A product earns 2 points when its strength is within 1 of the target and
+    2 more when its acidity is. Products over a profile's max_price are left
+    out, as are removed ones. Ties keep catalog order, like the stable
+    sort this replaces.
+    """
+    targets = np.array([parse_profile(preferences) for preferences in profiles], dtype=np.float64)
+    product_count = len(catalog.records)
+    if len(catalog) == 0 or k <= 0:
+        return [[] for _ in profiles]
+
+    strength = catalog.columns['strength']
+    acidity = catalog.columns['acidity']
+    price = catalog.columns['price']
+    k = min(k, len(catalog))
+    removed = ~catalog.alive
+
+    # Fold the catalog position into the key so partial selection breaks
+    # ties exactly like a stable sort would: earlier products win
+    key_type = np.int32 if product_count < (1 << 28) else np.int64
+    tiebreak = np.arange(product_count - 1, -1, -1, dtype=key_type)
+    rows_per_chunk = max(1, CHUNK_ELEMENTS // product_count)
+
+    results = []
+    for start in range(0, len(targets), rows_per_chunk):
+        chunk = targets[start:start + rows_per_chunk]
+
+        scores = (np.abs(strength - chunk[:, 0:1]) <= 1).astype(key_type)
+        scores += np.abs(acidity - chunk[:, 1:2]) <= 1
+        keys = scores * (2 * product_count) + tiebreak
+        keys[price > chunk[:, 2:3]] = -1
+        keys[:, removed] = -1
+
+        top = np.argpartition(-keys, k - 1, axis=1)[:, :k]
+        top_keys = np.take_along_axis(keys, top, axis=1)
+        order = np.argsort(-top_keys, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_keys = np.take_along_axis(top_keys, order, axis=1)
+
+        for row_ids, row_keys in zip(top.tolist(), top_keys.tolist()):
+            results.append([product_id for product_id, key in zip(row_ids, row_keys) if key >= 0])
+
+    return results
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Kopico - Shared Segments
+Versioned read-only arrays in shared memory that every worker process maps without copying
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import threading
+import contextlib
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # No flock on Windows; publishing is then only serialized within a process
+    fcntl = None
+
+# Versions kept besides the current one, for readers still attaching to them
+KEEP_VERSIONS = 2
+
+
+def save_arrays(directory, arrays, meta):
+    """
+    Write arrays as .npy files plus a meta.json into a directory.
+
+    The files are written to a staging directory that then replaces the
+    target as a whole, so a reader sees either the old files or the new ones.
+    """
+    directory = os.path.abspath(directory)
+    staging = f"{directory}.tmp-{os.getpid()}-{threading.get_ident()}"
+    os.makedirs(staging, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(staging, f"{name}.npy"), np.ascontiguousarray(array))
+    with open(os.path.join(staging, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+
+    retired = None
+    if os.path.exists(directory):
+        retired = f"{directory}.old-{os.getpid()}-{threading.get_ident()}"
+        os.replace(directory, retired)
+    os.replace(staging, directory)
+    if retired is not None:
+        shutil.rmtree(retired, ignore_errors=True)
+
+
+def read_meta(directory):
+    """The meta.json of an array directory, or None if there is no readable one"""
+    try:
+        with open(os.path.join(directory, "meta.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def load_arrays(directory, mmap_mode="r"):
+    """
+    Every array in a directory written by save_arrays, keyed by name.
+
+    Arrays are memory-mapped by default: opening costs the same at any size,
+    and the pages are shared by every process that maps the same files.
+    """
+    arrays = {}
+    for filename in os.listdir(directory):
+        if filename.endswith(".npy"):
+            # Plain ndarray views of the mapping; np.memmap slices are slower
+            arrays[filename[:-4]] = np.asarray(np.load(os.path.join(directory, filename), mmap_mode=mmap_mode))
+    return arrays
+
+
+def default_segment_root(name):
+    """A directory for segments in shared memory (/dev/shm) where there is one"""
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(base, name)
+
+
+class SegmentStore:
+    """
+    Numbered versions of a set of read-only arrays, shared through files.
+
+    Kept in /dev/shm the files are named shared memory: every process that
+    attaches to a version maps the same physical pages, so workers hold one
+    copy of the index between them whatever their number. A publisher writes
+    version N+1 next to the current one and then replaces the CURRENT file,
+    so readers switch atomically. Each version may carry a small JSON record
+    of the change that produced it, appended to a journal, which lets a
+    process that is behind replay what it missed. A base version, one no
+    earlier record can be replayed onto, starts the journal afresh, so it
+    holds only the changes since the last base. Publishing is serialized
+    between processes with lock().
+    """
+
+    def __init__(self, root, keep=KEEP_VERSIONS):
+        self.root = os.path.abspath(root)
+        self.keep = keep
+        self._lock = threading.RLock()
+        # (inode, first line, byte offset, version) of the journal line this
+        # process last read, so a later read starts after it
+        self._journal_position = None
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, version):
+        return os.path.join(self.root, f"v{version:08d}")
+
+    @property
+    def _journal(self):
+        return os.path.join(self.root, "journal.jsonl")
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Hold the publishing lock of the store, shared by every process using it"""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.root, "lock"), "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def current_version(self):
+        """The latest published version, 0 before the first"""
+        try:
+            with open(os.path.join(self.root, "CURRENT"), encoding="ascii") as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    def publish(self, arrays, meta=None, record=None, base=False):
+        """
+        Write a new version and make it current; returns its number.
+
+        Call it while holding lock(). record, if given, is journaled under
+        the new version before the version becomes current. With base, the
+        journal is replaced by that record alone.
+        """
+        version = self.current_version() + 1
+        save_arrays(self._path(version), arrays, dict(meta or {}, version=version))
+        if record is not None:
+            line = json.dumps({"version": version, "record": record}) + "\n"
+            if base:
+                staging = f"{self._journal}.tmp-{os.getpid()}"
+                with open(staging, "w", encoding="utf-8") as f:
+                    f.write(line)
+                # Readers holding the old journal open finish reading it
+                os.replace(staging, self._journal)
+            else:
+                with open(self._journal, "a", encoding="utf-8") as f:
+                    f.write(line)
+
+        pointer = os.path.join(self.root, f"CURRENT.tmp-{os.getpid()}")
+        with open(pointer, "w", encoding="ascii") as f:
+            f.write(str(version))
+        os.replace(pointer, os.path.join(self.root, "CURRENT"))
+
+        stale = self._path(version - self.keep - 1)
+        if os.path.isdir(stale):
+            # Processes still mapping these files keep their pages until they let go
+            shutil.rmtree(stale, ignore_errors=True)
+        return version
+
+    def attach(self, version=None):
+        """(arrays, meta) of a version, the current one by default, memory-mapped"""
+        version = self.current_version() if version is None else version
+        directory = self._path(version)
+        meta = read_meta(directory)
+        if meta is None:
+            raise FileNotFoundError(f"No segment version {version} in {self.root}")
+        return load_arrays(directory), meta
+
+    def records_since(self, version, until=None):
+        """
+        (version, record) pairs journaled after a version, up to until, in order.
+
+        Reading starts after the line this process last read when that is
+        no later than version, so catching up costs the new lines only.
+        """
+        try:
+            f = open(self._journal, "rb")
+        except OSError:
+            return []
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            first = f.readline()
+            position = self._journal_position
+            # A journal started afresh has a new inode, or a new first line
+            # should the inode have been reused
+            if position is not None and position[:2] == (inode, first) and position[3] <= version:
+                f.seek(position[2])
+                last = position[3]
+            else:
+                f.seek(0)
+                last = None
+            offset = f.tell()
+            records = []
+            for line in iter(f.readline, b""):
+                if not line.endswith(b"\n"):
+                    # Still being written
+                    break
+                entry = json.loads(line)
+                last = entry["version"]
+                offset += len(line)
+                if last > version and (until is None or last <= until):
+                    records.append((last, entry["record"]))
+            if last is not None:
+                self._journal_position = (inode, first, offset, last)
+        return records
+
+    def remove(self):
+        """Delete the store and every version in it"""
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def open_segment_store(root=None):
+    """A SegmentStore at root, or None when no root is configured"""
+    return SegmentStore(root) if root else None
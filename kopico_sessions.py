@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+"""
+Kopico - Sessions
+Compact per-user conversation state in a bounded in-process or shared store
+"""
+
+import sys
+import math
+import time
+import struct
+import socket
+import argparse
+import threading
+import socketserver
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+# Rough per-entry cost of the dict slot, tuple and bytes objects holding a
+# session, counted on top of the key and payload against the memory cap
+ENTRY_OVERHEAD = 200
+
+# Most products remembered from the last reply; follow-ups name one of them
+MAX_REMEMBERED_PRODUCTS = 4
+
+# Weight of each new observation in the running preference average
+PREFERENCE_RATE = 0.3
+
+# Header: format, intent length, product count, observations, strength, acidity
+_HEADER = struct.Struct("<BBBHff")
+_FORMAT = 1
+
+
+class Session:
+    """
+    What Kopico remembers about one user between messages.
+
+    preference is an inferred (strength, acidity) pair on the catalog's 1-5
+    scales, or None until the user has shown interest in some product.
+    """
+
+    __slots__ = ("last_intent", "last_products", "preference", "observations")
+
+    def __init__(self, last_intent=None, last_products=(), preference=None, observations=0):
+        self.last_intent = last_intent
+        self.last_products = tuple(last_products)
+        self.preference = preference
+        self.observations = observations
+
+    def observe(self, strength, acidity, weight=1.0):
+        """Move the inferred preference towards a product the user showed interest in"""
+        if self.preference is None:
+            self.preference = (float(strength), float(acidity))
+        else:
+            rate = PREFERENCE_RATE * weight
+            self.preference = (self.preference[0] + rate * (strength - self.preference[0]),
+                               self.preference[1] + rate * (acidity - self.preference[1]))
+        self.observations = min(self.observations + 1, 0xFFFF)
+
+    def preferences(self):
+        """The inferred preference as a /coffee-recommendations preferences dict"""
+        if self.preference is None:
+            return {}
+        return {'strength': round(self.preference[0], 2), 'acidity': round(self.preference[1], 2)}
+
+    def pack(self):
+        """Serialize to a few dozen bytes"""
+        intent = (self.last_intent or "").encode("utf-8")[:255]
+        products = self.last_products[-MAX_REMEMBERED_PRODUCTS:]
+        strength, acidity = self.preference if self.preference is not None else (0.0, 0.0)
+        header = _HEADER.pack(_FORMAT, len(intent), len(products), self.observations, strength, acidity)
+        return header + intent + struct.pack(f"<{len(products)}I", *products)
+
+    @classmethod
+    def unpack(cls, data):
+        """Inverse of pack; None for data written in an unknown format"""
+        if len(data) < _HEADER.size or data[0] != _FORMAT:
+            return None
+        _, intent_length, count, observations, strength, acidity = _HEADER.unpack_from(data)
+        offset = _HEADER.size + intent_length
+        intent = data[_HEADER.size:offset].decode("utf-8") or None
+        products = struct.unpack_from(f"<{count}I", data, offset)
+        preference = (strength, acidity) if observations else None
+        return cls(intent, products, preference, observations)
+
+    def to_dict(self):
+        return {
+            'last_intent': self.last_intent,
+            'last_products': list(self.last_products),
+            'preferences': self.preferences(),
+            'observations': self.observations
+        }
+
+
+class SessionStore:
+    """
+    Base class for session backends, which store packed sessions by key.
+
+    Subclasses implement get_bytes, set_bytes and delete. Lost or evicted
+    sessions only cost context, so backends may drop entries at any time.
+    """
+
+    def __init__(self, ttl=1800.0):
+        self.ttl = ttl
+
+    def load(self, user_id):
+        """The session of a user, or None when there is none"""
+        data = self.get_bytes(user_id)
+        return Session.unpack(data) if data is not None else None
+
+    def save(self, user_id, session):
+        self.set_bytes(user_id, session.pack(), self.ttl)
+
+    def get_bytes(self, key):
+        raise NotImplementedError
+
+    def set_bytes(self, key, value, ttl):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+
+class LocalSessionStore(SessionStore):
+    """
+    Sessions in this process, evicted least recently used first.
+
+    Both an entry count and a byte budget are enforced; the byte budget
+    counts keys, payloads and a fixed per-entry overhead, so the store
+    never holds much more than max_bytes however many users show up.
+    """
+
+    def __init__(self, max_entries=100000, ttl=1800.0, max_bytes=32 << 20, clock=time.monotonic):
+        super().__init__(ttl)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _cost(key, value):
+        return len(key) + len(value) + ENTRY_OVERHEAD
+
+    def get_bytes(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= self.clock():
+                self._discard(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set_bytes(self, key, value, ttl):
+        cost = self._cost(key, value)
+        if cost > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (value, self.clock() + ttl)
+            self._bytes += cost
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            return self._discard(key)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._bytes -= self._cost(key, entry[0])
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'local',
+                'size': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+
+class ProtocolError(Exception):
+    """The session server sent something this client does not understand"""
+
+
+def _encode_command(*args):
+    """A command as a RESP array of bulk strings"""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode("utf-8")
+        elif isinstance(arg, int):
+            arg = str(arg).encode("ascii")
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+def _read_reply(reader):
+    """Read one RESP reply: simple string, error, integer, bulk string or array"""
+    line = reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("session server closed the connection")
+    kind, body = line[:1], line[1:-2]
+    if kind == b"+":
+        return body.decode("utf-8")
+    if kind == b"-":
+        raise ProtocolError(body.decode("utf-8", "replace"))
+    if kind == b":":
+        return int(body)
+    if kind == b"$":
+        length = int(body)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        if len(data) != length + 2:
+            raise ConnectionError("session server closed the connection")
+        return data[:-2]
+    if kind == b"*":
+        count = int(body)
+        return None if count < 0 else [_read_reply(reader) for _ in range(count)]
+    raise ProtocolError(f"unexpected reply {line[:20]!r}")
+
+
+class RespClient:
+    """
+    A client for the few Redis protocol commands Kopico needs.
+
+    Each thread keeps its own connection. When the server cannot be reached
+    commands return None rather than raising, and no connection is tried
+    again for retry_after seconds, so a missing server costs callers nothing.
+    """
+
+    def __init__(self, url, timeout=0.25, retry_after=5.0, name="session server"):
+        parsed = urlparse(url)
+        self.address = (parsed.hostname or "127.0.0.1", parsed.port or 6379)
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.name = name
+        self._local = threading.local()
+        self._down_until = 0.0
+        self.errors = 0
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            sock = socket.create_connection(self.address, timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = self._local.conn = (sock, sock.makefile("rb"))
+        return conn
+
+    def _disconnect(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            conn[1].close()
+            conn[0].close()
+
+    def command(self, *args):
+        """Send one command and return its reply, or None when the server is unavailable"""
+        if time.monotonic() < self._down_until:
+            return None
+        try:
+            sock, reader = self._connection()
+            sock.sendall(_encode_command(*args))
+            return _read_reply(reader)
+        except (OSError, ProtocolError) as e:
+            self._disconnect()
+            self.errors += 1
+            self._down_until = time.monotonic() + self.retry_after
+            print(f"⚠️  {self.name.capitalize()} {self.address[0]}:{self.address[1]} unavailable: {e}", file=sys.stderr)
+            return None
+
+
+class RemoteSessionStore(SessionStore):
+    """
+    Sessions kept in a server shared by every worker process.
+
+    Speaks the Redis protocol (GET, SET with PX, DEL), so a Redis server
+    works as well as the stand-in started with `python kopico_sessions.py`.
+    When the server cannot be reached sessions are skipped rather than
+    failing the chat request.
+    """
+
+    def __init__(self, url, ttl=1800.0, timeout=0.25, retry_after=5.0, prefix="kopico:session:"):
+        super().__init__(ttl)
+        self.client = RespClient(url, timeout, retry_after)
+        self.prefix = prefix
+
+    def command(self, *args):
+        return self.client.command(*args)
+
+    def get_bytes(self, key):
+        return self.command("GET", self.prefix + key)
+
+    def set_bytes(self, key, value, ttl):
+        self.command("SET", self.prefix + key, value, "PX", max(1, int(ttl * 1000)))
+
+    def delete(self, key):
+        return bool(self.command("DEL", self.prefix + key))
+
+    def stats(self):
+        return {
+            'backend': 'remote',
+            'address': f"{self.client.address[0]}:{self.client.address[1]}",
+            'errors': self.client.errors
+        }
+
+
+def open_session_store(url=None, max_entries=100000, ttl=1800.0, max_bytes=32 << 20):
+    """A RemoteSessionStore for a redis:// or kopico:// URL, otherwise a LocalSessionStore"""
+    if url:
+        scheme = urlparse(url).scheme
+        if scheme not in ("redis", "kopico"):
+            raise ValueError(f"Unsupported session store URL: {url}")
+        return RemoteSessionStore(url, ttl=ttl)
+    return LocalSessionStore(max_entries, ttl, max_bytes)
+
+
+def _throttle(buckets, key, max_burst, count, period, quantity=b"1"):
+    """
+    Answer CL.THROTTLE the way the redis-cell module does: limited (0 or 1),
+    limit, remaining, seconds until a retry can succeed (-1 when allowed)
+    and seconds until the bucket is full again.
+    """
+    try:
+        burst = int(max_burst) + 1
+        period = int(period)
+        rate = int(count) / period
+        cost = int(quantity)
+    except (ValueError, ZeroDivisionError):
+        return b"-ERR invalid CL.THROTTLE arguments\r\n"
+    allowed, remaining, wait = buckets.take(key.decode("utf-8"), cost, rate, burst)
+    # A quantity larger than the bucket can never pass; report a full period
+    retry_after = -1 if allowed else math.ceil(min(wait, period))
+    reset_after = math.ceil((burst - remaining) / rate) if rate > 0 else 0
+    return b"*5\r\n:%d\r\n:%d\r\n:%d\r\n:%d\r\n:%d\r\n" % (
+        0 if allowed else 1, burst, int(remaining), retry_after, reset_after)
+
+
+class _SessionRequestHandler(socketserver.StreamRequestHandler):
+    """Serve the subset of the Redis protocol RemoteSessionStore and SharedTokenBuckets use"""
+
+    def handle(self):
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        store = self.server.store
+        while True:
+            try:
+                command = _read_reply(self.rfile)
+            except (ConnectionError, ProtocolError, ValueError):
+                return
+            if not isinstance(command, list) or not command or not all(isinstance(arg, bytes) for arg in command):
+                self.wfile.write(b"-ERR expected a command array\r\n")
+                continue
+            try:
+                reply = self._execute(store, command[0].upper(), command[1:])
+            except ValueError:
+                # A key that is not UTF-8 or a TTL that is not a number fails this
+                # command only, as in Redis; the connection stays open
+                reply = b"-ERR invalid argument\r\n"
+            self.wfile.write(reply)
+
+    def _execute(self, store, name, args):
+        """The RESP reply to one command; raises ValueError for a malformed argument"""
+        if name == b"GET" and len(args) == 1:
+            value = store.get_bytes(args[0].decode("utf-8"))
+            return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+        if name == b"SET" and len(args) in (2, 4):
+            ttl = store.ttl
+            if len(args) == 4 and args[2].upper() in (b"PX", b"EX"):
+                ttl = int(args[3]) / (1000.0 if args[2].upper() == b"PX" else 1.0)
+            store.set_bytes(args[0].decode("utf-8"), args[1], ttl)
+            return b"+OK\r\n"
+        if name == b"DEL" and args:
+            return b":%d\r\n" % sum(store.delete(key.decode("utf-8")) for key in args)
+        if name == b"CL.THROTTLE" and len(args) in (4, 5) and self.server.buckets is not None:
+            return _throttle(self.server.buckets, *args)
+        if name == b"PING":
+            return b"+PONG\r\n"
+        if name == b"DBSIZE":
+            return b":%d\r\n" % len(store)
+        return b"-ERR unsupported command\r\n"
+
+
+class SessionServer(socketserver.ThreadingTCPServer):
+    """
+    A LocalSessionStore served over TCP so every worker process sees the same
+    sessions, along with the rate limit buckets the workers share.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, store, buckets=None):
+        self.store = store
+        self.buckets = buckets
+        super().__init__(address, _SessionRequestHandler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve Kopico sessions and rate limits to every worker process")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6390)
+    parser.add_argument('--max-entries', type=int, default=1000000)
+    parser.add_argument('--max-bytes', type=int, default=256 << 20)
+    args = parser.parse_args(argv)
+
+    # Imported here: kopico_admission itself builds on this module's client
+    from kopico_admission import TokenBuckets
+
+    server = SessionServer((args.host, args.port), LocalSessionStore(args.max_entries, max_bytes=args.max_bytes),
+                           TokenBuckets(rate=1, burst=1, max_keys=args.max_entries))
+    print(f"🗂️  Kopico session server on {args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Kopico - Catalog Sources
+Streaming readers that load products and brewing guides from JSONL, CSV or SQLite files
+"""
+
+import os
+import re
+import csv
+import json
+import time
+import sqlite3
+from pathlib import Path
+
+from kopico_catalog import CoffeeCatalog, CoffeeRecord
+
+# File extensions of each supported format
+FORMATS = {
+    ".jsonl": "jsonl", ".ndjson": "jsonl",
+    ".csv": "csv",
+    ".db": "sqlite", ".sqlite": "sqlite", ".sqlite3": "sqlite"
+}
+
+# Fields that hold numbers and lists when a row comes from a CSV file or SQLite table
+NUMBER_FIELDS = ("price", "strength", "acidity")
+LIST_FIELDS = ("flavor_profile", "brewing_methods", "aliases")
+# List cells are "a|b|c", or a JSON array
+LIST_SEPARATOR = "|"
+
+GUIDE_FIELDS = ("grind", "ratio", "time", "temperature", "tips")
+
+# Tables read from a SQLite source
+PRODUCT_TABLE = "products"
+GUIDE_TABLE = "brewing_guides"
+
+# Rejected rows kept with their reason; the rest are only counted
+MAX_REPORTED_ERRORS = 20
+
+IDENTIFIER_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def source_format(path):
+    """The format of a source file, from its extension"""
+    fmt = FORMATS.get(Path(path).suffix.lower())
+    if fmt is None:
+        raise ValueError(f"Unsupported catalog file {path} (use {', '.join(sorted(FORMATS))})")
+    return fmt
+
+
+class SourceReport:
+    """What reading a source did: rows read, products kept, and why rows were rejected"""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.rows = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, location, reason):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f"{location}: {reason}")
+
+    def to_dict(self):
+        return {
+            'path': self.path,
+            'rows': self.rows,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'errors': list(self.errors)
+        }
+
+
+def _cell_number(value):
+    """A CSV cell as an int or float; anything else is returned for validation to reject"""
+    if not isinstance(value, str):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+def _cell_list(value):
+    """A "a|b|c" or JSON array cell as a list of strings"""
+    if not isinstance(value, str):
+        return value
+    value = value.strip()
+    if value.startswith("["):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    return [item.strip() for item in value.split(LIST_SEPARATOR) if item.strip()]
+
+
+def _typed(row):
+    """A flat CSV or SQLite row with its number and list fields converted"""
+    for field in NUMBER_FIELDS:
+        if field in row:
+            row[field] = _cell_number(row[field])
+    for field in LIST_FIELDS:
+        if field in row:
+            row[field] = _cell_list(row[field])
+    return row
+
+
+def _jsonl_rows(path, report):
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            report.rows += 1
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                report.reject(f"line {line_number}", f"invalid JSON ({e})")
+                continue
+            if not isinstance(row, dict):
+                report.reject(f"line {line_number}", "not a JSON object")
+                continue
+            yield f"line {line_number}", row
+
+
+def _csv_rows(path, report):
+    with open(path, encoding="utf-8", newline="") as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            report.rows += 1
+            if None in row:
+                report.reject(f"line {reader.line_num}", "more cells than header columns")
+                continue
+            yield f"line {reader.line_num}", _typed({key.strip(): value for key, value in row.items()
+                                                     if value is not None})
+
+
+def _sqlite_rows(path, report, table):
+    if not IDENTIFIER_PATTERN.match(table):
+        raise ValueError(f"Invalid table name: {table}")
+    # Read-only, so a feed being written meanwhile is never locked for long
+    connection = sqlite3.connect(f"{Path(path).absolute().as_uri()}?mode=ro", uri=True)
+    try:
+        connection.row_factory = sqlite3.Row
+        # The cursor fetches rows from the file as they are consumed
+        for number, row in enumerate(connection.execute(f"SELECT * FROM {table}"), 1):
+            report.rows += 1
+            yield f"{table} row {number}", _typed(dict(row))
+    finally:
+        connection.close()
+
+
+def iter_rows(path, report, table=PRODUCT_TABLE):
+    """
+    Yield (location, row dict) for each row of a source file, one at a time.
+
+    Rows that cannot be parsed are recorded in the report and skipped.
+    table names the SQLite table to read; the other formats hold one table.
+    """
+    fmt = source_format(path)
+    if fmt == "jsonl":
+        return _jsonl_rows(path, report)
+    if fmt == "csv":
+        return _csv_rows(path, report)
+    return _sqlite_rows(path, report, table)
+
+
+def read_catalog(path, version=1, table=PRODUCT_TABLE):
+    """
+    Stream a product file into a CoffeeCatalog; returns (catalog, SourceReport).
+
+    Each row is validated and turned into a record as it is read, so only
+    the records are ever held, never the file or a list of row dicts.
+    Invalid rows and repeated names are rejected and reported rather than
+    failing the whole file.
+    """
+    report = SourceReport(path)
+    records = []
+    names = set()
+    for location, row in iter_rows(path, report, table):
+        try:
+            record = CoffeeRecord.from_dict(len(records), row)
+        except ValueError as e:
+            report.reject(location, e)
+            continue
+        key = record.name.lower()
+        if key in names:
+            report.reject(location, f"a product named '{record.name}' already exists")
+            continue
+        names.add(key)
+        records.append(record)
+    report.accepted = len(records)
+    return CoffeeCatalog.from_records(records, version), report
+
+
+def _guide(row):
+    """A brewing guide row as (method, guide dict), validated"""
+    method = row.get("method")
+    if not isinstance(method, str) or not method.strip():
+        raise ValueError("Guide field 'method' must be a non-empty string")
+    missing = [field for field in GUIDE_FIELDS if not isinstance(row.get(field), str)]
+    if missing:
+        raise ValueError(f"Guide fields must be strings: {', '.join(missing)}")
+    return method.strip().lower().replace(" ", "-"), {field: row[field] for field in GUIDE_FIELDS}
+
+
+def _json_guides(path, report):
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError(f"{path} must hold a JSON object of guides keyed by method")
+    for method, guide in data.items():
+        report.rows += 1
+        if not isinstance(guide, dict):
+            report.reject(f"method {method!r}", "not a JSON object")
+            continue
+        yield f"method {method!r}", dict(guide, method=method)
+
+
+def read_guides(path, table=GUIDE_TABLE):
+    """
+    Brewing guides keyed by method from a file; returns (guides, SourceReport).
+
+    Besides the row formats, a .json file holding {method: guide} is read.
+    """
+    report = SourceReport(path)
+    if Path(path).suffix.lower() == ".json":
+        rows = _json_guides(path, report)
+    else:
+        rows = iter_rows(path, report, table)
+
+    guides = {}
+    for location, row in rows:
+        try:
+            method, guide = _guide(row)
+        except ValueError as e:
+            report.reject(location, e)
+            continue
+        guides[method] = guide
+    report.accepted = len(guides)
+    return guides, report
+
+
+def _has_table(path, table):
+    connection = sqlite3.connect(f"{Path(path).absolute().as_uri()}?mode=ro", uri=True)
+    try:
+        return connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                  (table,)).fetchone() is not None
+    finally:
+        connection.close()
+
+
+class CatalogSource:
+    """
+    Where the catalog (and optionally the brewing guides) are read from.
+
+    A SQLite catalog may hold its guides in a brewing_guides table; other
+    formats take them from guides_path. Without either the built-in guides
+    are kept. signature() changes whenever one of the files does, which is
+    how a server notices a new feed.
+    """
+
+    def __init__(self, path, guides_path=None):
+        self.path = str(path)
+        self.guides_path = str(guides_path) if guides_path else None
+        source_format(self.path)
+
+    def files(self):
+        """Every file whose change means the source changed"""
+        files = [self.path]
+        if source_format(self.path) == "sqlite":
+            # Commits in WAL mode land in the -wal file until a checkpoint
+            files.append(f"{self.path}-wal")
+        if self.guides_path:
+            files.append(self.guides_path)
+        return files
+
+    def signature(self):
+        """(mtime, size) of each file, None for a missing one"""
+        signature = []
+        for path in self.files():
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def age(self):
+        """Seconds since the most recent change to any file of the source"""
+        times = [entry[0] for entry in self.signature() if entry is not None]
+        return time.time() - max(times) / 1e9 if times else 0.0
+
+    def read(self, version=1):
+        """
+        (catalog, guides or None, report dict) read from the source.
+
+        guides is None when the source has none, meaning keep the current ones.
+        """
+        catalog, report = read_catalog(self.path, version)
+        guides = guide_report = None
+        if self.guides_path:
+            guides, guide_report = read_guides(self.guides_path)
+        elif source_format(self.path) == "sqlite" and _has_table(self.path, GUIDE_TABLE):
+            guides, guide_report = read_guides(self.path)
+        report = report.to_dict()
+        if guide_report is not None:
+            report['guides'] = guide_report.to_dict()
+        return catalog, guides, report
+
+
+def open_catalog_source(path=None, guides_path=None):
+    """A CatalogSource for path, or None when no path is configured"""
+    return CatalogSource(path, guides_path) if path else None
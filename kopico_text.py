@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Kopico - Text Preprocessing
+Regex tokenizer and memoized Porter stemmer shared by intent matching and retrieval
+"""
+
+import re
+
+# Runs of letters and digits; everything else separates tokens, so
+# "pour-over", "pour over" and "Pour Over!" all become ["pour", "over"]
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+
+# Distinct words whose stems are remembered; chat vocabulary is small, and
+# the bound keeps a stream of made-up words from growing the memo forever
+STEM_CACHE_SIZE = 1 << 16
+
+# word -> stem; cleared when full, which is cheaper to check on every
+# lookup than keeping LRU order, and refills with the common words at once
+_stems = {}
+
+# scikit-learn's ENGLISH_STOP_WORDS, copied so that serving queries does not
+# have to import scikit-learn (about a second of startup on its own)
+ENGLISH_STOP_WORDS = frozenset([
+    'a', 'about', 'above', 'across', 'after', 'afterwards', 'again', 'against', 'all',
+    'almost', 'alone', 'along', 'already', 'also', 'although', 'always', 'am', 'among',
+    'amongst', 'amoungst', 'amount', 'an', 'and', 'another', 'any', 'anyhow', 'anyone',
+    'anything', 'anyway', 'anywhere', 'are', 'around', 'as', 'at', 'back', 'be', 'became',
+    'because', 'become', 'becomes', 'becoming', 'been', 'before', 'beforehand', 'behind',
+    'being', 'below', 'beside', 'besides', 'between', 'beyond', 'bill', 'both', 'bottom',
+    'but', 'by', 'call', 'can', 'cannot', 'cant', 'co', 'con', 'could', 'couldnt', 'cry',
+    'de', 'describe', 'detail', 'do', 'done', 'down', 'due', 'during', 'each', 'eg',
+    'eight', 'either', 'eleven', 'else', 'elsewhere', 'empty', 'enough', 'etc', 'even',
+    'ever', 'every', 'everyone', 'everything', 'everywhere', 'except', 'few', 'fifteen',
+    'fifty', 'fill', 'find', 'fire', 'first', 'five', 'for', 'former', 'formerly', 'forty',
+    'found', 'four', 'from', 'front', 'full', 'further', 'get', 'give', 'go', 'had', 'has',
+    'hasnt', 'have', 'he', 'hence', 'her', 'here', 'hereafter', 'hereby', 'herein',
+    'hereupon', 'hers', 'herself', 'him', 'himself', 'his', 'how', 'however', 'hundred',
+    'i', 'ie', 'if', 'in', 'inc', 'indeed', 'interest', 'into', 'is', 'it', 'its',
+    'itself', 'keep', 'last', 'latter', 'latterly', 'least', 'less', 'ltd', 'made', 'many',
+    'may', 'me', 'meanwhile', 'might', 'mill', 'mine', 'more', 'moreover', 'most',
+    'mostly', 'move', 'much', 'must', 'my', 'myself', 'name', 'namely', 'neither', 'never',
+    'nevertheless', 'next', 'nine', 'no', 'nobody', 'none', 'noone', 'nor', 'not',
+    'nothing', 'now', 'nowhere', 'of', 'off', 'often', 'on', 'once', 'one', 'only', 'onto',
+    'or', 'other', 'others', 'otherwise', 'our', 'ours', 'ourselves', 'out', 'over', 'own',
+    'part', 'per', 'perhaps', 'please', 'put', 'rather', 're', 'same', 'see', 'seem',
+    'seemed', 'seeming', 'seems', 'serious', 'several', 'she', 'should', 'show', 'side',
+    'since', 'sincere', 'six', 'sixty', 'so', 'some', 'somehow', 'someone', 'something',
+    'sometime', 'sometimes', 'somewhere', 'still', 'such', 'system', 'take', 'ten', 'than',
+    'that', 'the', 'their', 'them', 'themselves', 'then', 'thence', 'there', 'thereafter',
+    'thereby', 'therefore', 'therein', 'thereupon', 'these', 'they', 'thick', 'thin',
+    'third', 'this', 'those', 'though', 'three', 'through', 'throughout', 'thru', 'thus',
+    'to', 'together', 'too', 'top', 'toward', 'towards', 'twelve', 'twenty', 'two', 'un',
+    'under', 'until', 'up', 'upon', 'us', 'very', 'via', 'was', 'we', 'well', 'were',
+    'what', 'whatever', 'when', 'whence', 'whenever', 'where', 'whereafter', 'whereas',
+    'whereby', 'wherein', 'whereupon', 'wherever', 'whether', 'which', 'while', 'whither',
+    'who', 'whoever', 'whole', 'whom', 'whose', 'why', 'will', 'with', 'within', 'without',
+    'would', 'yet', 'you', 'your', 'yours', 'yourself', 'yourselves'
+])
+
+_VOWELS = frozenset("aeiou")
+
+# (suffix, replacement) rules of steps 2, 3 and 4, applied to the longest
+# matching suffix only, as in Porter's paper
+_STEP2 = (
+    ("ational", "ate"), ("tional", "tion"), ("enci", "ence"), ("anci", "ance"), ("izer", "ize"),
+    ("abli", "able"), ("alli", "al"), ("entli", "ent"), ("eli", "e"), ("ousli", "ous"),
+    ("ization", "ize"), ("ation", "ate"), ("ator", "ate"), ("alism", "al"), ("iveness", "ive"),
+    ("fulness", "ful"), ("ousness", "ous"), ("aliti", "al"), ("iviti", "ive"), ("biliti", "ble"),
+)
+_STEP3 = (
+    ("icate", "ic"), ("ative", ""), ("alize", "al"), ("iciti", "ic"), ("ical", "ic"),
+    ("ful", ""), ("ness", ""),
+)
+_STEP4 = (
+    "al", "ance", "ence", "er", "ic", "able", "ible", "ant", "ement", "ment", "ent",
+    "ion", "ou", "ism", "ate", "iti", "ous", "ive", "ize",
+)
+
+
+def _longest(rules, word, key=lambda rule: rule[0]):
+    """The rule with the longest suffix that word ends with, or None"""
+    best = None
+    for rule in rules:
+        suffix = key(rule)
+        if word.endswith(suffix) and (best is None or len(suffix) > len(key(best))):
+            best = rule
+    return best
+
+
+def _is_consonant(word, i):
+    char = word[i]
+    if char in _VOWELS:
+        return False
+    if char == "y":
+        return i == 0 or not _is_consonant(word, i - 1)
+    return True
+
+
+def _measure(stem):
+    """Porter's m: the number of vowel-consonant sequences in stem"""
+    m = 0
+    previous_vowel = False
+    for i in range(len(stem)):
+        vowel = not _is_consonant(stem, i)
+        if previous_vowel and not vowel:
+            m += 1
+        previous_vowel = vowel
+    return m
+
+
+def _has_vowel(stem):
+    return any(not _is_consonant(stem, i) for i in range(len(stem)))
+
+
+def _ends_double_consonant(word):
+    return len(word) >= 2 and word[-1] == word[-2] and _is_consonant(word, len(word) - 1)
+
+
+def _ends_cvc(word):
+    """consonant-vowel-consonant, where the last consonant is not w, x or y"""
+    return (len(word) >= 3 and _is_consonant(word, len(word) - 3)
+            and not _is_consonant(word, len(word) - 2)
+            and _is_consonant(word, len(word) - 1) and word[-1] not in "wxy")
+
+
+def _porter(word):
+    """The Porter (1980) stemming algorithm for one lowercase word"""
+    # Step 1a: plurals
+    if word.endswith("sses") or word.endswith("ies"):
+        word = word[:-2]
+    elif word.endswith("s") and not word.endswith("ss"):
+        word = word[:-1]
+
+    # Step 1b: past tense and gerunds
+    trimmed = False
+    if word.endswith("eed"):
+        if _measure(word[:-3]) > 0:
+            word = word[:-1]
+    elif word.endswith("ed") and _has_vowel(word[:-2]):
+        word, trimmed = word[:-2], True
+    elif word.endswith("ing") and _has_vowel(word[:-3]):
+        word, trimmed = word[:-3], True
+    if trimmed:
+        if word.endswith(("at", "bl", "iz")):
+            word += "e"
+        elif _ends_double_consonant(word) and word[-1] not in "lsz":
+            word = word[:-1]
+        elif _measure(word) == 1 and _ends_cvc(word):
+            word += "e"
+
+    # Step 1c
+    if word.endswith("y") and _has_vowel(word[:-1]):
+        word = word[:-1] + "i"
+
+    # Steps 2 and 3: double and single suffixes
+    for rules in (_STEP2, _STEP3):
+        rule = _longest(rules, word)
+        if rule is not None and _measure(word[:-len(rule[0])]) > 0:
+            word = word[:-len(rule[0])] + rule[1]
+
+    # Step 4: remove a final suffix from longer stems
+    suffix = _longest(_STEP4, word, key=lambda rule: rule)
+    if suffix is not None:
+        stem = word[:-len(suffix)]
+        if _measure(stem) > 1 and (suffix != "ion" or stem.endswith(("s", "t"))):
+            word = stem
+
+    # Step 5: tidy up a final e and double l
+    if word.endswith("e"):
+        stem = word[:-1]
+        m = _measure(stem)
+        if m > 1 or (m == 1 and not _ends_cvc(stem)):
+            word = stem
+    if word.endswith("ll") and _measure(word) > 1:
+        word = word[:-1]
+
+    return word
+
+
+def stem(token):
+    """Porter stem of a lowercase token; words of one or two letters and numbers are kept as they are"""
+    stemmed = _stems.get(token)
+    if stemmed is not None:
+        return stemmed
+    if len(token) <= 2 or not token.isalpha():
+        return token
+
+    stemmed = _porter(token)
+    if len(_stems) >= STEM_CACHE_SIZE:
+        _stems.clear()
+    _stems[token] = stemmed
+    return stemmed
+
+
+def clear_stem_cache():
+    """Forget every memoized stem"""
+    _stems.clear()
+
+
+def stem_cache_size():
+    """Number of memoized stems"""
+    return len(_stems)
+
+
+def tokenize(text):
+    """Lowercase word tokens of a text"""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def stem_text(text):
+    """
+    A text as space separated stems, the form phrases are matched in.
+
+    Stop words are kept: intent phrases such as "tell me about" are made of them.
+    """
+    get = _stems.get
+    return " ".join([get(token) or stem(token) for token in TOKEN_PATTERN.findall(text.lower())])
+
+
+def index_terms(text):
+    """Stems of the tokens retrieval indexes: at least two characters and not stop words"""
+    get = _stems.get
+    return [get(token) or stem(token) for token in TOKEN_PATTERN.findall(text.lower())
+            if len(token) > 1 and token not in ENGLISH_STOP_WORDS]
+
+
+def stem_texts(texts):
+    """stem_text for a list of texts, processing each distinct text once"""
+    done = {}
+    for text in texts:
+        if text not in done:
+            done[text] = stem_text(text)
+    return [done[text] for text in texts]
+
+
+def index_terms_many(texts):
+    """index_terms for a list of texts, processing each distinct text once"""
+    done = {}
+    for text in texts:
+        if text not in done:
+            done[text] = index_terms(text)
+    return [done[text] for text in texts]
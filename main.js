@@ -65,6 +65,15 @@ function addToCart(name, price, image) {
     localStorage.setItem('coffeeCart', JSON.stringify(cart));
     updateCartDisplay();
     showNotification(`${name} added to cart!`);
+    
+    // Tell Kopico what went into the cart with what, for "also bought" suggestions
+    if (kopico && kopico.recordEvent) {
+        kopico.recordEvent({
+            type: 'cart',
+            product: name,
+            cart: cart.filter(item => item.name !== name).map(item => item.name)
+        });
+    }
 }
 
 // Remove from cart
@@ -403,6 +412,9 @@ document.addEventListener('DOMContentLoaded', function() {
                 showNotification('Your cart is empty!');
                 return;
             }
+            if (kopico && kopico.recordEvent) {
+                kopico.recordEvent({ type: 'order', products: cart.map(item => item.name) });
+            }
             showNotification('Checkout functionality coming soon!');
         });
     }
@@ -442,8 +454,8 @@ document.addEventListener('DOMContentLoaded', function() {
     // Initialize analytics charts
     initializeCharts();
     
-    // Start real-time stats animation
-    animateRealTimeStats();
+    // Follow real-time stats from the backend
+    followRealTimeStats();
     
     // Add install prompt for PWA
     let deferredPrompt;
@@ -537,18 +549,21 @@ window.addEventListener('offline', () => {
     showNotification('You are offline. Some features may be limited. 📱');
 });
 
-// Analytics Charts
+// Analytics Charts, fed by the backend's rolling-window /analytics aggregates
+const ANALYTICS_POLL_INTERVAL = 10000;
+const analyticsCharts = {};
+
 function initializeCharts() {
-    // Sales Chart
-    const salesCtx = document.getElementById('salesChart');
-    if (salesCtx) {
-        new Chart(salesCtx, {
+    // Requests per minute over the last hour
+    const requestsCtx = document.getElementById('requestsChart');
+    if (requestsCtx) {
+        analyticsCharts.requests = new Chart(requestsCtx, {
             type: 'line',
             data: {
-                labels: ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun'],
+                labels: [],
                 datasets: [{
-                    label: 'Sales ($)',
-                    data: [12000, 19000, 15000, 25000, 22000, 30000],
+                    label: 'Requests',
+                    data: [],
                     borderColor: '#bc9667',
                     backgroundColor: 'rgba(188, 150, 103, 0.1)',
                     tension: 0.4,
@@ -558,6 +573,7 @@ function initializeCharts() {
             options: {
                 responsive: true,
                 maintainAspectRatio: false,
+                animation: false,
                 plugins: {
                     legend: {
                         display: false
@@ -567,9 +583,7 @@ function initializeCharts() {
                     y: {
                         beginAtZero: true,
                         ticks: {
-                            callback: function(value) {
-                                return '$' + value.toLocaleString();
-                            }
+                            precision: 0
                         }
                     }
                 }
@@ -577,21 +591,26 @@ function initializeCharts() {
         });
     }
     
-    // Popularity Chart
+    // Products Kopico recommended most
     const popularityCtx = document.getElementById('popularityChart');
     if (popularityCtx) {
-        new Chart(popularityCtx, {
+        analyticsCharts.popularity = new Chart(popularityCtx, {
             type: 'doughnut',
             data: {
-                labels: ['Ethiopian Yirgacheffe', 'Colombian Supremo', 'Brazilian Santos', 'Italian Espresso', 'Others'],
+                labels: [],
                 datasets: [{
-                    data: [30, 25, 20, 15, 10],
+                    data: [],
                     backgroundColor: [
                         '#bc9667',
                         '#8b4513',
                         '#d4b896',
                         '#a0522d',
-                        '#deb887'
+                        '#deb887',
+                        '#6f4e37',
+                        '#c19a6b',
+                        '#966919',
+                        '#e6ccb2',
+                        '#4b3621'
                     ],
                     borderWidth: 2,
                     borderColor: '#fff'
@@ -612,35 +631,101 @@ function initializeCharts() {
             }
         });
     }
+    
+    // What chat messages ask for
+    const intentCtx = document.getElementById('intentChart');
+    if (intentCtx) {
+        analyticsCharts.intents = new Chart(intentCtx, {
+            type: 'bar',
+            data: {
+                labels: [],
+                datasets: [{
+                    label: 'Messages',
+                    data: [],
+                    backgroundColor: '#bc9667'
+                }]
+            },
+            options: {
+                responsive: true,
+                maintainAspectRatio: false,
+                plugins: {
+                    legend: {
+                        display: false
+                    }
+                },
+                scales: {
+                    y: {
+                        beginAtZero: true,
+                        ticks: {
+                            precision: 0
+                        }
+                    }
+                }
+            }
+        });
+    }
 }
 
-// Animate real-time stats
-function animateRealTimeStats() {
-    const cupsServed = document.getElementById('cupsServed');
-    const activeUsers = document.getElementById('activeUsers');
-    const conversionRate = document.getElementById('conversionRate');
-    
-    // Simulate real-time updates
-    setInterval(() => {
-        if (cupsServed) {
-            const currentCups = parseInt(cupsServed.textContent.replace(',', ''));
-            cupsServed.textContent = (currentCups + Math.floor(Math.random() * 5) + 1).toLocaleString();
+// Show one /analytics snapshot in the charts and real-time stats
+function updateAnalytics(snapshot) {
+    const setChart = (chart, labels, values) => {
+        if (chart) {
+            chart.data.labels = labels;
+            chart.data.datasets[0].data = values;
+            chart.update();
         }
-        
-        if (activeUsers) {
-            const currentUsers = parseInt(activeUsers.textContent);
-            const change = Math.floor(Math.random() * 11) - 5; // -5 to +5
-            const newUsers = Math.max(100, currentUsers + change);
-            activeUsers.textContent = newUsers;
+    };
+    const minutes = snapshot.requests_per_minute || [];
+    setChart(analyticsCharts.requests,
+             minutes.map(m => new Date(m.minute * 1000).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' })),
+             minutes.map(m => m.requests));
+    const products = snapshot.top_products || [];
+    setChart(analyticsCharts.popularity, products.map(p => p.name), products.map(p => p.count));
+    setChart(analyticsCharts.intents, Object.keys(snapshot.intents || {}), Object.values(snapshot.intents || {}));
+    
+    const windowRequests = document.getElementById('windowRequests');
+    const latencyP95 = document.getElementById('latencyP95');
+    const errorRate = document.getElementById('errorRate');
+    const latency = (snapshot.latency || {}).all;
+    if (windowRequests) {
+        windowRequests.textContent = snapshot.requests.toLocaleString();
+    }
+    if (latencyP95) {
+        latencyP95.textContent = latency && latency.p95_ms !== null ? latency.p95_ms.toLocaleString() + ' ms' : '–';
+    }
+    if (errorRate) {
+        errorRate.textContent = snapshot.requests ? (100 * snapshot.errors / snapshot.requests).toFixed(1) + '%' : '–';
+    }
+}
+
+// Follow the backend's analytics: pushed over /analytics/stream, else polled from /analytics
+function followRealTimeStats() {
+    const apiUrl = (kopico && kopico.apiUrl) || 'http://localhost:5000';
+    if (typeof EventSource === 'undefined') {
+        pollAnalytics(apiUrl);
+        return;
+    }
+    const source = new EventSource(`${apiUrl}/analytics/stream`);
+    source.addEventListener('analytics', (event) => updateAnalytics(JSON.parse(event.data)));
+    source.onerror = () => {
+        // The browser reconnects by itself after a dropped connection, but
+        // not after a refusal (the server serving its most streams)
+        if (source.readyState === EventSource.CLOSED) {
+            pollAnalytics(apiUrl);
         }
-        
-        if (conversionRate) {
-            const currentRate = parseFloat(conversionRate.textContent.replace('%', ''));
-            const change = (Math.random() * 0.4) - 0.2; // -0.2 to +0.2
-            const newRate = Math.max(1.0, Math.min(5.0, currentRate + change));
-            conversionRate.textContent = newRate.toFixed(1) + '%';
+    };
+}
+
+async function pollAnalytics(apiUrl) {
+    try {
+        const response = await fetch(`${apiUrl}/analytics`);
+        if (response.ok) {
+            updateAnalytics(await response.json());
         }
-    }, 5000); // Update every 5 seconds
+    } catch (error) {
+        // Backend offline; the charts keep their last data
+    }
+    setTimeout(() => pollAnalytics(apiUrl), ANALYTICS_POLL_INTERVAL);
 }
 
 // Coffee recommendation ML algorithm (simplified)
@@ -786,6 +871,13 @@ class KopicoAssistant {
         this.isOnline = false;
         this.fallbackMode = true;
         
+        // One ID per visitor so Kopico can follow up on earlier replies
+        this.userId = localStorage.getItem('kopicoUserId');
+        if (!this.userId) {
+            this.userId = 'web_user_' + Date.now() + '_' + Math.random().toString(36).slice(2, 10);
+            localStorage.setItem('kopicoUserId', this.userId);
+        }
+        
         // Fallback responses when Python backend is not available
         this.fallbackResponses = {
             greeting: [
@@ -832,10 +924,15 @@ class KopicoAssistant {
         }
     }
     
-    async processMessage(message) {
+    async processMessage(message, onChunk) {
         // Try Python backend first
         if (!this.fallbackMode) {
             try {
+                // Stream the reply when the caller can render it piece by piece
+                if (onChunk && typeof TextDecoder !== 'undefined') {
+                    return await this.streamMessage(message, onChunk);
+                }
+                
                 const response = await fetch(`${this.apiUrl}/chat`, {
                     method: 'POST',
                     headers: {
@@ -843,7 +940,7 @@ class KopicoAssistant {
                     },
                     body: JSON.stringify({
                         message: message,
-                        user_id: 'web_user_' + Date.now()
+                        user_id: this.userId
                     }),
                     timeout: 10000
                 });
@@ -851,6 +948,8 @@ class KopicoAssistant {
                 if (response.ok) {
                     const data = await response.json();
                     return data.response;
+                } else if (this.isBusy(response)) {
+                    return this.busyMessage(response);
                 } else {
                     throw new Error('Backend response error');
                 }
@@ -864,6 +963,78 @@ class KopicoAssistant {
         return this.processFallbackMessage(message);
     }
     
+    async streamMessage(message, onChunk) {
+        // Read Server-Sent Events from /chat/stream, passing each section to onChunk
+        const response = await fetch(`${this.apiUrl}/chat/stream`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Accept': 'text/event-stream'
+            },
+            body: JSON.stringify({
+                message: message,
+                user_id: this.userId
+            })
+        });
+        
+        if (this.isBusy(response)) {
+            return this.busyMessage(response);
+        }
+        if (!response.ok || !response.body) {
+            throw new Error('Backend response error');
+        }
+        
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let text = '';
+        
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            
+            // Events are separated by a blank line
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                
+                let event = 'message';
+                let data = '';
+                rawEvent.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) event = line.slice(6).trim();
+                    else if (line.startsWith('data:')) data += line.slice(5).trim();
+                });
+                
+                const payload = data ? JSON.parse(data) : {};
+                if (event === 'chunk') {
+                    text += payload.text;
+                    onChunk(payload.text);
+                } else if (event === 'error') {
+                    throw new Error(payload.error);
+                } else if (event === 'done') {
+                    return text;
+                }
+            }
+        }
+        
+        if (!text) {
+            throw new Error('Stream ended without a reply');
+        }
+        return text;
+    }
+    
+    isBusy(response) {
+        // A refusal under load: the backend is up, so stay out of offline mode
+        return response.status === 429 || response.status === 503;
+    }
+    
+    busyMessage(response) {
+        const seconds = parseInt(response.headers.get('Retry-After'), 10) || 1;
+        return `☕ I'm brewing a lot of answers right now! Please try again in ${seconds} second${seconds === 1 ? '' : 's'}.`;
+    }
+    
     processFallbackMessage(message) {
         const lowerMessage = message.toLowerCase();
         
@@ -953,6 +1124,19 @@ class KopicoAssistant {
         return responses[Math.floor(Math.random() * responses.length)];
     }
     
+    recordEvent(event) {
+        // Fire and forget: a lost event only makes suggestions a little less informed
+        if (this.fallbackMode) return;
+        fetch(`${this.apiUrl}/events`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ ...event, user_id: this.userId }),
+            keepalive: true
+        }).catch(error => console.log("Could not record event:", error.message));
+    }
+    
     async getPersonalizedRecommendations(preferences) {
         if (!this.fallbackMode) {
             try {
@@ -1086,11 +1270,27 @@ function sendMessage() {
     
     // Always provide immediate fallback response if Kopico fails
     try {
+        // Render the reply as it streams in, starting with the first section
+        let streamed = null;
+        const onChunk = chunk => {
+            if (!streamed) {
+                hideTypingIndicator();
+                streamed = addMessage('', 'bot');
+            }
+            streamed.textContent += chunk;
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+        };
+        
         // Use Kopico AI system for response
-        kopico.processMessage(message)
+        kopico.processMessage(message, onChunk)
             .then(response => {
                 hideTypingIndicator();
-                addMessage(response, 'bot');
+                if (streamed) {
+                    // Also replaces a partial reply if the stream broke off
+                    streamed.textContent = response;
+                } else {
+                    addMessage(response, 'bot');
+                }
                 sendButton.disabled = false;
             })
             .catch(error => {
@@ -1130,6 +1330,8 @@ function addMessage(text, sender) {
     
     chatMessages.appendChild(messageDiv);
     chatMessages.scrollTop = chatMessages.scrollHeight;
+    
+    return paragraph;
 }
 
 function showTypingIndicator() {
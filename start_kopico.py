@@ -7,10 +7,42 @@ Simple script to start the Kopico backend server
 import subprocess
 import sys
 import os
+import gc
+import json
 import time
+import atexit
+import signal
+import socket
+import argparse
+import threading
 import webbrowser
+import urllib.request
 from pathlib import Path
 
+# Requests each production worker serves at once before refusing more
+DEFAULT_MAX_IN_FLIGHT = 2
+
+# Seconds a server gets to load its model and warm up before the launcher gives up on it
+READY_TIMEOUT = 120
+
+# Seconds between readiness polls
+READY_POLL_INTERVAL = 0.2
+
+LAUNCHER_PID = os.getpid()
+
+def at_launcher_exit(func, *args):
+    """
+    Run func when the launcher exits, but not in forked workers.
+    
+    Gunicorn workers leave through sys.exit, which runs every atexit handler
+    inherited from the launcher; a recycled worker would otherwise stop the
+    session server or delete the segments the others still use.
+    """
+    def run():
+        if os.getpid() == LAUNCHER_PID:
+            func(*args)
+    atexit.register(run)
+
 def check_requirements():
     """Check if required packages are installed"""
     try:
@@ -50,19 +82,115 @@ def download_nltk_data():
         print(f"❌ Failed to download NLTK data: {e}")
         return False
 
-def start_kopico_server():
-    """Start the Kopico AI server"""
+def build_model():
+    """Prebuild the similarity index so the server starts without fitting it"""
+    print("🔧 Building Kopico model...")
+    try:
+        subprocess.check_call([sys.executable, "kopico_bot.py", "--build-model"], cwd=Path(__file__).parent)
+        return True
+    except subprocess.CalledProcessError:
+        print("❌ Failed to build the model")
+        return False
+
+def bind_listener(host, port):
+    """
+    Listening socket the server processes inherit. A replacement server
+    accepts from the same socket, so restarting never refuses a connection.
+    """
+    listener = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(128)
+    listener.set_inheritable(True)
+    return listener
+
+def local_url(host, port):
+    """URL the launcher reaches a server bound to host and port at"""
+    if host in ('', '0.0.0.0'):
+        host = '127.0.0.1'
+    elif host == '::':
+        host = '::1'
+    return f"http://[{host}]:{port}" if ':' in host else f"http://{host}:{port}"
+
+def start_server_process(listener=None, **options):
+    """
+    Start kopico_bot.py serving on the launcher's socket, or on its own port
+    without one. options go to subprocess.Popen (stdout, env and so on).
+    """
+    command = [sys.executable, "kopico_bot.py"]
+    if listener is None:
+        return subprocess.Popen(command, cwd=Path(__file__).parent, **options)
+    return subprocess.Popen(command + ["--fd", str(listener.fileno())], pass_fds=(listener.fileno(),),
+                            cwd=Path(__file__).parent, **options)
+
+def wait_until_ready(url, process, timeout=READY_TIMEOUT, pid=None):
+    """
+    Poll url/health/ready until it answers 200, from process pid when one
+    is given (a new server sharing the socket with an old one answers only
+    some polls). False if the process exits or timeout runs out first.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            with urllib.request.urlopen(f"{url}/health/ready", timeout=2) as response:
+                if pid is None or json.load(response).get('pid') == pid:
+                    return True
+        except (OSError, ValueError):
+            # Not listening yet, or 503 while warming up or draining
+            pass
+        time.sleep(READY_POLL_INTERVAL)
+    return False
+
+def stop_server(process, timeout=None):
+    """SIGTERM a server, which drains its requests in flight, and kill it if it takes longer than timeout"""
+    if timeout is None:
+        timeout = float(os.environ.get('KOPICO_DRAIN_TIMEOUT', 30)) + 5
+    process.terminate()
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def restart_server(listener, old, url, timeout=READY_TIMEOUT):
+    """
+    Replace a server process without refusing or dropping a request, and
+    return the one now serving.
+    
+    The new process loads its model and warms up before it accepts from the
+    shared socket, so the old one serves alone until the new one answers
+    /health/ready. Then the old one is stopped: it stops accepting, leaving
+    queued connections to the new one, and exits once its requests in
+    flight are done. A new process that does not become ready is stopped
+    and the old one keeps serving.
+    """
+    print("🔄 Starting a new Kopico server...")
+    new = start_server_process(listener)
+    if not wait_until_ready(url, new, timeout, pid=new.pid):
+        stop_server(new)
+        print("❌ The new server did not become ready; the old one keeps serving")
+        return old
+    print(f"✅ New server (pid {new.pid}) is ready; draining the old one (pid {old.pid})")
+    stop_server(old)
+    return new
+
+def start_kopico_server(listener=None, url="http://127.0.0.1:5000", timeout=READY_TIMEOUT):
+    """Start the Kopico AI server and wait until it is ready; returns its process, or None"""
     print("🚀 Starting Kopico AI server...")
     try:
         # Change to the script directory
         os.chdir(Path(__file__).parent)
         
-        # Start the Flask server
-        subprocess.Popen([sys.executable, "kopico_bot.py"])
-        print("✅ Kopico server started on http://localhost:5000")
-        
-        # Wait a moment for server to start
-        time.sleep(3)
+        process = start_server_process(listener)
+        print("⏳ Waiting for Kopico to load its model and warm up...")
+        if not wait_until_ready(url, process, timeout):
+            print(f"❌ Kopico did not become ready within {timeout:.0f}s")
+            if process.poll() is None:
+                stop_server(process)
+            return None
+        print(f"✅ Kopico server ready on {url}")
         
         # Try to open the website
         try:
@@ -75,26 +203,182 @@ def start_kopico_server():
                 print("📝 Please open index.html in your browser to use the website")
         except Exception:
             print("📝 Please open index.html in your browser to use the website")
-            
-        return True
+        
+        return process
     except Exception as e:
         print(f"❌ Failed to start server: {e}")
-        return False
+        return None
 
-def main():
-    """Main launcher function"""
-    print("🤖 Kopico AI Coffee Assistant Launcher")
-    print("=" * 40)
+def start_session_server(port):
+    """
+    Start the shared session store, which also keeps the rate limits
+    workers share, and return its URL (None if it did not start). It is
+    stopped when the launcher exits.
+    """
+    print(f"🗂️  Starting the session server on port {port}...")
+    process = subprocess.Popen([sys.executable, "kopico_sessions.py", "--port", str(port)],
+                               cwd=Path(__file__).parent)
+    at_launcher_exit(process.terminate)
+    
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and process.poll() is None:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    else:
+        print("⚠️  The session server did not start; each worker keeps its own sessions and rate limits")
+        return None
     
+    return f"redis://127.0.0.1:{port}"
+
+def serve_production(host, port, workers, threads, max_requests, graceful_timeout, max_in_flight=None,
+                     segment_dir=None):
+    """
+    Serve with preforked worker processes that share one loaded model.
+    
+    The model is loaded here, in the parent, before any worker is forked,
+    so workers start instantly and share its memory copy-on-write. SIGTERM
+    stops gracefully: workers finish in-flight requests (up to
+    graceful_timeout seconds) before exiting. SIGHUP replaces every worker.
+    Each worker is also replaced after about max_requests requests, which
+    bounds the growth of its caches and any leaked memory.
+    
+    Each worker admits max_in_flight requests at a time and runs threads
+    more on top of them, which answer health checks and refuse requests
+    past the cap. Without those spare threads excess requests would wait in
+    gunicorn's queue, where admission control never sees them. The default
+    cap is low because requests are CPU bound: a worker runs Python one
+    request at a time, so each request admitted beyond the first couple
+    makes all of them slower without serving more.
+    
+    The similarity index and catalog columns are published as shared
+    segments in segment_dir (by default a directory in /dev/shm named after
+    the port, removed on exit), which workers map rather than copy: their
+    memory stays shared even after catalog changes, which every worker
+    picks up. An empty segment_dir turns this off.
+    """
+    os.chdir(Path(__file__).parent)
+    sys.path.insert(0, os.getcwd())
+    if max_in_flight is None:
+        max_in_flight = int(os.environ.get('KOPICO_MAX_IN_FLIGHT', DEFAULT_MAX_IN_FLIGHT))
+    # Read by kopico_bot when it is imported
+    os.environ['KOPICO_MAX_IN_FLIGHT'] = str(max_in_flight)
+    admission = os.environ.get('KOPICO_ADMISSION', '1') != '0' and max_in_flight > 0
+    if segment_dir is None:
+        segment_dir = os.environ.get('KOPICO_SEGMENT_DIR')
+    if segment_dir is None:
+        from kopico_segments import default_segment_root
+        segment_dir = default_segment_root(f"kopico-{port}")
+    if segment_dir:
+        from kopico_segments import SegmentStore
+        # Start from an empty store; versions left by an earlier run are stale
+        store = SegmentStore(segment_dir)
+        store.remove()
+        at_launcher_exit(store.remove)
+    os.environ['KOPICO_SEGMENT_DIR'] = segment_dir
+    import kopico_bot
+    
+    print("🧠 Loading Kopico model...")
+    kopico_bot.get_kopico()
+    # Warmed here, so every worker starts with warm caches and reports ready at once
+    kopico_bot.warm_up()
+    # Keep the loaded objects out of the garbage collector's reach so that
+    # collections in the workers do not write to (and so copy) shared pages
+    gc.freeze()
+    
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        # gunicorn does not run on Windows; serve threaded from one process
+        print("⚠️  gunicorn is not installed (or not supported here), using the threaded development server")
+        kopico_bot.serve(host, port)
+        return
+    
+    if admission:
+        threads = max_in_flight + threads
+    options = {
+        'bind': f"{host}:{port}",
+        'workers': workers,
+        'threads': threads,
+        'worker_class': 'gthread' if threads > 1 else 'sync',
+        'max_requests': max_requests,
+        'max_requests_jitter': max(1, max_requests // 10) if max_requests else 0,
+        'graceful_timeout': graceful_timeout,
+        'timeout': 30,
+        'preload_app': True,
+        # Threads do not survive the fork: each worker starts its own catalog file watcher,
+        # so an idle worker picks up a new feed as soon as a busy one
+        'post_fork': lambda server, worker: kopico_bot.get_kopico().watch_source(),
+        'accesslog': None
+    }
+    
+    class KopicoApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+        
+        def load(self):
+            return kopico_bot.app
+    
+    print(f"🚀 Serving on http://{host}:{port} with {workers} workers x {threads} threads")
+    KopicoApplication().run()
+
+def parse_args(argv=None):
+    """Command line options for the launcher"""
+    parser = argparse.ArgumentParser(description="Start the Kopico AI backend")
+    parser.add_argument('--production', action='store_true',
+                        help="serve with preforked workers instead of the development server")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('KOPICO_WORKERS', os.cpu_count() or 1)),
+                        help="worker processes in production mode (default: CPU count)")
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('KOPICO_THREADS', 4)),
+                        help="threads per worker in production mode (default: 4)")
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                        help="requests each production worker serves at once before refusing more with 503 "
+                             "(default: KOPICO_MAX_IN_FLIGHT or 2; 0 disables)")
+    parser.add_argument('--host', default=os.environ.get('KOPICO_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('KOPICO_PORT', 5000)))
+    parser.add_argument('--max-requests', type=int, default=int(os.environ.get('KOPICO_MAX_REQUESTS', 10000)),
+                        help="recycle a worker after about this many requests (0 disables)")
+    parser.add_argument('--graceful-timeout', type=int, default=30,
+                        help="seconds workers get to finish in-flight requests on shutdown")
+    parser.add_argument('--session-server', action='store_true',
+                        help="share sessions between production workers through a local session server "
+                             "(ignored when KOPICO_SESSION_URL is set)")
+    parser.add_argument('--shared-rate-limits', action='store_true',
+                        help="apply per-user and per-address rate limits across all production workers "
+                             "through the local session server (ignored when KOPICO_RATE_LIMIT_URL is set)")
+    parser.add_argument('--segment-dir', default=None,
+                        help="directory the production workers share the index through "
+                             "(default: KOPICO_SEGMENT_DIR or /dev/shm/kopico-PORT; '' disables)")
+    parser.add_argument('--session-port', type=int, default=int(os.environ.get('KOPICO_SESSION_PORT', 6390)))
+    parser.add_argument('--catalog', default=None,
+                        help="JSONL, CSV or SQLite file to load the products from, reloaded when it changes "
+                             "(default: KOPICO_CATALOG_PATH, else the built-in products)")
+    parser.add_argument('--guides', default=None,
+                        help="JSON, JSONL, CSV or SQLite file of brewing guides (default: KOPICO_GUIDES_PATH)")
+    parser.add_argument('--event-log', default=None,
+                        help="directory to log chat, recommendation and brewing guide requests to "
+                             "(default: KOPICO_EVENT_LOG_DIR; read it with python kopico_eventlog.py)")
+    parser.add_argument('--ready-timeout', type=float, default=READY_TIMEOUT,
+                        help=f"seconds a server gets to load and warm up before it counts as failed "
+                             f"(default: {READY_TIMEOUT})")
+    parser.add_argument('--skip-setup', action='store_true',
+                        help="do not check packages, download NLTK data or build the model")
+    return parser.parse_args(argv)
+
+def setup():
+    """Check files and packages, fetch NLTK data and build the model"""
     # Check if requirements.txt exists
     if not Path("requirements.txt").exists():
         print("❌ requirements.txt not found!")
-        return
+        return False
     
     # Check if kopico_bot.py exists
     if not Path("kopico_bot.py").exists():
         print("❌ kopico_bot.py not found!")
-        return
+        return False
     
     # Check requirements
     if not check_requirements():
@@ -102,23 +386,72 @@ def main():
         if not install_requirements():
             print("❌ Installation failed. Please run manually:")
             print("   pip install -r requirements.txt")
-            return
+            return False
     
     # Download NLTK data
     if not download_nltk_data():
         print("⚠️  NLTK data download failed, but continuing...")
     
-    # Start server
-    if start_kopico_server():
+    # Build the model artifact the server loads at startup
+    if not build_model():
+        print("⚠️  The server will fit its model at startup instead")
+    
+    return True
+
+def main():
+    """Main launcher function"""
+    args = parse_args()
+    print("🤖 Kopico AI Coffee Assistant Launcher")
+    print("=" * 40)
+    
+    # Read by kopico_bot, in the server and when it builds the model
+    if args.catalog:
+        os.environ['KOPICO_CATALOG_PATH'] = os.path.abspath(args.catalog)
+    if args.guides:
+        os.environ['KOPICO_GUIDES_PATH'] = os.path.abspath(args.guides)
+    if args.event_log:
+        os.environ['KOPICO_EVENT_LOG_DIR'] = os.path.abspath(args.event_log)
+
+    if not args.skip_setup and not setup():
+        return
+    
+    # Production mode serves from this process until it is stopped
+    if args.production:
+        share_sessions = args.session_server and not os.environ.get('KOPICO_SESSION_URL')
+        share_rate_limits = args.shared_rate_limits and not os.environ.get('KOPICO_RATE_LIMIT_URL')
+        url = start_session_server(args.session_port) if share_sessions or share_rate_limits else None
+        if url and share_sessions:
+            os.environ['KOPICO_SESSION_URL'] = url
+        if url and share_rate_limits:
+            os.environ['KOPICO_RATE_LIMIT_URL'] = url
+        serve_production(args.host, args.port, args.workers, args.threads,
+                         args.max_requests, args.graceful_timeout, args.max_in_flight, args.segment_dir)
+        return
+    
+    # Start server. The launcher holds the listening socket, so the server
+    # can be replaced without refusing connections (not on Windows, where
+    # sockets cannot be handed to a child process like this)
+    listener = bind_listener(args.host, args.port) if os.name != 'nt' else None
+    url = local_url(args.host, args.port)
+    server = start_kopico_server(listener, url, args.ready_timeout)
+    if server:
         print("\n🎉 Kopico is now running!")
         print("💬 You can now chat with Kopico on your website!")
+        restart = threading.Event()
+        if listener is not None:
+            signal.signal(signal.SIGHUP, lambda signum, frame: restart.set())
+            print(f"🔄 Run kill -HUP {os.getpid()} to restart it (picking up code changes) without dropping requests")
         print("🛑 Press Ctrl+C to stop the server")
         
         try:
             # Keep the launcher running
-            while True:
-                time.sleep(1)
+            while server.poll() is None:
+                if restart.wait(1):
+                    restart.clear()
+                    server = restart_server(listener, server, url, args.ready_timeout)
+            print("❌ The Kopico server exited")
         except KeyboardInterrupt:
+            stop_server(server)
             print("\n👋 Kopico stopped. Thanks for using our AI assistant!")
     else:
         print("❌ Failed to start Kopico. Please check the error messages above.")
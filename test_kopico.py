@@ -7,6 +7,7 @@ Tests all components of the AI-powered coffee website
 import requests
 import time
 import json
+import re
 import sys
 from pathlib import Path
 
@@ -73,13 +74,27 @@ def test_recommendations_endpoint():
             timeout=10
         )
         
-        if response.status_code == 200:
-            data = response.json()
-            print(f"✅ Recommendations: {len(data.get('recommendations', []))} coffees recommended")
-            return True
-        else:
+        if response.status_code != 200:
             print(f"❌ Recommendations failed: {response.status_code}")
             return False
+        data = response.json()
+        
+        # Prices that are not a finite, non-negative number are the caller's mistake
+        for max_price in ([30], {'usd': 30}, -5, 'nan'):
+            invalid = requests.post('http://localhost:5000/coffee-recommendations',
+                                    json={'preferences': {'max_price': max_price}}, timeout=10)
+            if invalid.status_code != 400:
+                print(f"❌ max_price {max_price!r} answered {invalid.status_code}")
+                return False
+        # JSON true is a bool, which Python counts as the int 1
+        for limit in (True, 2.0, 0):
+            invalid = requests.post('http://localhost:5000/coffee-recommendations',
+                                    json={'preferences': {}, 'limit': limit}, timeout=10)
+            if invalid.status_code != 400:
+                print(f"❌ limit {limit!r} answered {invalid.status_code}")
+                return False
+        print(f"✅ Recommendations: {len(data.get('recommendations', []))} coffees recommended; bad prices and limits refused")
+        return True
             
     except requests.exceptions.RequestException as e:
         print(f"❌ Recommendations error: {e}")
@@ -156,36 +171,1213 @@ def test_ai_intelligence():
         except requests.exceptions.RequestException as e:
             print(f"❌ Intelligence test error: {e}")
 
-def run_performance_test():
-    """Test response times"""
-    print("\n🧪 Testing Performance:")
-    
-    start_time = time.time()
+def test_session_followup():
+    """Test that a follow-up can refer to a product from the previous reply"""
+    print("\n🧪 Testing Conversation Context:")
     try:
-        response = requests.post(
+        first = requests.post(
             'http://localhost:5000/chat',
-            json={
-                'message': 'Hello, how are you?',
-                'user_id': 'performance_test'
-            },
+            json={'message': 'Recommend a strong coffee', 'user_id': 'session_test'},
             timeout=10
-        )
+        ).json()['response']
+        followup = requests.post(
+            'http://localhost:5000/chat',
+            json={'message': 'Tell me more about the second one', 'user_id': 'session_test'},
+            timeout=10
+        ).json()['response']
+        
+        # The second recommendation is the second bold product name in the reply
+        names = re.findall(r"\*\*(.+?)\*\*", first)
+        if len(names) >= 2 and followup.startswith(f"**{names[1]}**"):
+            print(f"✅ Follow-up resolved to {names[1]}")
+            return True
+        print(f"❌ Follow-up not resolved: {followup[:50]}...")
+        return False
+    
+    except (requests.exceptions.RequestException, KeyError) as e:
+        print(f"❌ Session test error: {e}")
+        return False
+
+def test_coffee_search():
+    """Test /coffees filters, cursor pagination and facet counts"""
+    print("\n🧪 Testing Faceted Search:")
+    try:
+        everything = requests.get('http://localhost:5000/coffees', params={'limit': 100}, timeout=10).json()
+        coffees = everything['coffees']
         
-        end_time = time.time()
-        response_time = end_time - start_time
+        # Page through by price two at a time; every product must come once, cheapest first
+        seen = []
+        params = {'sort': 'price', 'limit': 2}
+        while True:
+            page = requests.get('http://localhost:5000/coffees', params=params, timeout=10).json()
+            seen += page['coffees']
+            if not page['next_cursor']:
+                break
+            params['cursor'] = page['next_cursor']
+        if sorted(coffee['name'] for coffee in seen) != sorted(coffee['name'] for coffee in coffees):
+            print("❌ Paging with cursors did not return every product once")
+            return False
+        if [coffee['price'] for coffee in seen] != sorted(coffee['price'] for coffee in coffees):
+            print("❌ Pages are not sorted by price")
+            return False
         
-        if response.status_code == 200:
-            if response_time < 2.0:
-                print(f"✅ Fast response time: {response_time:.2f}s")
-            elif response_time < 5.0:
-                print(f"⚠️  Acceptable response time: {response_time:.2f}s")
-            else:
-                print(f"❌ Slow response time: {response_time:.2f}s")
-        else:
-            print(f"❌ Performance test failed: {response.status_code}")
-            
+        origin = coffees[0]['origin']
+        filtered = requests.get('http://localhost:5000/coffees',
+                                params={'origin': origin, 'strength_min': 2}, timeout=10).json()
+        expected = [coffee['name'] for coffee in coffees
+                    if coffee['origin'].lower() == origin.lower() and coffee['strength'] >= 2]
+        if [coffee['name'] for coffee in filtered['coffees']] != expected or filtered['total'] != len(expected):
+            print(f"❌ Filter on origin {origin} and strength >= 2 returned the wrong products")
+            return False
+        
+        # Origin counts ignore the origin filter itself
+        counts = {entry['value']: entry['count'] for entry in filtered['facets']['origin']}
+        expected_count = sum(1 for coffee in coffees if coffee['origin'] == origin and coffee['strength'] >= 2)
+        if counts.get(origin, 0) != expected_count:
+            print(f"❌ Facet count for {origin} is {counts.get(origin)}, expected {expected_count}")
+            return False
+        
+        if requests.get('http://localhost:5000/coffees', params={'sort': 'colour'}, timeout=10).status_code != 400:
+            print("❌ Unknown sort order accepted")
+            return False
+        
+        # Cursors come back from clients: ones pointing past the catalog or holding the wrong types are refused
+        from kopico_facets import encode_cursor
+        for sort, cursor in (('price', encode_cursor('price', 9.99, 10 ** 9)), ('price', encode_cursor('price', 9.99, -1)),
+                             ('price', encode_cursor('price', 9.99, True)), ('price', encode_cursor('price', 'cheap', 0)),
+                             ('name', encode_cursor('name', 4.5, 0)), ('', encode_cursor('', None, 1.5)),
+                             ('price', 'not-a-cursor')):
+            tampered = requests.get('http://localhost:5000/coffees', params={'sort': sort, 'cursor': cursor}, timeout=10)
+            if tampered.status_code != 400:
+                print(f"❌ Tampered cursor {cursor} for sort {sort!r} answered {tampered.status_code}")
+                return False
+        print(f"✅ {len(seen)} products paged by price; {len(expected)} match origin {origin} with strength >= 2")
+        return True
+    
+    except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+        print(f"❌ Faceted search test error: {e}")
+        return False
+
+def test_fuzzy_lookup():
+    """Test that misspelt product names still find the product, and that other messages find none"""
+    print("\n🧪 Testing Fuzzy Product Lookup:")
+    try:
+        found = requests.get('http://localhost:5000/coffees/lookup', params={'q': 'columbian'}, timeout=10).json()
+        if found['coffee']['name'] != 'Colombian Supremo' or not 0.75 <= found['confidence'] < 1:
+            print(f"❌ 'columbian' found {found}")
+            return False
+        missing = requests.get('http://localhost:5000/coffees/lookup', params={'q': 'opening hours'}, timeout=10)
+        if missing.status_code != 404:
+            print(f"❌ 'opening hours' found a coffee ({missing.status_code})")
+            return False
+        
+        reply = requests.post('http://localhost:5000/chat', json={'message': 'yirgachefe'}, timeout=10).json()
+        if 'Did you mean **Ethiopian Yirgacheffe**' not in reply['response']:
+            print(f"❌ 'yirgachefe' -> {reply['response'][:60]}")
+            return False
+
+        reply = requests.post('http://localhost:5000/chat', json={'message': 'what is your best blend'}, timeout=10).json()
+        if not reply['response'].startswith("I'd be happy to tell you about our coffee products"):
+            print(f"❌ 'what is your best blend' -> {reply['response'][:60]}")
+            return False
+        missing = requests.get('http://localhost:5000/coffees/lookup', params={'q': 'special offers'}, timeout=10)
+        if missing.status_code != 404:
+            print(f"❌ 'special offers' found a coffee ({missing.status_code})")
+            return False
+        print(f"✅ 'columbian' -> {found['coffee']['name']} ({found['confidence']}); "
+              f"'yirgachefe' answered with Ethiopian Yirgacheffe; everyday words name no coffee")
+        return True
+    
+    except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+        print(f"❌ Fuzzy lookup test error: {e}")
+        return False
+
+def test_also_bought():
+    """Test that coffees ordered together become each other's also-bought neighbours"""
+    print("\n🧪 Testing Also Bought:")
+    try:
+        events = [{'type': 'order', 'products': ['Guatemalan Antigua', 'House Special Blend']},
+                  {'type': 'cart', 'product': 'House Special Blend', 'cart': ['Guatemalan Antigua']}]
+        recorded = requests.post('http://localhost:5000/events', json={'events': events}, timeout=10)
+        if recorded.status_code != 202 or recorded.json()['accepted'] != 2:
+            print(f"❌ Events not recorded ({recorded.status_code}): {recorded.text[:80]}")
+            return False
+        
+        # Neighbour lists are refreshed in the background every few seconds
+        names = []
+        deadline = time.time() + 15
+        while time.time() < deadline:
+            found = requests.get('http://localhost:5000/also-bought/Guatemalan Antigua', timeout=10).json()
+            names = [coffee['name'] for coffee in found['also_bought']]
+            if 'House Special Blend' in names:
+                break
+            time.sleep(0.5)
+        if 'House Special Blend' not in names:
+            print(f"❌ Also bought with Guatemalan Antigua: {names}")
+            return False
+        
+        invalid = requests.post('http://localhost:5000/events', json={'type': 'refund'}, timeout=10)
+        if invalid.status_code != 400:
+            print(f"❌ An unknown event type was accepted ({invalid.status_code})")
+            return False
+        print(f"✅ Also bought with Guatemalan Antigua: {', '.join(names)}")
+        return True
+    
+    except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+        print(f"❌ Also bought test error: {e}")
+        return False
+
+def test_rate_limit():
+    """Test that a user sending faster than their rate is refused with a Retry-After"""
+    print("\n🧪 Testing Admission Control:")
+    try:
+        admission = requests.get('http://localhost:5000/health', timeout=5).json().get('admission')
+        if not admission or not admission.get('users'):
+            print("⚠️  Per-user rate limits are off on this server, skipping")
+            return True
+        
+        # The default burst is 20; a few more messages must be refused
+        session = requests.Session()
+        user_id = f"rate_test_{int(time.time())}"
+        refused = None
+        for _ in range(40):
+            response = session.post('http://localhost:5000/chat',
+                                    json={'message': 'Hello', 'user_id': user_id}, timeout=10)
+            if response.status_code == 429:
+                refused = response
+                break
+        
+        if refused is None:
+            print("❌ 40 rapid messages were all accepted")
+            return False
+        if not refused.headers.get('Retry-After', '').isdigit():
+            print("❌ Refusal without a Retry-After header")
+            return False
+        if session.get('http://localhost:5000/health', timeout=5).status_code != 200:
+            print("❌ Health check refused along with the user")
+            return False
+        print(f"✅ Refused with 429, Retry-After {refused.headers['Retry-After']}s; health still served")
+        return True
+    
     except requests.exceptions.RequestException as e:
+        print(f"❌ Admission test error: {e}")
+        return False
+
+def test_phrase_matcher():
+    """Test that the phrase matcher finds every phrase on word boundaries only, best rank first"""
+    print("\n🧪 Testing Phrase Matcher:")
+    from kopico_matcher import PhraseMatcher
+    
+    phrases = {"hi": 0, "brew": 2, "cold brew": 1, "press": 3, "french press": 1, "what is": 0}
+    matcher = PhraseMatcher()
+    for phrase, rank in phrases.items():
+        matcher.add(phrase, rank, phrase)
+    
+    messages = ("hi there", "something to brew", "this is it", "cold brew, or a french press?", "oh, hi!",
+                "brewing", "what is a cold-brew", "pressure", "so what is this")
+    for message in messages:
+        found = sorted((start, payload) for start, _, _, payload in matcher.scan(message))
+        # The same phrases found by a regex with word boundaries
+        expected = sorted((match.start(), phrase) for phrase in phrases
+                          for match in re.finditer(rf"(?<!\w){re.escape(phrase)}(?!\w)", message))
+        if found != expected:
+            print(f"❌ {message!r}: found {found}, expected {expected}")
+            return False
+    
+    best = matcher.best("cold brew, or a french press?")
+    if best != (1, "cold brew") or matcher.best("something") is not None:
+        print(f"❌ Best match {best}")
+        return False
+    print(f"✅ {len(messages)} messages matched on word boundaries, as a regex finds them")
+    return True
+
+def test_catalog_indexes():
+    """Test that an updated catalog's indexes and columns match a linear scan and a fresh build"""
+    print("\n🧪 Testing Catalog Indexes:")
+    import numpy as np
+    from kopico_bot import COFFEE_PRODUCTS
+    from kopico_catalog import CoffeeCatalog
+    
+    catalog = CoffeeCatalog(COFFEE_PRODUCTS)
+    updated, changed, removed = catalog.updated(
+        upserts=[("House Special Blend", {"name": "House Reserve", "strength": 5}),
+                 ("Test Decaf", dict(COFFEE_PRODUCTS[2], name="Test Decaf", strength=1, origin="Peru"))],
+        removals=["Colombian Supremo"]
+    )
+    if updated.version != catalog.version + 1 or len(catalog) != len(COFFEE_PRODUCTS):
+        print(f"❌ Version {updated.version}, original changed to {len(catalog)} products")
+        return False
+    if catalog.find_by_name("House Special Blend") is None or updated.find_by_name("House Special Blend") is not None:
+        print("❌ A rename showed in the original catalog, or not in the new one")
+        return False
+    
+    live = list(updated)
+    fresh = CoffeeCatalog.from_records(list(updated.records), version=updated.version)
+    for candidate in (updated, fresh):
+        for field in CoffeeCatalog.RANGE_FIELDS:
+            for low, high in ((None, None), (2, 4), (3, 3), (None, 2), (25, None)):
+                expected = [record.id for record in live
+                            if (low is None or getattr(record, field) >= low) and (high is None or getattr(record, field) <= high)]
+                if candidate.ids_in_range(field, low, high) != expected:
+                    print(f"❌ {field} in [{low}, {high}] gave {candidate.ids_in_range(field, low, high)}, expected {expected}")
+                    return False
+            if not np.array_equal(candidate.columns[field], fresh.columns[field], equal_nan=True):
+                print(f"❌ The {field} column differs from a fresh build")
+                return False
+        for method in {method for record in live for method in record.brewing_methods}:
+            if candidate.ids_with_method(method) != [record.id for record in live if method in record.brewing_methods]:
+                print(f"❌ Products brewed by {method} are wrong")
+                return False
+        if candidate.ids_from_origin("peru") != [len(COFFEE_PRODUCTS)] or candidate.ids_from_origin("colombia"):
+            print(f"❌ Origin index: Peru {candidate.ids_from_origin('peru')}, Colombia {candidate.ids_from_origin('colombia')}")
+            return False
+    if len(changed) != 2 or [record.name for record in removed] != ["Colombian Supremo"] or len(updated) != len(live):
+        print(f"❌ Changed {len(changed)}, removed {removed}, {len(updated)} live")
+        return False
+    print(f"✅ Indexes of version {updated.version} match a scan of its {len(live)} products and a fresh build")
+    return True
+
+def test_similarity_search():
+    """Test that top-k retrieval with early termination returns what a brute-force cosine ranks first"""
+    print("\n🧪 Testing Similarity Search:")
+    import random
+    import numpy as np
+    from kopico_retrieval import SimilarityIndexWriter, term_ids
+    
+    # Words drawn with a skew, so common terms have postings long enough to be read a part at a time
+    rng = random.Random(4)
+    words = ["".join(rng.choice("bcdfghjklmnpqrstvwxz") + rng.choice("aeiou") for _ in range(3)) for _ in range(400)]
+    skew = [1.0 / (rank + 1) for rank in range(len(words))]
+    texts = [" ".join(rng.choices(words, skew, k=rng.randint(4, 12))) for _ in range(5000)]
+    index = SimilarityIndexWriter.fit(enumerate(texts)).publish()
+    
+    statistics = index.statistics
+    vectors = []
+    for text in texts:
+        ids, counts = term_ids(text)
+        vectors.append(dict(zip(ids.tolist(), statistics.weigh(ids, counts).tolist())))
+    queries = [" ".join(rng.choices(words, skew, k=rng.randint(1, 4))) for _ in range(40)]
+    batch = index.search_many(queries, k=5, threshold=0.1)
+    for query, batched in zip(queries, batch):
+        ids, counts = term_ids(query)
+        known = statistics.document_frequency[ids] > 0
+        weights = dict(zip(ids[known].tolist(), statistics.weigh(ids[known], counts[known]).tolist()))
+        scores = np.array([sum(weight * vector.get(term, 0.0) for term, weight in weights.items()) for vector in vectors])
+        expected = sorted(scores[scores > 0.1], reverse=True)[:5]
+        found = index.search(query, k=5, threshold=0.1)
+        # Compared by score, so products tied with the k-th one may stand in for each other
+        if not np.allclose(scores[found], expected) or not np.allclose(scores[batched], expected):
+            print(f"❌ {query!r}: scores {scores[found].round(4)}, batch {scores[batched].round(4)}, "
+                  f"expected {np.round(expected, 4)}")
+            return False
+    print(f"✅ {len(queries)} queries over {len(texts)} products ranked as a brute-force cosine ranks them")
+    return True
+
+def test_incremental_index():
+    """Test that index changes publish a new version without touching the old one, and compact to a fresh fit"""
+    print("\n🧪 Testing Incremental Index:")
+    from kopico_bot import COFFEE_PRODUCTS
+    from kopico_catalog import CoffeeCatalog
+    from kopico_retrieval import SimilarityIndexWriter
+    
+    catalog = CoffeeCatalog(COFFEE_PRODUCTS)
+    writer = SimilarityIndexWriter.fit((coffee.id, coffee.text) for coffee in catalog)
+    before = writer.publish()
+    removed = catalog.find_by_name("Italian Espresso Blend").id
+    added = len(catalog.records)
+    writer.upsert(added, "Kenyan Peaberry blackcurrant tomato juicy Kenya")
+    writer.remove(removed)
+    after = writer.publish()
+    
+    if after.version <= before.version or after.search("blackcurrant tomato") != [added]:
+        print(f"❌ Version {after.version} after {before.version}, blackcurrant found {after.search('blackcurrant tomato')}")
+        return False
+    if removed in after.search("bold intense dark roasted espresso", k=6) or before.search("blackcurrant tomato"):
+        print("❌ A removed product is still found, or the change showed in the version published before it")
+        return False
+    if removed not in before.search("bold intense dark roasted espresso", k=6):
+        print("❌ The version published before the removal lost the product")
+        return False
+    
+    # Compacted, the index weighs everything with current statistics, as a fresh fit does
+    writer.compact()
+    texts = [(coffee.id, coffee.text) for coffee in catalog if coffee.id != removed]
+    texts.append((added, "Kenyan Peaberry blackcurrant tomato juicy Kenya"))
+    fresh = SimilarityIndexWriter.fit(texts).publish()
+    compacted = writer.publish()
+    queries = ["chocolate nutty", "floral bright citrus", "smooth low acidity", "juicy Kenya", "spicy smoky"]
+    for query in queries:
+        if compacted.search(query, k=6, threshold=0.0) != fresh.search(query, k=6, threshold=0.0):
+            print(f"❌ {query!r}: compacted {compacted.search(query, k=6)}, fresh {fresh.search(query, k=6)}")
+            return False
+    print(f"✅ Changes published as version {after.version} without a refit; compacted index answers as a fresh fit")
+    return True
+
+def test_prebuilt_model():
+    """Test that a saved model is mapped at startup instead of refitted, and that a stale one is refitted"""
+    print("\n🧪 Testing Prebuilt Model:")
+    import io
+    import shutil
+    import tempfile
+    import subprocess
+    import contextlib
+    import numpy as np
+    from kopico_bot import KopicoAI, COFFEE_PRODUCTS, build_model
+    
+    # NLTK is only imported when text is first preprocessed, not with the module
+    probe = "import sys, kopico_bot; print(sorted(m for m in ('nltk', 'sklearn') if m in sys.modules))"
+    loaded = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True, cwd=Path(__file__).parent)
+    if loaded.stdout.strip() != "[]":
+        print(f"❌ Importing kopico_bot loaded {loaded.stdout.strip() or loaded.stderr[-200:]}")
+        return False
+    
+    directory = tempfile.mkdtemp(prefix="kopico-test-")
+    try:
+        build_model(COFFEE_PRODUCTS, directory)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            mapped = KopicoAI(products=COFFEE_PRODUCTS, model_path=directory)
+            changed = KopicoAI(products=COFFEE_PRODUCTS[:-1], model_path=directory)
+        fitted = KopicoAI(products=COFFEE_PRODUCTS)
+        if output.getvalue().count("No prebuilt model") != 1:
+            print(f"❌ Expected one refit, for the changed catalog: {output.getvalue()!r}")
+            return False
+        if not isinstance(mapped.index_writer.base.postings_ids.base, np.memmap):
+            print("❌ The prebuilt index was read into memory rather than mapped")
+            return False
+        queries = ["chocolate nutty", "floral bright", "bold espresso", "smooth cold brew"]
+        for query in queries:
+            ranked = [[coffee.id for coffee in bot.find_similar_coffee(query)] for bot in (mapped, fitted)]
+            if ranked[0] != ranked[1]:
+                print(f"❌ {query!r} ranked differently by the mapped and the fitted index")
+                return False
+        if len(changed.similarity_index) != len(COFFEE_PRODUCTS) - 1:
+            print(f"❌ The refitted index holds {len(changed.similarity_index)} products")
+            return False
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    print(f"✅ Prebuilt model mapped at startup and ranks {len(queries)} queries as a fitted one; stale model refitted")
+    return True
+
+def test_batch_chat():
+    """Test that a batch answers each message as a single request would, in order, one bad item at a time"""
+    print("\n🧪 Testing Batch Chat:")
+    import kopico_bot
+    from kopico_bot import KopicoAI, COFFEE_PRODUCTS, MAX_BATCH_MESSAGES
+    
+    messages = ["Recommend a fruity coffee", "How do I brew with a chemex?", "Tell me about Brazilian Santos",
+                "Recommend a fruity coffee", "Recommend something bold", "Something chocolatey please",
+                "yirgachefe", "What goes with a french press?"]
+    batch = KopicoAI(products=COFFEE_PRODUCTS)
+    single = KopicoAI(products=COFFEE_PRODUCTS)
+    intents = batch.detect_intents(messages)
+    if intents != [single.detect_intent(message) for message in messages]:
+        print(f"❌ Batch intents {intents} differ from one at a time")
+        return False
+    for message, intent, reply in zip(messages, intents, batch.process_messages(messages)):
+        # Greetings pick a template at random; every recommendation above has similar coffees to pick from
+        if intent in kopico_bot.CACHEABLE_INTENTS and reply != single.process_message(message):
+            print(f"❌ {message!r} answered differently in a batch")
+            return False
+    
+    client = kopico_bot.app.test_client()
+    answered = client.post('/chat/batch', json={'messages': [{'message': messages[0]}, {'message': '  '}, {'text': 1},
+                                                             {'message': messages[1]}]}).get_json()['results']
+    if [sorted(result) for result in answered] != [['response'], ['error'], ['error'], ['response']]:
+        print(f"❌ Batch results {answered}")
+        return False
+    too_many = client.post('/chat/batch', json={'messages': [{'message': 'hi'}] * (MAX_BATCH_MESSAGES + 1)})
+    if too_many.status_code != 400:
+        print(f"❌ A batch of {MAX_BATCH_MESSAGES + 1} answered {too_many.status_code}")
+        return False
+    print(f"✅ {len(messages)} messages answered in a batch as one at a time; bad items and oversized batches refused")
+    return True
+
+def test_production_options():
+    """Test the production launcher's options, and that exit handlers run in the launcher but not in its workers"""
+    print("\n🧪 Testing Production Options:")
+    import atexit
+    import start_kopico
+    from start_kopico import parse_args, bind_listener, local_url
+    
+    args = parse_args(['--production', '--workers', '3', '--threads', '2', '--max-requests', '50'])
+    if (args.production, args.workers, args.threads, args.max_requests) != (True, 3, 2, 50):
+        print(f"❌ Production options parsed as {args}")
+        return False
+    if parse_args([]).production or parse_args([]).graceful_timeout != 30:
+        print("❌ The launcher serves in production mode, or with another graceful timeout, by default")
+        return False
+    
+    # Workers are forked from the launcher, so they inherit its exit handlers but not its pid
+    calls = []
+    handlers = []
+    register = atexit.register
+    atexit.register = handlers.append
+    try:
+        start_kopico.at_launcher_exit(calls.append, 'stopped')
+    finally:
+        atexit.register = register
+    handlers[0]()
+    launcher_pid = start_kopico.LAUNCHER_PID
+    start_kopico.LAUNCHER_PID = launcher_pid + 1
+    try:
+        handlers[0]()
+    finally:
+        start_kopico.LAUNCHER_PID = launcher_pid
+    if calls != ['stopped']:
+        print(f"❌ The exit handler ran {len(calls)} times across the launcher and a worker")
+        return False
+    
+    listener = bind_listener('127.0.0.1', 0)
+    try:
+        if not listener.get_inheritable():
+            print("❌ Server processes cannot inherit the launcher's socket")
+            return False
+        port = listener.getsockname()[1]
+        urls = [local_url(host, port) for host in ('0.0.0.0', '::', '10.0.0.2')]
+        if urls != [f"http://127.0.0.1:{port}", f"http://[::1]:{port}", f"http://10.0.0.2:{port}"]:
+            print(f"❌ The launcher reaches its servers at {urls}")
+            return False
+    finally:
+        listener.close()
+    print("✅ Production options parsed; exit handlers skip workers; the shared socket is inheritable")
+    return True
+
+def test_chat_stream():
+    """Test that a streamed reply arrives in sections that join to the /chat reply, then a done event"""
+    print("\n🧪 Testing Chat Stream:")
+    import kopico_bot
+    from kopico_bot import KopicoAI, COFFEE_PRODUCTS
+    
+    message = "Recommend something chocolatey and nutty"
+    bot = KopicoAI(products=COFFEE_PRODUCTS)
+    sections = list(bot.stream_message(message))
+    if len(sections) < 3 or "".join(sections) != KopicoAI(products=COFFEE_PRODUCTS).process_message(message):
+        print(f"❌ Streamed {len(sections)} sections that do not join to the reply")
+        return False
+    # A cached reply has nothing left to wait for and arrives whole
+    if list(bot.stream_message(message)) != ["".join(sections)]:
+        print("❌ A cached reply was streamed in pieces")
+        return False
+    
+    client = kopico_bot.app.test_client()
+    response = client.post('/chat/stream', json={'message': message, 'user_id': 'stream-test'})
+    events = [block.split("\n", 1) for block in response.get_data(as_text=True).split("\n\n") if block]
+    names = [event[len("event: "):] for event, data in events]
+    payloads = [json.loads(data[len("data: "):]) for event, data in events]
+    if response.mimetype != 'text/event-stream' or names[-1] != 'done' or set(names[:-1]) != {'chunk'}:
+        print(f"❌ /chat/stream sent {response.mimetype} events {names}")
+        return False
+    if "".join(payload['text'] for payload in payloads[:-1]) != kopico_bot.get_kopico().process_message(message):
+        print("❌ /chat/stream sent another reply than /chat")
+        return False
+    if client.get('/chat/stream', query_string={'message': '  '}).status_code != 400:
+        print("❌ An empty message was streamed")
+        return False
+    print(f"✅ {len(sections)} sections streamed and joined to the reply; cached replies arrive whole")
+    return True
+
+def test_load_generator():
+    """Test the load generator against an in-process server, and the baseline regression check"""
+    print("\n🧪 Testing Load Generator:")
+    import logging
+    import threading
+    import kopico_bot
+    from werkzeug.serving import make_server
+    from bench_kopico import LOAD_REQUESTS, _client_process, compare_to_baseline
+    
+    # Every request comes from this host; rate limits are not under test, nor is the access log
+    admission = kopico_bot.admission
+    kopico_bot.admission = None
+    access_log = logging.getLogger('werkzeug')
+    access_log.disabled = True
+    server = make_server('127.0.0.1', 0, kopico_bot.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        latencies, errors = _client_process('127.0.0.1', server.port, 2, 1.0, LOAD_REQUESTS)
+    finally:
+        server.shutdown()
+        access_log.disabled = False
+        kopico_bot.admission = admission
+    missing = [endpoint for endpoint, timings in latencies.items() if not timings]
+    if missing or any(errors.values()):
+        print(f"❌ No timings for {missing}, errors {errors}")
+        return False
+    
+    baseline = {'chat.rps': 100, 'chat.p99_ms': 10, 'chat.errors': 0, 'batch.rps': 20, 'batch.p50_ms': 50}
+    metrics = {'chat.rps': 85, 'chat.p99_ms': 12, 'chat.errors': 1, 'batch.rps': 19, 'batch.p50_ms': 54, 'new.rps': 1}
+    regressions = [line.split(":")[0] for line in compare_to_baseline(metrics, baseline, 0.1)]
+    if regressions != ['chat.errors', 'chat.p99_ms', 'chat.rps']:
+        print(f"❌ Flagged {regressions} as regressions")
+        return False
+    recorded = json.loads(Path('bench_baseline.json').read_text())['metrics']
+    if compare_to_baseline(recorded, recorded, 0.0):
+        print("❌ The committed baseline regresses against itself")
+        return False
+    requests_made = sum(len(timings) for timings in latencies.values())
+    print(f"✅ {requests_made} requests over {len(latencies)} endpoints without errors; regressions flagged past tolerance")
+    return True
+
+def test_metrics_format():
+    """Test that metrics render in the Prometheus text format, here and on /metrics"""
+    print("\n🧪 Testing Metrics Format:")
+    import kopico_bot
+    from kopico_metrics import MetricsRegistry
+    
+    registry = MetricsRegistry()
+    requests_total = registry.counter('requests_total', 'Requests served', ('endpoint',))
+    latency = registry.histogram('latency_seconds', 'Request latency', buckets=(0.1, 1.0))
+    registry.add_collector(lambda: [('cache_entries', 'gauge', 'Cached replies', [({'cache': 'a"b'}, 3)])])
+    requests_total.inc('/chat')
+    requests_total.inc('/chat', amount=2)
+    for value in (0.05, 0.5, 0.5, 5.0):
+        latency.observe(value)
+    expected = "\n".join([
+        '# HELP requests_total Requests served',
+        '# TYPE requests_total counter',
+        'requests_total{endpoint="/chat"} 3',
+        '# HELP latency_seconds Request latency',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        'latency_seconds_sum 6.05',
+        'latency_seconds_count 4',
+        '# HELP cache_entries Cached replies',
+        '# TYPE cache_entries gauge',
+        'cache_entries{cache="a\\"b"} 3',
+    ]) + "\n"
+    if registry.render() != expected:
+        print(f"❌ Rendered:\n{registry.render()}")
+        return False
+    
+    response = kopico_bot.app.test_client().get('/metrics')
+    sample = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})? (-?[0-9.e+-]+|\+Inf|NaN)$')
+    typed = set()
+    for line in response.get_data(as_text=True).splitlines():
+        if line.startswith('# TYPE '):
+            typed.add(line.split()[2])
+            continue
+        if line.startswith('# HELP '):
+            continue
+        # Every sample follows the TYPE line of its metric; histograms add suffixes to the name
+        match = sample.match(line)
+        if match is None or not {match.group(1), re.sub(r'_(bucket|sum|count)$', '', match.group(1))} & typed:
+            print(f"❌ /metrics line {line!r} is not a sample of a typed metric")
+            return False
+    if not response.content_type.startswith('text/plain; version=0.0.4') or not typed:
+        print(f"❌ /metrics answered {response.content_type} with {len(typed)} metrics")
+        return False
+    print(f"✅ Counters, histograms and collectors rendered exactly; {len(typed)} metrics on /metrics well formed")
+    return True
+
+def test_reply_fragments():
+    """Test that a catalog change renders only the changed products' fragments and leaves older versions intact"""
+    print("\n🧪 Testing Reply Fragments:")
+    from kopico_bot import KopicoAI, COFFEE_PRODUCTS
+    from kopico_fragments import render_card, render_pick
+    
+    bot = KopicoAI(products=COFFEE_PRODUCTS)
+    before = bot.snapshot.fragments
+    changed, unchanged = (bot.catalog.find_by_name(product['name']) for product in COFFEE_PRODUCTS[:2])
+    bot.update_product(changed.name, {'price': 99})
+    after = bot.snapshot.fragments
+    if (after.cards[unchanged.id] is not before.cards[unchanged.id]
+            or after.picks[unchanged.id] is not before.picks[unchanged.id]):
+        print("❌ An unchanged product was rendered again")
+        return False
+    updated = bot.catalog[changed.id]
+    if after.card(updated) != render_card(updated) or "$99" not in after.pick(updated):
+        print("❌ The changed product kept its old fragments")
+        return False
+    # Replies still being formatted from the old version see the old price
+    if before.card(changed) != render_card(changed) or after.pick(changed) != render_pick(changed):
+        print("❌ The old version's fragments changed along with the catalog")
+        return False
+    
+    added = bot.add_product(dict(COFFEE_PRODUCTS[0], name="Fragment Test Lot", description="Fragment test lot"))
+    if after.cards is bot.snapshot.fragments.cards or "Fragment Test Lot" not in bot.snapshot.fragments.pick(added):
+        print("❌ A new product was not rendered into a new version")
+        return False
+    bot.remove_product("Fragment Test Lot")
+    if bot.snapshot.fragments.cards[added.id] is not None:
+        print("❌ A removed product kept its fragments")
+        return False
+    print("✅ Only changed products rendered again; older versions keep their own text")
+    return True
+
+def test_prepared_responses():
+    """Test that each encoding of a prepared response has its own ETag and answers 304 when it still matches"""
+    print("\n🧪 Testing Prepared Responses:")
+    import gzip
+    import kopico_bot
+    import kopico_responses
+    from kopico_responses import PreparedResponse, MIN_COMPRESS_BYTES
+    
+    client = kopico_bot.app.test_client()
+    url = '/coffees?sort=price&limit=20'
+    decompress = {'identity': bytes, 'gzip': gzip.decompress}
+    if kopico_responses.brotli is not None:
+        decompress['br'] = kopico_responses.brotli.decompress
+    encodings = list(decompress)
+    etags = {}
+    for encoding in encodings:
+        response = client.get(url, headers={'Accept-Encoding': encoding})
+        sent = response.headers.get('Content-Encoding', 'identity')
+        if sent != encoding or response.headers['Vary'] != 'Accept-Encoding':
+            print(f"❌ Asked for {encoding}, sent {sent}")
+            return False
+        body = decompress[encoding](response.get_data())
+        etags[encoding] = response.headers['ETag']
+        if encoding != 'identity' and body != client.get(url, headers={'Accept-Encoding': 'identity'}).get_data():
+            print(f"❌ The {encoding} body decodes to another body")
+            return False
+        revalidated = client.get(url, headers={'Accept-Encoding': encoding, 'If-None-Match': etags[encoding]})
+        if revalidated.status_code != 304 or revalidated.get_data():
+            print(f"❌ A matching {encoding} ETag answered {revalidated.status_code}")
+            return False
+    stale = client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': '"0123456789abcdef"'})
+    if len(set(etags.values())) != len(encodings) or stale.status_code != 200:
+        print(f"❌ ETags {etags}; a stale ETag answered {stale.status_code}")
+        return False
+    
+    small = PreparedResponse("x" * (MIN_COMPRESS_BYTES - 1))
+    large = PreparedResponse("x" * MIN_COMPRESS_BYTES)
+    if list(small.bodies) != ['identity'] or 'gzip' not in large.bodies or small.tag == large.tag:
+        print(f"❌ Stored encodings {list(small.bodies)} and {list(large.bodies)}")
+        return False
+    print(f"✅ {len(encodings)} encodings with their own ETags, each revalidated with a 304")
+    return True
+
+def test_text_pipeline():
+    """Test the tokenizer and memoized stemmer against NLTK's Porter stemmer, and the memo's bound"""
+    print("\n🧪 Testing Text Pipeline:")
+    from nltk.stem.porter import PorterStemmer
+    import kopico_text
+    from kopico_text import tokenize, stem, stem_text, stem_texts, index_terms, clear_stem_cache, stem_cache_size
+    from kopico_bot import COFFEE_PRODUCTS
+    
+    if tokenize("Pour-over, or pour_over? Top 10!") != ["pour", "over", "or", "pour", "over", "top", "10"]:
+        print(f"❌ Tokenized as {tokenize('Pour-over, or pour_over? Top 10!')}")
+        return False
+    
+    # Examples from Porter's paper, plus every word of the catalog
+    words = ("caresses ponies ties cats feed agreed plastered motoring conflated troubled sized hopping "
+             "falling hissing happy relational conditional valenci digitizer vietnamization decisiveness "
+             "hopefulness sensibiliti triplicate electrical goodness revival allowance adjustable "
+             "replacement adoption homologous effective bowdlerize generalizations controll roll").split()
+    for product in COFFEE_PRODUCTS:
+        words += tokenize(f"{product['name']} {product['description']}")
+    porter = PorterStemmer(PorterStemmer.ORIGINAL_ALGORITHM)
+    clear_stem_cache()
+    differ = [word for word in words if len(word) > 2 and word.isalpha() and stem(word) != porter.stem(word)]
+    if differ:
+        print(f"❌ Stems differ from NLTK's for {differ}")
+        return False
+    # Memoized stems are the same the second time round
+    if [stem(word) for word in words] != [porter.stem(word) if len(word) > 2 else word for word in words]:
+        print("❌ Memoized stems differ from fresh ones")
+        return False
+    
+    texts = ["How do I brew a pour-over?", "Tell me about Ethiopian coffee", "How do I brew a pour-over?"]
+    if stem_texts(texts) != [stem_text(text) for text in texts] or stem_text(texts[0]) != "how do i brew a pour over":
+        print(f"❌ Stemmed texts {stem_texts(texts)}")
+        return False
+    if index_terms("Tell me about a fruity, floral Ethiopian") != ["tell", "fruiti", "floral", "ethiopian"]:
+        print(f"❌ Index terms {index_terms('Tell me about a fruity, floral Ethiopian')}")
+        return False
+    
+    size = kopico_text.STEM_CACHE_SIZE
+    kopico_text.STEM_CACHE_SIZE = 8
+    try:
+        clear_stem_cache()
+        for word in words:
+            stem(word)
+        bounded = stem_cache_size()
+    finally:
+        kopico_text.STEM_CACHE_SIZE = size
+        clear_stem_cache()
+    if not 0 < bounded <= 8:
+        print(f"❌ A memo bounded at 8 stems holds {bounded}")
+        return False
+    print(f"✅ {len(words)} words stemmed as NLTK's Porter stemmer does; the memo stays bounded")
+    return True
+
+def test_product_intents():
+    """Test that names and origins, exact or misspelt, make product questions, and everyday words do not"""
+    print("\n🧪 Testing Product Intents:")
+    from kopico_bot import KopicoAI, COFFEE_PRODUCTS
+    
+    bot = KopicoAI(products=COFFEE_PRODUCTS)
+    cards = {
+        "colombia coffee": "Colombian Supremo", "brazil": "Brazilian Santos", "Colombia?": "Colombian Supremo",
+        "house blend": "House Special Blend", "Tell me about Ethiopian coffee": "Ethiopian Yirgacheffe"
+    }
+    for message, name in cards.items():
+        reply = bot.process_message(message)
+        if bot.detect_intent(message) != "product" or not reply.startswith(f"**{name}**"):
+            print(f"❌ {message!r} ({bot.detect_intent(message)}) -> {reply[:60]!r}")
+            return False
+    
+    reply = bot.process_message("colombai coffee")
+    if not reply.startswith("Did you mean **Colombian Supremo**"):
+        print(f"❌ A misspelt origin was not answered as a guess: {reply[:60]!r}")
+        return False
+    
+    # Everyday words in product names name no product, nor does a country meant as a place
+    for message in ("Do you have any special offers?", "Is the shop open in the house district?",
+                    "I want to visit Brazil", "I want to travel to colombai"):
+        if bot.detect_intent(message) != "default":
+            print(f"❌ {message!r} detected as {bot.detect_intent(message)}")
+            return False
+    print(f"✅ {len(cards)} names and origins answered with their card, a typo with a guess; "
+          f"everyday words and places name no coffee")
+    return True
+
+def test_client_address():
+    """Test that rate limits see the client behind a trusted proxy, and only behind a trusted one"""
+    print("\n🧪 Testing Client Addresses:")
+    import kopico_bot
+    
+    cases = (
+        ('127.0.0.1', '', '127.0.0.1'),
+        ('10.0.0.5', '198.51.100.7', '10.0.0.5'),
+        ('10.0.0.1', '198.51.100.7', '198.51.100.7'),
+        ('10.0.0.1', '203.0.113.9, 198.51.100.7, 10.0.0.2', '198.51.100.7'),
+        ('10.0.0.1', '', '10.0.0.1')
+    )
+    previous = kopico_bot.TRUSTED_PROXIES
+    kopico_bot.TRUSTED_PROXIES = frozenset(('10.0.0.1', '10.0.0.2'))
+    try:
+        for remote, forwarded, expected in cases:
+            headers = {'X-Forwarded-For': forwarded} if forwarded else {}
+            with kopico_bot.app.test_request_context('/chat', headers=headers, environ_base={'REMOTE_ADDR': remote}):
+                address = kopico_bot.client_address()
+            if address != expected:
+                print(f"❌ {remote} forwarding {forwarded!r} was taken for {address}, expected {expected}")
+                return False
+    finally:
+        kopico_bot.TRUSTED_PROXIES = previous
+    print(f"✅ {len(cases)} requests traced back through trusted proxies only")
+    return True
+
+def test_session_server():
+    """Test that a malformed command gets an error reply and leaves the connection usable"""
+    print("\n🧪 Testing Session Server:")
+    import socket
+    import threading
+    from kopico_sessions import SessionServer, LocalSessionStore
+    
+    server = SessionServer(('127.0.0.1', 0), LocalSessionStore(100))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    frames = (
+        (b"*3\r\n$3\r\nSET\r\n$2\r\n\xff\xfe\r\n$1\r\nv\r\n", b"-ERR"),
+        (b"*5\r\n$3\r\nSET\r\n$1\r\nk\r\n$1\r\nv\r\n$2\r\nPX\r\n$4\r\nsoon\r\n", b"-ERR"),
+        (b"*2\r\n$3\r\nGET\r\n:1\r\n", b"-ERR"),
+        (b"*3\r\n$3\r\nSET\r\n$1\r\nk\r\n$1\r\nv\r\n", b"+OK"),
+        (b"*1\r\n$4\r\nPING\r\n", b"+PONG")
+    )
+    try:
+        with socket.create_connection(server.server_address, timeout=5) as connection:
+            replies = connection.makefile('rb')
+            for frame, expected in frames:
+                connection.sendall(frame)
+                reply = replies.readline()
+                if not reply.startswith(expected):
+                    print(f"❌ {frame!r} answered {reply!r}, expected {expected!r}")
+                    return False
+    except OSError as e:
+        print(f"❌ Session server connection error: {e}")
+        return False
+    finally:
+        server.shutdown()
+        server.server_close()
+    print(f"✅ {len(frames)} commands on one connection, malformed ones refused with -ERR")
+    return True
+
+def test_shared_also_bought():
+    """Test that worker processes sharing an event journal rank the same also-bought neighbours"""
+    print("\n🧪 Testing Shared Also Bought:")
+    import os
+    import random
+    import shutil
+    import tempfile
+    from kopico_cooccurrence import CoOccurrence
+    
+    directory = tempfile.mkdtemp(prefix="kopico-test-")
+    try:
+        # Two matrices on one journal stand in for two workers; a small journal is snapshotted often
+        workers = [CoOccurrence(refresh_interval=3600, journal=directory, journal_bytes=4096) for _ in range(2)]
+        rng = random.Random(7)
+        products = [f"coffee {i}" for i in range(30)]
+        for i in range(400):
+            basket = rng.sample(products, rng.randint(2, 4))
+            if i % 3:
+                workers[i % 2].record("order", basket)
+            else:
+                workers[i % 2].record("cart", basket[1:], added=basket[0])
+            if i % 50 == 49:
+                workers[i // 50 % 2].refresh()
+        for worker in workers:
+            worker.refresh()
+        # A worker started later picks the counts up from the latest snapshot and what followed it
+        workers.append(CoOccurrence(refresh_interval=3600, journal=directory, journal_bytes=4096))
+        workers[-1].refresh()
+        
+        lists = [[worker.neighbors(product) for product in products] for worker in workers]
+        if lists[0] != lists[1] or lists[0] != lists[2] or not any(lists[0]):
+            print("❌ Workers sharing a journal rank different neighbours")
+            return False
+        snapshots = [name for name in os.listdir(directory) if name.startswith("snapshot-")]
+        if not snapshots or os.path.getsize(os.path.join(directory, "events.jsonl")) > 4096 * 2:
+            print(f"❌ The journal was not folded into a snapshot ({len(snapshots)} snapshots)")
+            return False
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    print(f"✅ {len(workers)} workers agree on {sum(1 for ranked in lists[0] if ranked)} neighbour lists "
+          f"across {len(snapshots)} snapshots")
+    return True
+
+def test_response_cache():
+    """Test that every miss is counted, and that identical streamed messages are computed once"""
+    print("\n🧪 Testing Response Cache:")
+    import threading
+    from kopico_bot import KopicoAI, COFFEE_PRODUCTS
+    
+    bot = KopicoAI(products=COFFEE_PRODUCTS)
+    cache = bot.response_cache
+    bot.process_messages(["Can you recommend a strong coffee?", "How do I brew pour-over coffee?"] * 2)
+    if (cache.hits, cache.misses) != (0, 2):
+        print(f"❌ A batch of 2 distinct messages counted {cache.hits} hits, {cache.misses} misses")
+        return False
+    if cache.get("never cached") is not None or cache.misses != 3:
+        print(f"❌ A miss of get() was not counted: {cache.stats()}")
+        return False
+    
+    # A second identical stream started while the first is half-way waits for its reply
+    message = "Can you recommend a smooth coffee with chocolate notes?"
+    first = bot.stream_message(message)
+    head = next(first)
+    second = []
+    follower = threading.Thread(target=lambda: second.extend(bot.stream_message(message)))
+    follower.start()
+    time.sleep(0.2)
+    rest = "".join(first)
+    follower.join()
+    if "".join(second) != head + rest or cache.coalesced != 1:
+        print(f"❌ Concurrent streams: coalesced {cache.coalesced}, replies differ: {second != [head + rest]}")
+        return False
+    
+    # A stream its client abandons leaves the reply to the next request
+    abandoned = bot.stream_message("Can you suggest a fruity coffee?")
+    next(abandoned)
+    abandoned.close()
+    if cache._flights or not bot.process_message("Can you suggest a fruity coffee?"):
+        print("❌ An abandoned stream left its computation behind")
+        return False
+    print(f"✅ Hits and misses counted ({cache.hits}/{cache.misses}); 2 identical streams computed once")
+    return True
+
+def test_shared_segments():
+    """Test that a catalog change made by one worker process reaches another through shared segments"""
+    print("\n🧪 Testing Shared Segments:")
+    import tempfile
+    from kopico_bot import KopicoAI, COFFEE_PRODUCTS
+    from kopico_segments import SegmentStore
+    
+    store = SegmentStore(tempfile.mkdtemp(prefix="kopico-test-"))
+    try:
+        # Two bots on one store stand in for two forked workers
+        first = KopicoAI(products=COFFEE_PRODUCTS, segments=store)
+        second = KopicoAI(products=COFFEE_PRODUCTS, segments=store)
+        first.add_product(dict(COFFEE_PRODUCTS[0], name="Segment Test Lot", description="Honey sweet test lot"))
+        first.update_product(COFFEE_PRODUCTS[1]['name'], {'price': 99})
+        
+        second.sync_segments(force=True)
+        if second.segment_version != first.segment_version:
+            print(f"❌ Second worker at version {second.segment_version}, first at {first.segment_version}")
+            return False
+        message = "tell me about Segment Test Lot"
+        if second.process_message(message) != first.process_message(message):
+            print("❌ Workers answer differently after syncing")
+            return False
+        if second.catalog.find_by_name(COFFEE_PRODUCTS[1]['name']).price != 99:
+            print("❌ Price change did not reach the second worker")
+            return False
+        if second.index_writer.base.postings_ids.flags.owndata:
+            print("❌ The index of the second worker is not mapped from the segment")
+            return False
+        
+        # Loading another catalog starts the journal afresh
+        KopicoAI(products=COFFEE_PRODUCTS[:3], segments=store)
+        journal = store.records_since(0)
+        if len(journal) != 1 or 'load' not in journal[0][1]:
+            print(f"❌ Journal after a new load: {journal}")
+            return False
+        print(f"✅ Both workers at segment version {second.segment_version} with the same answers; "
+              f"a new load compacts the journal")
+        return True
+    finally:
+        store.remove()
+
+def test_catalog_source():
+    """Test loading the catalog from a JSONL feed, rejecting bad rows, and reloading it on demand and when it changes"""
+    print("\n🧪 Testing Catalog Source:")
+    import os
+    import json
+    import tempfile
+    import kopico_bot
+    from kopico_bot import KopicoAI, COFFEE_PRODUCTS
+    from kopico_sources import CatalogSource
+    
+    # Watchers read the interval as they go; a short one keeps the test short
+    previous = kopico_bot.SOURCE_CHECK_INTERVAL
+    kopico_bot.SOURCE_CHECK_INTERVAL = 0.2
+    try:
+        with tempfile.TemporaryDirectory(prefix="kopico-test-") as directory:
+            path = os.path.join(directory, "feed.jsonl")
+            with open(path, "w", encoding="utf-8") as f:
+                for product in COFFEE_PRODUCTS:
+                    f.write(json.dumps(product) + "\n")
+                f.write('{"name": "Broken Row"\n')
+                f.write(json.dumps(dict(COFFEE_PRODUCTS[0], name="No Price", price="free")) + "\n")
+        
+            bot = KopicoAI(source=CatalogSource(path))
+            report = bot.source_report
+            if len(bot.catalog) != len(COFFEE_PRODUCTS) or report['rejected'] != 2:
+                print(f"❌ Loaded {len(bot.catalog)} products, rejected {report['rejected']} rows")
+                return False
+        
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(dict(COFFEE_PRODUCTS[0], name="Reloaded Geisha", description="Jasmine test lot")) + "\n")
+            old = bot.snapshot
+            bot.reload_catalog(wait=True)
+            if bot.reload_error is not None or bot.catalog.find_by_name("Reloaded Geisha") is None:
+                print(f"❌ Reload did not pick up the new product: {bot.reload_error}")
+                return False
+            if old.catalog.find_by_name("Reloaded Geisha") is not None:
+                print("❌ The snapshot served before the reload was changed")
+                return False
+            if "Reloaded Geisha" not in bot.process_message("tell me about Reloaded Geisha"):
+                print("❌ The reloaded product is not answered")
+                return False
+        
+            # A feed renamed into place is picked up by the watcher, with no request or reload call
+            staging = os.path.join(directory, "feed.jsonl.tmp")
+            with open(path, encoding="utf-8") as source, open(staging, "w", encoding="utf-8") as f:
+                f.write(source.read() + json.dumps(dict(COFFEE_PRODUCTS[0], name="Watched Lot")) + "\n")
+            settled = time.time() - 10
+            os.utime(staging, (settled, settled))
+            os.replace(staging, path)
+            deadline = time.monotonic() + 30
+            while bot.catalog.find_by_name("Watched Lot") is None and time.monotonic() < deadline:
+                time.sleep(0.1)
+            if bot.catalog.find_by_name("Watched Lot") is None:
+                print("❌ A changed feed was not reloaded by the source watcher")
+                return False
+        
+            os.remove(path)
+            bot.reload_catalog(wait=True)
+            if bot.reload_error is None or bot.catalog.find_by_name("Reloaded Geisha") is None:
+                print("❌ A failed reload did not keep the current catalog")
+                return False
+            print(f"✅ Loaded {report['accepted']} products ({report['rejected']} rows rejected), "
+                  f"reloaded to version {bot.snapshot.version}")
+            return True
+    finally:
+        kopico_bot.SOURCE_CHECK_INTERVAL = previous
+
+def run_performance_test(duration=5):
+    """Load test the running backend and report latency percentiles per endpoint"""
+    print("\n🧪 Testing Performance:")
+    
+    # The load generator lives with the benchmarks; see bench_kopico.py for
+    # microbenchmarks and baseline comparisons
+    from bench_kopico import load_test
+    
+    try:
+        # Every request comes from this host, so per-address limits would refuse most of them
+        admission = requests.get('http://localhost:5000/health', timeout=5).json().get('admission')
+        if admission and admission.get('addresses'):
+            print("⚠️  Per-address rate limits are on; start the server with KOPICO_ADDRESS_RATE=0 to load test it, skipping")
+            return
+        report = load_test('localhost', 5000, duration=duration, processes=2, threads=4)
+    except Exception as e:
         print(f"❌ Performance test error: {e}")
+        return
+    
+    for endpoint, stats in report.items():
+        line = (f"{endpoint}: {stats['rps']:.0f} req/s, p50 {stats['p50_ms']:.1f}ms, "
+                f"p95 {stats['p95_ms']:.1f}ms, p99 {stats['p99_ms']:.1f}ms, errors {stats['errors']}")
+        if stats['errors'] or not stats['requests']:
+            print(f"❌ {line}")
+        elif stats['p99_ms'] < 200:
+            print(f"✅ {line}")
+        else:
+            print(f"⚠️  {line}")
+
+def test_event_log():
+    """Test that chat, recommendation and guide requests are logged, and that a full buffer drops events"""
+    print("\n🧪 Testing Event Log:")
+    import tempfile
+    import kopico_bot
+    from kopico_eventlog import EventLog, read_events
+    
+    with tempfile.TemporaryDirectory(prefix="kopico-test-") as directory:
+        previous = kopico_bot.event_log
+        kopico_bot.event_log = EventLog(directory)
+        try:
+            client = kopico_bot.app.test_client()
+            client.post('/chat', json={'message': 'Can you recommend a strong coffee?'})
+            client.post('/coffee-recommendations', json={'preferences': {'strength': 4}})
+            client.get('/brewing-guide/espresso')
+            client.get('/health')
+            kopico_bot.event_log.close()
+        finally:
+            kopico_bot.event_log = previous
+        events = list(read_events(directory))
+        
+        if [event['endpoint'] for event in events] != ['/chat', '/coffee-recommendations', '/brewing-guide/<method>']:
+            print(f"❌ Logged {[event['endpoint'] for event in events]}")
+            return False
+        if events[0].get('intent') != 'recommend' or not events[0].get('products') or 'ms' not in events[0]:
+            print(f"❌ Chat event: {events[0]}")
+            return False
+        
+        full = EventLog(directory, capacity=4)
+        with full._write_lock:
+            accepted = sum(full.emit((0, '/chat', 200, 1.0, 'test', None, None)) for _ in range(10))
+        if accepted != 4 or full.dropped != 6:
+            print(f"❌ A full buffer accepted {accepted} events and dropped {full.dropped}")
+            return False
+        full.close()
+        print(f"✅ {len(events)} requests logged; a full buffer dropped {full.dropped} events without waiting")
+        return True
+
+def test_analytics():
+    """Test that /analytics counts requests, intents and recommended products, and that old minutes leave the window"""
+    print("\n🧪 Testing Analytics:")
+    import random
+    import kopico_bot
+    from kopico_analytics import RollingStats, LatencySketch, bucket_index
+    
+    now = [time.time()]
+    previous = kopico_bot.analytics
+    kopico_bot.analytics = RollingStats(minutes=5, max_age=0, clock=lambda: now[0])
+    try:
+        client = kopico_bot.app.test_client()
+        client.post('/chat', json={'message': 'Can you recommend a strong coffee?'})
+        client.post('/chat', json={'message': 'Hello!'})
+        client.post('/coffee-recommendations', json={'preferences': {'strength': 4}})
+        client.get('/health')
+        snapshot = client.get('/analytics').get_json()
+        stream = client.get('/analytics/stream')
+        pushed = b"".join(next(stream.response) for _ in range(2)).decode()
+        stream.close()
+        now[0] += 6 * 60
+        expired = client.get('/analytics').get_json()
+    finally:
+        kopico_bot.analytics = previous
+    
+    if snapshot['requests'] != 3 or snapshot['intents'] != {'recommend': 1, 'greeting': 1}:
+        print(f"❌ Counted {snapshot['requests']} requests, intents {snapshot['intents']}")
+        return False
+    if not snapshot['top_products'] or snapshot['latency']['/chat']['requests'] != 2:
+        print(f"❌ Products {snapshot['top_products']}, latency {snapshot['latency']}")
+        return False
+    if 'event: analytics' not in pushed:
+        print(f"❌ Stream sent {pushed[:200]!r}")
+        return False
+    if expired['requests'] or expired['intents'] or expired['top_products'] or expired['latency']:
+        print(f"❌ Minutes past the window still counted: {expired}")
+        return False
+    
+    # Sketches merged from halves answer as one built from everything, within the accuracy
+    latencies = [random.lognormvariate(3, 1) for _ in range(10000)]
+    halves = LatencySketch(), LatencySketch()
+    for i, ms in enumerate(latencies):
+        halves[i % 2].add(bucket_index(ms))
+    halves[0].merge(halves[1])
+    latencies.sort()
+    for estimate, fraction in zip(halves[0].quantiles([0.5, 0.99]), (0.5, 0.99)):
+        exact = latencies[int(fraction * (len(latencies) - 1))]
+        if abs(estimate - exact) > 0.03 * exact:
+            print(f"❌ p{int(fraction * 100)} estimated {estimate}, exactly {exact:.2f}")
+            return False
+    print(f"✅ {snapshot['requests']} requests counted, pushed over the stream and expired; merged sketch within 3%")
+    return True
+
+def test_rolling_restart():
+    """Test the probes, and that a rolling restart neither refuses nor drops a request"""
+    print("\n🧪 Testing Rolling Restart:")
+    import os
+    import threading
+    import subprocess
+    import kopico_bot
+    from start_kopico import bind_listener, start_server_process, wait_until_ready, stop_server
+    
+    client = kopico_bot.app.test_client()
+    live = client.get('/health/live')
+    ready = client.get('/health/ready')
+    if live.status_code != 200 or ready.status_code not in (200, 503):
+        print(f"❌ /health/live answered {live.status_code}, /health/ready {ready.status_code}")
+        return False
+    kopico_bot.warm_up()
+    ready = client.get('/health/ready')
+    if ready.status_code != 200 or ready.get_json()['warmup']['failed']:
+        print(f"❌ After warming up /health/ready answered {ready.status_code}: {ready.get_json()}")
+        return False
+    
+    port = 5056
+    url = f"http://127.0.0.1:{port}"
+    listener = bind_listener('127.0.0.1', port)
+    # The load comes from this host alone, so only the restart may refuse a request
+    quiet = {'stdout': subprocess.DEVNULL, 'stderr': subprocess.DEVNULL,
+             'env': dict(os.environ, KOPICO_ADDRESS_RATE='0')}
+    server = start_server_process(listener, **quiet)
+    results = []
+    stop = threading.Event()
+    
+    def load():
+        while not stop.is_set():
+            try:
+                response = requests.post(f"{url}/chat", json={'message': 'Can you recommend a strong coffee?'}, timeout=30)
+                results.append(response.status_code)
+            except requests.RequestException as e:
+                results.append(type(e).__name__)
+    
+    try:
+        if not wait_until_ready(url, server):
+            print("❌ The first server never became ready")
+            return False
+        threads = [threading.Thread(target=load) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        time.sleep(1)
+        new = start_server_process(listener, **quiet)
+        if not wait_until_ready(url, new, pid=new.pid):
+            print("❌ The new server never became ready")
+            stop.set()
+            stop_server(new)
+            return False
+        stop_server(server)
+        server = new
+        time.sleep(1)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        stop.set()
+        stop_server(server)
+        listener.close()
+    
+    failed = [result for result in results if result != 200]
+    if failed or not results:
+        print(f"❌ {len(failed)} of {len(results)} requests failed across the restart: {failed[:5]}")
+        return False
+    print(f"✅ Probes answer; {len(results)} requests served across a rolling restart, none failed")
+    return True
 
 def main():
     """Run all tests"""
@@ -197,6 +1389,30 @@ def main():
         print("\n❌ Frontend files missing. Please ensure all files are in place.")
         return
     
+    test_phrase_matcher()
+    test_catalog_indexes()
+    test_similarity_search()
+    test_incremental_index()
+    test_prebuilt_model()
+    test_batch_chat()
+    test_production_options()
+    test_chat_stream()
+    test_load_generator()
+    test_metrics_format()
+    test_reply_fragments()
+    test_prepared_responses()
+    test_text_pipeline()
+    test_product_intents()
+    test_client_address()
+    test_session_server()
+    test_response_cache()
+    test_shared_segments()
+    test_shared_also_bought()
+    test_catalog_source()
+    test_event_log()
+    test_analytics()
+    test_rolling_restart()
+    
     # Test backend
     print("\n🔌 Testing Backend Connection...")
     if not test_backend_health():
@@ -210,6 +1426,11 @@ def main():
     test_chat_endpoint()
     test_recommendations_endpoint()
     test_ai_intelligence()
+    test_session_followup()
+    test_coffee_search()
+    test_fuzzy_lookup()
+    test_also_bought()
+    test_rate_limit()
     run_performance_test()
     
     print("\n🎉 Test Suite Complete!")